@@ -0,0 +1,137 @@
+"""
+地址改写吞吐基准
+生成指定大小的合成抓包，分别测量:
+  copy   顺序读写同一文件 (磁盘吞吐上限参考)
+  cold   首次改写 (含服务端地址推断、逐包改写、校验和修正与哈希计算)
+  warm   相同规则再次请求 (命中改写缓存)
+用法 (在 backend 目录下):
+  python -m benchmarks.bench_rewrite --size-mb 2048
+  python -m benchmarks.bench_rewrite --size-mb 512 --json
+"""
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+
+import dpkt
+
+from services.pcap_rewriter import PCAPRewriter, RewriteRules
+
+SERVER_IP = "192.168.1.10"
+TARGET_IP = "172.20.0.50"
+TARGET_MAC = "02:42:ac:14:00:32"
+
+
+def _build_block(packets: int = 2000, seed: int = 7):
+    """一组混合报文：TCP 双向会话 (含握手)、DNS/UDP 以及与服务端无关的背景流量"""
+    rng = random.Random(seed)
+    server = socket.inet_aton(SERVER_IP)
+    records = []
+    for i in range(packets):
+        client = socket.inet_aton(f"10.0.{i % 16}.{i % 200 + 2}")
+        kind = rng.random()
+        if kind < 0.7:
+            tcp = dpkt.tcp.TCP(
+                sport=40000 + i % 1000,
+                dport=80,
+                flags=dpkt.tcp.TH_SYN if i % 50 == 1 else dpkt.tcp.TH_ACK,
+                data=os.urandom(rng.choice((0, 64, 512, 1400))),
+            )
+            src, dst = (client, server) if i % 2 else (server, client)
+            ip = dpkt.ip.IP(src=src, dst=dst, p=dpkt.ip.IP_PROTO_TCP, data=tcp)
+        elif kind < 0.85:
+            udp = dpkt.udp.UDP(sport=53000 + i % 100, dport=53, data=os.urandom(rng.randint(30, 120)))
+            ip = dpkt.ip.IP(src=client, dst=server, p=dpkt.ip.IP_PROTO_UDP, data=udp)
+        else:
+            udp = dpkt.udp.UDP(sport=123, dport=123, data=os.urandom(48))
+            ip = dpkt.ip.IP(src=client, dst=socket.inet_aton("8.8.8.8"), p=dpkt.ip.IP_PROTO_UDP, data=udp)
+        eth = dpkt.ethernet.Ethernet(
+            src=b"\x02\x00\x00\x00\x00\x01", dst=b"\x02\x00\x00\x00\x00\x02", data=ip
+        )
+        records.append(bytes(eth))
+    return records
+
+
+def generate(path: str, size_mb: int) -> int:
+    """重复写入同一组报文直到达到目标大小，返回包数"""
+    block = _build_block()
+    target = size_mb * 1024 * 1024
+    count, ts = 0, 1_700_000_000.0
+    with open(path, "wb", buffering=1024 * 1024) as f:
+        writer = dpkt.pcap.Writer(f, snaplen=65535)
+        while f.tell() < target:
+            for buf in block:
+                writer.writepkt(buf, ts=ts)
+                ts += 0.0001
+            count += len(block)
+    return count
+
+
+def _timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def run(size_mb: int, workdir: str) -> dict:
+    pcap = os.path.join(workdir, "bench.pcap")
+    packets = generate(pcap, size_mb)
+    size = os.path.getsize(pcap)
+
+    copy_seconds, _ = _timed(lambda: shutil.copyfile(pcap, os.path.join(workdir, "copy.pcap")))
+    os.remove(os.path.join(workdir, "copy.pcap"))
+
+    rewriter = PCAPRewriter(pcap, "0" * 64, cache_dir=os.path.join(workdir, "cache"))
+    rules = RewriteRules(target_ip=TARGET_IP, target_mac=TARGET_MAC)
+    cold_seconds, cold = _timed(lambda: rewriter.rewrite(rules))
+    warm_seconds, warm = _timed(lambda: rewriter.rewrite(rules))
+    assert warm["cached"] and warm["sha256"] == cold["sha256"]
+
+    def stage(seconds):
+        return {
+            "seconds": round(seconds, 3),
+            "mb_per_s": round(size / 1024 / 1024 / seconds, 1),
+            "mpps": round(packets / seconds / 1e6, 3),
+        }
+
+    return {
+        "file_mb": round(size / 1024 / 1024, 1),
+        "packets": packets,
+        "rewritten": cold["rewritten"],
+        "ip_map": cold["ip_map"],
+        "copy": stage(copy_seconds),
+        "cold": stage(cold_seconds),
+        "warm": {"seconds": round(warm_seconds, 4)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PCAP address rewrite throughput benchmark")
+    parser.add_argument("--size-mb", type=int, default=1024, help="合成抓包大小 (MB)")
+    parser.add_argument("--workdir", default=None, help="临时文件目录 (默认系统临时目录)")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-rewrite-", dir=args.workdir)
+    try:
+        result = run(args.size_mb, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print(f"file     {result['file_mb']} MB, {result['packets']} packets ({result['rewritten']} rewritten)")
+    print(f"map      {result['ip_map']}")
+    for name in ("copy", "cold"):
+        r = result[name]
+        print(f"{name:<8} {r['seconds']:>8.3f}s  {r['mb_per_s']:>8.1f} MB/s  {r['mpps']:>6.3f} Mpps")
+    print(f"warm     {result['warm']['seconds']:>8.4f}s  (cache hit)")
+
+
+if __name__ == "__main__":
+    main()
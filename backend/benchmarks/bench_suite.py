@@ -0,0 +1,345 @@
+"""
+解析 / 分析 / 重放准备路径的吞吐基准套件
+对每个规模 (默认 1 万、10 万、100 万包) 生成确定性的合成抓包，逐阶段测量:
+  parse_basic     PCAPParser.get_basic_info (上传时的计数与时长统计)
+  parse_detailed  PCAPParser.get_detailed_info
+  file_hash       PCAPParser.get_file_hash (上传与沙箱缓存键)
+  analyze         TrafficAnalyzer.full_analysis (含全量会话迭代)
+  index           包偏移索引构建 (重放子集的前置步骤)
+  subset          按过滤表达式提取子集 (复用上一步的索引)
+  rewrite         重放前的地址改写
+每个阶段在独立子进程中运行，报告耗时、包/秒、MB/秒与峰值 RSS。
+指定 --api 时另对运行中的服务测量上传、分析与各查询接口的延迟。
+结果保存为 JSON (默认 results/benchmarks/)，--compare 可与旧结果逐项对比。
+
+用法 (在 backend 目录下):
+  python -m benchmarks.bench_suite
+  python -m benchmarks.bench_suite --packets 10000 1000000 50000000 --formats pcap pcapng
+  python -m benchmarks.bench_suite --packets 100000 --api http://127.0.0.1:8000 --compare old.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.synthetic import FORMATS, TrafficProfile, generate, parse_mix
+
+STAGES = ("parse_basic", "parse_detailed", "file_hash", "analyze", "index", "subset", "rewrite")
+DEFAULT_PACKETS = (10000, 100000, 1000000)
+RESULTS_DIR = Path("results/benchmarks")
+
+SUBSET_FILTER = "tcp and port 80"
+REWRITE_TARGET = "172.20.0.50"
+
+# --api 模式下重复请求的查询接口 ({id} 为上传得到的 file_id)
+API_QUERIES = (
+    "/api/pcap/{id}/info",
+    "/api/analysis/{id}/statistics",
+    "/api/analysis/{id}/timeline",
+    "/api/analysis/{id}/attack-path",
+    "/api/analysis/{id}/flows?limit=100",
+    "/api/analysis/{id}/flows?limit=100&protocol=TCP&sort=bytes",
+    "/api/analysis/{id}/alerts?limit=100",
+)
+
+
+def _peak_rss_mb() -> float:
+    # Linux 上 ru_maxrss 单位为 KiB，macOS 为字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _run_stage(stage: str, path: str, workdir: str) -> Dict[str, Any]:
+    """在子进程中执行单个阶段 (峰值 RSS 只反映该阶段)"""
+    from services.pcap_parser import PCAPParser
+    from services.traffic_analyzer import TrafficAnalyzer
+    from services.packet_filter import PacketSelection
+    from services.packet_index import PacketIndex, SubsetExtractor
+    from services.pcap_rewriter import PCAPRewriter, RewriteRules
+
+    file_hash = hashlib.sha256(path.encode("utf-8")).hexdigest()  # 仅作索引/缓存键
+    index_dir = Path(workdir) / "index"
+    baseline = _peak_rss_mb()
+    started = time.perf_counter()
+
+    if stage == "parse_basic":
+        detail = {"packets": PCAPParser(path).get_basic_info()["total_packets"]}
+    elif stage == "parse_detailed":
+        info = PCAPParser(path).get_detailed_info()
+        detail = {"protocols": info["protocols"]}
+    elif stage == "file_hash":
+        detail = {"sha256": PCAPParser(path).get_file_hash()[:16]}
+    elif stage == "analyze":
+        flows = []
+        result = TrafficAnalyzer(path).full_analysis(on_flows=lambda rows: flows.append(sum(1 for _ in rows)))
+        detail = {"flows": sum(flows), "alerts": result["statistics"]["total_threats"]}
+    elif stage == "index":
+        with PacketIndex.open(path, file_hash, index_dir) as index:
+            detail = {"indexed_flows": len(index.meta["flows"])}
+        detail["index_mb"] = round(sum(f.stat().st_size for f in index_dir.iterdir()) / 1024 / 1024, 1)
+    elif stage == "subset":
+        subset = SubsetExtractor(
+            path, file_hash, index_dir=index_dir, cache_dir=Path(workdir) / "subset"
+        ).extract(PacketSelection(SUBSET_FILTER))
+        detail = {"selected": subset["packets"], "filter": SUBSET_FILTER}
+    elif stage == "rewrite":
+        result = PCAPRewriter(path, file_hash, cache_dir=Path(workdir) / "rewrite").rewrite(
+            RewriteRules(target_ip=REWRITE_TARGET)
+        )
+        detail = {"rewritten": result["rewritten"]}
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {
+        "seconds": time.perf_counter() - started,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": _peak_rss_mb(),
+        "detail": detail,
+    }
+
+
+def _stage_result(raw: Dict[str, Any], packets: int, size: int) -> Dict[str, Any]:
+    seconds = max(raw["seconds"], 1e-9)
+    return {
+        "seconds": round(seconds, 3),
+        "packets_per_s": round(packets / seconds),
+        "mb_per_s": round(size / 1024 / 1024 / seconds, 1),
+        "peak_rss_mb": raw["peak_rss_mb"],
+        "rss_growth_mb": round(raw["peak_rss_mb"] - raw["baseline_rss_mb"], 1),
+        **raw["detail"],
+    }
+
+
+# ---------- 接口延迟 (--api) ----------
+
+
+class _MultipartFile:
+    """
+    流式 multipart 请求体：requests 按 __len__ 设置 Content-Length 并分块调用 read，
+    不会把大文件整体读入内存
+    """
+
+    def __init__(self, path: str, boundary: str):
+        self._parts = [
+            (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="{os.path.basename(path)}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode(),
+            open(path, "rb"),
+            f"\r\n--{boundary}--\r\n".encode(),
+        ]
+        self._length = len(self._parts[0]) + os.path.getsize(path) + len(self._parts[2])
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        while self._parts:
+            part = self._parts[0]
+            if isinstance(part, bytes):
+                chunk = part if size < 0 else part[:size]
+                rest = part[len(chunk):]
+                if rest:
+                    self._parts[0] = rest
+                else:
+                    self._parts.pop(0)
+            else:
+                chunk = part.read(size if size > 0 else 1024 * 1024)
+                if not chunk:
+                    part.close()
+                    self._parts.pop(0)
+                    continue
+            return chunk
+        return b""
+
+
+def _latency(samples: List[float]) -> Dict[str, Any]:
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+    return {"count": len(ordered), "p50_ms": pick(50), "p95_ms": pick(95), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def _bench_api(base_url: str, path: str, repeat: int) -> Dict[str, Any]:
+    import requests
+
+    session = requests.Session()
+    results: Dict[str, Any] = {}
+
+    boundary = uuid.uuid4().hex
+    started = time.perf_counter()
+    resp = session.post(
+        f"{base_url}/api/pcap/upload",
+        data=_MultipartFile(path, boundary),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    resp.raise_for_status()
+    results["POST /api/pcap/upload"] = _latency([time.perf_counter() - started])
+    file_id = resp.json()["file_id"]
+
+    try:
+        # 分析为异步任务：测量从提交到状态变为 completed 的端到端时间
+        started = time.perf_counter()
+        task = session.post(f"{base_url}/api/analysis/analyze", json={"file_id": file_id}).json()
+        status = task.get("status")
+        cached = status == "completed"  # 同内容文件已有分析快照
+        while status not in ("completed", "failed"):
+            time.sleep(0.2)
+            status = session.get(f"{base_url}/api/analysis/status/{task['task_id']}").json().get("status")
+        results["POST /api/analysis/analyze (until completed)"] = {
+            **_latency([time.perf_counter() - started]),
+            "status": status,
+            "cached": cached,
+        }
+
+        for template in API_QUERIES:
+            url = template.format(id=file_id)
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                session.get(f"{base_url}{url}").raise_for_status()
+                samples.append(time.perf_counter() - started)
+            results[f"GET {template}"] = _latency(samples)
+    finally:
+        session.delete(f"{base_url}/api/pcap/{file_id}")
+    return results
+
+
+# ---------- 套件 ----------
+
+
+def _environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        commit = ""
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def run_suite(
+    packet_counts: List[int],
+    formats: List[str],
+    stages: List[str],
+    base: Dict[str, Any],
+    workdir: str,
+    api: Optional[str] = None,
+    repeat: int = 5,
+) -> Dict[str, Any]:
+    ctx = multiprocessing.get_context("spawn")
+    runs = []
+    for packets in packet_counts:
+        # 会话数随规模增长 (每 100 包一个会话，至少 100 个)
+        profile = TrafficProfile.from_dict({"flows": max(100, packets // 100), **base, "packets": packets})
+        for fmt in formats:
+            path = os.path.join(workdir, f"synthetic-{packets}.{fmt}")
+            generated = generate(path, profile, fmt)
+            size = generated["file_size"]
+            print(f"[{packets} packets, {fmt}] {size / 1024 / 1024:.1f} MB generated in {generated['seconds']}s", flush=True)
+
+            stage_dir = tempfile.mkdtemp(dir=workdir)
+            run = {"packets": packets, "format": fmt, "file_mb": round(size / 1024 / 1024, 1), "stages": {}}
+            for stage in stages:
+                with ctx.Pool(1) as pool:
+                    raw = pool.apply(_run_stage, (stage, path, stage_dir))
+                run["stages"][stage] = _stage_result(raw, packets, size)
+                r = run["stages"][stage]
+                print(
+                    f"  {stage:<15} {r['seconds']:>9.3f}s {r['packets_per_s']:>11,} pkt/s "
+                    f"{r['mb_per_s']:>8.1f} MB/s  peak {r['peak_rss_mb']:>7.1f} MB",
+                    flush=True,
+                )
+            if api:
+                run["api"] = _bench_api(api.rstrip("/"), path, repeat)
+                for name, r in run["api"].items():
+                    print(f"  {name:<60} p50 {r['p50_ms']:>9.2f} ms  max {r['max_ms']:>9.2f} ms", flush=True)
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            os.remove(path)
+            runs.append(run)
+    return {"environment": _environment(), "profile": base, "runs": runs}
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]):
+    """按 (规模, 格式, 阶段) 对比吞吐与峰值内存，比值 < 1 表示变慢"""
+    old = {(r["packets"], r["format"]): r for r in baseline.get("runs", [])}
+    print(f"\nCompared with {baseline.get('environment', {}).get('commit')} ({baseline.get('environment', {}).get('timestamp')}):")
+    for run in current["runs"]:
+        prev = old.get((run["packets"], run["format"]))
+        if not prev:
+            continue
+        for stage, r in run["stages"].items():
+            p = prev["stages"].get(stage)
+            if not p or not p["packets_per_s"]:
+                continue
+            ratio = r["packets_per_s"] / p["packets_per_s"]
+            flag = "  <-- slower" if ratio < 0.9 else ""
+            print(
+                f"  {run['packets']:>9} {run['format']:<6} {stage:<15} throughput x{ratio:.2f}  "
+                f"peak RSS {p['peak_rss_mb']} -> {r['peak_rss_mb']} MB{flag}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parser / analyzer / replay-path benchmark suite")
+    parser.add_argument("--packets", type=int, nargs="+", default=list(DEFAULT_PACKETS), help="各轮次的包数")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=["pcap"])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--mix", default=None, help="协议比例，如 tcp=0.8,udp=0.2")
+    parser.add_argument("--ipv6-ratio", type=float, default=None)
+    parser.add_argument("--signature-rate", type=float, default=None)
+    parser.add_argument("--scan-ratio", type=float, default=None)
+    parser.add_argument("--flood-ratio", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--api", default=None, help="运行中服务的地址，给出时测量接口延迟")
+    parser.add_argument("--repeat", type=int, default=5, help="每个查询接口的请求次数")
+    parser.add_argument("--workdir", default=None, help="临时文件目录 (默认系统临时目录)")
+    parser.add_argument("--output", default=None, help="结果 JSON 路径")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果 JSON 对比")
+    args = parser.parse_args()
+
+    base: Dict[str, Any] = {}
+    if args.mix:
+        base["protocol_mix"] = parse_mix(args.mix)
+    for name in ("ipv6_ratio", "signature_rate", "scan_ratio", "flood_ratio", "seed"):
+        if getattr(args, name) is not None:
+            base[name] = getattr(args, name)
+    TrafficProfile.from_dict(base)  # 尽早校验参数
+
+    workdir = tempfile.mkdtemp(prefix="bench-suite-", dir=args.workdir)
+    try:
+        result = run_suite(args.packets, args.formats, args.stages, base, workdir, args.api, args.repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"suite-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2), encoding="utf-8")
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        compare(result, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
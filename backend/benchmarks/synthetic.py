@@ -0,0 +1,375 @@
+"""
+确定性合成抓包生成器
+同一 TrafficProfile (含随机种子) 总是生成逐字节相同的文件，便于不同版本之间对比基准结果。
+
+流量构成:
+  正常会话   flows 个客户端-服务端会话，协议按 protocol_mix 分配，ipv6_ratio 比例的会话使用 IPv6；
+             各会话的包数呈长尾分布，TCP 会话以 SYN / SYN-ACK 开始，双向交替收发
+  特征命中   发往 80 端口的 TCP 载荷中 signature_rate 比例替换为能命中分析规则的攻击载荷
+  端口扫描   scan_ratio 比例的包为单一扫描源对受害主机逐端口发送的 SYN
+  洪泛       flood_ratio 比例的包为伪造随机源地址的 SYN 洪泛
+报文直接按字节拼装 (不经过 dpkt 对象)，IPv4 头校验和有效，TCP/UDP/ICMP 校验和置零。
+
+用法 (在 backend 目录下):
+  python -m benchmarks.synthetic out.pcap --packets 1000000 --flows 5000
+  python -m benchmarks.synthetic out.pcapng --format pcapng --scan-ratio 0.05 --ipv6-ratio 0.3
+"""
+import json
+import time
+import random
+import struct
+import argparse
+from typing import Any, Dict, List, Optional, Sequence
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+SERVER_COUNT = 32
+SCANNER_IP = bytes([203, 0, 113, 66])
+VICTIM_IP = bytes([192, 168, 0, 1])
+CLIENT_MAC = b"\x02\x00\x00\x00\x00\x01"
+SERVER_MAC = b"\x02\x00\x00\x00\x00\x02"
+
+TCP_PORTS = (80, 80, 80, 443, 443, 8080, 22, 3306)
+UDP_PORTS = (53, 53, 123, 514)
+
+TH_SYN, TH_PSH, TH_ACK = 0x02, 0x08, 0x10
+
+# 能命中 TrafficAnalyzer.THREAT_SIGNATURES 的载荷 (正常载荷只含字母数字与空格，不会误命中)
+SIGNATURE_PAYLOADS = (
+    b"GET /item?id=1 UNION SELECT username, password FROM users HTTP/1.1\r\nHost: shop\r\n\r\n",
+    b"GET /search?q=<script>alert(1)</script> HTTP/1.1\r\nHost: shop\r\n\r\n",
+    b"GET /download?file=../../etc/passwd HTTP/1.1\r\nHost: shop\r\n\r\n",
+    b"POST /ping HTTP/1.1\r\nHost: shop\r\n\r\nhost=127.0.0.1; ls -la",
+)
+PAYLOAD_ALPHABET = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 "
+PAYLOAD_VARIANTS = 16
+ICMP_PAYLOAD = bytes(range(0x10, 0x48))  # 56 字节，与 ping 默认长度一致
+
+PROTOCOLS = ("tcp", "udp", "icmp")
+FORMATS = ("pcap", "pcapng")
+
+
+class TrafficProfile:
+    """合成流量参数 (比例取值 0~1)"""
+
+    def __init__(
+        self,
+        packets: int = 100000,
+        flows: int = 1000,
+        protocol_mix: Optional[Dict[str, float]] = None,
+        ipv6_ratio: float = 0.1,
+        payload_sizes: Sequence[int] = (0, 64, 512, 1400),
+        signature_rate: float = 0.001,
+        scan_ratio: float = 0.0,
+        flood_ratio: float = 0.0,
+        pps: float = 10000.0,
+        seed: int = 1,
+        start_time: float = 1_700_000_000.0,
+    ):
+        self.packets = int(packets)
+        self.flows = int(flows)
+        self.protocol_mix = dict(protocol_mix or {"tcp": 0.75, "udp": 0.2, "icmp": 0.05})
+        self.ipv6_ratio = float(ipv6_ratio)
+        self.payload_sizes = [int(s) for s in payload_sizes]
+        self.signature_rate = float(signature_rate)
+        self.scan_ratio = float(scan_ratio)
+        self.flood_ratio = float(flood_ratio)
+        self.pps = float(pps)
+        self.seed = int(seed)
+        self.start_time = float(start_time)
+
+        if self.packets < 1 or self.flows < 1 or self.pps <= 0:
+            raise ValueError("packets, flows and pps must be positive")
+        unknown = set(self.protocol_mix) - set(PROTOCOLS)
+        if unknown or not any(w > 0 for w in self.protocol_mix.values()):
+            raise ValueError(f"protocol_mix must weight some of {PROTOCOLS}")
+        for name in ("ipv6_ratio", "signature_rate", "scan_ratio", "flood_ratio"):
+            if not 0.0 <= getattr(self, name) <= 1.0:
+                raise ValueError(f"{name} must be within [0, 1]")
+        if self.scan_ratio + self.flood_ratio > 1.0:
+            raise ValueError("scan_ratio + flood_ratio must not exceed 1")
+        if not self.payload_sizes or any(s < 0 or s > 9000 for s in self.payload_sizes):
+            raise ValueError("payload_sizes must be within [0, 9000]")
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "TrafficProfile":
+        return cls(**(data or {}))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "packets": self.packets,
+            "flows": self.flows,
+            "protocol_mix": self.protocol_mix,
+            "ipv6_ratio": self.ipv6_ratio,
+            "payload_sizes": self.payload_sizes,
+            "signature_rate": self.signature_rate,
+            "scan_ratio": self.scan_ratio,
+            "flood_ratio": self.flood_ratio,
+            "pps": self.pps,
+            "seed": self.seed,
+            "start_time": self.start_time,
+        }
+
+
+# ---------- 报文拼装 ----------
+
+
+def _ipv4_checksum(header: bytes) -> int:
+    total = sum(struct.unpack("!10H", header))
+    total = (total & 0xFFFF) + (total >> 16)
+    total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _ipv4(src: bytes, dst: bytes, proto: int, ident: int, payload: bytes) -> bytes:
+    header = struct.pack(
+        "!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), ident & 0xFFFF, 0x4000, 64, proto, 0, src, dst
+    )
+    return header[:10] + struct.pack("!H", _ipv4_checksum(header)) + header[12:] + payload
+
+
+def _ipv6(src: bytes, dst: bytes, proto: int, payload: bytes) -> bytes:
+    return struct.pack("!IHBB16s16s", 0x60000000, len(payload), proto, 64, src, dst) + payload
+
+
+def _tcp(sport: int, dport: int, seq: int, flags: int, payload: bytes) -> bytes:
+    return struct.pack("!HHIIBBHHH", sport, dport, seq & 0xFFFFFFFF, 0, 0x50, flags, 65535, 0, 0) + payload
+
+
+def _udp(sport: int, dport: int, payload: bytes) -> bytes:
+    return struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+
+
+def _icmp(v6: bool, reply: bool, ident: int, seq: int, payload: bytes) -> bytes:
+    kind = (129 if reply else 128) if v6 else (0 if reply else 8)
+    return struct.pack("!BBHHH", kind, 0, 0, ident & 0xFFFF, seq & 0xFFFF) + payload
+
+
+class _Flow:
+    __slots__ = ("proto", "v6", "client", "server", "sport", "dport", "sent")
+
+    def __init__(self, proto, v6, client, server, sport, dport):
+        self.proto, self.v6 = proto, v6
+        self.client, self.server = client, server
+        self.sport, self.dport = sport, dport
+        self.sent = 0
+
+
+class SyntheticTrafficGenerator:
+    """按 TrafficProfile 逐包生成以太网帧"""
+
+    def __init__(self, profile: TrafficProfile):
+        self.profile = profile
+        self.rng = random.Random(profile.seed)
+        self.stats = {
+            "packets": 0,
+            "bytes": 0,
+            "ipv6_packets": 0,
+            "signature_packets": 0,
+            "scan_packets": 0,
+            "flood_packets": 0,
+        }
+        self._payloads = {
+            size: [
+                bytes(self.rng.choice(PAYLOAD_ALPHABET) for _ in range(size))
+                for _ in range(PAYLOAD_VARIANTS if size else 1)
+            ]
+            for size in set(profile.payload_sizes)
+        }
+        self._flows = self._build_flows()
+        self._scan_port = 0
+
+    def _build_flows(self) -> List[_Flow]:
+        names = [p for p in PROTOCOLS if self.profile.protocol_mix.get(p, 0) > 0]
+        weights = [self.profile.protocol_mix[p] for p in names]
+        flows = []
+        for i in range(self.profile.flows):
+            proto = self.rng.choices(names, weights)[0]
+            v6 = self.rng.random() < self.profile.ipv6_ratio
+            server_id = self.rng.randrange(SERVER_COUNT)
+            if v6:
+                client = b"\xfd\x00" + b"\x00" * 10 + struct.pack("!I", i + 1)
+                server = b"\xfd\x00\x00\x01" + b"\x00" * 10 + struct.pack("!H", server_id + 1)
+            else:
+                client = bytes([10, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF])
+                server = bytes([192, 168, 1, server_id + 1])
+            sport = 1024 + i % 64000
+            if proto == "tcp":
+                dport = self.rng.choice(TCP_PORTS)
+            elif proto == "udp":
+                dport = self.rng.choice(UDP_PORTS)
+            else:
+                dport = 0
+            flows.append(_Flow(proto, v6, client, server, sport, dport))
+        return flows
+
+    def _payload(self, limit: int = 9000) -> bytes:
+        size = self.rng.choice(self.profile.payload_sizes)
+        return self.rng.choice(self._payloads[size])[:limit]
+
+    def _flow_packet(self, index: int) -> bytes:
+        # 会话编号取平方分布: 少数会话承载大部分报文 (长尾)
+        flow = self._flows[int(self.profile.flows * self.rng.random() ** 2)]
+        n = flow.sent
+        flow.sent += 1
+        outbound = n % 2 == 0
+        src, dst = (flow.client, flow.server) if outbound else (flow.server, flow.client)
+        sport, dport = (flow.sport, flow.dport) if outbound else (flow.dport, flow.sport)
+
+        if flow.proto == "tcp":
+            if n == 0:
+                flags, payload = TH_SYN, b""
+            elif n == 1:
+                flags, payload = TH_SYN | TH_ACK, b""
+            else:
+                payload = self._payload()
+                if outbound and dport == 80 and self.rng.random() < self.profile.signature_rate:
+                    payload = self.rng.choice(SIGNATURE_PAYLOADS)
+                    self.stats["signature_packets"] += 1
+                flags = TH_PSH | TH_ACK if payload else TH_ACK
+            l4, proto = _tcp(sport, dport, n * 1460, flags, payload), 6
+        elif flow.proto == "udp":
+            l4, proto = _udp(sport, dport, self._payload(limit=512)), 17
+        else:
+            l4 = _icmp(flow.v6, not outbound, index, n, ICMP_PAYLOAD)
+            proto = 58 if flow.v6 else 1
+
+        src_mac, dst_mac = (CLIENT_MAC, SERVER_MAC) if outbound else (SERVER_MAC, CLIENT_MAC)
+        if flow.v6:
+            self.stats["ipv6_packets"] += 1
+            return dst_mac + src_mac + b"\x86\xdd" + _ipv6(src, dst, proto, l4)
+        return dst_mac + src_mac + b"\x08\x00" + _ipv4(src, dst, proto, index, l4)
+
+    def _scan_packet(self, index: int) -> bytes:
+        self._scan_port = self._scan_port % 65535 + 1
+        self.stats["scan_packets"] += 1
+        l4 = _tcp(40000 + index % 1000, self._scan_port, index, TH_SYN, b"")
+        return CLIENT_MAC + SERVER_MAC + b"\x08\x00" + _ipv4(SCANNER_IP, VICTIM_IP, 6, index, l4)
+
+    def _flood_packet(self, index: int) -> bytes:
+        self.stats["flood_packets"] += 1
+        spoofed = bytes([100, 64 + self.rng.randrange(64), self.rng.randrange(256), self.rng.randrange(1, 255)])
+        l4 = _tcp(self.rng.randrange(1024, 65536), 80, self.rng.getrandbits(32), TH_SYN, b"")
+        return CLIENT_MAC + SERVER_MAC + b"\x08\x00" + _ipv4(spoofed, VICTIM_IP, 6, index, l4)
+
+    def __iter__(self):
+        """逐包产出 (时间戳纳秒, 帧)"""
+        profile = self.profile
+        scan, flood = profile.scan_ratio, profile.scan_ratio + profile.flood_ratio
+        start_ns = int(profile.start_time * 1e9)
+        interval_ns = max(1, int(1e9 / profile.pps))
+        for i in range(profile.packets):
+            r = self.rng.random()
+            if r < scan:
+                frame = self._scan_packet(i)
+            elif r < flood:
+                frame = self._flood_packet(i)
+            else:
+                frame = self._flow_packet(i)
+            self.stats["packets"] += 1
+            self.stats["bytes"] += len(frame)
+            yield start_ns + i * interval_ns, frame
+
+
+# ---------- 文件写出 ----------
+
+
+def _pcap_header() -> bytes:
+    return struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)
+
+
+def _pcap_record(ts_ns: int, frame: bytes) -> bytes:
+    sec, ns = divmod(ts_ns, 1_000_000_000)
+    return struct.pack("<IIII", sec, ns // 1000, len(frame), len(frame)) + frame
+
+
+def _pcapng_header() -> bytes:
+    shb = struct.pack("<IIIHHqI", 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28)
+    # if_tsresol = 9 (纳秒)
+    options = struct.pack("<HHB3x", 9, 1, 9) + struct.pack("<HH", 0, 0)
+    idb_len = 16 + len(options) + 4
+    idb = struct.pack("<IIHHI", 1, idb_len, 1, 0, 65535) + options + struct.pack("<I", idb_len)
+    return shb + idb
+
+
+def _pcapng_record(ts_ns: int, frame: bytes) -> bytes:
+    padded = frame + b"\x00" * (-len(frame) % 4)
+    length = 32 + len(padded)
+    return (
+        struct.pack("<IIIIIII", 6, length, 0, ts_ns >> 32, ts_ns & 0xFFFFFFFF, len(frame), len(frame))
+        + padded
+        + struct.pack("<I", length)
+    )
+
+
+def generate(path: str, profile: TrafficProfile, fmt: str = "pcap") -> Dict[str, Any]:
+    """写出合成抓包，返回生成统计"""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    header, record = (_pcap_header, _pcap_record) if fmt == "pcap" else (_pcapng_header, _pcapng_record)
+    started = time.perf_counter()
+    generator = SyntheticTrafficGenerator(profile)
+    with open(path, "wb") as f:
+        f.write(header())
+        chunk: List[bytes] = []
+        pending = 0
+        for ts_ns, frame in generator:
+            data = record(ts_ns, frame)
+            chunk.append(data)
+            pending += len(data)
+            if pending >= WRITE_BUFFER_SIZE:
+                f.write(b"".join(chunk))
+                chunk, pending = [], 0
+        f.write(b"".join(chunk))
+        size = f.tell()
+    return {
+        **generator.stats,
+        "format": fmt,
+        "flows": profile.flows,
+        "file_size": size,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """解析 "tcp=0.8,udp=0.2" 形式的协议比例"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip().lower()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic synthetic pcap/pcapng generator")
+    parser.add_argument("output", help="输出文件路径")
+    parser.add_argument("--format", choices=FORMATS, default="pcap")
+    parser.add_argument("--packets", type=int, default=100000)
+    parser.add_argument("--flows", type=int, default=1000)
+    parser.add_argument("--mix", default="tcp=0.75,udp=0.2,icmp=0.05", help="协议比例，如 tcp=0.8,udp=0.2")
+    parser.add_argument("--ipv6-ratio", type=float, default=0.1)
+    parser.add_argument("--payload-sizes", default="0,64,512,1400", help="载荷长度候选 (字节)")
+    parser.add_argument("--signature-rate", type=float, default=0.001)
+    parser.add_argument("--scan-ratio", type=float, default=0.0)
+    parser.add_argument("--flood-ratio", type=float, default=0.0)
+    parser.add_argument("--pps", type=float, default=10000.0, help="时间戳间隔对应的包速率")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    profile = TrafficProfile(
+        packets=args.packets,
+        flows=args.flows,
+        protocol_mix=parse_mix(args.mix),
+        ipv6_ratio=args.ipv6_ratio,
+        payload_sizes=[int(s) for s in args.payload_sizes.split(",")],
+        signature_rate=args.signature_rate,
+        scan_ratio=args.scan_ratio,
+        flood_ratio=args.flood_ratio,
+        pps=args.pps,
+        seed=args.seed,
+    )
+    print(json.dumps(generate(args.output, profile, args.format), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+from typing import Optional
+
+import docker
+import redis
+import redis.asyncio as aioredis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from redis.client import Pipeline
+
+from metrics import DOCKER_API_SECONDS, REDIS_COMMAND_SECONDS, instrument_session
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+
+# Docker 客户端健康检查的最小间隔 (秒)，避免每个请求都 ping 一次 daemon
+DOCKER_HEALTH_CHECK_INTERVAL = float(os.getenv("DOCKER_HEALTH_CHECK_INTERVAL", "30"))
+
+_lock = threading.Lock()
+_redis_pool: Optional[redis.ConnectionPool] = None
+_async_redis_pool: Optional[aioredis.ConnectionPool] = None
+_docker_client: Optional[docker.DockerClient] = None
+_docker_checked_at = 0.0
+
+
+class _TimedPipeline(Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with REDIS_COMMAND_SECONDS.labels("PIPELINE").time():
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """记录每条命令往返耗时的 Redis 客户端 (pipeline 按整批计时)"""
+
+    def execute_command(self, *args, **options):
+        with REDIS_COMMAND_SECONDS.labels(str(args[0]).upper()).time():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> Pipeline:
+        return _TimedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+def _redis_pool_kwargs() -> dict:
+    return {
+        "host": REDIS_HOST,
+        "port": REDIS_PORT,
+        "decode_responses": True,
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        # 空闲连接复用前先 PING，断线时由连接池自动重建
+        "health_check_interval": 30,
+        "socket_keepalive": True,
+        "retry": Retry(ExponentialBackoff(cap=2, base=0.1), 3),
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+    }
+
+
+def _create_docker_client() -> Optional[docker.DockerClient]:
+    try:
+        client = docker.from_env()
+        instrument_session(client.api, DOCKER_API_SECONDS)
+        client.ping()
+        return client
+    except Exception as e:
+        logger.warning(f"Docker client init failed: {e}")
+        return None
+
+
+def init_clients():
+    """在应用启动时创建共享的 Redis 连接池与 Docker 客户端"""
+    global _redis_pool, _async_redis_pool, _docker_client, _docker_checked_at
+    with _lock:
+        if _redis_pool is None:
+            _redis_pool = redis.ConnectionPool(**_redis_pool_kwargs())
+        if _async_redis_pool is None:
+            _async_redis_pool = aioredis.ConnectionPool(**_redis_pool_kwargs())
+        if _docker_client is None:
+            _docker_client = _create_docker_client()
+            _docker_checked_at = time.monotonic()
+
+
+async def close_clients():
+    """在应用关闭时释放连接"""
+    global _redis_pool, _async_redis_pool, _docker_client
+    with _lock:
+        redis_pool, async_pool, docker_client = _redis_pool, _async_redis_pool, _docker_client
+        _redis_pool = _async_redis_pool = _docker_client = None
+
+    if redis_pool:
+        redis_pool.disconnect()
+    if async_pool:
+        await async_pool.disconnect()
+    if docker_client:
+        try:
+            docker_client.close()
+        except Exception as e:
+            logger.warning(f"Docker client close failed: {e}")
+
+
+def get_redis() -> redis.Redis:
+    """
+    获取共享连接池上的 Redis 客户端 (可用作 FastAPI 依赖)。
+    客户端对象本身很轻量，连接从连接池按需借还；后台线程和独立进程中也可直接调用。
+    """
+    if _redis_pool is None:
+        init_clients()
+    return InstrumentedRedis(connection_pool=_redis_pool)
+
+
+def get_async_redis() -> aioredis.Redis:
+    """获取共享连接池上的 asyncio Redis 客户端 (用于 Pub/Sub 推送等异步场景)"""
+    if _async_redis_pool is None:
+        init_clients()
+    return aioredis.Redis(connection_pool=_async_redis_pool)
+
+
+def get_docker() -> Optional[docker.DockerClient]:
+    """
+    获取共享 Docker 客户端 (可用作 FastAPI 依赖)。
+    按间隔做健康检查，daemon 重启或连接失效时自动重建客户端；不可用时返回 None。
+    """
+    global _docker_client, _docker_checked_at
+    now = time.monotonic()
+    # 检查间隔内直接复用上次结果 (包括不可用的情况，避免反复重连拖慢请求)
+    if _docker_checked_at and now - _docker_checked_at < DOCKER_HEALTH_CHECK_INTERVAL:
+        return _docker_client
+
+    with _lock:
+        if _docker_client is not None:
+            try:
+                _docker_client.ping()
+                _docker_checked_at = now
+                return _docker_client
+            except Exception as e:
+                logger.warning(f"Docker health check failed, reconnecting: {e}")
+                try:
+                    _docker_client.close()
+                except Exception:
+                    pass
+        _docker_client = _create_docker_client()
+        _docker_checked_at = now
+        return _docker_client
+
+
+def check_health() -> dict:
+    """依赖服务健康状态 (供 /health 接口使用)"""
+    status = {}
+    try:
+        get_redis().ping()
+        status["redis"] = "ok"
+    except Exception as e:
+        status["redis"] = f"error: {e}"
+
+    status["docker"] = "ok" if get_docker() is not None else "unavailable"
+    return status
@@ -1,13 +1,57 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data.db")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+# 连接池大小：同步的数据库访问都在线程池中执行 (默认 40 个线程)，
+# 常驻连接 + 溢出连接与线程数对齐，高峰时请求不会卡在等待连接上
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# SQLite 写锁等待时间 (毫秒)：并发写入时排队等待而不是立即报 database is locked
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# 每个连接的页缓存 (KiB) 与内存映射读取大小 (字节)
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
 
 # For SQLite, need check_same_thread=False for FastAPI default threading
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+connect_args = {"check_same_thread": False} if IS_SQLITE else {}
+pool_args = {}
+if DATABASE_URL not in ("sqlite://", "sqlite:///:memory:"):
+    # 内存库使用单连接池，不接受这些参数
+    pool_args = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+
+engine = create_engine(
+    DATABASE_URL, echo=False, future=True, connect_args=connect_args, **pool_args
+)
+
+
+if IS_SQLITE:
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        """
+        WAL 模式：读不阻塞写、写不阻塞读，列表查询与上传/删除可以并发进行；
+        WAL 下 synchronous=NORMAL 仍保证崩溃一致性，只是省去每次提交的 fsync
+        """
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        finally:
+            cursor.close()
 
-engine = create_engine(DATABASE_URL, echo=False, future=True, connect_args=connect_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, future=True)
 Base = declarative_base()
 
@@ -18,3 +62,29 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def init_db():
+    """
+    建表并补齐旧数据库中缺失的列和索引。
+    create_all 不会修改已存在的表，这里只做增量变更 (新增可空列、补建索引)，不删除任何数据。
+    """
+    import models  # noqa: F401  确保所有模型已注册到 Base.metadata
+
+    Base.metadata.create_all(bind=engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}")
+                )
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
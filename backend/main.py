@@ -1,14 +1,72 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 import uvicorn
 from pathlib import Path
 import os
+import logging
+import threading
 
-from routers import pcap_router, replay_router, analysis_router
-from database import Base, engine
+from routers import pcap_router, replay_router, analysis_router, live_router
+from database import init_db
+from clients import init_clients, close_clients, check_health, get_redis
+from metrics import CONTENT_TYPE_LATEST, REPLAY_QUEUE_DEPTH, render, track
+from serialization import JSONResponse
+from services.replay_scheduler import ReplayScheduler
+from services.replay_task_store import ReplayTaskStore
+from services.flow_store import FlowStore
+from services.live_capture import live_registry
+from worker import ReplayWorker
 
-app = FastAPI(title="网络攻击复现与分析系统", version="1.0.0")
+logger = logging.getLogger(__name__)
+
+# 是否在 API 进程内运行重放 worker (本地开发默认开启；容器部署由独立的 worker 服务执行)
+REPLAY_EMBEDDED_WORKER = os.getenv("REPLAY_EMBEDDED_WORKER", "1") == "1"
+# 响应压缩：超过该字节数且客户端支持时 gzip 压缩 (流式响应逐块压缩并刷新)
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+# 抓包下载本身难以压缩，且需保持零拷贝发送
+GZIP_EXCLUDED_TYPES = ("application/vnd.tcpdump.pcap", "application/octet-stream")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 整个进程共享一个 Redis 连接池和一个 Docker 客户端
+    init_clients()
+    try:
+        # 旧版整段 JSON 存储的重放任务迁移到任务注册表
+        await run_in_threadpool(ReplayTaskStore(get_redis()).migrate_legacy)
+    except Exception as e:
+        logger.warning(f"Replay task migration skipped: {e}")
+    track(REPLAY_QUEUE_DEPTH, lambda: ReplayScheduler(get_redis()).depth())
+    # 旧版会话明细只有逗号分隔的威胁类型列，补建按类型过滤用的明细表
+    await run_in_threadpool(FlowStore().migrate_threats)
+
+    worker = None
+    if REPLAY_EMBEDDED_WORKER:
+        worker = ReplayWorker()
+        threading.Thread(target=worker.run, name="replay-worker", daemon=True).start()
+    yield
+    if worker:
+        worker.stop()
+    # 实时分析线程退出前写入断点
+    for session in live_registry.list():
+        session.stop()
+    for session in live_registry.list():
+        session.join(5)
+    await close_clients()
+
+
+app = FastAPI(
+    title="网络攻击复现与分析系统",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=JSONResponse,
+)
 
 # 配置CORS
 app.add_middleware(
@@ -18,6 +76,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=GZIP_MINIMUM_SIZE,
+    compresslevel=GZIP_LEVEL,
+    exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + GZIP_EXCLUDED_TYPES,
+)
 
 # 创建必要的目录
 UPLOAD_DIR = Path("uploads")
@@ -25,13 +89,14 @@ RESULTS_DIR = Path("results")
 UPLOAD_DIR.mkdir(exist_ok=True)
 RESULTS_DIR.mkdir(exist_ok=True)
 
-# 初始化数据库表
-Base.metadata.create_all(bind=engine)
+# 初始化数据库表 (含旧库的增量字段补齐)
+init_db()
 
 # 注册路由
 app.include_router(pcap_router.router, prefix="/api/pcap", tags=["PCAP管理"])
 app.include_router(replay_router.router, prefix="/api/replay", tags=["流量重放"])
 app.include_router(analysis_router.router, prefix="/api/analysis", tags=["数据分析"])
+app.include_router(live_router.router, prefix="/api/live", tags=["实时分析"])
 
 
 @app.get("/")
@@ -45,7 +110,15 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    dependencies = await run_in_threadpool(check_health)
+    healthy = dependencies.get("redis") == "ok"
+    return {"status": "healthy" if healthy else "degraded", "dependencies": dependencies}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus 抓取接口 (队列长度等仪表在抓取时读取 Redis，放到线程池中执行)"""
+    return Response(await run_in_threadpool(render), media_type=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
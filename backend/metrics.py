@@ -0,0 +1,213 @@
+"""
+Prometheus 指标
+API 进程通过 /metrics 暴露；独立运行的重放 worker 在 WORKER_METRICS_PORT 上单独暴露。
+热路径上只做计数器/直方图的原子累加，逐包循环内先在局部变量中累计，结束时一次性上报。
+"""
+import os
+import re
+from typing import Callable, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    start_http_server,
+)
+
+NAMESPACE = "cyber_replay"
+
+# 独立 worker 进程的指标端口 (0 表示不暴露；内嵌在 API 进程中的 worker 共用 /metrics)
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+
+# 网络往返类调用 (Redis 命令、Docker API、沙箱代理) 的耗时分桶，覆盖亚毫秒到秒级
+_CALL_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# 解析、分析等批处理阶段的耗时分桶
+_STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+_BYTES_PER_SECOND_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-2, 12))
+_PPS_BUCKETS = (10, 100, 500, 1e3, 5e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6)
+
+# --- 文件接入 ---
+UPLOAD_BYTES = Counter(
+    "pcap_upload_bytes", "已接收的上传字节数", namespace=NAMESPACE
+)
+UPLOAD_SECONDS = Histogram(
+    "pcap_upload_seconds", "上传接收并落盘耗时", namespace=NAMESPACE, buckets=_STAGE_BUCKETS
+)
+UPLOAD_THROUGHPUT = Histogram(
+    "pcap_upload_throughput_bytes_per_second",
+    "单次上传的接收速率",
+    namespace=NAMESPACE,
+    buckets=_BYTES_PER_SECOND_BUCKETS,
+)
+UPLOAD_CHUNKS = Counter(
+    "pcap_upload_chunks",
+    "分块上传收到的分块 (ok: 已校验; checksum_mismatch: 校验和不一致; rejected: 偏移或长度不符，或上传正在完成)",
+    ["result"],
+    namespace=NAMESPACE,
+)
+PARSE_SECONDS = Histogram(
+    "pcap_parse_seconds",
+    "PCAP 解析耗时 (basic: 上传时的基本信息; detailed: 详细信息)",
+    ["kind"],
+    namespace=NAMESPACE,
+    buckets=_STAGE_BUCKETS,
+)
+
+# --- 流量分析 ---
+ANALYSIS_STAGE_SECONDS = Histogram(
+    "analysis_stage_seconds",
+    "分析各阶段耗时 (decode: 逐包解码与计数; dpi: 特征匹配; aggregate: 结果汇总; persist: 会话落库)",
+    ["stage"],
+    namespace=NAMESPACE,
+    buckets=_STAGE_BUCKETS,
+)
+ANALYSIS_PACKETS = Counter(
+    "analysis_packets", "分析器已处理的报文数", namespace=NAMESPACE
+)
+ANALYSIS_SPILLS = Counter(
+    "analysis_spills", "聚合状态超出内存预算时写出到磁盘的次数", ["table"], namespace=NAMESPACE
+)
+ANALYSIS_TASKS = Gauge(
+    "analysis_tasks", "分析任务数 (queued: 等待执行; running: 执行中)", ["state"], namespace=NAMESPACE
+)
+ANALYSIS_RESULTS = Counter(
+    "analysis_tasks_finished",
+    "结束的分析任务 (completed/failed/cached)",
+    ["status"],
+    namespace=NAMESPACE,
+)
+ANALYSIS_SECONDS = Histogram(
+    "analysis_duration_seconds", "分析任务从开始执行到结束的耗时", namespace=NAMESPACE, buckets=_STAGE_BUCKETS
+)
+LIVE_BACKLOG_BYTES = Gauge(
+    "live_ingest_backlog_bytes", "实时分析中已写入但尚未处理的抓包字节数", ["watch"], namespace=NAMESPACE
+)
+PACKET_SEARCH_SECONDS = Histogram(
+    "packet_search_seconds", "倒排索引检索耗时 (不含首次生成索引)", namespace=NAMESPACE, buckets=_CALL_BUCKETS
+)
+
+# --- 流量重放 ---
+REPLAY_QUEUE_DEPTH = Gauge(
+    "replay_queue_depth", "调度队列中等待执行的重放任务数", namespace=NAMESPACE
+)
+REPLAY_PREPARE_SECONDS = Histogram(
+    "replay_prepare_seconds",
+    "重放准备耗时 (子集提取、地址改写与沙箱缓存上传)",
+    namespace=NAMESPACE,
+    buckets=_STAGE_BUCKETS,
+)
+REPLAY_START_SECONDS = Histogram(
+    "replay_time_to_start_seconds",
+    "从提交重放到沙箱开始发包的耗时 (含排队与准备)",
+    namespace=NAMESPACE,
+    buckets=_STAGE_BUCKETS,
+)
+REPLAY_PPS = Histogram(
+    "replay_achieved_pps", "重放结束时的实际发包速率", namespace=NAMESPACE, buckets=_PPS_BUCKETS
+)
+REPLAY_KEEP_UP = Histogram(
+    "replay_keep_up_ratio",
+    "实际发包速率与期望速率之比",
+    namespace=NAMESPACE,
+    buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0, 1.05, 1.25),
+)
+REPLAY_PACKETS = Counter(
+    "replay_packets_sent", "沙箱已发送的报文数", namespace=NAMESPACE
+)
+REPLAY_RESULTS = Counter(
+    "replay_tasks_finished", "结束的重放任务", ["status"], namespace=NAMESPACE
+)
+
+# --- 外部依赖 ---
+REDIS_COMMAND_SECONDS = Histogram(
+    "redis_command_seconds",
+    "Redis 命令往返耗时 (pipeline 整体计为 PIPELINE)",
+    ["command"],
+    namespace=NAMESPACE,
+    buckets=_CALL_BUCKETS,
+)
+DOCKER_API_SECONDS = Histogram(
+    "docker_api_seconds",
+    "Docker API 请求耗时 (到收到响应头为止)",
+    ["method", "endpoint"],
+    namespace=NAMESPACE,
+    buckets=_CALL_BUCKETS,
+)
+SANDBOX_AGENT_SECONDS = Histogram(
+    "sandbox_agent_request_seconds",
+    "沙箱重放代理请求耗时 (到收到响应头为止，流式重放即启动耗时)",
+    ["method", "endpoint"],
+    namespace=NAMESPACE,
+    buckets=_CALL_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests", "各级缓存查询次数", ["cache", "result"], namespace=NAMESPACE
+)
+
+# 路径第二段为对象 ID/名称的资源 (Docker API 与沙箱代理)，归一化后避免标签基数失控
+_ID_RESOURCES = {"containers", "networks", "exec", "images", "volumes", "cache", "replays"}
+_COLLECTION_ACTIONS = {"json", "create", "prune", "search", "load"}
+_API_VERSION = re.compile(r"^/v\d+(\.\d+)?(?=/)")
+
+
+def endpoint_label(path: str) -> str:
+    """/v1.41/containers/<id>/json -> /containers/{id}/json"""
+    parts = _API_VERSION.sub("", path.split("?", 1)[0]).strip("/").split("/")
+    if len(parts) > 1 and parts[0] in _ID_RESOURCES and parts[1] not in _COLLECTION_ACTIONS:
+        parts[1] = "{id}"
+    return "/" + "/".join(parts)
+
+
+def _response_hook(histogram: Histogram):
+    def hook(resp, *args, **kwargs):
+        histogram.labels(
+            resp.request.method, endpoint_label(resp.request.path_url)
+        ).observe(resp.elapsed.total_seconds())
+
+    return hook
+
+
+def instrument_session(session, histogram: Histogram):
+    """为 requests.Session (Docker APIClient 亦是其子类) 挂载耗时统计钩子"""
+    session.hooks["response"].append(_response_hook(histogram))
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_replay_rate(metrics: dict, expected_pps: Optional[float]):
+    """重放结束时上报实际速率与跟上期望速率的程度"""
+    REPLAY_PACKETS.inc(metrics.get("sent") or 0)
+    pps = metrics.get("pps") or 0.0
+    if pps > 0:
+        REPLAY_PPS.observe(pps)
+        if expected_pps:
+            REPLAY_KEEP_UP.observe(pps / expected_pps)
+
+
+def track(gauge: Gauge, read: Callable[[], float]):
+    """抓取时才读取的仪表 (如 Redis 队列长度)；读取失败时上报 NaN，不影响其余指标"""
+
+    def safe_read() -> float:
+        try:
+            return read()
+        except Exception:
+            return float("nan")
+
+    gauge.set_function(safe_read)
+
+
+def render() -> bytes:
+    return generate_latest()
+
+
+def serve(port: int = WORKER_METRICS_PORT):
+    """在独立进程中启动指标 HTTP 服务 (后台线程)"""
+    start_http_server(port)
+
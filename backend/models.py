@@ -1,6 +1,6 @@
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import Column, Integer, String, Float, DateTime, Text, LargeBinary, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from database import Base
 
@@ -15,16 +15,26 @@ class PcapFile(Base):
     size: Mapped[int] = mapped_column(Integer, default=0)
     total_packets: Mapped[int] = mapped_column(Integer, default=0)
     duration: Mapped[float] = mapped_column(Float, default=0.0)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # 文件内容 SHA-256，相同内容的文件共享分析快照
+    file_hash: Mapped[Optional[str]] = mapped_column(String(64), index=True, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
 
 
 class AnalysisSnapshot(Base):
     __tablename__ = "analysis_snapshots"
+    __table_args__ = (
+        # 快照唯一键: 文件内容 + 分析类型 + 参数
+        Index("ix_snapshot_key", "file_hash", "analysis_type", "params_key", unique=True),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     file_id: Mapped[str] = mapped_column(String(64), index=True)
+    file_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
     analysis_type: Mapped[str] = mapped_column(String(32), default="full")
-    payload: Mapped[str] = mapped_column(Text)  # JSON string
+    params_key: Mapped[Optional[str]] = mapped_column(String(64), default="", nullable=True)
+    params: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON string
+    payload: Mapped[bytes] = mapped_column(LargeBinary)  # zlib 压缩的 JSON
+    payload_size: Mapped[Optional[int]] = mapped_column(Integer, default=0, nullable=True)  # 压缩前字节数
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
@@ -41,3 +51,68 @@ class ReplayTask(Base):
     error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class FlowRecord(Base):
+    """单个文件的全量会话明细 (用于分页/过滤/排序查询)"""
+
+    __tablename__ = "flow_records"
+    __table_args__ = (
+        # 排序键均带 id 作为游标分页的稳定次序
+        Index("ix_flow_hash_packets", "file_hash", "packets", "id"),
+        Index("ix_flow_hash_bytes", "file_hash", "bytes", "id"),
+        Index("ix_flow_hash_duration", "file_hash", "duration", "id"),
+        Index("ix_flow_hash_start", "file_hash", "start_time"),
+        Index("ix_flow_hash_src_ip", "file_hash", "src_ip"),
+        Index("ix_flow_hash_dst_ip", "file_hash", "dst_ip"),
+        Index("ix_flow_hash_src_port", "file_hash", "src_port"),
+        Index("ix_flow_hash_dst_port", "file_hash", "dst_port"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    file_hash: Mapped[str] = mapped_column(String(64))
+    src_ip: Mapped[str] = mapped_column(String(45))
+    dst_ip: Mapped[str] = mapped_column(String(45))
+    src_port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    dst_port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    protocol: Mapped[str] = mapped_column(String(8))
+    packets: Mapped[int] = mapped_column(Integer, default=0)
+    bytes: Mapped[int] = mapped_column(Integer, default=0)
+    start_time: Mapped[float] = mapped_column(Float, default=0.0)
+    end_time: Mapped[float] = mapped_column(Float, default=0.0)
+    duration: Mapped[float] = mapped_column(Float, default=0.0)
+    threats: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)  # 逗号分隔 (展示用)
+
+
+class FlowThreat(Base):
+    """会话命中的威胁类型 (每个类型一行，按类型过滤会话时走精确匹配索引)"""
+
+    __tablename__ = "flow_threats"
+    __table_args__ = (Index("ix_flow_threat_hash_type", "file_hash", "threat_type", "flow_id"),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    file_hash: Mapped[str] = mapped_column(String(64))
+    threat_type: Mapped[str] = mapped_column(String(64))
+    flow_id: Mapped[int] = mapped_column(Integer)
+
+
+class AlertRecord(Base):
+    """单个文件的全量威胁告警明细"""
+
+    __tablename__ = "alert_records"
+    __table_args__ = (
+        Index("ix_alert_hash_time", "file_hash", "time", "id"),
+        Index("ix_alert_hash_type", "file_hash", "threat_type", "time"),
+        Index("ix_alert_hash_src_ip", "file_hash", "src_ip"),
+        Index("ix_alert_hash_dst_ip", "file_hash", "dst_ip"),
+        Index("ix_alert_hash_port", "file_hash", "port", "time"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    file_hash: Mapped[str] = mapped_column(String(64))
+    time: Mapped[float] = mapped_column(Float)
+    src_ip: Mapped[str] = mapped_column(String(45))
+    dst_ip: Mapped[str] = mapped_column(String(45))
+    port: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    threat_type: Mapped[str] = mapped_column(String(64))
+    protocol: Mapped[str] = mapped_column(String(8))
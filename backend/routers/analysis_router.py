@@ -1,54 +1,143 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from pathlib import Path
+from typing import Iterator, Optional, Tuple
 import os
 import uuid
 import time
-import json
-import redis
 import logging
 
 # 业务逻辑引用
 from services.traffic_analyzer import TrafficAnalyzer
+from services.pcap_parser import PCAPParser
+from services.analysis_profiler import AnalysisProfiler
+from services.analysis_store import AnalysisStore
+from services.flow_store import FlowStore
+from services.file_catalog import file_catalog
+from clients import get_redis
+from database import SessionLocal
+from metrics import ANALYSIS_RESULTS, ANALYSIS_SECONDS, ANALYSIS_TASKS
+from models import PcapFile
+from serialization import JSONResponse, RawJSONResponse, dumps, loads, ndjson_response
+from services.task_events import (
+    analysis_channel,
+    publish_task_event,
+    stream_task_events,
+)
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
-UPLOAD_DIR = Path("uploads")
 
-# --- Redis 配置 ---
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=6379, decode_responses=True)
-except Exception as e:
-    logger.error(f"Redis init failed: {e}")
-    redis_client = None
+# 任务状态只是短期进度信息 (结果本体存放在快照库)，设置过期时间避免 Redis 无限增长
+ANALYSIS_TASK_TTL = int(os.getenv("ANALYSIS_TASK_TTL", "86400"))
+# NDJSON 流式导出明细时每次查询的行数
+NDJSON_PAGE_SIZE = 1000
+
+analysis_store = AnalysisStore()
+flow_store = FlowStore()
 
 # --- Redis 辅助函数 ---
 def save_analysis_task(task_id, data):
-    """将任务状态写入 Redis"""
+    """将任务状态写入 Redis (共享连接池)"""
+    redis_client = get_redis()
     if redis_client:
-        redis_client.set(f"analysis_task:{task_id}", json.dumps(data))
+        redis_client.set(f"analysis_task:{task_id}", dumps(data), ex=ANALYSIS_TASK_TTL)
 
 def get_analysis_task(task_id):
     """从 Redis 读取任务状态"""
+    redis_client = get_redis()
     if redis_client:
         data = redis_client.get(f"analysis_task:{task_id}")
-        return json.loads(data) if data else None
+        return loads(data) if data else None
     return None
 
+def save_analysis_profile(task_id, report):
+    """剖析产物与任务状态同样存放在 Redis、同样过期"""
+    redis_client = get_redis()
+    if redis_client:
+        redis_client.set(f"analysis_profile:{task_id}", dumps(report), ex=ANALYSIS_TASK_TTL)
+
+def load_analysis_profile(task_id):
+    redis_client = get_redis()
+    if redis_client:
+        data = redis_client.get(f"analysis_profile:{task_id}")
+        return loads(data) if data else None
+    return None
+
+def publish_analysis_event(task_id, task):
+    """推送任务状态变化 (不含结果本体，客户端收到 completed 后再拉取一次结果)"""
+    publish_task_event(get_redis(), analysis_channel(task_id), task)
+
+def _snapshot_params():
+    """快照参数：分析器结果版本号变化后旧快照自动失效"""
+    return {"version": TrafficAnalyzer.RESULT_VERSION}
+
+def _resolve_file_hash(file_id: str, file_path: Path) -> str:
+    """读取文件内容哈希；旧数据没有哈希时现场计算并回写数据库"""
+    entry = file_catalog.get(file_id)
+    if entry and entry.get("file_hash"):
+        return entry["file_hash"]
+
+    file_hash = PCAPParser(str(file_path)).get_file_hash()
+    db = SessionLocal()
+    try:
+        record = db.query(PcapFile).filter(PcapFile.file_id == file_id).first()
+        if record:
+            record.file_hash = file_hash
+            db.commit()
+    finally:
+        db.close()
+    file_catalog.invalidate(file_id)
+    return file_hash
+
+def _run_full_analysis(file_path: str, file_hash: str, profiler: Optional[AnalysisProfiler] = None):
+    """完整分析：同时把全量会话和告警写入明细表，供分页查询接口使用"""
+    return TrafficAnalyzer(file_path, profiler).full_analysis(
+        on_flows=lambda flows: flow_store.replace_flows(file_hash, flows),
+        on_alerts=lambda alerts: flow_store.replace_alerts(file_hash, alerts),
+    )
+
+def _run_analyzer(
+    file_path: str, file_hash: str, analysis_type: str, profiler: Optional[AnalysisProfiler] = None
+):
+    analyzer = TrafficAnalyzer(file_path, profiler)
+    if analysis_type == "full":
+        return _run_full_analysis(file_path, file_hash, profiler)
+    elif analysis_type == "attack_path":
+        return analyzer.get_attack_path_graph() # 适配 analyzer 的新旧方法名
+    elif analysis_type == "protocol":
+        return analyzer.analyze_protocols()
+    elif analysis_type == "flow":
+        return analyzer.analyze_flows()
+    return _run_full_analysis(file_path, file_hash, profiler)
+
 # --- 定义请求模型 (关键修复：恢复对 JSON Body 的支持) ---
 class AnalysisRequest(BaseModel):
     file_id: str
     analysis_type: str = "full"
+    # 在采样剖析器与 tracemalloc 下执行 (忽略已有快照，强制重新分析)，产物经 /profile/{task_id} 下载
+    profile: bool = False
 
 # --- 后台任务逻辑 ---
-def _run_analysis_task(task_id: str, file_path: str, analysis_type: str):
+def _run_analysis_task(
+    task_id: str,
+    file_id: str,
+    file_path: str,
+    file_hash: str,
+    analysis_type: str,
+    profile: bool = False,
+):
     """
-    后台执行流量分析
+    后台执行流量分析，结果写入快照库
     """
+    ANALYSIS_TASKS.labels("queued").dec()
+    ANALYSIS_TASKS.labels("running").inc()
+    started = time.perf_counter()
     try:
         # 1. 获取并更新状态：分析中
         task = get_analysis_task(task_id)
@@ -56,28 +145,28 @@ def _run_analysis_task(task_id: str, file_path: str, analysis_type: str):
         
         task["status"] = "analyzing"
         save_analysis_task(task_id, task)
+        publish_analysis_event(task_id, task)
 
         # 2. 执行分析
         # 注意：TrafficAnalyzer 已经优化为流式读取
-        analyzer = TrafficAnalyzer(file_path)
-        
-        result = None
-        if analysis_type == "full":
-            result = analyzer.full_analysis()
-        elif analysis_type == "attack_path":
-            result = analyzer.get_attack_path_graph() # 适配 analyzer 的新旧方法名
-        elif analysis_type == "protocol":
-            result = analyzer.analyze_protocols()
-        elif analysis_type == "flow":
-            result = analyzer.analyze_flows()
+        if not profile:
+            result = _run_analyzer(file_path, file_hash, analysis_type)
         else:
-            result = analyzer.full_analysis()
+            profiler = AnalysisProfiler()
+            with profiler:
+                result = _run_analyzer(file_path, file_hash, analysis_type, profiler)
+            save_analysis_profile(task_id, profiler.report())
+            task["profile"] = profiler.summary()
 
-        # 3. 更新状态：完成
+        # 3. 持久化结果 (任务状态中不再内嵌结果，查询时从快照库读取)
+        analysis_store.put(file_id, file_hash, analysis_type, result, _snapshot_params())
+
+        # 4. 更新状态：完成
         task["status"] = "completed"
-        task["result"] = result
         task["end_time"] = time.time()
         save_analysis_task(task_id, task)
+        publish_analysis_event(task_id, task)
+        ANALYSIS_RESULTS.labels("completed").inc()
 
     except Exception as e:
         logger.error(f"Analysis failed: {e}")
@@ -85,6 +174,22 @@ def _run_analysis_task(task_id: str, file_path: str, analysis_type: str):
         task["status"] = "failed"
         task["error"] = str(e)
         save_analysis_task(task_id, task)
+        publish_analysis_event(task_id, task)
+        ANALYSIS_RESULTS.labels("failed").inc()
+    finally:
+        ANALYSIS_TASKS.labels("running").dec()
+        ANALYSIS_SECONDS.observe(time.perf_counter() - started)
+
+def _submit_analysis_task(task_id: str, task_info: dict, use_snapshot: bool) -> bool:
+    """保存新任务；允许使用快照且快照存在时任务直接记为完成，返回是否命中快照"""
+    if use_snapshot and analysis_store.get(
+        task_info["file_hash"], task_info["analysis_type"], _snapshot_params()
+    ) is not None:
+        task_info.update({"status": "completed", "cached": True, "end_time": time.time()})
+        save_analysis_task(task_id, task_info)
+        return True
+    save_analysis_task(task_id, task_info)
+    return False
 
 # --- 路由接口 ---
 
@@ -92,45 +197,48 @@ def _run_analysis_task(task_id: str, file_path: str, analysis_type: str):
 async def analyze_traffic(request: AnalysisRequest, background_tasks: BackgroundTasks):
     """
     提交分析任务 (接收 file_id，异步处理)
+    同一文件内容已有分析快照时直接返回已完成的任务，不会重新分析
     """
-    # 1. 根据 file_id 查找文件
-    # 前端上传时可能保存为 {file_id}.pcap 或 {file_id}.pcapng
-    file_path = None
-    if UPLOAD_DIR.exists():
-        # 尝试直接匹配 ID
-        for ext in [".pcap", ".pcapng", ".cap"]:
-            possible_path = UPLOAD_DIR / f"{request.file_id}{ext}"
-            if possible_path.exists():
-                file_path = possible_path
-                break
-        
-        # 如果找不到，尝试模糊匹配 (防止上传时加了前缀)
-        if not file_path:
-            for f in UPLOAD_DIR.iterdir():
-                if request.file_id in f.name:
-                    file_path = f
-                    break
-
+    # 1. 根据 file_id 查找文件 (文件目录服务：LRU 缓存 + 数据库索引)
+    file_path = await run_in_threadpool(file_catalog.resolve, request.file_id)
     if not file_path:
         raise HTTPException(status_code=404, detail=f"PCAP file not found for ID: {request.file_id}")
 
     # 2. 生成任务 ID
     task_id = str(uuid.uuid4())
+    file_hash = await run_in_threadpool(_resolve_file_hash, request.file_id, file_path)
     
     # 3. 初始化任务状态到 Redis
     task_info = {
         "task_id": task_id,
         "file_id": request.file_id,
+        "file_hash": file_hash,
+        "analysis_type": request.analysis_type,
         "status": "pending",
+        "profiled": request.profile,
         "submit_time": time.time(),
         "file_path": str(file_path)
     }
-    save_analysis_task(task_id, task_info)
 
-    # 4. 启动后台任务
-    background_tasks.add_task(_run_analysis_task, task_id, str(file_path), request.analysis_type)
+    # 4. 命中快照则直接完成 (剖析请求总是重新分析)；快照查询与任务写入在同一次线程池调用中完成
+    cached = await run_in_threadpool(_submit_analysis_task, task_id, task_info, not request.profile)
+    if cached:
+        ANALYSIS_RESULTS.labels("cached").inc()
+        return {"task_id": task_id, "status": "completed", "message": "Analysis loaded from snapshot"}
+
+    # 5. 启动后台任务
+    ANALYSIS_TASKS.labels("queued").inc()
+    background_tasks.add_task(
+        _run_analysis_task,
+        task_id,
+        request.file_id,
+        str(file_path),
+        file_hash,
+        request.analysis_type,
+        request.profile,
+    )
 
-    # 5. 返回 task_id 给前端
+    # 6. 返回 task_id 给前端
     return {"task_id": task_id, "status": "pending", "message": "Analysis started"}
 
 
@@ -139,47 +247,206 @@ async def get_status(task_id: str):
     """
     查询任务状态 (从 Redis)
     """
-    task = get_analysis_task(task_id)
+    task = await run_in_threadpool(get_analysis_task, task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
-    
-    return task
+
+    if task.get("status") != "completed":
+        return JSONResponse(task)
+    # 结果以缓存中的 JSON 字节原样拼入响应，不做解码与重新编码
+    task.pop("result", None)
+    result = await run_in_threadpool(
+        analysis_store.get_raw,
+        task.get("file_hash"),
+        task.get("analysis_type", "full"),
+        _snapshot_params(),
+    )
+    return RawJSONResponse(dumps(task)[:-1] + b',"result":' + (result or b"null") + b"}")
+
+
+@router.get("/profile/{task_id}")
+async def get_analysis_profile(
+    task_id: str, format: str = Query("json", pattern="^(json|collapsed)$")
+):
+    """
+    下载剖析产物 (提交时 profile=true 的任务)
+    json: 计数器、热点帧、内存分配 Top 与折叠栈；collapsed: 仅折叠栈文本，可直接导入 flamegraph.pl / speedscope
+    """
+    profile = await run_in_threadpool(load_analysis_profile, task_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        return PlainTextResponse(
+            profile["collapsed"],
+            headers={"Content-Disposition": f'attachment; filename="analysis-{task_id}.collapsed.txt"'},
+        )
+    return profile
+
+
+@router.get("/events/{task_id}")
+async def stream_status(task_id: str):
+    """
+    订阅任务进度 (SSE)，替代前端定时轮询 /status
+    """
+    if not await run_in_threadpool(get_analysis_task, task_id):
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    def snapshot():
+        return get_analysis_task(task_id)
+
+    return StreamingResponse(
+        stream_task_events(analysis_channel(task_id), snapshot=snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # --- 兼容接口 ---
 
 def _find_file_by_id(file_id: str) -> Path:
-    if not UPLOAD_DIR.exists(): return None
-    for ext in [".pcap", ".pcapng", ".cap"]:
-        path = UPLOAD_DIR / f"{file_id}{ext}"
-        if path.exists(): return path
-    for f in UPLOAD_DIR.iterdir():
-        if file_id in f.name: return f
-    return None
+    return file_catalog.resolve(file_id)
+
+def _load_full_analysis(file_id: str, file_path: Path) -> dict:
+    """兼容接口共用：优先读取快照，没有快照时分析一次并保存"""
+    file_hash = _resolve_file_hash(file_id, file_path)
+    result = analysis_store.get(file_hash, "full", _snapshot_params())
+    if result is None:
+        result = _run_full_analysis(str(file_path), file_hash)
+        analysis_store.put(file_id, file_hash, "full", result, _snapshot_params())
+    return result
 
 @router.get("/{file_id}/attack-path")
 async def get_attack_path(file_id: str):
-    file_path = _find_file_by_id(file_id)
+    file_path = await run_in_threadpool(_find_file_by_id, file_id)
     if not file_path: raise HTTPException(status_code=404, detail="File not found")
     try:
-        return TrafficAnalyzer(str(file_path)).get_attack_path_graph()
+        return JSONResponse((await run_in_threadpool(_load_full_analysis, file_id, file_path))["attack_path"])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/{file_id}/statistics")
 async def get_statistics(file_id: str):
-    file_path = _find_file_by_id(file_id)
+    file_path = await run_in_threadpool(_find_file_by_id, file_id)
     if not file_path: raise HTTPException(status_code=404, detail="File not found")
     try:
-        return TrafficAnalyzer(str(file_path)).get_statistics()
+        return JSONResponse((await run_in_threadpool(_load_full_analysis, file_id, file_path))["statistics"])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/{file_id}/timeline")
-async def get_timeline(file_id: str):
-    file_path = _find_file_by_id(file_id)
+async def get_timeline(file_id: str, format: str = Query("json", pattern="^(json|ndjson)$")):
+    """format=ndjson 时每个时间点一行，流式返回"""
+    file_path = await run_in_threadpool(_find_file_by_id, file_id)
     if not file_path: raise HTTPException(status_code=404, detail="File not found")
     try:
-        return TrafficAnalyzer(str(file_path)).get_timeline_data()
+        timeline = (await run_in_threadpool(_load_full_analysis, file_id, file_path))["timeline"]
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+    if format == "ndjson":
+        return ndjson_response(timeline.get("timeline") or [])
+    return JSONResponse(timeline)
+
+
+def _fetch_page(file_hash: str, query_fn, params: dict) -> dict:
+    db = SessionLocal()
+    try:
+        return query_fn(db, file_hash, **params)
+    finally:
+        db.close()
+
+def _query_records(file_id: str, file_path: Path, query_fn, **params) -> dict:
+    file_hash = _resolve_file_hash(file_id, file_path)
+    result = _fetch_page(file_hash, query_fn, params)
+    # 明细表在完整分析完成后写入，未分析过的文件返回空结果并提示
+    result["indexed"] = analysis_store.exists(file_hash, "full", _snapshot_params())
+    return result
+
+def _stream_records(file_id: str, file_path: Path, query_fn, **params) -> Tuple[Iterator[dict], bool]:
+    """
+    NDJSON 导出：从 cursor 开始按游标逐页查询直到末尾，每页单独的短会话
+    首页在返回前查询 (参数错误可以返回 400 而不是中断已开始的流)
+    """
+    file_hash = _resolve_file_hash(file_id, file_path)
+    params["limit"] = NDJSON_PAGE_SIZE
+    first = _fetch_page(file_hash, query_fn, params)
+
+    def rows() -> Iterator[dict]:
+        page = first
+        while True:
+            yield from page["items"]
+            if not page["next_cursor"]:
+                return
+            page = _fetch_page(file_hash, query_fn, {**params, "cursor": page["next_cursor"]})
+
+    return rows(), analysis_store.exists(file_hash, "full", _snapshot_params())
+
+async def _records_response(format: str, file_id: str, file_path: Path, query_fn, **params):
+    if format == "ndjson":
+        rows, indexed = await run_in_threadpool(_stream_records, file_id, file_path, query_fn, **params)
+        return ndjson_response(rows, headers={"X-Indexed": "true" if indexed else "false"})
+    return JSONResponse(
+        await run_in_threadpool(_query_records, file_id, file_path, query_fn, **params)
+    )
+
+@router.get("/{file_id}/flows")
+async def query_flows(
+    file_id: str,
+    ip: Optional[str] = None,
+    src_ip: Optional[str] = None,
+    dst_ip: Optional[str] = None,
+    port: Optional[int] = None,
+    protocol: Optional[str] = None,
+    threat_type: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    sort: str = Query("packets", pattern="^(packets|bytes|duration|start_time)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """
+    会话明细查询 (全量，不限于 Top 50)：支持 IP/端口/协议/威胁类型/时间范围过滤，
+    按包数/字节数/持续时间排序，使用 next_cursor 翻页；
+    format=ndjson 时从 cursor 起流式返回全部匹配会话 (每行一条，忽略 limit)
+    """
+    file_path = await run_in_threadpool(_find_file_by_id, file_id)
+    if not file_path: raise HTTPException(status_code=404, detail="File not found")
+    try:
+        return await _records_response(
+            format, file_id, file_path, FlowStore.query_flows,
+            ip=ip, src_ip=src_ip, dst_ip=dst_ip, port=port, protocol=protocol,
+            threat_type=threat_type, start=start, end=end,
+            sort=sort, order=order, limit=limit, cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{file_id}/alerts")
+async def query_alerts(
+    file_id: str,
+    ip: Optional[str] = None,
+    src_ip: Optional[str] = None,
+    dst_ip: Optional[str] = None,
+    port: Optional[int] = None,
+    protocol: Optional[str] = None,
+    threat_type: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """威胁告警明细查询：过滤 + 按时间排序 + 游标分页；format=ndjson 时从 cursor 起流式返回全部匹配告警"""
+    file_path = await run_in_threadpool(_find_file_by_id, file_id)
+    if not file_path: raise HTTPException(status_code=404, detail="File not found")
+    try:
+        return await _records_response(
+            format, file_id, file_path, FlowStore.query_alerts,
+            ip=ip, src_ip=src_ip, dst_ip=dst_ip, port=port, protocol=protocol,
+            threat_type=threat_type, start=start, end=end,
+            order=order, limit=limit, cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,120 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from typing import Optional
+import logging
+
+from clients import get_redis
+from serialization import JSONResponse, RawJSONResponse, loads
+from services.live_capture import (
+    LIVE_WINDOW_SECONDS,
+    live_registry,
+    resolve_target,
+    snapshot_key,
+)
+from services.task_events import live_channel, stream_task_events
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+class LiveWatchRequest(BaseModel):
+    # LIVE_CAPTURE_ROOT 下的抓包文件或轮转目录 (相对路径)
+    path: str
+    # 滚动窗口长度 (秒，按抓包时间)
+    window_seconds: int = LIVE_WINDOW_SECONDS
+
+
+def _stored_snapshot(watch_id: str) -> Optional[bytes]:
+    """Redis 中的最新快照 (任务可能运行在其他进程中)"""
+    return get_redis().get(snapshot_key(watch_id))
+
+
+@router.post("/start")
+async def start_watch(request: LiveWatchRequest):
+    """
+    开始监视 (同一目标已在监视时直接返回该任务)
+    同一目标再次开始时从断点继续 (已处理的数据不再重复读取)，统计从本次开始累计
+    """
+    if request.window_seconds <= 0:
+        raise HTTPException(status_code=400, detail="window_seconds must be positive")
+    try:
+        target = resolve_target(request.path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    session = await run_in_threadpool(
+        live_registry.start, target, request.window_seconds, get_redis()
+    )
+    return {"watch_id": session.watch_id, "target": str(session.target), "status": session.status}
+
+
+@router.get("/")
+async def list_watches():
+    """本进程中的监视任务"""
+    return [
+        {
+            "watch_id": s.watch_id,
+            "target": str(s.target),
+            "status": s.status,
+            "window_seconds": s.window,
+            "started_at": s.started_at,
+        }
+        for s in live_registry.list()
+    ]
+
+
+@router.get("/{watch_id}")
+async def get_snapshot(watch_id: str):
+    """最新快照：累计统计、滚动窗口统计、窗口内告警与各文件进度"""
+    session = live_registry.get(watch_id)
+    if session is not None:
+        return JSONResponse(await run_in_threadpool(session.snapshot))
+    data = await run_in_threadpool(_stored_snapshot, watch_id)
+    if not data:
+        raise HTTPException(status_code=404, detail="Watch not found")
+    return RawJSONResponse(data)
+
+
+@router.get("/{watch_id}/events")
+async def stream_watch(watch_id: str):
+    """订阅快照推送 (SSE)，每个发布周期一条，含自上次推送以来的新告警"""
+    session = live_registry.get(watch_id)
+    if session is None and not await run_in_threadpool(_stored_snapshot, watch_id):
+        raise HTTPException(status_code=404, detail="Watch not found")
+
+    def snapshot():
+        if session is not None:
+            return session.snapshot()
+        data = _stored_snapshot(watch_id)
+        return loads(data) if data else None
+
+    return StreamingResponse(
+        stream_task_events(live_channel(watch_id), snapshot=snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{watch_id}/result")
+async def get_result(watch_id: str):
+    """累计的完整分析结果 (结构同离线分析结果)"""
+    session = live_registry.get(watch_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Watch not running in this instance")
+    return JSONResponse(await run_in_threadpool(session.result))
+
+
+@router.delete("/{watch_id}")
+async def stop_watch(watch_id: str):
+    """停止监视 (断点保留，再次开始时继续)；任务运行在其他进程时经 Redis 通知"""
+    local = await run_in_threadpool(live_registry.stop, watch_id, get_redis())
+    if not local and not await run_in_threadpool(_stored_snapshot, watch_id):
+        raise HTTPException(status_code=404, detail="Watch not found")
+    return {"watch_id": watch_id, "message": "Stop requested"}
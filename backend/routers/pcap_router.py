@@ -1,17 +1,54 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, BackgroundTasks, File, Header, Request, UploadFile, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
 from pathlib import Path
+from typing import Optional
+import asyncio
+import errno
 import uuid
 import os
-import json
-from datetime import datetime
-from sqlalchemy.orm import Session
+import time
+import hashlib
+import logging
 
 # 确保引入了 DB 相关依赖
 from services.pcap_parser import PCAPParser
-from database import get_db
+from services.analysis_store import AnalysisStore
+from services.flow_store import FlowStore
+from services.file_catalog import file_catalog, FileCatalog
+from services.metadata_writer import metadata_writer
+from services.packet_search import (
+    PACKET_SEARCH_INDEX_ON_UPLOAD,
+    PacketSearchIndex,
+    PcapExporter,
+    build_search_index,
+    delete_derived_files,
+)
+from services.packet_filter import PacketFilter
+from services.upload_sessions import (
+    ChecksumMismatch,
+    IncompleteUpload,
+    UploadBusy,
+    UploadSessionStore,
+)
+from clients import get_redis
+from database import SessionLocal
+from metrics import (
+    PARSE_SECONDS,
+    UPLOAD_BYTES,
+    UPLOAD_CHUNKS,
+    UPLOAD_SECONDS,
+    UPLOAD_THROUGHPUT,
+    cache_lookup,
+)
+from serialization import JSONResponse, RawJSONResponse, dumps, ndjson_response
 from models import PcapFile
 
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 UPLOAD_DIR = Path("uploads")
@@ -19,10 +56,50 @@ RESULTS_DIR = Path("results")
 RESULTS_DIR.mkdir(exist_ok=True)
 UPLOAD_DIR.mkdir(exist_ok=True)  # 确保上传目录存在
 
+# 上传落盘时的分块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 包检索 JSON 响应的默认/最大页大小 (更大的结果集使用 NDJSON 流式返回)
+SEARCH_PAGE_SIZE = 100
+SEARCH_PAGE_MAX = 1000
+
+
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+    # 分块大小 (字节)，缺省为 UPLOAD_CHUNK_DEFAULT
+    chunk_size: Optional[int] = None
+    # 可选的整体 SHA-256，complete 时核对
+    sha256: Optional[str] = None
+
+
+def _save_upload(source, save_path: Path):
+    """把上传内容分块写入磁盘并同时计算 SHA-256，返回 (字节数, 摘要)，不在内存中保留整个文件"""
+    digest = hashlib.sha256()
+    size = 0
+    source.seek(0)
+    with open(save_path, "wb") as f:
+        while True:
+            chunk = source.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def _parse_basic_info(save_path: Path):
+    with PARSE_SECONDS.labels("basic").time():
+        return PCAPParser(str(save_path)).get_basic_info()
+
 
 @router.post("/upload")
-async def upload_pcap(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    """上传PCAP文件"""
+async def upload_pcap(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    """
+    上传PCAP文件
+    落盘、解析和数据库写入都是阻塞操作，分别放到线程池 / 元数据写入线程中执行，不占用事件循环；
+    响应返回后在后台生成包检索索引
+    """
     if not file.filename.endswith((".pcap", ".pcapng", ".cap")):
         raise HTTPException(status_code=400, detail="只支持PCAP格式文件")
 
@@ -32,32 +109,54 @@ async def upload_pcap(file: UploadFile = File(...), db: Session = Depends(get_db
     save_path = UPLOAD_DIR / f"{file_id}{file_extension}"
 
     # 保存文件
+    started = time.perf_counter()
     try:
-        content = await file.read()
-        with open(save_path, "wb") as f:
-            f.write(content)
+        size, file_hash = await run_in_threadpool(_save_upload, file.file, save_path)
     except Exception as e:
+        if save_path.exists():
+            os.remove(save_path)
         raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
+    elapsed = time.perf_counter() - started
+    UPLOAD_BYTES.inc(size)
+    _observe_upload(size, elapsed)
+    return await _register_upload(background_tasks, file_id, file.filename, save_path, size, file_hash)
+
+
+def _observe_upload(size: int, elapsed: float):
+    UPLOAD_SECONDS.observe(elapsed)
+    if elapsed > 0:
+        UPLOAD_THROUGHPUT.observe(size / elapsed)
 
-    # 解析基本信息
-    parser = PCAPParser(str(save_path))
+
+async def _register_upload(
+    background_tasks: BackgroundTasks,
+    file_id: str,
+    filename: str,
+    save_path: Path,
+    size: int,
+    file_hash: str,
+):
+    """已落盘的上传文件入库：解析基本信息、写入元数据，响应返回后在后台生成包检索索引"""
     try:
-        basic_info = parser.get_basic_info()
-        # 写入数据库
+        # 解析基本信息
+        basic_info = await run_in_threadpool(_parse_basic_info, save_path)
+        # 写入数据库 (与同一时刻的其他上传合并为一次提交)
         db_obj = PcapFile(
             file_id=file_id,
-            filename=file.filename,  # 存入原始文件名
+            filename=filename,  # 存入原始文件名
             path=str(save_path),
-            size=len(content),
+            size=size,
             total_packets=basic_info.get("total_packets", 0),
             duration=basic_info.get("duration", 0.0),
+            file_hash=file_hash,
         )
-        db.add(db_obj)
-        db.commit()
+        await asyncio.wrap_future(metadata_writer.submit(db_obj))
+        if PACKET_SEARCH_INDEX_ON_UPLOAD:
+            background_tasks.add_task(build_search_index, str(save_path), file_hash)
         return {
             "file_id": file_id,
-            "filename": file.filename,
-            "size": len(content),
+            "filename": filename,
+            "size": size,
             "info": basic_info,
         }
     except Exception as e:
@@ -67,89 +166,363 @@ async def upload_pcap(file: UploadFile = File(...), db: Session = Depends(get_db
         raise HTTPException(status_code=500, detail=f"PCAP解析失败: {str(e)}")
 
 
-@router.get("/list")
-async def list_pcap_files(db: Session = Depends(get_db)):
+# --- 可续传的分块上传 ---
+@router.post("/uploads")
+async def create_upload_session(request: UploadSessionRequest):
     """
-    列出所有已上传的PCAP文件
-    (从数据库读取，以获取原始文件名和时间)
+    创建分块上传会话 (服务端按 size 预分配文件)
+    返回 upload_id 与 chunk_size，之后按 chunk_size 的整数倍偏移 PATCH 各分块
     """
-    # 查询数据库所有记录
-    records = db.query(PcapFile).all()
-
-    files = []
-    for row in records:
-        # 获取文件上传时间 (如果没有数据库时间字段，则读取物理文件的修改时间)
-        upload_time_str = "未知"
-        if os.path.exists(row.path):
-            timestamp = os.path.getmtime(row.path)
-            upload_time_str = datetime.fromtimestamp(timestamp).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
+    store = UploadSessionStore(get_redis())
+    try:
+        session = await run_in_threadpool(
+            store.create, request.filename, request.size, request.chunk_size, request.sha256
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise HTTPException(status_code=507, detail="磁盘空间不足")
+        raise HTTPException(status_code=500, detail=f"创建上传会话失败: {str(e)}")
+    return await run_in_threadpool(store.status, session["upload_id"])
+
+
+@router.get("/uploads/{upload_id}")
+async def get_upload_session(upload_id: str):
+    """会话进度，missing 为尚未接收的分块偏移 (断线续传时只补传这些分块)"""
+    status = await run_in_threadpool(UploadSessionStore(get_redis()).status, upload_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    return status
 
-        files.append(
-            {
-                "file_id": row.file_id,
-                "filename": row.filename,  # 这里返回的是数据库里存的原始文件名
-                "size": row.size,
-                "upload_time": upload_time_str,  # 新增的时间字段
-            }
+
+@router.patch("/uploads/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    x_chunk_sha256: Optional[str] = Header(None),
+    x_chunk_crc32: Optional[str] = Header(None),
+):
+    """
+    上传一个分块 (请求体为原始字节)，须带 X-Chunk-SHA256 或 X-Chunk-CRC32 (十六进制) 校验头
+    分块可并发、乱序、重复上传；数据先写入临时文件，校验一致后才写入上传文件，
+    校验不一致时返回 422 (已接收的同一分块不受影响)；complete 开始后到达的分块返回 409
+    """
+    expected = x_chunk_sha256 or x_chunk_crc32
+    if not expected:
+        raise HTTPException(status_code=400, detail="Missing X-Chunk-SHA256 or X-Chunk-CRC32 header")
+    store = UploadSessionStore(get_redis())
+    session = await run_in_threadpool(store.get, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    if session["status"] != "uploading":
+        raise HTTPException(status_code=409, detail="上传会话已完成")
+    try:
+        writer = await run_in_threadpool(
+            store.open_chunk, session, offset, "sha256" if x_chunk_sha256 else "crc32"
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="上传会话数据已丢失")
+
+    try:
+        declared = request.headers.get("content-length")
+        if declared is not None and int(declared) != writer.length:
+            raise ValueError(f"Chunk at offset {offset} must be {writer.length} bytes")
+        # 请求体边收边写临时文件：攒满 UPLOAD_CHUNK_SIZE 后在线程池中写出，内存占用与分块大小无关
+        buffer = bytearray()
+        async for piece in request.stream():
+            buffer += piece
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                data, buffer = buffer, bytearray()
+                await run_in_threadpool(writer.write, data)
+        if buffer:
+            await run_in_threadpool(writer.write, buffer)
+        writer.verify(expected)
+        received = await run_in_threadpool(store.commit_chunk, session, writer)
+    except ChecksumMismatch as e:
+        UPLOAD_CHUNKS.labels("checksum_mismatch").inc()
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        UPLOAD_CHUNKS.labels("rejected").inc()
+        raise HTTPException(status_code=400, detail=str(e))
+    except UploadBusy:
+        UPLOAD_CHUNKS.labels("rejected").inc()
+        raise HTTPException(status_code=409, detail="上传正在完成中")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="上传会话数据已丢失")
+    finally:
+        await run_in_threadpool(writer.close)
+
+    UPLOAD_CHUNKS.labels("ok").inc()
+    UPLOAD_BYTES.inc(writer.length)
+    return {
+        "upload_id": upload_id,
+        "offset": offset,
+        "length": writer.length,
+        "checksum": writer.checksum,
+        "received": received,
+        "chunks": session["chunks"],
+    }
+
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, background_tasks: BackgroundTasks):
+    """
+    全部分块到齐后完成上传：计算整体摘要并按常规上传入库 (file_id 即 upload_id)
+    仍有缺失分块时返回 409 与缺失偏移；重复调用返回同一结果
+    """
+    store = UploadSessionStore(get_redis())
+    session = await run_in_threadpool(store.get, upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    if session["status"] == "completed":
+        return session["result"]
+
+    save_path = UPLOAD_DIR / f"{upload_id}{Path(session['filename']).suffix}"
+    try:
+        size, file_hash = await run_in_threadpool(store.finalize, upload_id, save_path)
+    except IncompleteUpload as e:
+        raise HTTPException(
+            status_code=409, detail={"message": "仍有分块未上传", "missing": e.missing}
+        )
+    except UploadBusy:
+        raise HTTPException(status_code=409, detail="上传正在完成中")
+    except ChecksumMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="上传会话数据已丢失")
+    _observe_upload(size, time.time() - session["created_at"])
+
+    try:
+        result = await _register_upload(
+            background_tasks, upload_id, session["filename"], save_path, size, file_hash
         )
+    except HTTPException:
+        await run_in_threadpool(store.abort, upload_id)
+        raise
+    await run_in_threadpool(store.complete, upload_id, result)
+    return result
+
 
-    # 按时间倒序排列（最新的在最前）
-    files.sort(key=lambda x: x["upload_time"], reverse=True)
+@router.delete("/uploads/{upload_id}")
+async def abort_upload(upload_id: str):
+    """放弃上传会话并删除已接收的数据"""
+    if not await run_in_threadpool(UploadSessionStore(get_redis()).abort, upload_id):
+        raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+    return {"message": "上传已取消", "upload_id": upload_id}
 
-    return {"files": files}
+
+def _list_files(page: int, page_size: int):
+    db = SessionLocal()
+    try:
+        return FileCatalog.list_files(db, page, page_size)
+    finally:
+        db.close()
+
+
+@router.get("/list")
+async def list_pcap_files(
+    page: int = Query(1, ge=1),
+    page_size: int = Query(100, ge=1, le=1000),
+):
+    """
+    分页列出已上传的PCAP文件
+    (从数据库读取原始文件名和上传时间，按上传时间倒序，排序与分页均在数据库中完成)
+    """
+    return await run_in_threadpool(_list_files, page, page_size)
 
 
 @router.get("/{file_id}/info")
 async def get_pcap_info(file_id: str):
-    """获取PCAP文件详细信息"""
+    """获取PCAP文件详细信息 (首次解析整个文件，在线程池中执行)"""
+    return RawJSONResponse(await run_in_threadpool(_load_pcap_info, file_id))
+
+
+def _load_pcap_info(file_id: str) -> bytes:
+    """返回编码好的 JSON (缓存命中时原样读出，不解码)"""
     # 1. 尝试从缓存读取分析结果
     result_path = RESULTS_DIR / f"{file_id}.json"
     if result_path.exists():
         try:
-            with open(result_path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            info = result_path.read_bytes()
+            cache_lookup("pcap_info", True)
+            return info
         except Exception:
             pass
+    cache_lookup("pcap_info", False)
 
-    file_path = None
-    for ext in [".pcap", ".pcapng", ".cap"]:
-        path = UPLOAD_DIR / f"{file_id}{ext}"
-        if path.exists():
-            file_path = path
-            break
-
+    file_path = file_catalog.resolve(file_id)
     if not file_path:
         raise HTTPException(status_code=404, detail="文件不存在")
 
     parser = PCAPParser(str(file_path))
     try:
-        info = parser.get_detailed_info()
+        with PARSE_SECONDS.labels("detailed").time():
+            info = dumps(parser.get_detailed_info())
 
         # 2. 保存分析结果到文件
         try:
-            with open(result_path, "w", encoding="utf-8") as f:
-                json.dump(info, f, ensure_ascii=False)
+            result_path.write_bytes(info)
         except Exception as e:
-            print(f"Warning: Failed to save analysis result: {e}")
+            logger.warning(f"Failed to save analysis result: {e}")
 
         return info
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"解析失败: {str(e)}")
 
 
+@router.get("/{file_id}/search")
+async def search_packets(
+    file_id: str,
+    q: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    flow: Optional[int] = Query(None, ge=0),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """
+    包检索：q 为类 BPF 布尔表达式 (如 host 10.0.0.1 and host 10.0.0.2 and port 445)，
+    可叠加时间范围与会话编号；返回命中包数与按包序号排列的包摘要 (offset/limit 翻页)
+    format=ndjson 时逐行流式返回包摘要 (不限 limit 时直到最后一个命中包)，命中包数与会话数在响应头中
+    """
+    if format == "ndjson":
+        total, flows, summaries = await run_in_threadpool(
+            _stream_packets, file_id, q, start, end, flow, offset, limit
+        )
+        return ndjson_response(
+            summaries, headers={"X-Total-Count": str(total), "X-Flow-Count": str(flows)}
+        )
+    if limit is None:
+        limit = SEARCH_PAGE_SIZE
+    elif limit > SEARCH_PAGE_MAX:
+        raise HTTPException(
+            status_code=400, detail=f"limit 不能超过 {SEARCH_PAGE_MAX} (大结果请使用 format=ndjson)"
+        )
+    return JSONResponse(
+        await run_in_threadpool(_search_packets, file_id, q, start, end, flow, offset, limit)
+    )
+
+
+def _open_search_index(file_id: str) -> PacketSearchIndex:
+    entry = file_catalog.get(file_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    # 旧数据没有入库哈希时现场计算 (索引按内容哈希存放)
+    file_hash = entry["file_hash"] or PCAPParser(entry["path"]).get_file_hash()
+    return PacketSearchIndex.open(entry["path"], file_hash)
+
+
+def _search_packets(file_id: str, q, start, end, flow, offset: int, limit: int):
+    try:
+        result = _open_search_index(file_id).search(q, start, end, flow, offset, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"file_id": file_id, "expression": q, **result}
+
+
+def _stream_packets(file_id: str, q, start, end, flow, offset: int, limit: Optional[int]):
+    try:
+        return _open_search_index(file_id).stream(q, start, end, flow, offset, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/{file_id}/export")
+async def export_pcap(
+    file_id: str,
+    q: Optional[str] = None,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    flow: Optional[int] = Query(None, ge=0),
+    flow_id: Optional[int] = None,
+    alert_id: Optional[int] = None,
+    src_ip: Optional[str] = None,
+    dst_ip: Optional[str] = None,
+    src_port: Optional[int] = None,
+    dst_port: Optional[int] = None,
+    protocol: Optional[str] = None,
+):
+    """
+    导出 PCAP：条件同包检索 (q / start / end / flow)，另可按会话或告警记录 (flow_id / alert_id)
+    或五元组 (双向) 选取，各条件之间为"与"关系；不带任何条件时下载原始文件
+    命中记录由内核从源文件整段拷贝到导出文件 (按条件缓存)，响应同样以零拷贝方式发送
+    """
+    tuple_fields = {
+        "src_ip": src_ip,
+        "dst_ip": dst_ip,
+        "src_port": src_port,
+        "dst_port": dst_port,
+        "protocol": protocol,
+    }
+    return await run_in_threadpool(
+        _export_pcap, file_id, q, start, end, flow, flow_id, alert_id, tuple_fields
+    )
+
+
+def _export_pcap(file_id: str, q, start, end, flow, flow_id, alert_id, tuple_fields: dict):
+    entry = file_catalog.get(file_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    path = Path(entry["path"])
+    file_hash = entry["file_hash"] or PCAPParser(entry["path"]).get_file_hash()
+
+    parts = []
+    try:
+        if any(v is not None for v in tuple_fields.values()):
+            parts.append(PacketFilter.flow_expression(**tuple_fields))
+        if flow_id is not None or alert_id is not None:
+            db = SessionLocal()
+            try:
+                record = FlowStore.flow_tuple(db, file_hash, flow_id, alert_id)
+            finally:
+                db.close()
+            if record is None:
+                raise HTTPException(
+                    status_code=404, detail="会话或告警不存在 (请先完成该文件的完整分析)"
+                )
+            parts.append(PacketFilter.flow_expression(**record))
+        if q and q.strip():
+            parts.append(q.strip())
+        if len(parts) > 1:
+            parts = [f"({p})" for p in parts]
+
+        if not parts and start is None and end is None and flow is None:
+            # 原始文件可能是 PCAPNG，按通用二进制类型下发
+            return FileResponse(path, media_type="application/octet-stream", filename=entry["filename"])
+        result = PcapExporter(str(path), file_hash).export(
+            " and ".join(parts) or None, start, end, flow
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    stem = Path(entry["filename"]).stem
+    return FileResponse(
+        result["path"],
+        media_type="application/vnd.tcpdump.pcap",
+        filename=f"{stem}-export.pcap",
+        headers={"X-Packet-Count": str(result["packets"])},
+    )
+
+
 @router.delete("/{file_id}")
-async def delete_pcap(file_id: str, db: Session = Depends(get_db)):
+async def delete_pcap(file_id: str):
     """删除PCAP文件"""
+    return await run_in_threadpool(_delete_pcap, file_id)
+
+
+def _delete_pcap(file_id: str):
     # 1. 删除物理文件
     deleted = False
-    for ext in [".pcap", ".pcapng", ".cap"]:
-        file_path = UPLOAD_DIR / f"{file_id}{ext}"
-        if file_path.exists():
-            os.remove(file_path)
-            deleted = True
-            break
+    file_path = file_catalog.resolve(file_id)
+    if file_path:
+        os.remove(file_path)
+        deleted = True
+    file_catalog.invalidate(file_id)
 
     # 2. 删除缓存文件
     result_path = RESULTS_DIR / f"{file_id}.json"
@@ -157,10 +530,23 @@ async def delete_pcap(file_id: str, db: Session = Depends(get_db)):
         os.remove(result_path)
 
     # 3. 删除数据库记录 (可选，建议加上以保持数据一致性)
-    db_record = db.query(PcapFile).filter(PcapFile.file_id == file_id).first()
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        db_record = db.query(PcapFile).filter(PcapFile.file_id == file_id).first()
+        if db_record:
+            db.delete(db_record)
+            db.commit()
+            still_used = db_record.file_hash and (
+                db.query(PcapFile.id).filter(PcapFile.file_hash == db_record.file_hash).first()
+            )
+    finally:
+        db.close()
     if db_record:
-        db.delete(db_record)
-        db.commit()
+        # 4. 没有其他文件引用同一内容时，一并清理分析快照、会话/告警明细，以及包索引与导出/重放派生文件
+        AnalysisStore().delete_for_hash(db_record.file_hash)
+        FlowStore().delete_for_hash(db_record.file_hash)
+        if db_record.file_hash and not still_used:
+            delete_derived_files(db_record.file_hash)
 
     if not deleted and not db_record:
         # 如果文件和数据库都没找到
@@ -1,92 +1,301 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional
 
+from clients import get_redis
+from database import SessionLocal
 from services.traffic_replayer import TrafficReplayer
+from services.replay_scheduler import QueueFullError
+from services.sandbox_pool import sandbox_pool
+from services.file_catalog import file_catalog
+from services.flow_store import FlowStore
+from services.packet_filter import PacketFilter
+from services.task_events import (
+    REPLAY_CHANNEL_PREFIX,
+    replay_channel,
+    stream_task_events,
+)
 
 router = APIRouter()
 
-UPLOAD_DIR = Path("uploads")
+
+class ReplayFlow(BaseModel):
+    src_ip: Optional[str] = None
+    dst_ip: Optional[str] = None
+    src_port: Optional[int] = None
+    dst_port: Optional[int] = None
+    protocol: Optional[str] = None
+    # 同时匹配反方向的应答包
+    bidirectional: bool = True
+
+
+class ReplayFilter(BaseModel):
+    """重放子集条件，各条件之间为"与"关系"""
+
+    # 类 BPF 表达式，如 "tcp and host 10.0.0.5 and port 80"
+    expression: Optional[str] = None
+    # 会话五元组，或分析结果中的会话/告警 ID
+    flow: Optional[ReplayFlow] = None
+    flow_id: Optional[int] = None
+    alert_id: Optional[int] = None
+    # 抓包时间范围 (Unix 时间戳，秒)
+    start_time: Optional[float] = None
+    end_time: Optional[float] = None
+    # 包序号范围 [[起, 止], ...]，从 0 开始、含两端
+    packet_ranges: Optional[List[List[int]]] = None
 
 
 class ReplayRequest(BaseModel):
     file_id: str
     target_ip: Optional[str] = None
+    # 目标主机 MAC：给出时改写发往/来自目标地址的帧的 MAC
+    target_mac: Optional[str] = None
+    # 显式地址映射 (原地址 -> 新地址)，可与 target_ip 同时使用
+    ip_map: Optional[Dict[str, str]] = None
+    # 只重放抓包的一个子集 (单个会话、告警所在会话、时间窗口等)
+    filter: Optional[ReplayFilter] = None
     speed_multiplier: float = 1.0
     use_sandbox: bool = True
+    # 重放期间在沙箱网卡抓包，结束后与源抓包对齐，报告丢包、乱序与包间隔抖动
+    measure_fidelity: bool = False
 
 
 class ReplayStatusRequest(BaseModel):
     task_id: str
 
 
+class SandboxScaleRequest(BaseModel):
+    replicas: int
+
+
+def _build_selection(file_hash: Optional[str], f: ReplayFilter) -> dict:
+    """把请求中的会话/告警/五元组条件转换为过滤表达式，与其余条件一起组成子集选择"""
+    parts = []
+    if f.flow is not None:
+        parts.append(
+            PacketFilter.flow_expression(
+                f.flow.src_ip,
+                f.flow.dst_ip,
+                f.flow.src_port,
+                f.flow.dst_port,
+                f.flow.protocol,
+                f.flow.bidirectional,
+            )
+        )
+    if f.flow_id is not None or f.alert_id is not None:
+        db = SessionLocal()
+        try:
+            flow = FlowStore.flow_tuple(db, file_hash, f.flow_id, f.alert_id)
+        finally:
+            db.close()
+        if flow is None:
+            raise LookupError("会话或告警不存在 (请先完成该文件的完整分析)")
+        parts.append(PacketFilter.flow_expression(**flow))
+    if f.expression and f.expression.strip():
+        parts.append(f.expression.strip())
+
+    if len(parts) > 1:
+        parts = [f"({p})" for p in parts]
+    return {
+        "expression": " and ".join(parts) or None,
+        "start_time": f.start_time,
+        "end_time": f.end_time,
+        "packet_ranges": f.packet_ranges,
+    }
+
+
+def get_replayer(redis_client=Depends(get_redis)):
+    """注入共享 Redis 客户端的重放器 (构造开销可忽略)"""
+    return TrafficReplayer(redis_client=redis_client)
+
+
 @router.post("/start")
-async def start_replay(request: ReplayRequest):
+async def start_replay(
+    request: ReplayRequest,
+    redis_client=Depends(get_redis),
+):
     """启动流量重放"""
     # 查找文件
-    file_path = None
-    for ext in [".pcap", ".pcapng", ".cap"]:
-        path = UPLOAD_DIR / f"{request.file_id}{ext}"
-        if path.exists():
-            file_path = path
-            break
-
-    if not file_path:
+    entry = await run_in_threadpool(file_catalog.get, request.file_id)
+    if not entry:
         raise HTTPException(status_code=404, detail="PCAP文件不存在")
 
-    # 创建重放器
-    replayer = TrafficReplayer(str(file_path))
+    # 创建重放器 (内容哈希作为沙箱缓存键)
+    replayer = TrafficReplayer(
+        entry["path"],
+        redis_client,
+        file_hash=entry["file_hash"],
+        total_packets=entry["total_packets"],
+        duration=entry["duration"],
+    )
 
     try:
-        task_id = replayer.start_replay(
+        selection = None
+        if request.filter is not None:
+            selection = await run_in_threadpool(
+                _build_selection, entry["file_hash"], request.filter
+            )
+        # 包数未知时需要完整解析一遍抓包，另有多次 Redis 写入，均在线程池中执行
+        task_id = await run_in_threadpool(
+            replayer.start_replay,
             target_ip=request.target_ip,
             speed_multiplier=request.speed_multiplier,
             use_sandbox=request.use_sandbox,
+            target_mac=request.target_mac,
+            ip_map=request.ip_map,
+            selection=selection,
+            measure_fidelity=request.measure_fidelity,
         )
 
-        return {"task_id": task_id, "status": "started", "message": "流量重放已启动"}
+        return {"task_id": task_id, "status": "queued", "message": "流量重放任务已加入队列"}
+    except QueueFullError:
+        raise HTTPException(status_code=429, detail="重放队列已满，请稍后再试")
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"重放参数无效: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"重放失败: {str(e)}")
 
 
 @router.post("/status")
-async def get_replay_status(request: ReplayStatusRequest):
+async def get_replay_status(
+    request: ReplayStatusRequest, replayer: TrafficReplayer = Depends(get_replayer)
+):
     """获取重放任务状态"""
-    replayer = TrafficReplayer()
-
     try:
-        status = replayer.get_status(request.task_id)
+        status = await run_in_threadpool(replayer.get_status, request.task_id)
         return status
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"任务不存在: {str(e)}")
 
 
 @router.post("/stop")
-async def stop_replay(request: ReplayStatusRequest):
+async def stop_replay(
+    request: ReplayStatusRequest, replayer: TrafficReplayer = Depends(get_replayer)
+):
     """停止流量重放"""
-    replayer = TrafficReplayer()
-
     try:
-        result = replayer.stop_replay(request.task_id)
+        # 停止请求经沙箱代理转发，代理无响应时可能等待到超时，不能阻塞事件循环
+        result = await run_in_threadpool(replayer.stop_replay, request.task_id)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"停止失败: {str(e)}")
 
 
 @router.get("/tasks")
-async def list_replay_tasks():
-    """列出所有重放任务"""
-    replayer = TrafficReplayer()
-    tasks = replayer.list_tasks()
-    return {"tasks": tasks}
+async def list_replay_tasks(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    replayer: TrafficReplayer = Depends(get_replayer),
+):
+    """分页列出重放任务 (按开始时间倒序，仅摘要，日志请通过 /status 或 /events 获取)"""
+    result = await run_in_threadpool(replayer.list_tasks, offset, limit)
+    return {**result, "offset": offset, "limit": limit}
+
+
+@router.get("/queue")
+async def get_replay_queue(replayer: TrafficReplayer = Depends(get_replayer)):
+    """调度队列概况：排队数、各沙箱运行数与并发上限"""
+    return await run_in_threadpool(replayer.scheduler.stats, sandbox_pool.names())
+
+
+@router.get("/sandboxes")
+async def list_sandboxes():
+    """沙箱池成员：健康状态、是否排空、当前负载与容量"""
+    return {"sandboxes": await run_in_threadpool(sandbox_pool.members, True)}
+
+
+@router.post("/sandboxes/scale")
+async def scale_sandboxes(request: SandboxScaleRequest):
+    """调整沙箱数量 (通过 Docker API 创建/移除托管副本)"""
+    try:
+        return await run_in_threadpool(sandbox_pool.scale, request.replicas)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"扩缩容失败: {str(e)}")
+
+
+@router.post("/sandboxes/{name}/drain")
+async def drain_sandbox(name: str):
+    """排空沙箱：不再接收新任务，运行中的任务照常结束"""
+    await run_in_threadpool(sandbox_pool.drain, name)
+    return {"name": name, "draining": True}
+
+
+@router.post("/sandboxes/{name}/undrain")
+async def undrain_sandbox(name: str):
+    """恢复沙箱调度"""
+    await run_in_threadpool(sandbox_pool.undrain, name)
+    return {"name": name, "draining": False}
+
+
+@router.get("/events")
+async def stream_all_replay_events():
+    """订阅所有重放任务的状态与日志更新 (SSE)"""
+    return StreamingResponse(
+        stream_task_events(f"{REPLAY_CHANNEL_PREFIX}*", pattern=True),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/events/{task_id}")
+async def stream_replay_events(
+    task_id: str, replayer: TrafficReplayer = Depends(get_replayer)
+):
+    """订阅单个重放任务的状态与日志更新 (SSE)，首条消息为完整任务快照"""
+    if not await run_in_threadpool(replayer.get_status, task_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    return StreamingResponse(
+        stream_task_events(
+            replay_channel(task_id), snapshot=lambda: replayer.get_status(task_id)
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{task_id}/metrics")
+async def get_replay_metrics(
+    task_id: str, replayer: TrafficReplayer = Depends(get_replayer)
+):
+    """获取重放吞吐时间序列 (每秒一个采样点)，用于判断沙箱是否跟上了设定倍速"""
+    task = await run_in_threadpool(replayer.get_status, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return {
+        "task_id": task_id,
+        "speed_multiplier": task.get("speed_multiplier"),
+        "expected_pps": task.get("expected_pps"),
+        "samples": await run_in_threadpool(replayer.get_metrics, task_id),
+    }
+
+
+@router.get("/{task_id}/fidelity")
+async def get_replay_fidelity(
+    task_id: str, replayer: TrafficReplayer = Depends(get_replayer)
+):
+    """获取时间保真度报告：丢包、乱序、包间隔分布与相对原始节奏的抖动分位数"""
+    task = await run_in_threadpool(replayer.get_status, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return {
+        "task_id": task_id,
+        "measure_fidelity": task.get("measure_fidelity", False),
+        "status": task.get("status"),
+        "report": await run_in_threadpool(replayer.get_fidelity, task_id),
+    }
 
 
 @router.delete("/{task_id}")
-async def delete_replay_task(task_id: str):
+async def delete_replay_task(
+    task_id: str, replayer: TrafficReplayer = Depends(get_replayer)
+):
     """删除重放任务"""
-    replayer = TrafficReplayer()
-    result = replayer.delete_task(task_id)
+    result = await run_in_threadpool(replayer.delete_task, task_id)
     if result.get("error"):
         raise HTTPException(status_code=404, detail=result["error"])
     return result
@@ -0,0 +1,76 @@
+"""
+JSON 序列化与响应
+全项目统一使用 orjson：直接输出 UTF-8 字节，比标准库 json 快一个数量级，大体积的分析结果与包摘要受益最明显。
+缓存键等需要稳定文本的场景 (参数摘要) 仍使用标准库 json，保证与已有缓存键一致。
+"""
+import os
+from typing import Any, Iterable, Iterator, Mapping, Optional
+
+import orjson
+from fastapi.responses import StreamingResponse
+from starlette.responses import JSONResponse as _StarletteJSONResponse
+
+# NDJSON 流式响应攒批发送的字节数 (首行立即发送，降低首字节时间)
+NDJSON_CHUNK_SIZE = int(os.getenv("NDJSON_CHUNK_SIZE", str(64 * 1024)))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 与标准库 json 的兼容性：允许非字符串键 (如整数秒时间戳)
+_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode("utf-8")
+
+
+def loads(data) -> Any:
+    """接受 bytes / str (Redis 客户端开启了 decode_responses)"""
+    return orjson.loads(data)
+
+
+class JSONResponse(_StarletteJSONResponse):
+    """orjson 编码的 JSON 响应 (应用的默认响应类)；大结果直接返回该类可跳过 FastAPI 的逐字段转换"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class RawJSONResponse(_StarletteJSONResponse):
+    """已编码的 JSON 字节原样下发 (如缓存中的分析结果)，不再解码与重新编码"""
+
+    def render(self, content: bytes) -> bytes:
+        return content
+
+
+def ndjson_lines(rows: Iterable[Any], chunk_size: int = NDJSON_CHUNK_SIZE) -> Iterator[bytes]:
+    """逐条编码为 NDJSON，首条单独发送，之后按 chunk_size 攒批"""
+    buffer = bytearray()
+    first = True
+    for row in rows:
+        buffer += dumps(row)
+        buffer += b"\n"
+        if first or len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+            first = False
+    if buffer:
+        yield bytes(buffer)
+
+
+def ndjson_response(
+    rows: Iterable[Any], headers: Optional[Mapping[str, str]] = None
+) -> StreamingResponse:
+    """
+    NDJSON 流式响应：每行一条记录，客户端可边收边渲染
+    rows 为同步迭代器时由 Starlette 在线程池中迭代，查库/解码不阻塞事件循环
+    """
+    return StreamingResponse(ndjson_lines(rows), media_type=NDJSON_MEDIA_TYPE, headers=headers)
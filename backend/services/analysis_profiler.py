@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+# 采样间隔 (秒)
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("ANALYSIS_PROFILE_INTERVAL", "0.002"))
+# 单个调用栈最多记录的帧数 (超出部分从最外层截断)
+PROFILE_MAX_DEPTH = int(os.getenv("ANALYSIS_PROFILE_MAX_DEPTH", "64"))
+# 内存分配报告保留的条目数 (按源码行汇总)
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("ANALYSIS_PROFILE_TOP_ALLOCATIONS", "25"))
+# 折叠栈保留的条目数 (按样本数从多到少)，控制产物大小
+PROFILE_MAX_STACKS = int(os.getenv("ANALYSIS_PROFILE_MAX_STACKS", "2000"))
+
+# tracemalloc 是进程级开关：并发的剖析任务按引用计数共享
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_owned = True
+        _tracemalloc_users += 1
+        if _tracemalloc_users == 1:
+            tracemalloc.reset_peak()
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_owned
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_owned:
+            tracemalloc.stop()
+            _tracemalloc_owned = False
+
+
+def _short_path(filename: str) -> str:
+    """只保留 包目录/文件名，折叠栈更紧凑且与部署路径无关"""
+    parts = filename.replace("\\", "/").rsplit("/", 2)
+    return "/".join(parts[-2:])
+
+
+class AnalysisProfiler:
+    """
+    单个分析任务的按需剖析 (with 块内、当前线程中执行的代码即被剖析对象)
+    1. 采样由当前线程的 profile 钩子驱动：每次函数调用/返回时检查是否到达采样间隔，
+       到达时把距上次采样的时间按间隔折算为样本数，记到当时正在执行的调用栈上
+       (C 函数返回时记到该 C 函数，如 Pattern.search)；汇总为折叠栈 (flamegraph.pl / speedscope 可直接导入)。
+       不用独立线程读取调用栈：被采样线程只会在让出 GIL 的位置被看到，正则匹配等 C 调用完全采不到。
+    2. tracemalloc 记录分配；分析器在逐包循环结束 (状态最大) 时调用 checkpoint 留存快照，按源码行汇总。
+    3. counters 供分析器写入各阶段计数 (解码失败、载荷字节、各规则匹配耗时等)，未剖析时分析器不做这些统计。
+    注意：profile 钩子与 tracemalloc 会显著拖慢分析，剖析结果中的耗时只适合看占比。
+    """
+
+    def __init__(
+        self,
+        interval: float = PROFILE_SAMPLE_INTERVAL,
+        top_allocations: int = PROFILE_TOP_ALLOCATIONS,
+    ):
+        self.interval = interval
+        self.top_allocations = top_allocations
+        self.counters: Counter = Counter()
+        self._stacks: Counter = Counter()
+        self._labels: Dict[Tuple[Any, int], str] = {}
+        self._samples = 0
+        self._root = None
+        self._last_sample = self._next_sample = 0.0
+        self._snapshot = None
+        self._checkpoint: Dict[str, Any] = {}
+        self._wall = self._cpu = 0.0
+        self._peak = 0
+
+    def __enter__(self) -> "AnalysisProfiler":
+        # 调用栈只记录到进入剖析的函数为止，线程池等外层帧不计入
+        self._root = sys._getframe(1)
+        _start_tracemalloc()
+        self._wall, self._cpu = time.perf_counter(), time.thread_time()
+        self._last_sample = self._wall
+        self._next_sample = self._wall + self.interval
+        sys.setprofile(self._on_event)
+        return self
+
+    def __exit__(self, *exc):
+        sys.setprofile(None)
+        self._wall = time.perf_counter() - self._wall
+        self._cpu = time.thread_time() - self._cpu
+        try:
+            if self._snapshot is None:
+                self.checkpoint("finished")
+            self._peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            _stop_tracemalloc()
+        self._root = None
+        return False
+
+    def checkpoint(self, stage: str):
+        """留存内存快照 (由分析器在内存占用最大处调用，重复调用以最后一次为准)"""
+        # 拍快照本身的耗时不计入采样
+        sys.setprofile(None)
+        current, peak = tracemalloc.get_traced_memory()
+        self._snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        )
+        self._checkpoint = {"stage": stage, "traced_bytes": current, "peak_bytes": peak}
+        if self._root is not None:
+            self._last_sample = time.perf_counter()
+            self._next_sample = self._last_sample + self.interval
+            sys.setprofile(self._on_event)
+
+    def _label(self, code, lineno: int) -> str:
+        key = (code, lineno)
+        label = self._labels.get(key)
+        if label is None:
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{lineno})"
+            self._labels[key] = label
+        return label
+
+    def _on_event(self, frame, event: str, arg):
+        now = time.perf_counter()
+        if now < self._next_sample:
+            return
+        samples = int((now - self._last_sample) / self.interval)
+        self._last_sample = now
+        self._next_sample = now + self.interval
+
+        stack: List[str] = []
+        if event == "call":
+            # 刚进入被调函数：这段时间花在调用方
+            frame = frame.f_back
+        elif event in ("c_return", "c_exception"):
+            stack.append(f"{getattr(arg, '__qualname__', repr(arg))} (builtin)")
+        while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+            stack.append(self._label(frame.f_code, frame.f_lineno))
+            if frame is self._root:
+                break
+            frame = frame.f_back
+        if stack:
+            stack.reverse()
+            self._stacks[";".join(stack)] += samples
+            self._samples += samples
+
+    def collapsed(self) -> str:
+        """折叠栈文本：每行 "外层;...;内层 样本数" """
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self._stacks.most_common(PROFILE_MAX_STACKS)
+        )
+
+    def _allocations(self) -> List[Dict[str, Any]]:
+        if self._snapshot is None:
+            return []
+        return [
+            {
+                "location": f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                "size": stat.size,
+                "count": stat.count,
+            }
+            for stat in self._snapshot.statistics("lineno")[: self.top_allocations]
+        ]
+
+    def _hot_frames(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """按栈顶帧汇总的自身耗时占比 (不必下载折叠栈也能看出热点)"""
+        leaves: Counter = Counter()
+        for stack, count in self._stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = self._samples or 1
+        return [
+            {"frame": frame, "samples": count, "ratio": round(count / total, 4)}
+            for frame, count in leaves.most_common(limit)
+        ]
+
+    def report(self) -> Dict[str, Any]:
+        counters = {
+            k: round(v, 6) if isinstance(v, float) else v for k, v in sorted(self.counters.items())
+        }
+        return {
+            "wall_seconds": round(self._wall, 3),
+            "cpu_seconds": round(self._cpu, 3),
+            "interval": self.interval,
+            "samples": self._samples,
+            "memory": {**self._checkpoint, "peak_bytes": self._peak},
+            "counters": counters,
+            "hot_frames": self._hot_frames(),
+            "top_allocations": self._allocations(),
+            "collapsed": self.collapsed(),
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        """写入任务状态的摘要 (完整产物单独存放)"""
+        return {
+            "wall_seconds": round(self._wall, 3),
+            "cpu_seconds": round(self._cpu, 3),
+            "samples": self._samples,
+            "peak_bytes": self._peak,
+        }
@@ -0,0 +1,204 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+from clients import get_redis
+from database import SessionLocal
+from metrics import cache_lookup
+from models import AnalysisSnapshot, PcapFile
+from serialization import dumps, loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Redis 热缓存过期时间 (秒)；持久化以数据库快照为准
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+
+
+class AnalysisStore:
+    """
+    分析结果持久化存储
+    1. 数据库快照为唯一可信来源，键为 (文件内容哈希, 分析类型, 参数)，payload 使用 zlib 压缩。
+    2. Redis 仅作热缓存，所有 key 带 TTL，配合 volatile-lru 淘汰策略控制内存上限。
+    3. Redis 被清空或服务重启后，从快照回填缓存，不会触发重新分析。
+    """
+
+    def __init__(self, redis_client=None, session_factory=SessionLocal):
+        self._redis = redis_client
+        self.session_factory = session_factory
+
+    @property
+    def redis(self):
+        # 未注入时使用共享连接池
+        return self._redis if self._redis is not None else get_redis()
+
+    @staticmethod
+    def params_key(params: Optional[Dict[str, Any]] = None) -> str:
+        """参数规范化后取哈希，保证同一组参数得到同一个键"""
+        canonical = json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _cache_key(file_hash: str, analysis_type: str, params_key: str) -> str:
+        return f"analysis_cache:{file_hash}:{analysis_type}:{params_key}"
+
+    def _cache_get(self, key: str) -> Optional[bytes]:
+        if not self.redis:
+            return None
+        try:
+            data = self.redis.getex(key, ex=ANALYSIS_CACHE_TTL)
+            if not data:
+                return None
+            return data.encode("utf-8") if isinstance(data, str) else data
+        except Exception as e:
+            logger.warning(f"Analysis cache read failed: {e}")
+            return None
+
+    def _cache_set(self, key: str, payload: bytes):
+        if not self.redis:
+            return
+        try:
+            self.redis.set(key, payload, ex=ANALYSIS_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Analysis cache write failed: {e}")
+
+    def get(
+        self, file_hash: str, analysis_type: str, params: Optional[Dict[str, Any]] = None
+    ) -> Optional[dict]:
+        """读取分析结果：先查 Redis 热缓存，未命中再查数据库快照并回填缓存"""
+        payload = self.get_raw(file_hash, analysis_type, params)
+        return loads(payload) if payload is not None else None
+
+    def get_raw(
+        self, file_hash: str, analysis_type: str, params: Optional[Dict[str, Any]] = None
+    ) -> Optional[bytes]:
+        """同 get，但返回编码好的 JSON 字节 (直接作为响应体时省去解码与重新编码)"""
+        if not file_hash:
+            return None
+        params_key = self.params_key(params)
+        cache_key = self._cache_key(file_hash, analysis_type, params_key)
+
+        cached = self._cache_get(cache_key)
+        cache_lookup("analysis_redis", cached is not None)
+        if cached is not None:
+            return cached
+
+        db = self.session_factory()
+        try:
+            snapshot = (
+                db.query(AnalysisSnapshot)
+                .filter(
+                    AnalysisSnapshot.file_hash == file_hash,
+                    AnalysisSnapshot.analysis_type == analysis_type,
+                    AnalysisSnapshot.params_key == params_key,
+                )
+                .first()
+            )
+            cache_lookup("analysis_snapshot", snapshot is not None)
+            if not snapshot:
+                return None
+            payload = zlib.decompress(snapshot.payload)
+        finally:
+            db.close()
+
+        self._cache_set(cache_key, payload)
+        return payload
+
+    def exists(
+        self, file_hash: str, analysis_type: str, params: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """仅检查快照是否存在 (不解压 payload)"""
+        if not file_hash:
+            return False
+        db = self.session_factory()
+        try:
+            return (
+                db.query(AnalysisSnapshot.id)
+                .filter(
+                    AnalysisSnapshot.file_hash == file_hash,
+                    AnalysisSnapshot.analysis_type == analysis_type,
+                    AnalysisSnapshot.params_key == self.params_key(params),
+                )
+                .first()
+                is not None
+            )
+        finally:
+            db.close()
+
+    def put(
+        self,
+        file_id: str,
+        file_hash: str,
+        analysis_type: str,
+        result: dict,
+        params: Optional[Dict[str, Any]] = None,
+    ):
+        """写入 (或覆盖) 分析快照，并刷新热缓存"""
+        if not file_hash:
+            return
+        params_key = self.params_key(params)
+        payload = dumps(result)
+        compressed = zlib.compress(payload, 6)
+
+        db = self.session_factory()
+        try:
+            snapshot = (
+                db.query(AnalysisSnapshot)
+                .filter(
+                    AnalysisSnapshot.file_hash == file_hash,
+                    AnalysisSnapshot.analysis_type == analysis_type,
+                    AnalysisSnapshot.params_key == params_key,
+                )
+                .first()
+            )
+            if not snapshot:
+                snapshot = AnalysisSnapshot(
+                    file_hash=file_hash,
+                    analysis_type=analysis_type,
+                    params_key=params_key,
+                )
+                db.add(snapshot)
+            snapshot.file_id = file_id
+            snapshot.params = json.dumps(params or {}, sort_keys=True)
+            snapshot.payload = compressed
+            snapshot.payload_size = len(payload)
+            db.commit()
+        finally:
+            db.close()
+
+        self._cache_set(self._cache_key(file_hash, analysis_type, params_key), payload)
+
+    def delete_for_hash(self, file_hash: str):
+        """删除某个文件内容对应的全部快照 (仍有其他文件引用同一内容时保留)"""
+        if not file_hash:
+            return
+        db = self.session_factory()
+        try:
+            still_used = (
+                db.query(PcapFile.id).filter(PcapFile.file_hash == file_hash).first()
+            )
+            if still_used:
+                return
+            snapshots = (
+                db.query(AnalysisSnapshot)
+                .filter(AnalysisSnapshot.file_hash == file_hash)
+                .all()
+            )
+            cache_keys = [
+                self._cache_key(s.file_hash, s.analysis_type, s.params_key)
+                for s in snapshots
+            ]
+            for s in snapshots:
+                db.delete(s)
+            db.commit()
+        finally:
+            db.close()
+
+        if self.redis and cache_keys:
+            try:
+                self.redis.delete(*cache_keys)
+            except Exception as e:
+                logger.warning(f"Analysis cache delete failed: {e}")
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
+
+from metrics import cache_lookup
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+IO_BUFFER_SIZE = 1024 * 1024
+# 单次内核拷贝的最大字节数
+KERNEL_COPY_CHUNK = 1024 ** 3
+# 内核拷贝不支持 (跨文件系统、旧内核、特殊文件系统) 时的错误码，遇到后退回下一种方式
+_KERNEL_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+class HashingWriter:
+    """写入时同步计算 SHA-256，派生文件无需再读一遍即可得到沙箱缓存键"""
+
+    def __init__(self, f: BinaryIO):
+        self._f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data) -> int:
+        self.digest.update(data)
+        return self._f.write(data)
+
+    def copy_range(self, fd: int, start: int, end: int):
+        """拷贝源文件 [start, end) 字节 (需要计算摘要，经用户态分块读写)"""
+        while start < end:
+            chunk = os.pread(fd, min(IO_BUFFER_SIZE, end - start), start)
+            if not chunk:
+                raise IOError("Source file is shorter than expected")
+            self.write(chunk)
+            start += len(chunk)
+
+    def flush(self):
+        self._f.flush()
+
+
+class ZeroCopyWriter:
+    """
+    不计算摘要的写出器 (用于导出等不需要内容哈希的派生文件)
+    小块写入在内存中攒批；整段拷贝交给内核完成 (copy_file_range，不支持时退回 sendfile，
+    最后退回 pread/write)，大段数据不经过用户态，也不占用与拷贝量成正比的内存。
+    """
+
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._buffer = bytearray()
+        self._methods = [m for m in ("copy_file_range", "sendfile") if hasattr(os, m)]
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= IO_BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        view = memoryview(self._buffer)
+        try:
+            while view:
+                view = view[os.write(self._fd, view) :]
+        finally:
+            view.release()
+        self._buffer.clear()
+
+    def copy_range(self, fd: int, start: int, end: int):
+        """拷贝源文件 [start, end) 字节到当前写入位置"""
+        self.flush()
+        while start < end:
+            copied = self._kernel_copy(fd, start, min(end - start, KERNEL_COPY_CHUNK))
+            if not copied:
+                raise IOError("Source file is shorter than expected")
+            start += copied
+
+    def _kernel_copy(self, fd: int, offset: int, count: int) -> int:
+        while self._methods:
+            try:
+                if self._methods[0] == "copy_file_range":
+                    return os.copy_file_range(fd, self._fd, count, offset)
+                return os.sendfile(self._fd, fd, offset, count)
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+                self._methods.pop(0)
+        chunk = os.pread(fd, min(count, IO_BUFFER_SIZE), offset)
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(self._fd, view) :]
+        return len(chunk)
+
+
+PcapWriter = Union[HashingWriter, ZeroCopyWriter]
+
+
+class DerivedPcapCache:
+    """
+    派生 PCAP (地址改写、子集提取等) 的磁盘缓存
+    文件按 "{源文件哈希}-{参数摘要}" 命名，元数据 (内容哈希与统计) 存放在同名 .json 中；
+    生成过程写入临时文件后原子替换，超出磁盘预算时按最近使用时间淘汰。
+    """
+
+    def __init__(self, cache_dir: Path, budget: int, kind: str = "derived"):
+        self.cache_dir = Path(cache_dir)
+        self.budget = budget
+        # 指标标签 (rewrite/subset)，用于区分各派生缓存的命中率
+        self.kind = kind
+
+    def _paths(self, name: str):
+        base = self.cache_dir / name
+        return base.with_suffix(".pcap"), base.with_suffix(".json")
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """查询缓存 (命中时刷新最近使用时间)"""
+        pcap_path, meta_path = self._paths(name)
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            os.utime(pcap_path)
+            os.utime(meta_path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return {**meta, "path": str(pcap_path), "cached": True}
+
+    def get_or_build(
+        self,
+        name: str,
+        produce: Callable[[PcapWriter], Dict[str, Any]],
+        zero_copy: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        未命中时调用 produce(out) 写出文件内容并返回统计字段；
+        同一进程内对同一缓存项串行生成，避免并发任务重复处理。
+        zero_copy 时 out 为 ZeroCopyWriter，不计算内容哈希 (元数据中 sha256 为 None)。
+        """
+        with build_lock(f"{self.cache_dir}/{name}"):
+            hit = self.get(name)
+            cache_lookup(self.kind, hit is not None)
+            if hit:
+                return hit
+
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            pcap_path, meta_path = self._paths(name)
+            partial = pcap_path.with_name(f"{pcap_path.name}.{threading.get_ident()}.partial")
+            started = time.perf_counter()
+            try:
+                with open(partial, "wb", buffering=0 if zero_copy else IO_BUFFER_SIZE) as raw:
+                    out = ZeroCopyWriter(raw.fileno()) if zero_copy else HashingWriter(raw)
+                    stats = produce(out)
+                    out.flush()
+                os.replace(partial, pcap_path)
+            except Exception:
+                partial.unlink(missing_ok=True)
+                raise
+
+            meta = {
+                **stats,
+                "sha256": None if zero_copy else out.digest.hexdigest(),
+                "size": pcap_path.stat().st_size,
+                "seconds": round(time.perf_counter() - started, 3),
+            }
+            meta_path.write_text(json.dumps(meta), encoding="utf-8")
+            self._evict(keep=pcap_path)
+            return {**meta, "path": str(pcap_path), "cached": False}
+
+    def delete_for_hash(self, file_hash: str) -> List[str]:
+        """删除以某个文件内容为源的全部缓存项，返回被删除项的内容哈希 (以它们为源的下一级派生需一并清理)"""
+        derived = []
+        for meta_path in self.cache_dir.glob(f"{file_hash}-*.json"):
+            try:
+                sha256 = json.loads(meta_path.read_text(encoding="utf-8")).get("sha256")
+            except (FileNotFoundError, ValueError):
+                sha256 = None
+            if sha256:
+                derived.append(sha256)
+            meta_path.unlink(missing_ok=True)
+        # 元数据缺失的残留文件
+        for pcap_path in self.cache_dir.glob(f"{file_hash}-*.pcap"):
+            pcap_path.unlink(missing_ok=True)
+        return derived
+
+    def _evict(self, keep: Path):
+        entries = []
+        for path in self.cache_dir.glob("*.pcap"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            path.with_suffix(".json").unlink(missing_ok=True)
+            total -= size
+            logger.info(f"Evicted derived pcap {path.name}")
+
+
+_build_locks: Dict[str, threading.Lock] = {}
+_build_locks_guard = threading.Lock()
+
+
+def build_lock(name: str) -> threading.Lock:
+    """同一进程内按名称串行化派生文件/索引的生成"""
+    with _build_locks_guard:
+        return _build_locks.setdefault(name, threading.Lock())
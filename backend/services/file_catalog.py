@@ -0,0 +1,151 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from datetime import timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from metrics import cache_lookup
+from models import PcapFile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path("uploads")
+PCAP_EXTENSIONS = (".pcap", ".pcapng", ".cap")
+
+# 进程内 LRU 容量 (条目数)
+FILE_CATALOG_CACHE_SIZE = int(os.getenv("FILE_CATALOG_CACHE_SIZE", "4096"))
+
+
+class FileCatalog:
+    """
+    PCAP 文件目录服务
+    file_id -> 文件记录 的解析统一走这里：进程内 LRU 缓存 + 数据库唯一索引查询，
+    查找和列表的开销与 uploads/ 中的文件数量无关 (不再遍历目录)。
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        upload_dir: Path = UPLOAD_DIR,
+        max_entries: int = FILE_CATALOG_CACHE_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.upload_dir = upload_dir
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _to_entry(row: PcapFile) -> Dict[str, Any]:
+        return {
+            "file_id": row.file_id,
+            "filename": row.filename,
+            "path": row.path,
+            "size": row.size,
+            "total_packets": row.total_packets,
+            "duration": row.duration,
+            "file_hash": row.file_hash,
+        }
+
+    def _cache_get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._cache.get(file_id)
+            if entry is not None:
+                self._cache.move_to_end(file_id)
+            return entry
+
+    def _cache_put(self, file_id: str, entry: Dict[str, Any]):
+        with self._lock:
+            self._cache[file_id] = entry
+            self._cache.move_to_end(file_id)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, file_id: str):
+        with self._lock:
+            self._cache.pop(file_id, None)
+
+    def _probe_legacy(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """兼容未入库的历史文件：按固定扩展名探测 (常数次 stat，不遍历目录)"""
+        for ext in PCAP_EXTENSIONS:
+            path = self.upload_dir / f"{file_id}{ext}"
+            if path.exists():
+                return {
+                    "file_id": file_id,
+                    "filename": path.name,
+                    "path": str(path),
+                    "size": path.stat().st_size,
+                    "total_packets": 0,
+                    "duration": 0.0,
+                    "file_hash": None,
+                }
+        return None
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """按 file_id 获取文件记录 (缓存 -> 数据库 -> 历史文件探测)"""
+        entry = self._cache_get(file_id)
+        cache_lookup("file_catalog", entry is not None)
+        if entry is None:
+            db = self.session_factory()
+            try:
+                row = db.query(PcapFile).filter(PcapFile.file_id == file_id).first()
+                entry = self._to_entry(row) if row else None
+            finally:
+                db.close()
+            if entry is None:
+                # 历史文件不缓存，入库后即可走正常路径
+                return self._probe_legacy(file_id)
+            self._cache_put(file_id, entry)
+
+        # 文件可能已被外部删除：一次 stat 校验，失效则剔除缓存
+        if not os.path.exists(entry["path"]):
+            self.invalidate(file_id)
+            return None
+        return entry
+
+    def resolve(self, file_id: str) -> Optional[Path]:
+        """按 file_id 获取文件路径，不存在时返回 None"""
+        entry = self.get(file_id)
+        return Path(entry["path"]) if entry else None
+
+    @staticmethod
+    def list_files(db: Session, page: int = 1, page_size: int = 100) -> Dict[str, Any]:
+        """分页列出文件，由数据库按 created_at 倒序排序 (走索引)"""
+        total = db.query(PcapFile.id).count()
+        rows = (
+            db.query(PcapFile)
+            .order_by(PcapFile.created_at.desc(), PcapFile.id.desc())
+            .offset((page - 1) * page_size)
+            .limit(page_size)
+            .all()
+        )
+        files = []
+        for row in rows:
+            upload_time_str = "未知"
+            if row.created_at:
+                # created_at 以 UTC 存储，展示时转换为服务器本地时间
+                upload_time_str = (
+                    row.created_at.replace(tzinfo=timezone.utc)
+                    .astimezone()
+                    .strftime("%Y-%m-%d %H:%M:%S")
+                )
+            files.append(
+                {
+                    "file_id": row.file_id,
+                    "filename": row.filename,  # 数据库里存的原始文件名
+                    "size": row.size,
+                    "total_packets": row.total_packets,
+                    "upload_time": upload_time_str,
+                }
+            )
+        return {"files": files, "total": total, "page": page, "page_size": page_size}
+
+
+# 进程级单例，各路由共享同一份缓存
+file_catalog = FileCatalog()
@@ -0,0 +1,389 @@
+import json
+import base64
+import logging
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, func, insert, or_, select, union
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models import AlertRecord, FlowRecord, FlowThreat, PcapFile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 批量写入大小：单条 INSERT 语句过多会让 SQLite 事务过大，过少则往返开销高
+INSERT_BATCH_SIZE = 5000
+
+FLOW_SORT_KEYS = {
+    "packets": FlowRecord.packets,
+    "bytes": FlowRecord.bytes,
+    "duration": FlowRecord.duration,
+    "start_time": FlowRecord.start_time,
+}
+
+MAX_PAGE_SIZE = 1000
+
+
+def _encode_cursor(sort_value: Any, row_id: int) -> str:
+    raw = json.dumps([sort_value, row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[Any, int]:
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return sort_value, int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _port_or_none(port: Any) -> Optional[int]:
+    return port if isinstance(port, int) else None
+
+
+def _flow_values(file_hash: str, flow_id: int, f: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": flow_id,
+        "file_hash": file_hash,
+        "src_ip": f["src_ip"],
+        "dst_ip": f["dst_ip"],
+        "src_port": _port_or_none(f["src_port"]),
+        "dst_port": _port_or_none(f["dst_port"]),
+        "protocol": f["protocol"],
+        "packets": f["packets"],
+        "bytes": f["bytes"],
+        "start_time": f["start_time"],
+        "end_time": f["end_time"],
+        "duration": f["duration"],
+        "threats": ",".join(f["threats"]) or None,
+    }
+
+
+def _either(model, file_hash: str, first, second, value: Any):
+    """
+    两列任一等于 value (如源或目的 IP)：拆成两次各自走 (file_hash, 列) 索引的查找再 UNION，
+    避免 OR 条件让 SQLite 退化为按 file_hash 扫描该文件的全部记录
+    """
+    return model.id.in_(
+        union(
+            select(model.id).where(model.file_hash == file_hash, first == value),
+            select(model.id).where(model.file_hash == file_hash, second == value),
+        )
+    )
+
+
+def _batched(rows: Iterable[Dict[str, Any]], size: int) -> Iterable[List[Dict[str, Any]]]:
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+class FlowStore:
+    """
+    会话与告警明细存储
+    分析完成后全量写入 (按文件内容哈希归档)，查询走复合索引 + 游标分页，
+    不受单个文件会话数量影响，也不需要拉取整份分析结果。
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+
+    def replace_flows(self, file_hash: str, flows: Iterable[Dict[str, Any]]):
+        """
+        覆盖写入某个文件的全部会话 (流式分批插入，不在内存中累积整表)
+        会话命中的威胁类型另写入 flow_threats；会话 id 在写事务内显式分配，以便两表对应
+        """
+        db = self.session_factory()
+        try:
+            db.execute(delete(FlowRecord).where(FlowRecord.file_hash == file_hash))
+            db.execute(delete(FlowThreat).where(FlowThreat.file_hash == file_hash))
+            # 删除语句已取得写锁，此后到提交前不会有其他写入分配 id
+            next_id = (db.execute(select(func.max(FlowRecord.id))).scalar() or 0) + 1
+            for batch in _batched(flows, INSERT_BATCH_SIZE):
+                rows, threat_rows = [], []
+                for f in batch:
+                    rows.append(_flow_values(file_hash, next_id, f))
+                    threat_rows.extend(
+                        {"file_hash": file_hash, "threat_type": t, "flow_id": next_id}
+                        for t in f["threats"]
+                    )
+                    next_id += 1
+                db.execute(insert(FlowRecord), rows)
+                if threat_rows:
+                    db.execute(insert(FlowThreat), threat_rows)
+            db.commit()
+        finally:
+            db.close()
+
+    def replace_alerts(self, file_hash: str, alerts: Iterable[Dict[str, Any]]):
+        """覆盖写入某个文件的全部告警"""
+        db = self.session_factory()
+        try:
+            db.execute(delete(AlertRecord).where(AlertRecord.file_hash == file_hash))
+            rows = (
+                {
+                    "file_hash": file_hash,
+                    "time": a["time"],
+                    "src_ip": a["src_ip"],
+                    "dst_ip": a["dst_ip"],
+                    "port": _port_or_none(a["port"]),
+                    "threat_type": a["threat_type"],
+                    "protocol": a["protocol"],
+                }
+                for a in alerts
+            )
+            for batch in _batched(rows, INSERT_BATCH_SIZE):
+                db.execute(insert(AlertRecord), batch)
+            db.commit()
+        finally:
+            db.close()
+
+    def migrate_threats(self) -> int:
+        """旧版只在逗号分隔的 threats 列中记录会话的威胁类型：flow_threats 为空时据此补建"""
+        db = self.session_factory()
+        try:
+            if db.query(FlowThreat.id).first() is not None:
+                return 0
+            flows = db.execute(
+                select(FlowRecord.id, FlowRecord.file_hash, FlowRecord.threats).where(
+                    FlowRecord.threats.isnot(None)
+                )
+            )
+            rows = (
+                {"file_hash": file_hash, "threat_type": t, "flow_id": flow_id}
+                for flow_id, file_hash, threats in flows
+                for t in threats.split(",")
+            )
+            migrated = 0
+            for batch in _batched(rows, INSERT_BATCH_SIZE):
+                db.execute(insert(FlowThreat), batch)
+                migrated += len(batch)
+            db.commit()
+            if migrated:
+                logger.info(f"Migrated {migrated} flow threat labels")
+            return migrated
+        finally:
+            db.close()
+
+    def delete_for_hash(self, file_hash: str):
+        """删除某个文件内容对应的明细 (仍有其他文件引用同一内容时保留)"""
+        if not file_hash:
+            return
+        db = self.session_factory()
+        try:
+            if db.query(PcapFile.id).filter(PcapFile.file_hash == file_hash).first():
+                return
+            db.execute(delete(FlowRecord).where(FlowRecord.file_hash == file_hash))
+            db.execute(delete(FlowThreat).where(FlowThreat.file_hash == file_hash))
+            db.execute(delete(AlertRecord).where(AlertRecord.file_hash == file_hash))
+            db.commit()
+        finally:
+            db.close()
+
+    @staticmethod
+    def flow_tuple(
+        db: Session,
+        file_hash: str,
+        flow_id: Optional[int] = None,
+        alert_id: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """会话或告警对应的五元组 (用于按会话重放)；记录不存在或不属于该文件时返回 None"""
+        if flow_id is not None:
+            r = db.get(FlowRecord, flow_id)
+            if r is None or r.file_hash != file_hash:
+                return None
+            return {
+                "src_ip": r.src_ip,
+                "dst_ip": r.dst_ip,
+                "src_port": r.src_port,
+                "dst_port": r.dst_port,
+                "protocol": r.protocol,
+            }
+        if alert_id is not None:
+            r = db.get(AlertRecord, alert_id)
+            if r is None or r.file_hash != file_hash:
+                return None
+            # 告警只记录了目的端口：匹配该客户端与服务端之间、指向该端口的全部会话
+            return {
+                "src_ip": r.src_ip,
+                "dst_ip": r.dst_ip,
+                "dst_port": r.port,
+                "protocol": r.protocol,
+            }
+        return None
+
+    @staticmethod
+    def query_flows(
+        db: Session,
+        file_hash: str,
+        ip: Optional[str] = None,
+        src_ip: Optional[str] = None,
+        dst_ip: Optional[str] = None,
+        port: Optional[int] = None,
+        protocol: Optional[str] = None,
+        threat_type: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        sort: str = "packets",
+        order: str = "desc",
+        limit: int = 100,
+        cursor: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """会话查询：过滤 + 排序 + 游标分页 (keyset)，深翻页同样走索引"""
+        if sort not in FLOW_SORT_KEYS:
+            raise ValueError(f"Unsupported sort key: {sort}")
+        sort_col = FLOW_SORT_KEYS[sort]
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        # IP/端口/威胁类型条件先在各自的索引上取出本文件的候选 id，外层按 id 回表；
+        # 此时不再附加 file_hash 条件，免得 SQLite 选中排序索引逐行扫描整个文件的会话
+        candidates = []
+        if ip:
+            candidates.append(_either(FlowRecord, file_hash, FlowRecord.src_ip, FlowRecord.dst_ip, ip))
+        if port is not None:
+            candidates.append(
+                _either(FlowRecord, file_hash, FlowRecord.src_port, FlowRecord.dst_port, port)
+            )
+        if threat_type:
+            candidates.append(
+                FlowRecord.id.in_(
+                    select(FlowThreat.flow_id).where(
+                        FlowThreat.file_hash == file_hash, FlowThreat.threat_type == threat_type
+                    )
+                )
+            )
+        q = db.query(FlowRecord).filter(*candidates or [FlowRecord.file_hash == file_hash])
+        if src_ip:
+            q = q.filter(FlowRecord.src_ip == src_ip)
+        if dst_ip:
+            q = q.filter(FlowRecord.dst_ip == dst_ip)
+        if protocol:
+            q = q.filter(FlowRecord.protocol == protocol.upper())
+        # 时间范围：会话与区间有交集即命中
+        if start is not None:
+            q = q.filter(FlowRecord.end_time >= start)
+        if end is not None:
+            q = q.filter(FlowRecord.start_time <= end)
+
+        desc = order != "asc"
+        if cursor:
+            value, last_id = _decode_cursor(cursor)
+            if desc:
+                q = q.filter(
+                    or_(sort_col < value, and_(sort_col == value, FlowRecord.id < last_id))
+                )
+            else:
+                q = q.filter(
+                    or_(sort_col > value, and_(sort_col == value, FlowRecord.id > last_id))
+                )
+        if desc:
+            q = q.order_by(sort_col.desc(), FlowRecord.id.desc())
+        else:
+            q = q.order_by(sort_col.asc(), FlowRecord.id.asc())
+
+        rows = q.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        items = [
+            {
+                "id": r.id,
+                "src_ip": r.src_ip,
+                "src_port": r.src_port,
+                "dst_ip": r.dst_ip,
+                "dst_port": r.dst_port,
+                "protocol": r.protocol,
+                "packets": r.packets,
+                "bytes": r.bytes,
+                "start_time": r.start_time,
+                "end_time": r.end_time,
+                "duration": r.duration,
+                "threats": r.threats.split(",") if r.threats else [],
+            }
+            for r in rows
+        ]
+        next_cursor = (
+            _encode_cursor(getattr(rows[-1], sort), rows[-1].id) if has_more else None
+        )
+        return {"items": items, "next_cursor": next_cursor}
+
+    @staticmethod
+    def query_alerts(
+        db: Session,
+        file_hash: str,
+        ip: Optional[str] = None,
+        src_ip: Optional[str] = None,
+        dst_ip: Optional[str] = None,
+        port: Optional[int] = None,
+        protocol: Optional[str] = None,
+        threat_type: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        order: str = "asc",
+        limit: int = 100,
+        cursor: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """告警查询：按时间排序的游标分页"""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+        # 按 IP 过滤时同会话查询：候选 id 取自源/目的 IP 索引，外层按 id 回表
+        if ip:
+            q = db.query(AlertRecord).filter(
+                _either(AlertRecord, file_hash, AlertRecord.src_ip, AlertRecord.dst_ip, ip)
+            )
+        else:
+            q = db.query(AlertRecord).filter(AlertRecord.file_hash == file_hash)
+        if src_ip:
+            q = q.filter(AlertRecord.src_ip == src_ip)
+        if dst_ip:
+            q = q.filter(AlertRecord.dst_ip == dst_ip)
+        if port is not None:
+            q = q.filter(AlertRecord.port == port)
+        if protocol:
+            q = q.filter(AlertRecord.protocol == protocol.upper())
+        if threat_type:
+            q = q.filter(AlertRecord.threat_type == threat_type)
+        if start is not None:
+            q = q.filter(AlertRecord.time >= start)
+        if end is not None:
+            q = q.filter(AlertRecord.time <= end)
+
+        desc = order == "desc"
+        if cursor:
+            value, last_id = _decode_cursor(cursor)
+            if desc:
+                q = q.filter(
+                    or_(AlertRecord.time < value, and_(AlertRecord.time == value, AlertRecord.id < last_id))
+                )
+            else:
+                q = q.filter(
+                    or_(AlertRecord.time > value, and_(AlertRecord.time == value, AlertRecord.id > last_id))
+                )
+        if desc:
+            q = q.order_by(AlertRecord.time.desc(), AlertRecord.id.desc())
+        else:
+            q = q.order_by(AlertRecord.time.asc(), AlertRecord.id.asc())
+
+        rows = q.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        items = [
+            {
+                "id": r.id,
+                "time": r.time,
+                "src_ip": r.src_ip,
+                "dst_ip": r.dst_ip,
+                "port": r.port,
+                "threat_type": r.threat_type,
+                "protocol": r.protocol,
+            }
+            for r in rows
+        ]
+        next_cursor = _encode_cursor(rows[-1].time, rows[-1].id) if has_more else None
+        return {"items": items, "next_cursor": next_cursor}
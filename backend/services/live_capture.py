@@ -0,0 +1,644 @@
+"""
+实时分析 (监视模式)
+持续读取仍在增长的抓包文件或轮转抓包目录 (如 tcpdump -w cap.pcap -C 100 / -G 60)，
+按字节偏移只解析新增的完整记录，送入与全量分析相同的聚合器 (TrafficAnalyzer.consume)，
+并周期性发布滚动窗口统计与新告警。
+
+本地试用 (无需 Redis)：
+    python -m services.live_capture captures/ --window 60
+另开终端向 captures/ 下的抓包追加数据 (tcpdump -U -w captures/live.pcap，或脚本写入记录)，
+每个发布周期输出一行 JSON 快照。
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from metrics import LIVE_BACKLOG_BYTES
+from serialization import dumps, dumps_str, loads
+from services.packet_index import (
+    PCAPNG_BYTE_ORDER,
+    PCAPNG_EPB,
+    PCAPNG_IDB,
+    PCAPNG_IF_TSRESOL,
+    PCAPNG_PB,
+    PCAPNG_SHB,
+    PCAPNG_SPB,
+)
+from services.pcap_rewriter import PCAP_MAGICS
+from services.task_events import live_channel, publish_task_event
+from services.traffic_analyzer import ANALYSIS_SPILL_DIR, AnalysisState, TrafficAnalyzer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 允许通过 API 监视的根目录 (请求中的路径必须位于其中)
+LIVE_CAPTURE_ROOT = Path(os.getenv("LIVE_CAPTURE_ROOT", "captures"))
+# 各监视任务的断点 (每个文件已处理到的字节偏移)，重启后从断点继续
+LIVE_STATE_DIR = Path(os.getenv("LIVE_STATE_DIR", "results/live"))
+# 目录模式下视为抓包的文件名 (含 tcpdump -C 轮转产生的数字后缀)
+LIVE_CAPTURE_PATTERN = re.compile(os.getenv("LIVE_CAPTURE_PATTERN", r"\.(pcap|pcapng|cap)\d*$"))
+# 没有新数据时的轮询间隔、快照发布间隔 (秒) 与默认滚动窗口长度 (秒，按抓包时间)
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "1.0"))
+LIVE_PUBLISH_INTERVAL = float(os.getenv("LIVE_PUBLISH_INTERVAL", "2.0"))
+LIVE_WINDOW_SECONDS = int(os.getenv("LIVE_WINDOW_SECONDS", "60"))
+# 单次从一个文件读取的字节上限 (积压较多时分批追赶，期间照常发布快照)
+LIVE_READ_CHUNK = int(os.getenv("LIVE_READ_CHUNK", str(8 * 1024 * 1024)))
+# 快照中携带的告警条数上限 (全部告警计入内存预算，超出时溢出到磁盘)
+LIVE_SNAPSHOT_ALERTS = int(os.getenv("LIVE_SNAPSHOT_ALERTS", "100"))
+# Redis 中最新快照的过期时间 (秒)
+LIVE_SNAPSHOT_TTL = int(os.getenv("LIVE_SNAPSHOT_TTL", "86400"))
+
+# 单条记录长度上限：超过即视为文件损坏 (而不是无限等待数据)
+MAX_RECORD_BYTES = 16 * 1024 * 1024
+
+
+def snapshot_key(watch_id: str) -> str:
+    return f"live_watch:{watch_id}"
+
+
+def stop_key(watch_id: str) -> str:
+    return f"live_watch:{watch_id}:stop"
+
+
+def watch_id_for(target: Path) -> str:
+    """监视 ID 由目标的绝对路径决定：同一目标重新开始监视时沿用断点"""
+    return hashlib.sha1(str(Path(target).resolve()).encode("utf-8")).hexdigest()[:16]
+
+
+def resolve_target(path: str, root: Path = LIVE_CAPTURE_ROOT) -> Path:
+    """API 请求中的路径 -> 监视目标；只允许根目录内已存在的文件或目录"""
+    root = root.resolve()
+    target = (root / path).resolve()
+    if target != root and root not in target.parents:
+        raise ValueError(f"Path must be inside {root}")
+    if not target.exists():
+        raise FileNotFoundError(f"Path not found: {path}")
+    return target
+
+
+def _tsresol_divisor(tsresol: int) -> int:
+    """pcapng if_tsresol -> 每秒的时间戳单位数"""
+    return 2 ** (tsresol & 0x7F) if tsresol & 0x80 else 10 ** tsresol
+
+
+class CaptureTail:
+    """
+    单个抓包文件的增量读取 (经典 PCAP 与 PCAPNG)
+    offset 为已处理到的字节偏移 (下一条记录的起点)；每次 read 只解析其后已完整写入的记录，
+    末尾写了一半的记录留到下次。文件被截断 (变小) 时从头开始。
+    """
+
+    def __init__(self, path: Path, offset: int = 0):
+        self.path = path
+        self.offset = offset
+        self.size = 0
+        self.format: Optional[str] = None
+        self.error: Optional[str] = None
+        self._endian = "<"
+        self._record: Optional[struct.Struct] = None
+        self._frac_divisor = 1e6
+        self._interfaces: List[int] = []  # PCAPNG 各接口的时间戳单位数/秒
+        self._last_ts = 0.0
+
+    @property
+    def backlog(self) -> int:
+        return max(self.size - self.offset, 0)
+
+    def read(self, max_bytes: int = LIVE_READ_CHUNK) -> List[Tuple[float, bytes]]:
+        with open(self.path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size < self.offset:
+                logger.info(f"{self.path} was truncated, reading from the start")
+                self.offset, self.format = 0, None
+            if self.format is None and not self._read_header(f):
+                return []
+            if self.size <= self.offset:
+                return []
+            f.seek(self.offset)
+            data = f.read(min(self.size - self.offset, max(max_bytes, MAX_RECORD_BYTES + 16)))
+
+        if self.format == "pcap":
+            records, consumed = self._parse_pcap(data)
+        else:
+            records, consumed = self._parse_pcapng(data)
+        self.offset += consumed
+        return records
+
+    def _read_header(self, f) -> bool:
+        f.seek(0)
+        head = f.read(24)
+        if len(head) < 4:
+            return False
+        endian = PCAP_MAGICS.get(head[:4])
+        if endian:
+            if len(head) < 24:
+                return False
+            nano = head[:4] in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+            self._record = struct.Struct(endian + "IIII")
+            self._frac_divisor = 1e9 if nano else 1e6
+            self.format = "pcap"
+            self.offset = max(self.offset, 24)
+            return True
+        if struct.unpack("<I", head[:4])[0] == PCAPNG_SHB:
+            self.format = "pcapng"
+            if self.offset:
+                # 从断点继续：接口表 (时间戳精度) 需要重新读取断点之前的块头
+                self._restore_pcapng(f)
+            return True
+        raise ValueError(f"{self.path.name} is not a pcap/pcapng file")
+
+    def _parse_pcap(self, data: bytes) -> Tuple[List[Tuple[float, bytes]], int]:
+        record, divisor = self._record, self._frac_divisor
+        records: List[Tuple[float, bytes]] = []
+        pos, end = 0, len(data)
+        while end - pos >= 16:
+            sec, frac, caplen, _ = record.unpack_from(data, pos)
+            if caplen > MAX_RECORD_BYTES:
+                raise ValueError(f"Corrupt record at offset {self.offset + pos} in {self.path.name}")
+            if end - pos - 16 < caplen:
+                break
+            records.append((sec + frac / divisor, data[pos + 16 : pos + 16 + caplen]))
+            pos += 16 + caplen
+        return records, pos
+
+    def _parse_pcapng(self, data: bytes) -> Tuple[List[Tuple[float, bytes]], int]:
+        records: List[Tuple[float, bytes]] = []
+        pos, end = 0, len(data)
+        while end - pos >= 12:
+            block_type = struct.unpack_from(self._endian + "I", data, pos)[0]
+            if block_type == PCAPNG_SHB:
+                # 节头块：按字节序标记确定本节字节序，接口编号重新开始
+                order = struct.unpack_from("<I", data, pos + 8)[0]
+                self._endian = "<" if order == PCAPNG_BYTE_ORDER else ">"
+                self._interfaces = []
+            block_len = struct.unpack_from(self._endian + "I", data, pos + 4)[0]
+            if block_len < 12 or block_len > MAX_RECORD_BYTES:
+                raise ValueError(f"Corrupt block at offset {self.offset + pos} in {self.path.name}")
+            if end - pos < block_len:
+                break
+            body = data[pos + 8 : pos + block_len - 4]
+            self._handle_block(block_type, body, records)
+            pos += block_len
+        return records, pos
+
+    def _handle_block(self, block_type: int, body: bytes, records: List[Tuple[float, bytes]]):
+        endian = self._endian
+        if block_type == PCAPNG_IDB:
+            self._interfaces.append(_tsresol_divisor(self._if_tsresol(body)))
+        elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+            if block_type == PCAPNG_EPB:
+                iface = struct.unpack_from(endian + "I", body, 0)[0]
+            else:
+                iface = struct.unpack_from(endian + "H", body, 0)[0]
+            ts_high, ts_low, caplen, _ = struct.unpack_from(endian + "IIII", body, 4)
+            divisor = self._interfaces[iface] if iface < len(self._interfaces) else 1_000_000
+            self._last_ts = ((ts_high << 32) | ts_low) / divisor
+            records.append((self._last_ts, body[20 : 20 + caplen]))
+        elif block_type == PCAPNG_SPB:
+            # 简单包块不带时间戳，沿用上一个包的时间
+            wirelen = struct.unpack_from(endian + "I", body, 0)[0]
+            records.append((self._last_ts, body[4 : 4 + min(wirelen, len(body) - 4)]))
+
+    def _if_tsresol(self, body: bytes) -> int:
+        pos = 8  # linktype(2) + reserved(2) + snaplen(4)
+        while pos + 4 <= len(body):
+            code, length = struct.unpack_from(self._endian + "HH", body, pos)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL and length >= 1:
+                return body[pos + 4]
+            pos += 4 + ((length + 3) & ~3)
+        return 6
+
+    def _restore_pcapng(self, f):
+        pos = 0
+        while pos < self.offset:
+            f.seek(pos)
+            head = f.read(12)
+            if len(head) < 12:
+                break
+            block_type = struct.unpack_from(self._endian + "I", head)[0]
+            if block_type == PCAPNG_SHB:
+                order = struct.unpack_from("<I", head, 8)[0]
+                self._endian = "<" if order == PCAPNG_BYTE_ORDER else ">"
+                self._interfaces = []
+            block_len = struct.unpack_from(self._endian + "I", head, 4)[0]
+            if block_len < 12:
+                break
+            if block_type == PCAPNG_IDB:
+                f.seek(pos + 8)
+                self._interfaces.append(_tsresol_divisor(self._if_tsresol(f.read(block_len - 12))))
+            pos += block_len
+
+
+class CaptureWatcher:
+    """
+    监视单个抓包文件或轮转抓包目录
+    文件以 (设备号, inode) 标识：被改名轮转 (cap.pcap -> cap.pcap.1) 的文件从原偏移继续，
+    同名的新文件从头读取；按修改时间从旧到新处理，前一个文件读完之前不读后面的文件。
+    """
+
+    def __init__(self, target: Path, checkpoint: Optional[Dict[str, Any]] = None):
+        self.target = Path(target)
+        self.tails: Dict[str, CaptureTail] = {}
+        # 断点中的文件在首次见到时恢复偏移
+        self._resume: Dict[str, int] = {
+            key: entry["offset"] for key, entry in ((checkpoint or {}).get("files") or {}).items()
+        }
+
+    def _candidates(self) -> List[Tuple[str, Path]]:
+        if self.target.is_dir():
+            paths = [
+                p for p in self.target.iterdir()
+                if LIVE_CAPTURE_PATTERN.search(p.name) and p.is_file()
+            ]
+        else:
+            paths = [self.target] if self.target.exists() else []
+        found = []
+        for path in paths:
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            found.append((st.st_mtime, path.name, f"{st.st_dev}:{st.st_ino}", path))
+        return [(key, path) for _, _, key, path in sorted(found)]
+
+    def poll(self, max_bytes: int = LIVE_READ_CHUNK) -> Iterator[List[Tuple[float, bytes]]]:
+        """读取各文件新增的记录，逐批产出 (每个文件至多 max_bytes)"""
+        candidates = self._candidates()
+        live_keys = {key for key, _ in candidates}
+        for key in [k for k in self.tails if k not in live_keys]:
+            del self.tails[key]  # 已删除的轮转文件
+
+        for key, path in candidates:
+            tail = self.tails.get(key)
+            if tail is None:
+                tail = self.tails[key] = CaptureTail(path, self._resume.pop(key, 0))
+            tail.path = path
+            if tail.error:
+                continue
+            try:
+                records = tail.read(max_bytes)
+            except (OSError, ValueError) as e:
+                tail.error = str(e)
+                logger.warning(f"Stopped reading {path}: {e}")
+                continue
+            if records:
+                yield records
+            if tail.backlog:
+                return  # 保持时间顺序：先追上较早的文件
+
+    @property
+    def backlog(self) -> int:
+        return sum(t.backlog for t in self.tails.values() if not t.error)
+
+    def files(self) -> List[Dict[str, Any]]:
+        return [
+            {"path": str(t.path), "offset": t.offset, "size": t.size, "error": t.error}
+            for t in self.tails.values()
+        ]
+
+    def checkpoint(self) -> Dict[str, Any]:
+        files = {key: {"path": str(t.path), "offset": t.offset} for key, t in self.tails.items()}
+        # 尚未见到的断点文件原样保留
+        files.update({key: {"path": None, "offset": offset} for key, offset in self._resume.items()})
+        return {"target": str(self.target), "files": files}
+
+
+class LiveAnalysis:
+    """
+    单个监视任务：后台线程轮询 CaptureWatcher，把新记录逐批送入 AnalysisState，
+    每 publish_interval 秒发布一次快照 (累计统计 + 按抓包时间的滚动窗口 + 新告警)。
+    redis_client 为 None 时不写 Redis，只调用 on_snapshot (命令行模式)。
+    """
+
+    def __init__(
+        self,
+        target: Path,
+        window_seconds: int = LIVE_WINDOW_SECONDS,
+        redis_client=None,
+        on_snapshot: Optional[Callable[[Dict[str, Any]], None]] = None,
+        state_dir: Path = LIVE_STATE_DIR,
+        publish_interval: float = LIVE_PUBLISH_INTERVAL,
+    ):
+        self.target = Path(target).resolve()
+        self.watch_id = watch_id_for(self.target)
+        self.window = window_seconds
+        self.redis = redis_client
+        self.on_snapshot = on_snapshot
+        self.publish_interval = publish_interval
+        self.checkpoint_path = Path(state_dir) / f"{self.watch_id}.json"
+
+        self.analyzer = TrafficAnalyzer(str(self.target))
+        ANALYSIS_SPILL_DIR.mkdir(parents=True, exist_ok=True)
+        self._spill_dir = tempfile.mkdtemp(prefix=f"live-{self.watch_id}-", dir=ANALYSIS_SPILL_DIR)
+        self.state = AnalysisState(self._spill_dir)
+        self.watcher = CaptureWatcher(self.target, self._load_checkpoint())
+
+        self.lock = threading.Lock()
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        # 滚动窗口：抓包时间 (秒) -> [包数, 字节数]；协议分布按批记录增量
+        self._latest_second: Optional[int] = None
+        self._seconds: Dict[int, List[int]] = {}
+        self._protocol_deltas: Deque[Tuple[int, Counter]] = deque()
+        self._protocol_seen: Counter = Counter()
+        # 告警只保留快照需要的部分：最近的告警、每秒的威胁类型计数与待推送的新告警
+        self._alerts_seen = 0
+        self._recent_alerts: Deque[Dict[str, Any]] = deque(maxlen=LIVE_SNAPSHOT_ALERTS)
+        self._threat_seconds: Dict[int, Counter] = {}
+        self._new_alerts: Deque[Dict[str, Any]] = deque(maxlen=LIVE_SNAPSHOT_ALERTS)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 断点 ----------
+
+    def _load_checkpoint(self) -> Optional[Dict[str, Any]]:
+        try:
+            checkpoint = loads(self.checkpoint_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logger.warning(f"Ignoring unreadable live checkpoint {self.checkpoint_path}: {e}")
+            return None
+        if checkpoint.get("target") != str(self.target):
+            return None
+        logger.info(f"Resuming live analysis of {self.target} from checkpoint")
+        return checkpoint
+
+    def _save_checkpoint(self):
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        partial = self.checkpoint_path.with_suffix(".partial")
+        partial.write_bytes(dumps(self.watcher.checkpoint()))
+        os.replace(partial, self.checkpoint_path)
+
+    # ---------- 聚合 ----------
+
+    def ingest(self) -> int:
+        """读取一轮新增数据并聚合，返回处理的包数"""
+        ingested = 0
+        for records in self.watcher.poll():
+            with self.lock:
+                self.analyzer.consume(self.state, records)
+                self._update_window(records)
+            ingested += len(records)
+        return ingested
+
+    def _update_window(self, records: List[Tuple[float, bytes]]):
+        seconds = self._seconds
+        latest = self._latest_second
+        for ts, buf in records:
+            second = int(ts)
+            bucket = seconds.get(second)
+            if bucket is None:
+                seconds[second] = [1, len(buf)]
+            else:
+                bucket[0] += 1
+                bucket[1] += len(buf)
+            if latest is None or second > latest:
+                latest = second
+        self._latest_second = latest
+
+        delta = self.state.protocol_stats - self._protocol_seen
+        if delta:
+            self._protocol_deltas.append((latest, delta))
+            self._protocol_seen = Counter(self.state.protocol_stats)
+
+        threat_seconds = self._threat_seconds
+        for alert in self.state.alerts.since(self._alerts_seen):
+            self._recent_alerts.append(alert)
+            self._new_alerts.append(alert)
+            second = int(alert["time"])
+            counts = threat_seconds.get(second)
+            if counts is None:
+                counts = threat_seconds[second] = Counter()
+            counts[alert["threat_type"]] += 1
+        self._alerts_seen = len(self.state.alerts)
+
+        horizon = latest - self.window + 1
+        for second in [s for s in seconds if s < horizon]:
+            del seconds[second]
+        for second in [s for s in threat_seconds if s < horizon]:
+            del threat_seconds[second]
+        while self._protocol_deltas and self._protocol_deltas[0][0] < horizon:
+            self._protocol_deltas.popleft()
+
+    # ---------- 输出 ----------
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前快照：累计统计、滚动窗口统计与窗口内的告警"""
+        with self.lock:
+            state = self.state
+            latest = self._latest_second
+            window: Dict[str, Any] = {"seconds": self.window, "start": None, "end": None,
+                                      "packets": 0, "bytes": 0, "pps": 0.0, "bps": 0.0,
+                                      "protocols": {}, "threats": {}, "alerts": []}
+            if latest is not None:
+                horizon = latest - self.window + 1
+                packets = sum(b[0] for b in self._seconds.values())
+                size = sum(b[1] for b in self._seconds.values())
+                protocols: Counter = Counter()
+                for _, delta in self._protocol_deltas:
+                    protocols.update(delta)
+                threats: Counter = Counter()
+                for counts in self._threat_seconds.values():
+                    threats.update(counts)
+                window.update(
+                    {
+                        "start": horizon,
+                        "end": latest,
+                        "packets": packets,
+                        "bytes": size,
+                        "pps": packets / self.window,
+                        "bps": size * 8 / self.window,
+                        "protocols": dict(protocols),
+                        "threats": dict(threats),
+                        "alerts": [a for a in self._recent_alerts if a["time"] >= horizon],
+                    }
+                )
+            return {
+                "watch_id": self.watch_id,
+                "target": str(self.target),
+                "status": self.status,
+                "error": self.error,
+                "started_at": self.started_at,
+                "updated_at": time.time(),
+                "backlog_bytes": self.watcher.backlog,
+                "files": self.watcher.files(),
+                "totals": {
+                    "packets": state.total_packets,
+                    "bytes": state.total_bytes,
+                    "start_time": state.start_time,
+                    "end_time": state.end_time,
+                    "protocols": dict(state.protocol_stats),
+                    "threats": len(state.alerts),
+                },
+                "window": window,
+            }
+
+    def result(self) -> Dict[str, Any]:
+        """完整的累计分析结果 (结构同全量分析：Top 会话、攻击路径、时间线等)"""
+        with self.lock:
+            return self.analyzer.summarize(self.state)
+
+    def publish(self) -> Dict[str, Any]:
+        snapshot = self.snapshot()
+        with self.lock:
+            snapshot["new_alerts"] = list(self._new_alerts)
+            self._new_alerts.clear()
+        LIVE_BACKLOG_BYTES.labels(self.watch_id).set(snapshot["backlog_bytes"])
+        if self.redis is not None:
+            try:
+                self.redis.set(snapshot_key(self.watch_id), dumps(snapshot), ex=LIVE_SNAPSHOT_TTL)
+            except Exception as e:
+                logger.warning(f"Failed to store live snapshot {self.watch_id}: {e}")
+            publish_task_event(self.redis, live_channel(self.watch_id), snapshot)
+        if self.on_snapshot is not None:
+            self.on_snapshot(snapshot)
+        return snapshot
+
+    # ---------- 运行 ----------
+
+    def start(self):
+        if self.redis is not None:
+            try:
+                self.redis.delete(stop_key(self.watch_id))
+            except Exception as e:
+                logger.warning(f"Failed to clear live stop flag: {e}")
+        self._thread = threading.Thread(target=self.run, name=f"live-{self.watch_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: Optional[float] = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _stop_requested(self) -> bool:
+        if self._stop.is_set():
+            return True
+        if self.redis is None:
+            return False
+        try:
+            # 其他进程 (多实例部署) 通过 Redis 标记请求停止
+            return bool(self.redis.exists(stop_key(self.watch_id)))
+        except Exception:
+            return False
+
+    def run(self):
+        logger.info(f"Live analysis {self.watch_id} watching {self.target}")
+        last_publish = 0.0
+        try:
+            while not self._stop_requested():
+                try:
+                    ingested = self.ingest()
+                    self.error = None
+                except MemoryError:
+                    raise
+                except Exception as e:
+                    logger.exception(f"Live analysis {self.watch_id} ingest failed")
+                    self.error = str(e)
+                    ingested = 0
+                now = time.monotonic()
+                if now - last_publish >= self.publish_interval:
+                    self._save_checkpoint()
+                    self.publish()
+                    last_publish = now
+                if not ingested:
+                    self._stop.wait(LIVE_POLL_INTERVAL)
+        except Exception as e:
+            self.error = str(e)
+            logger.exception(f"Live analysis {self.watch_id} failed")
+        finally:
+            self.status = "stopped" if self.error is None else "failed"
+            self._save_checkpoint()
+            self.publish()
+            LIVE_BACKLOG_BYTES.remove(self.watch_id)
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            logger.info(f"Live analysis {self.watch_id} stopped")
+
+
+class LiveRegistry:
+    """进程内运行中的监视任务 (快照经 Redis 共享，其他进程也能读取与请求停止)"""
+
+    def __init__(self):
+        self._sessions: Dict[str, LiveAnalysis] = {}
+        self._lock = threading.Lock()
+
+    def start(self, target: Path, window_seconds: int, redis_client) -> LiveAnalysis:
+        watch_id = watch_id_for(target)
+        with self._lock:
+            session = self._sessions.get(watch_id)
+            if session is not None and session.status == "running":
+                return session
+            session = LiveAnalysis(target, window_seconds, redis_client=redis_client)
+            self._sessions[watch_id] = session
+        session.start()
+        return session
+
+    def get(self, watch_id: str) -> Optional[LiveAnalysis]:
+        with self._lock:
+            return self._sessions.get(watch_id)
+
+    def list(self) -> List[LiveAnalysis]:
+        with self._lock:
+            return list(self._sessions.values())
+
+    def stop(self, watch_id: str, redis_client=None) -> bool:
+        """请求停止；返回该任务是否在本进程中运行"""
+        if redis_client is not None:
+            redis_client.set(stop_key(watch_id), 1, ex=LIVE_SNAPSHOT_TTL)
+        session = self.get(watch_id)
+        if session is None:
+            return False
+        session.stop()
+        return True
+
+
+# 进程级单例
+live_registry = LiveRegistry()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Tail growing pcap files and print rolling statistics")
+    parser.add_argument("target", help="capture file or rotation directory")
+    parser.add_argument("--window", type=int, default=LIVE_WINDOW_SECONDS, help="rolling window (seconds)")
+    parser.add_argument("--interval", type=float, default=LIVE_PUBLISH_INTERVAL, help="print interval (seconds)")
+    parser.add_argument("--state-dir", default=str(LIVE_STATE_DIR), help="checkpoint directory")
+    args = parser.parse_args(argv)
+
+    def emit(snapshot: Dict[str, Any]):
+        sys.stdout.write(dumps_str(snapshot) + "\n")
+        sys.stdout.flush()
+
+    session = LiveAnalysis(
+        Path(args.target),
+        args.window,
+        on_snapshot=emit,
+        state_dir=Path(args.state_dir),
+        publish_interval=args.interval,
+    )
+    session.start()
+    try:
+        while session._thread.is_alive():
+            session.join(0.5)
+    except KeyboardInterrupt:
+        session.stop()
+        session.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+from typing import Any, List, Tuple
+
+from database import SessionLocal
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 单个事务最多合并的记录数
+METADATA_BATCH_SIZE = int(os.getenv("METADATA_BATCH_SIZE", "64"))
+
+
+class MetadataWriter:
+    """
+    元数据批量写入 (组提交)
+    上传等路径把待插入的 ORM 对象交给后台线程：线程取出队列中已到达的全部记录 (至多 batch_size 条)
+    放进同一个事务提交，提交期间新到达的记录进入下一批。单个请求不会为了凑批而额外等待，
+    并发上传时只付出一次提交开销，也不会多个请求线程争抢 SQLite 的写锁。
+    submit 返回 concurrent.futures.Future (提交成功后结果为该对象)，协程中用 asyncio.wrap_future 等待。
+    """
+
+    def __init__(self, session_factory=SessionLocal, batch_size: int = METADATA_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Tuple[Any, Future]]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, row: Any) -> Future:
+        future: Future = Future()
+        self._ensure_started()
+        self._queue.put((row, future))
+        return future
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="metadata-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch: List[Tuple[Any, Future]]):
+        # 提交后不过期属性，调用方拿到的对象在会话关闭后仍可读取
+        db = self.session_factory(expire_on_commit=False)
+        try:
+            db.add_all([row for row, _ in batch])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            error = e
+        else:
+            error = None
+        finally:
+            db.close()
+
+        if error is None:
+            for row, future in batch:
+                future.set_result(row)
+        elif len(batch) > 1:
+            # 单条记录出错 (如唯一约束冲突) 不连累同批的其他记录：逐条重试
+            logger.warning(f"Batched metadata commit failed, retrying one by one: {error}")
+            for item in batch:
+                self._commit([item])
+        else:
+            batch[0][1].set_exception(error)
+
+
+# 进程级单例
+metadata_writer = MetadataWriter()
@@ -0,0 +1,355 @@
+import re
+import json
+import hashlib
+import ipaddress
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# 会话键: (以太类型, IP 协议号, 源地址, 目的地址, 源端口, 目的端口)，缺失的字段为 None
+FlowKey = Tuple[int, Optional[int], Optional[str], Optional[str], Optional[int], Optional[int]]
+Predicate = Callable[[FlowKey], bool]
+# 解析结果 (语法树)：("and"|"or", [子节点]) / ("not", 子节点) / 原语
+# 原语: ("proto", 以太类型|None, 协议号|None) ("host", 方向, 地址) ("net", 方向, 网段) ("port", 方向, 下限, 上限)
+Node = Tuple[Any, ...]
+
+ETH_IPV4 = 0x0800
+ETH_ARP = 0x0806
+ETH_IPV6 = 0x86DD
+
+# 协议关键字 -> (以太类型, IP 协议号)
+PROTO_KEYWORDS = {
+    "ip": (ETH_IPV4, None),
+    "ip6": (ETH_IPV6, None),
+    "arp": (ETH_ARP, None),
+    "tcp": (None, 6),
+    "udp": (None, 17),
+    "icmp": (ETH_IPV4, 1),
+    "icmp6": (ETH_IPV6, 58),
+    "sctp": (None, 132),
+}
+# 会话/告警记录中的协议名 ("Other" 不限定协议，仅按地址匹配)
+PROTOCOL_NAMES = {"TCP": "tcp", "UDP": "udp", "ICMP": "icmp", "OTHER": None}
+
+MAX_PACKET_RANGES = 1000
+
+_TOKEN_RE = re.compile(r"\(|\)|&&|\|\||!|[^\s()!]+")
+
+
+class PacketFilter:
+    """
+    类 BPF 过滤表达式
+    只支持可由会话五元组判定的原语，按会话而非逐包求值 (配合包索引使用):
+      [src|dst] host ADDR     [src|dst] net CIDR
+      [src|dst] port N        [src|dst] portrange N-M
+      ip | ip6 | arp | tcp | udp | icmp | icmp6 | sctp     proto N
+    以 and / or / not (或 && / || / !) 与括号组合，例如:
+      tcp and host 10.0.0.5 and (port 80 or port 8080)
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression.strip()
+        self._tokens = _TOKEN_RE.findall(self.expression)
+        self._pos = 0
+        if not self._tokens:
+            raise ValueError("Empty filter expression")
+        self.tree: Node = self._parse_or()
+        if self._pos != len(self._tokens):
+            raise ValueError(f"Unexpected token '{self._tokens[self._pos]}' in filter")
+        self._predicate = _compile(self.tree)
+
+    def matches(self, flow: FlowKey) -> bool:
+        return self._predicate(flow)
+
+    def evaluate(self, primitive: Callable[[Node], int], universe: int) -> int:
+        """
+        以位图求值 (配合倒排索引使用)：primitive 把原语换算为命中会话的位图 (int，第 i 位对应会话 i)，
+        universe 为全部会话的位图，not 取其补集
+        """
+
+        def visit(node: Node) -> int:
+            op = node[0]
+            if op == "and":
+                result = universe
+                for child in node[1]:
+                    result &= visit(child)
+                    if not result:
+                        break
+                return result
+            if op == "or":
+                result = 0
+                for child in node[1]:
+                    result |= visit(child)
+                return result
+            if op == "not":
+                return universe & ~visit(node[1])
+            return primitive(node)
+
+        return visit(self.tree)
+
+    @staticmethod
+    def flow_expression(
+        src_ip: Optional[str] = None,
+        dst_ip: Optional[str] = None,
+        src_port: Optional[int] = None,
+        dst_port: Optional[int] = None,
+        protocol: Optional[str] = None,
+        bidirectional: bool = True,
+    ) -> str:
+        """由会话五元组生成过滤表达式；bidirectional 时同时匹配反方向的应答包"""
+
+        def side(a_ip, a_port, b_ip, b_port):
+            terms = []
+            if a_ip:
+                terms.append(f"src host {a_ip}")
+            if a_port is not None:
+                terms.append(f"src port {a_port}")
+            if b_ip:
+                terms.append(f"dst host {b_ip}")
+            if b_port is not None:
+                terms.append(f"dst port {b_port}")
+            return " and ".join(terms)
+
+        forward = side(src_ip, src_port, dst_ip, dst_port)
+        backward = side(dst_ip, dst_port, src_ip, src_port) if bidirectional else ""
+        if forward and backward and backward != forward:
+            expr = f"(({forward}) or ({backward}))"
+        else:
+            expr = f"({forward})" if forward else ""
+        proto = (protocol or "").lower()
+        proto = PROTOCOL_NAMES.get(proto.upper(), proto)
+        if proto:
+            if proto not in PROTO_KEYWORDS:
+                raise ValueError(f"Unknown protocol: {protocol}")
+            expr = f"{proto} and {expr}" if expr else proto
+        if not expr:
+            raise ValueError("Flow filter needs at least one field")
+        return expr
+
+    # ---------- 递归下降解析 ----------
+
+    def _peek(self) -> Optional[str]:
+        return self._tokens[self._pos].lower() if self._pos < len(self._tokens) else None
+
+    def _next(self, what: str = "token") -> str:
+        if self._pos >= len(self._tokens):
+            raise ValueError(f"Filter expression ended early, expected {what}")
+        token = self._tokens[self._pos]
+        self._pos += 1
+        return token
+
+    def _parse_or(self) -> Node:
+        terms = [self._parse_and()]
+        while self._peek() in ("or", "||"):
+            self._pos += 1
+            terms.append(self._parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return ("or", terms)
+
+    def _parse_and(self) -> Node:
+        terms = [self._parse_not()]
+        while self._peek() in ("and", "&&"):
+            self._pos += 1
+            terms.append(self._parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return ("and", terms)
+
+    def _parse_not(self) -> Node:
+        if self._peek() in ("not", "!"):
+            self._pos += 1
+            return ("not", self._parse_not())
+        if self._peek() == "(":
+            self._pos += 1
+            inner = self._parse_or()
+            if self._next("')'") != ")":
+                raise ValueError("Missing ')' in filter expression")
+            return inner
+        return self._parse_primitive()
+
+    def _parse_primitive(self) -> Node:
+        token = self._next("primitive").lower()
+        direction = None
+        if token in ("src", "dst"):
+            direction, token = token, self._next("host/net/port").lower()
+
+        if token in PROTO_KEYWORDS and direction is None:
+            ethertype, proto = PROTO_KEYWORDS[token]
+            return ("proto", ethertype, proto)
+        if token == "proto" and direction is None:
+            return ("proto", None, _parse_int(self._next("protocol number"), 0, 255))
+        if token == "host":
+            return ("host", direction, _parse_host(self._next("address")))
+        if token == "net":
+            return ("net", direction, _parse_net(self._next("network")))
+        if token == "port":
+            port = _parse_int(self._next("port"), 0, 65535)
+            return ("port", direction, port, port)
+        if token == "portrange":
+            low, _, high = self._next("port range").partition("-")
+            return ("port", direction, _parse_int(low, 0, 65535), _parse_int(high, 0, 65535))
+        if direction is not None:
+            # "src 10.0.0.1" 等价于 "src host 10.0.0.1"
+            return ("host", direction, _parse_host(token))
+        raise ValueError(f"Unsupported filter primitive '{token}'")
+
+
+def _compile(node: Node) -> Predicate:
+    """语法树 -> 逐会话判定函数"""
+    op = node[0]
+    if op in ("and", "or"):
+        terms = [_compile(child) for child in node[1]]
+        if op == "and":
+            return lambda f: all(t(f) for t in terms)
+        return lambda f: any(t(f) for t in terms)
+    if op == "not":
+        inner = _compile(node[1])
+        return lambda f: not inner(f)
+    if op == "proto":
+        _, ethertype, proto = node
+        return lambda f: (ethertype is None or f[0] == ethertype) and (
+            proto is None or f[1] == proto
+        )
+    if op == "host":
+        return _address_predicate(node[1], node[2])
+    if op == "net":
+        return _network_predicate(node[1], node[2])
+    return _port_predicate(node[1], node[2], node[3])
+
+
+def _parse_int(text: str, low: int, high: int) -> int:
+    try:
+        value = int(text)
+    except ValueError:
+        raise ValueError(f"Invalid number '{text}' in filter")
+    if not low <= value <= high:
+        raise ValueError(f"Number {value} out of range in filter")
+    return value
+
+
+def _parse_host(text: str) -> str:
+    try:
+        return str(ipaddress.ip_address(text))
+    except ValueError:
+        raise ValueError(f"Invalid address '{text}' in filter")
+
+
+def _parse_net(text: str):
+    try:
+        return ipaddress.ip_network(text, strict=False)
+    except ValueError:
+        raise ValueError(f"Invalid network '{text}' in filter")
+
+
+def _address_predicate(direction: Optional[str], addr: str) -> Predicate:
+    if direction == "src":
+        return lambda f: f[2] == addr
+    if direction == "dst":
+        return lambda f: f[3] == addr
+    return lambda f: f[2] == addr or f[3] == addr
+
+
+def _network_predicate(direction: Optional[str], net) -> Predicate:
+    def contains(addr: Optional[str]) -> bool:
+        if not addr:
+            return False
+        ip = ipaddress.ip_address(addr)
+        return ip.version == net.version and ip in net
+
+    if direction == "src":
+        return lambda f: contains(f[2])
+    if direction == "dst":
+        return lambda f: contains(f[3])
+    return lambda f: contains(f[2]) or contains(f[3])
+
+
+def _port_predicate(direction: Optional[str], low: int, high: int) -> Predicate:
+    def within(port: Optional[int]) -> bool:
+        return port is not None and low <= port <= high
+
+    if direction == "src":
+        return lambda f: within(f[4])
+    if direction == "dst":
+        return lambda f: within(f[5])
+    return lambda f: within(f[4]) or within(f[5])
+
+
+class PacketSelection:
+    """
+    重放子集选择条件 (各条件之间为"与"关系)
+    expression     类 BPF 过滤表达式 (会话/告警过滤会先转换为表达式)
+    start_time / end_time   抓包时间范围 (Unix 时间戳，秒，含两端)
+    packet_ranges  包序号范围列表 [[起, 止], ...]，序号从 0 开始、含两端，与包列表中的 index 一致
+    """
+
+    def __init__(
+        self,
+        expression: Optional[str] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        packet_ranges: Optional[Sequence[Sequence[int]]] = None,
+    ):
+        self.expression = expression.strip() if expression and expression.strip() else None
+        self.filter = PacketFilter(self.expression) if self.expression else None
+        self.start_time = float(start_time) if start_time is not None else None
+        self.end_time = float(end_time) if end_time is not None else None
+        if (
+            self.start_time is not None
+            and self.end_time is not None
+            and self.start_time > self.end_time
+        ):
+            raise ValueError("start_time must not be later than end_time")
+
+        self.packet_ranges: Optional[List[List[int]]] = None
+        if packet_ranges:
+            if len(packet_ranges) > MAX_PACKET_RANGES:
+                raise ValueError(f"At most {MAX_PACKET_RANGES} packet ranges are allowed")
+            ranges = []
+            for r in packet_ranges:
+                if len(r) != 2 or int(r[0]) < 0 or int(r[0]) > int(r[1]):
+                    raise ValueError(f"Invalid packet range: {list(r)}")
+                ranges.append([int(r[0]), int(r[1])])
+            self.packet_ranges = sorted(ranges)
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "PacketSelection":
+        data = data or {}
+        return cls(
+            data.get("expression"),
+            data.get("start_time"),
+            data.get("end_time"),
+            data.get("packet_ranges"),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "expression": self.expression,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "packet_ranges": self.packet_ranges,
+        }
+
+    def is_empty(self) -> bool:
+        return (
+            self.expression is None
+            and self.start_time is None
+            and self.end_time is None
+            and not self.packet_ranges
+        )
+
+    @property
+    def key(self) -> str:
+        """条件摘要，与文件哈希共同组成子集缓存键"""
+        canonical = json.dumps(self.to_dict(), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+    def describe(self) -> str:
+        parts = []
+        if self.expression:
+            parts.append(f"filter '{self.expression}'")
+        if self.start_time is not None or self.end_time is not None:
+            parts.append(f"time [{self.start_time}, {self.end_time}]")
+        if self.packet_ranges:
+            shown = ", ".join(f"{a}-{b}" for a, b in self.packet_ranges[:5])
+            more = " ..." if len(self.packet_ranges) > 5 else ""
+            parts.append(f"packets {shown}{more}")
+        return "; ".join(parts)
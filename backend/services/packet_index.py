@@ -0,0 +1,473 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import bisect
+import logging
+import ipaddress
+from array import array
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import cache_lookup
+from services.derived_pcap_cache import (
+    IO_BUFFER_SIZE,
+    DerivedPcapCache,
+    HashingWriter,
+    PcapWriter,
+    build_lock,
+)
+from services.packet_filter import ETH_ARP, ETH_IPV4, ETH_IPV6, PacketSelection
+from services.pcap_rewriter import IPV6_EXT_HEADERS, IPV6_FRAGMENT, PCAP_MAGICS, locate_l3
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 包索引目录 (按文件内容哈希命名，与文件路径无关)
+PACKET_INDEX_DIR = Path(os.getenv("PACKET_INDEX_DIR", "results/packet_index"))
+# 子集提取结果缓存
+SUBSET_CACHE_DIR = Path(os.getenv("REPLAY_SUBSET_CACHE_DIR", "results/subset_cache"))
+SUBSET_CACHE_BUDGET = int(os.getenv("REPLAY_SUBSET_CACHE_BUDGET", str(10 * 1024 ** 3)))
+
+INDEX_MAGIC = b"CRPIDX1\0"
+# 列式存储: (列名, array 类型码)；按顺序排列在元数据之后，各列 8 字节对齐
+INDEX_COLUMNS = (
+    ("offset", "Q"),  # 包数据在文件中的偏移
+    ("ts_ns", "q"),  # 时间戳 (纳秒)
+    ("caplen", "I"),
+    ("wirelen", "I"),
+    ("flow", "I"),  # 会话表下标
+)
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 1
+PCAPNG_PB = 2
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+PCAPNG_IF_TSRESOL = 9
+
+PORT_PROTOCOLS = (6, 17, 132)
+
+
+def _index_path(index_dir: Path, file_hash: str) -> Path:
+    return Path(index_dir) / f"{file_hash}.idx"
+
+
+def _ts_converter(tsresol: int):
+    """pcapng if_tsresol -> 时间戳单位到纳秒的换算函数"""
+    if tsresol & 0x80:
+        bits = tsresol & 0x7F
+        return lambda units: (units * 1_000_000_000) >> bits
+    if tsresol <= 9:
+        factor = 10 ** (9 - tsresol)
+        return lambda units: units * factor
+    divisor = 10 ** (tsresol - 9)
+    return lambda units: units // divisor
+
+
+class _IndexBuilder:
+    """一次顺序扫描生成包索引：记录每个包的数据偏移、长度、时间戳与所属会话"""
+
+    def __init__(self):
+        self.columns = {name: array(code) for name, code in INDEX_COLUMNS}
+        self.flow_ids: Dict[tuple, int] = {}
+        self.flows: List[tuple] = []
+        self.linktype: Optional[int] = None
+        self.flows_supported = True
+
+    def add(self, offset: int, ts_ns: int, caplen: int, wirelen: int, data: bytes):
+        c = self.columns
+        c["offset"].append(offset)
+        c["ts_ns"].append(ts_ns)
+        c["caplen"].append(caplen)
+        c["wirelen"].append(wirelen)
+        key = self._flow_key(data)
+        flow_id = self.flow_ids.get(key)
+        if flow_id is None:
+            flow_id = self.flow_ids[key] = len(self.flows)
+            self.flows.append(key)
+        c["flow"].append(flow_id)
+
+    def _flow_key(self, data: bytes) -> tuple:
+        if not self.flows_supported:
+            return (0, None, None, None, None, None)
+        try:
+            l3, ethertype = locate_l3(self.linktype, data)
+        except ValueError:
+            # 不支持的链路类型：仍可按时间/序号选择，但不能按表达式过滤
+            self.flows_supported = False
+            return (0, None, None, None, None, None)
+
+        if ethertype == ETH_IPV4 and len(data) >= l3 + 20:
+            proto = data[l3 + 9]
+            src, dst = data[l3 + 12 : l3 + 16], data[l3 + 16 : l3 + 20]
+            l4 = l3 + (data[l3] & 0x0F) * 4
+            first_fragment = (data[l3 + 6] & 0x1F) == 0 and data[l3 + 7] == 0
+        elif ethertype == ETH_IPV6 and len(data) >= l3 + 40:
+            proto, l4 = data[l3 + 6], l3 + 40
+            src, dst = data[l3 + 8 : l3 + 24], data[l3 + 24 : l3 + 40]
+            first_fragment = True
+            while len(data) >= l4 + 8 and proto in IPV6_EXT_HEADERS + (IPV6_FRAGMENT,):
+                if proto == IPV6_FRAGMENT:
+                    first_fragment = not ((data[l4 + 2] << 8) | data[l4 + 3]) & 0xFFF8
+                    proto, l4 = data[l4], l4 + 8
+                else:
+                    proto, l4 = data[l4], l4 + (data[l4 + 1] + 1) * 8
+        elif ethertype == ETH_ARP and len(data) >= l3 + 28:
+            return (ethertype, None, data[l3 + 14 : l3 + 18], data[l3 + 24 : l3 + 28], None, None)
+        else:
+            return (ethertype, None, None, None, None, None)
+
+        sport = dport = None
+        if proto in PORT_PROTOCOLS and first_fragment and len(data) >= l4 + 4:
+            sport = (data[l4] << 8) | data[l4 + 1]
+            dport = (data[l4 + 2] << 8) | data[l4 + 3]
+        return (ethertype, proto, src, dst, sport, dport)
+
+    def scan(self, f: BinaryIO) -> Dict[str, Any]:
+        header = f.read(24)
+        endian = PCAP_MAGICS.get(header[:4])
+        if endian:
+            return self._scan_pcap(f, header, endian)
+        f.seek(0)
+        return self._scan_pcapng(f)
+
+    def _scan_pcap(self, f: BinaryIO, header: bytes, endian: str) -> Dict[str, Any]:
+        nano = header[:4] in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d")
+        self.linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+        record = struct.Struct(endian + "IIII")
+        sub = 1 if nano else 1000
+        offset = 24
+        block, pos = b"", 0
+        while True:
+            if len(block) - pos < 16 or len(block) - pos < 16 + record.unpack_from(block, pos)[2]:
+                chunk = f.read(IO_BUFFER_SIZE)
+                if not chunk:
+                    break
+                block, pos = block[pos:] + chunk, 0
+                continue
+            sec, frac, caplen, wirelen = record.unpack_from(block, pos)
+            data = block[pos + 16 : pos + 16 + caplen]
+            self.add(offset + 16, sec * 1_000_000_000 + frac * sub, caplen, wirelen, data)
+            pos += 16 + caplen
+            offset += 16 + caplen
+        return {"format": "pcap", "header": header.hex(), "linktype": self.linktype}
+
+    def _scan_pcapng(self, f: BinaryIO) -> Dict[str, Any]:
+        endian = "<"
+        interfaces: List[Tuple[int, Any]] = []  # (linktype, 时间戳换算)
+        offset = 0
+        last_ts = 0
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                break
+            block_type = struct.unpack(endian + "I", head[:4])[0]
+            if block_type == PCAPNG_SHB:
+                # 节头块：根据字节序标记确定本节的字节序，接口编号重新开始
+                magic = f.read(4)
+                endian = "<" if struct.unpack("<I", magic)[0] == PCAPNG_BYTE_ORDER else ">"
+                block_len = struct.unpack(endian + "I", head[4:])[0]
+                body = magic + f.read(block_len - 12)
+                interfaces = []
+            else:
+                block_len = struct.unpack(endian + "I", head[4:])[0]
+                body = f.read(block_len - 8)
+            if len(body) < block_len - 8 or block_len < 12:
+                break  # 文件末尾的不完整块
+
+            if block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + "H", body, 0)[0]
+                interfaces.append((linktype, _ts_converter(self._if_tsresol(body, endian))))
+                if self.linktype is None:
+                    self.linktype = linktype
+                elif linktype != self.linktype:
+                    raise ValueError("pcapng files with mixed link types cannot be indexed")
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    iface = struct.unpack_from(endian + "I", body, 0)[0]
+                else:
+                    iface = struct.unpack_from(endian + "H", body, 0)[0]
+                ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + "IIII", body, 4)
+                to_ns = interfaces[iface][1] if iface < len(interfaces) else _ts_converter(6)
+                last_ts = to_ns((ts_high << 32) | ts_low)
+                self.add(offset + 28, last_ts, caplen, wirelen, body[20 : 20 + caplen])
+            elif block_type == PCAPNG_SPB:
+                wirelen = struct.unpack_from(endian + "I", body, 0)[0]
+                caplen = min(wirelen, block_len - 16)
+                self.add(offset + 12, last_ts, caplen, wirelen, body[4 : 4 + caplen])
+            offset += block_len
+        return {"format": "pcapng", "header": None, "linktype": self.linktype or 1}
+
+    @staticmethod
+    def _if_tsresol(body: bytes, endian: str) -> int:
+        pos = 8  # linktype(2) + reserved(2) + snaplen(4)
+        while pos + 4 <= len(body) - 4:
+            code, length = struct.unpack_from(endian + "HH", body, pos)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL and length >= 1:
+                return body[pos + 4]
+            pos += 4 + ((length + 3) & ~3)
+        return 6
+
+    def flow_table(self) -> List[list]:
+        def addr(raw: Optional[bytes]) -> Optional[str]:
+            return str(ipaddress.ip_address(raw)) if raw else None
+
+        return [
+            [ethertype, proto, addr(src), addr(dst), sport, dport]
+            for ethertype, proto, src, dst, sport, dport in self.flows
+        ]
+
+
+class PacketIndex:
+    """
+    抓包文件的包偏移索引 (列式、内存映射)
+    1. 首次使用时顺序扫描一次生成，按文件内容哈希保存，之后直接映射到内存，不再解析抓包。
+    2. 按序号/时间范围 (时间戳有序时二分查找) 与会话表达式 (按会话而非逐包求值) 选出包区间。
+    3. 只读取选中记录写出子集：经典 PCAP 的连续区间整段拷贝，PCAPNG 逐包转换为经典 PCAP 记录。
+    """
+
+    def __init__(self, pcap_file: str, path: Path):
+        self.pcap_file = pcap_file
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_len = struct.unpack_from("<I", self._mm, len(INDEX_MAGIC))[0]
+        meta_start = len(INDEX_MAGIC) + 4
+        self.meta = json.loads(bytes(self._mm[meta_start : meta_start + meta_len]))
+        self.count = self.meta["count"]
+        self.flows: List[list] = self.meta["flows"]
+
+        view = memoryview(self._mm)
+        pos = self.meta["columns_offset"]
+        self._views = [view]
+        self.columns: Dict[str, memoryview] = {}
+        for name, code in INDEX_COLUMNS:
+            size = array(code).itemsize * self.count
+            column = view[pos : pos + size].cast(code)
+            self._views.append(column)
+            self.columns[name] = column
+            pos += (size + 7) & ~7
+
+    @classmethod
+    def open(
+        cls, pcap_file: str, file_hash: str, index_dir: Path = PACKET_INDEX_DIR
+    ) -> "PacketIndex":
+        """打开索引，不存在时扫描抓包生成"""
+        path = _index_path(index_dir, file_hash)
+        with build_lock(str(path)):
+            exists = path.exists()
+            cache_lookup("packet_index", exists)
+            if not exists:
+                cls.build(pcap_file, path)
+        index = cls(pcap_file, path)
+        if index.meta.get("byteorder") != sys.byteorder:
+            index.close()
+            with build_lock(str(path)):
+                cls.build(pcap_file, path)
+            index = cls(pcap_file, path)
+        return index
+
+    @staticmethod
+    def build(pcap_file: str, path: Path):
+        builder = _IndexBuilder()
+        with open(pcap_file, "rb", buffering=IO_BUFFER_SIZE) as f:
+            info = builder.scan(f)
+        ts = builder.columns["ts_ns"]
+        meta = {
+            **info,
+            "count": len(ts),
+            "byteorder": sys.byteorder,
+            "ts_sorted": all(ts[i] <= ts[i + 1] for i in range(len(ts) - 1)),
+            "flows_supported": builder.flows_supported,
+            "flows": builder.flow_table(),
+        }
+
+        # 元数据长度确定后才能算出列的起始位置：先按占位值编码一次
+        meta["columns_offset"] = 0
+        encoded = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+        columns_offset = (len(INDEX_MAGIC) + 4 + len(encoded) + 32 + 7) & ~7
+        meta["columns_offset"] = columns_offset
+        encoded = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f"{path.name}.{os.getpid()}.partial")
+        with open(partial, "wb", buffering=IO_BUFFER_SIZE) as out:
+            out.write(INDEX_MAGIC + struct.pack("<I", len(encoded)) + encoded)
+            out.write(b"\0" * (columns_offset - out.tell()))
+            for name, _ in INDEX_COLUMNS:
+                raw = builder.columns[name].tobytes()
+                out.write(raw)
+                out.write(b"\0" * (-len(raw) % 8))
+        os.replace(partial, path)
+        logger.info(f"Built packet index for {pcap_file}: {meta['count']} packets, {len(builder.flows)} flows")
+
+    @staticmethod
+    def delete_for_hash(file_hash: str, index_dir: Path = PACKET_INDEX_DIR):
+        """删除某个文件内容的索引文件 (已映射的实例不受影响，随最后一个引用释放)"""
+        _index_path(index_dir, file_hash).unlink(missing_ok=True)
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------- 选择 ----------
+
+    @staticmethod
+    def _merge(runs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        merged: List[Tuple[int, int]] = []
+        for start, end in sorted(runs):
+            if start >= end:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def select(self, selection: PacketSelection) -> List[Tuple[int, int]]:
+        """返回选中包的区间列表 [起, 止) (按序号递增、互不重叠)"""
+        n = self.count
+        if selection.packet_ranges:
+            runs = self._merge([(a, min(b + 1, n)) for a, b in selection.packet_ranges if a < n])
+        else:
+            runs = [(0, n)] if n else []
+
+        ts = self.columns["ts_ns"]
+        start_ns = int(selection.start_time * 1e9) if selection.start_time is not None else None
+        end_ns = int(selection.end_time * 1e9) if selection.end_time is not None else None
+        time_bounded = start_ns is not None or end_ns is not None
+        if time_bounded and self.meta["ts_sorted"]:
+            lo = bisect.bisect_left(ts, start_ns) if start_ns is not None else 0
+            hi = bisect.bisect_right(ts, end_ns) if end_ns is not None else n
+            runs = [(max(a, lo), min(b, hi)) for a, b in runs if a < hi and b > lo]
+            time_bounded = False
+
+        flow_ok = None
+        if selection.filter is not None:
+            if not self.meta["flows_supported"]:
+                raise ValueError(
+                    f"Filter expressions are not supported for link type {self.meta['linktype']}"
+                )
+            flow_ok = bytes(1 if selection.filter.matches(tuple(f)) else 0 for f in self.flows)
+            if all(flow_ok):
+                flow_ok = None
+            elif not any(flow_ok):
+                return []
+
+        if flow_ok is None and not time_bounded:
+            return runs
+
+        # 逐包判定 (会话匹配结果已预先计算，循环内只做查表)
+        flows = self.columns["flow"]
+        lo_ns = start_ns if start_ns is not None else -(1 << 63)
+        hi_ns = end_ns if end_ns is not None else (1 << 63) - 1
+        selected: List[Tuple[int, int]] = []
+        for a, b in runs:
+            run_start = None
+            for i in range(a, b):
+                keep = (flow_ok is None or flow_ok[flows[i]]) and (
+                    not time_bounded or lo_ns <= ts[i] <= hi_ns
+                )
+                if keep:
+                    if run_start is None:
+                        run_start = i
+                elif run_start is not None:
+                    selected.append((run_start, i))
+                    run_start = None
+            if run_start is not None:
+                selected.append((run_start, b))
+        return selected
+
+    # ---------- 子集写出 ----------
+
+    def write_subset(self, runs: Iterable[Tuple[int, int]], out: PcapWriter) -> Dict[str, Any]:
+        """
+        写出选中区间 (按序号递增) 的包，runs 可以是惰性迭代器，只遍历一次
+        经典 PCAP 的连续区间交给 out.copy_range 整段拷贝 (ZeroCopyWriter 下由内核完成)
+        """
+        offsets, caplens = self.columns["offset"], self.columns["caplen"]
+        ts, wirelens = self.columns["ts_ns"], self.columns["wirelen"]
+        packets = 0
+        first_ts, last_ts = None, None
+
+        def tracked(source: Iterable[Tuple[int, int]]) -> Iterator[Tuple[int, int]]:
+            nonlocal packets, first_ts, last_ts
+            for a, b in source:
+                packets += b - a
+                first_ts = ts[a] if first_ts is None else min(first_ts, ts[a])
+                last_ts = ts[b - 1] if last_ts is None else max(last_ts, ts[b - 1])
+                yield a, b
+
+        fd = os.open(self.pcap_file, os.O_RDONLY)
+        try:
+            if self.meta["format"] == "pcap":
+                # 经典 PCAP：沿用原文件头，连续区间 (记录头 + 数据) 整段拷贝
+                out.write(bytes.fromhex(self.meta["header"]))
+                for a, b in tracked(runs):
+                    out.copy_range(fd, offsets[a] - 16, offsets[b - 1] + caplens[b - 1])
+            else:
+                # PCAPNG：逐包生成纳秒精度的经典 PCAP 记录
+                out.write(
+                    struct.pack("<IHHiIII", 0xA1B23C4D, 2, 4, 0, 0, 262144, self.meta["linktype"])
+                )
+                record = struct.Struct("<IIII")
+                pending, pending_size = [], 0
+                for a, b in tracked(runs):
+                    for i in range(a, b):
+                        sec, ns = divmod(ts[i], 1_000_000_000)
+                        pending.append(record.pack(sec, ns, caplens[i], wirelens[i]))
+                        pending.append(os.pread(fd, caplens[i], offsets[i]))
+                        pending_size += 16 + caplens[i]
+                        if pending_size >= IO_BUFFER_SIZE:
+                            out.write(b"".join(pending))
+                            pending, pending_size = [], 0
+                out.write(b"".join(pending))
+        finally:
+            os.close(fd)
+
+        return {
+            "packets": packets,
+            "total_packets": self.count,
+            "duration": (last_ts - first_ts) / 1e9 if packets else 0.0,
+        }
+
+
+class SubsetExtractor:
+    """按选择条件提取抓包子集，结果按 (文件哈希, 条件摘要) 缓存"""
+
+    def __init__(
+        self,
+        pcap_file: str,
+        file_hash: str,
+        index_dir: Path = PACKET_INDEX_DIR,
+        cache_dir: Path = SUBSET_CACHE_DIR,
+        cache_budget: int = SUBSET_CACHE_BUDGET,
+    ):
+        self.pcap_file = pcap_file
+        self.file_hash = file_hash
+        self.index_dir = index_dir
+        self.cache = DerivedPcapCache(cache_dir, cache_budget, kind="subset")
+
+    def extract(self, selection: PacketSelection) -> Dict[str, Any]:
+        def produce(out: HashingWriter) -> Dict[str, Any]:
+            with PacketIndex.open(self.pcap_file, self.file_hash, self.index_dir) as index:
+                runs = index.select(selection)
+                if not runs:
+                    raise ValueError("No packets match the replay filter")
+                return index.write_subset(runs, out)
+
+        return self.cache.get_or_build(f"{self.file_hash}-{selection.key}", produce)
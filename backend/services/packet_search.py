@@ -0,0 +1,699 @@
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import zlib
+import bisect
+import heapq
+import hashlib
+import struct
+import operator
+import logging
+import ipaddress
+import threading
+from array import array
+from collections import OrderedDict, defaultdict
+from itertools import accumulate, chain, compress, islice
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from metrics import PACKET_SEARCH_SECONDS, cache_lookup
+from services.derived_pcap_cache import IO_BUFFER_SIZE, DerivedPcapCache, build_lock
+from services.packet_filter import Node, PacketFilter
+from services.packet_index import (
+    PACKET_INDEX_DIR,
+    SUBSET_CACHE_BUDGET,
+    SUBSET_CACHE_DIR,
+    PacketIndex,
+)
+from services.pcap_rewriter import REWRITE_CACHE_BUDGET, REWRITE_CACHE_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 上传完成后是否在后台生成检索索引 (关闭时首次检索再生成)
+PACKET_SEARCH_INDEX_ON_UPLOAD = os.getenv("PACKET_SEARCH_INDEX_ON_UPLOAD", "1") == "1"
+# 进程内保持打开的检索索引个数
+PACKET_SEARCH_CACHE_SIZE = int(os.getenv("PACKET_SEARCH_CACHE_SIZE", "8"))
+# 导出结果缓存
+EXPORT_CACHE_DIR = Path(os.getenv("PCAP_EXPORT_CACHE_DIR", "results/export_cache"))
+EXPORT_CACHE_BUDGET = int(os.getenv("PCAP_EXPORT_CACHE_BUDGET", str(5 * 1024 ** 3)))
+
+SEARCH_MAGIC = b"CRPSIX1\0"
+# 会话目录 (按会话编号排列)：首包/末包序号、包数、包序号倒排表在数据区中的偏移与长度
+DIRECTORY_COLUMNS = (
+    ("first", "I"),
+    ("last", "I"),
+    ("count", "I"),
+    ("offset", "Q"),
+    ("length", "I"),
+)
+# 词表各列：词项对应的会话集合在数据区中的偏移、长度、会话数与编码 (1: 位图, 0: 差分编号)
+TERM_COLUMNS = (
+    ("offset", "Q"),
+    ("length", "I"),
+    ("count", "I"),
+    ("kind", "B"),
+)
+# 词项类别: (名称, 会话表字段下标, 键宽度)；会话表每项为 [以太类型, 协议号, 源地址, 目的地址, 源端口, 目的端口]
+# 键为定长大端字节串，字节序即数值序：网段与端口范围对应词表中的连续区间
+ADDRESS_KEY_WIDTH = 17  # 地址长度 (4/16) + 地址 (IPv4 右侧补零)
+TERM_FIELDS = (
+    ("ether", 0, 2),
+    ("proto", 1, 1),
+    ("src", 2, ADDRESS_KEY_WIDTH),
+    ("dst", 3, ADDRESS_KEY_WIDTH),
+    ("sport", 4, 2),
+    ("dport", 5, 2),
+)
+# 不超过该条目数的倒排表不压缩 (压缩流的固定开销大于收益)
+RAW_POSTING_MAX = 16
+# 命中会话数超过全部会话的 1/32 时，位图比编号数组 (每项 4 字节) 更小
+BITMAP_DENSITY = 32
+# 命中包占区间的比例不低于 1/SCAN_DENSITY 时，翻页改为顺序扫描包索引的会话列
+SCAN_DENSITY = 64
+
+_NONZERO = re.compile(b"[^\x00]")
+_SELECTED_RUN = re.compile(b"\x01+")
+# 扫描求区间时每次处理的包数 (掩码内存上限)
+SCAN_WINDOW = 1 << 20
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+def _search_path(index_dir: Path, file_hash: str) -> Path:
+    return Path(index_dir) / f"{file_hash}.sidx"
+
+
+def _address_key(packed: bytes) -> bytes:
+    return bytes((len(packed),)) + packed.ljust(16, b"\0")
+
+
+def _term_key(value: Any, width: int) -> bytes:
+    if width == ADDRESS_KEY_WIDTH:
+        return _address_key(ipaddress.ip_address(value).packed)
+    return int(value).to_bytes(width, "big")
+
+
+def _deflate(raw: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def _encode_ids(ids: array) -> bytes:
+    """递增编号 -> 差分后的 uint32 数组 (条目较多时再做 deflate 压缩)"""
+    raw = array("I", map(operator.sub, ids, chain((0,), ids))).tobytes()
+    return raw if len(ids) <= RAW_POSTING_MAX else _deflate(raw)
+
+
+def _decode_ids(raw: bytes, count: int) -> List[int]:
+    deltas = array("I")
+    deltas.frombytes(raw if count <= RAW_POSTING_MAX else zlib.decompress(raw, -15))
+    return list(accumulate(deltas))
+
+
+def _bit_positions(bitmap: int) -> List[int]:
+    """位图 -> 置位的编号 (递增)，按非零字节跳跃，稀疏位图只访问有值的字节"""
+    raw = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    positions: List[int] = []
+    extend = positions.extend
+    for match in _NONZERO.finditer(raw):
+        base = match.start() << 3
+        extend(base + bit for bit in _BYTE_BITS[raw[match.start()]])
+    return positions
+
+
+class _Keys:
+    """内存映射中的定长键序列 (只读，供 bisect 二分查找)"""
+
+    def __init__(self, mm: mmap.mmap, pos: int, width: int, count: int):
+        self.mm, self.pos, self.width, self.count = mm, pos, width, count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        start = self.pos + i * self.width
+        return self.mm[start : start + self.width]
+
+
+class PacketSearchIndex:
+    """
+    抓包文件的倒排检索索引 (由包索引派生，按文件内容哈希保存，内存映射读取)
+    1. 词项 (以太类型、协议号、源/目的地址、源/目的端口) -> 命中的会话集合：
+       稀疏时存差分编码的会话编号，稠密时存位图，均 deflate 压缩；查询时展开为 int 位图，
+       布尔表达式直接做按位与/或/补，与包数无关。词表按键排序，精确查找、网段与端口范围均为二分查找。
+    2. 会话 -> 包序号倒排表 (差分编码 + deflate)：计数只累加会话目录中的包数，
+       翻页时按首包序号依次解码会话并多路归并，只解码到所需页为止；命中包较稠密时改为顺序扫描会话列。
+       会话编号按首次出现的顺序分配，会话目录的首包序号天然递增。
+    3. 包摘要 (时间、长度、五元组) 直接取自包索引的列与会话表，不读取抓包文件。
+    """
+
+    def __init__(self, path: Path, packet_index: PacketIndex):
+        self.path = Path(path)
+        self.packet_index = packet_index
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        meta_len = struct.unpack_from("<I", self._mm, len(SEARCH_MAGIC))[0]
+        meta_start = len(SEARCH_MAGIC) + 4
+        self.meta = json.loads(bytes(self._mm[meta_start : meta_start + meta_len]))
+        self.flow_count = self.meta["flows"]
+        self.universe = (1 << self.flow_count) - 1
+        self._bitmap_bytes = (self.flow_count + 7) // 8
+        self._blob = self._section_pos("blob")
+
+        self.directory = {
+            name: self._load_column(f"flow.{name}", code) for name, code in DIRECTORY_COLUMNS
+        }
+        self.terms: Dict[str, Dict[str, Any]] = {}
+        for name, _, width in TERM_FIELDS:
+            table = {col: self._load_column(f"{name}.{col}", code) for col, code in TERM_COLUMNS}
+            keys_pos = self._section_pos(f"{name}.keys")
+            table["keys"] = _Keys(self._mm, keys_pos, width, len(table["count"]))
+            self.terms[name] = table
+
+    def _section_pos(self, name: str) -> int:
+        return self.meta["data_offset"] + self.meta["sections"][name][0]
+
+    def _load_column(self, name: str, code: str) -> array:
+        pos = self._section_pos(name)
+        column = array(code)
+        column.frombytes(self._mm[pos : pos + self.meta["sections"][name][1]])
+        return column
+
+    # ---------- 生成 ----------
+
+    @staticmethod
+    def build(packet_index: PacketIndex, path: Path):
+        flows = packet_index.flows
+        postings = [array("I") for _ in range(len(flows))]
+        appends = [posting.append for posting in postings]
+        for number, flow in enumerate(packet_index.columns["flow"]):
+            appends[flow](number)
+
+        sections: List[Tuple[str, bytes]] = []
+        blob: List[bytes] = []
+        blob_size = 0
+
+        def put(data: bytes) -> int:
+            nonlocal blob_size
+            blob.append(data)
+            blob_size += len(data)
+            return blob_size - len(data)
+
+        directory = {name: array(code) for name, code in DIRECTORY_COLUMNS}
+        for posting in postings:
+            data = _encode_ids(posting)
+            directory["first"].append(posting[0] if posting else 0)
+            directory["last"].append(posting[-1] if posting else 0)
+            directory["count"].append(len(posting))
+            directory["offset"].append(put(data))
+            directory["length"].append(len(data))
+        sections.extend((f"flow.{name}", directory[name].tobytes()) for name, _ in DIRECTORY_COLUMNS)
+
+        term_count = 0
+        bitmap_bytes = (len(flows) + 7) // 8
+        for name, field, width in TERM_FIELDS:
+            values: Dict[bytes, array] = defaultdict(lambda: array("I"))
+            for flow_id, flow in enumerate(flows):
+                if flow[field] is not None:
+                    values[_term_key(flow[field], width)].append(flow_id)
+            keys = sorted(values)
+            table = {col: array(code) for col, code in TERM_COLUMNS}
+            for key in keys:
+                ids = values[key]
+                if len(ids) * BITMAP_DENSITY > len(flows):
+                    bitmap = bytearray(bitmap_bytes)
+                    for flow_id in ids:
+                        bitmap[flow_id >> 3] |= 1 << (flow_id & 7)
+                    data, kind = _deflate(bytes(bitmap)), 1
+                else:
+                    data, kind = _encode_ids(ids), 0
+                table["offset"].append(put(data))
+                table["length"].append(len(data))
+                table["count"].append(len(ids))
+                table["kind"].append(kind)
+            sections.append((f"{name}.keys", b"".join(keys)))
+            sections.extend((f"{name}.{col}", table[col].tobytes()) for col, _ in TERM_COLUMNS)
+            term_count += len(keys)
+
+        # 各段相对数据区起点的位置 (8 字节对齐)，数据区紧跟在元数据之后
+        layout: Dict[str, List[int]] = {}
+        pos = 0
+        for name, raw in sections:
+            layout[name] = [pos, len(raw)]
+            pos += (len(raw) + 7) & ~7
+        layout["blob"] = [pos, blob_size]
+        meta = {
+            "packets": packet_index.count,
+            "flows": len(flows),
+            "byteorder": sys.byteorder,
+            "sections": layout,
+            "data_offset": 0,
+        }
+        # 元数据长度确定后才能算出数据区位置：先按占位值编码一次，再为偏移的位数预留余量
+        encoded = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+        data_offset = (len(SEARCH_MAGIC) + 4 + len(encoded) + 32 + 7) & ~7
+        meta["data_offset"] = data_offset
+        encoded = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f"{path.name}.{os.getpid()}.partial")
+        with open(partial, "wb", buffering=IO_BUFFER_SIZE) as out:
+            out.write(SEARCH_MAGIC + struct.pack("<I", len(encoded)) + encoded)
+            out.write(b"\0" * (data_offset - out.tell()))
+            for _, raw in sections:
+                out.write(raw)
+                out.write(b"\0" * (-len(raw) % 8))
+            for data in blob:
+                out.write(data)
+        os.replace(partial, path)
+        logger.info(
+            f"Built search index for {packet_index.pcap_file}: {packet_index.count} packets, "
+            f"{len(flows)} flows, {term_count} terms"
+        )
+
+    # ---------- 词项 -> 会话位图 ----------
+
+    def _union(self, name: str, low: bytes, high: bytes) -> int:
+        """键在 [low, high] 内的全部词项的会话位图之并：稀疏词项直接置位到同一个缓冲区"""
+        table = self.terms[name]
+        start = bisect.bisect_left(table["keys"], low)
+        end = bisect.bisect_right(table["keys"], high)
+        offsets, lengths, counts, kinds = (table[col] for col, _ in TERM_COLUMNS)
+        bitmap = bytearray(self._bitmap_bytes)
+        result = 0
+        for i in range(start, end):
+            pos = self._blob + offsets[i]
+            raw = self._mm[pos : pos + lengths[i]]
+            if kinds[i]:
+                result |= int.from_bytes(zlib.decompress(raw, -15), "little")
+            else:
+                for flow_id in _decode_ids(raw, counts[i]):
+                    bitmap[flow_id >> 3] |= 1 << (flow_id & 7)
+        return result | int.from_bytes(bitmap, "little")
+
+    def _term(self, name: str, value: Any, width: int) -> int:
+        key = _term_key(value, width)
+        return self._union(name, key, key)
+
+    @staticmethod
+    def _sides(direction: Optional[str], src: str, dst: str) -> Tuple[str, ...]:
+        if direction == "src":
+            return (src,)
+        if direction == "dst":
+            return (dst,)
+        return (src, dst)
+
+    def _primitive(self, node: Node) -> int:
+        op = node[0]
+        if op == "proto":
+            _, ethertype, proto = node
+            result = self.universe
+            if ethertype is not None:
+                result &= self._term("ether", ethertype, 2)
+            if proto is not None:
+                result &= self._term("proto", proto, 1)
+            return result
+        result = 0
+        if op == "host":
+            for name in self._sides(node[1], "src", "dst"):
+                result |= self._term(name, node[2], ADDRESS_KEY_WIDTH)
+        elif op == "net":
+            net = node[2]
+            low = _address_key(net.network_address.packed)
+            high = _address_key(net.broadcast_address.packed)
+            for name in self._sides(node[1], "src", "dst"):
+                result |= self._union(name, low, high)
+        else:
+            _, direction, low, high = node
+            for name in self._sides(direction, "sport", "dport"):
+                result |= self._union(name, low.to_bytes(2, "big"), high.to_bytes(2, "big"))
+        return result
+
+    # ---------- 检索 ----------
+
+    def _packets_of(self, flow_id: int) -> List[int]:
+        d = self.directory
+        offset = self._blob + d["offset"][flow_id]
+        return _decode_ids(self._mm[offset : offset + d["length"][flow_id]], d["count"][flow_id])
+
+    def _merge_packets(self, flow_ids: List[int], lo: int, hi: int) -> Iterator[int]:
+        """按包序号递增输出命中会话在 [lo, hi) 内的包；会话按首包序号排列，到需要时才解码"""
+        first = self.directory["first"]
+        heap: List[Tuple[int, int, List[int], int]] = []
+        pending = iter(flow_ids)
+        upcoming = next(pending, None)
+        while heap or upcoming is not None:
+            while upcoming is not None and (not heap or first[upcoming] <= heap[0][0]):
+                packets = self._packets_of(upcoming)
+                pos = bisect.bisect_left(packets, lo)
+                if pos < len(packets) and packets[pos] < hi:
+                    heapq.heappush(heap, (packets[pos], upcoming, packets, pos))
+                upcoming = next(pending, None)
+            if not heap:
+                continue
+            number, flow_id, packets, pos = heap[0]
+            yield number
+            pos += 1
+            if pos < len(packets) and packets[pos] < hi:
+                heapq.heapreplace(heap, (packets[pos], flow_id, packets, pos))
+            else:
+                heapq.heappop(heap)
+
+    def _scan_packets(self, flow_ids: List[int], lo: int, hi: int) -> Iterator[int]:
+        """顺序扫描包索引的会话列 [lo, hi)，逐包查表 (在 C 层完成，适合命中稠密的查询)"""
+        selected = bytearray(self.flow_count)
+        for flow_id in flow_ids:
+            selected[flow_id] = 1
+        flows = self.packet_index.columns["flow"][lo:hi]
+        return compress(range(lo, hi), map(selected.__getitem__, flows))
+
+    def _scan_runs(self, flow_ids: List[int], lo: int, hi: int) -> Iterator[Tuple[int, int]]:
+        """扫描会话列，按窗口生成命中掩码并用正则找出连续命中区间 (跨窗口的区间会合并)"""
+        selected = bytearray(self.flow_count)
+        for flow_id in flow_ids:
+            selected[flow_id] = 1
+        column = self.packet_index.columns["flow"]
+        start, end = None, None
+        for window in range(lo, hi, SCAN_WINDOW):
+            mask = bytes(map(selected.__getitem__, column[window : min(window + SCAN_WINDOW, hi)]))
+            for m in _SELECTED_RUN.finditer(mask):
+                a, b = window + m.start(), window + m.end()
+                if start is not None and a == end:
+                    end = b
+                    continue
+                if start is not None:
+                    yield start, end
+                start, end = a, b
+        if start is not None:
+            yield start, end
+
+    @staticmethod
+    def _coalesce(numbers: Iterator[int]) -> Iterator[Tuple[int, int]]:
+        """递增包序号 -> 连续区间 [起, 止)"""
+        start = end = None
+        for number in numbers:
+            if number == end:
+                end += 1
+                continue
+            if start is not None:
+                yield start, end
+            start, end = number, number + 1
+        if start is not None:
+            yield start, end
+
+    def _summary(self, number: int) -> Dict[str, Any]:
+        columns = self.packet_index.columns
+        ethertype, proto, src, dst, sport, dport = self.packet_index.flows[columns["flow"][number]]
+        return {
+            "index": number,
+            "time": columns["ts_ns"][number] / 1e9,
+            "length": columns["wirelen"][number],
+            "caplen": columns["caplen"][number],
+            "flow": columns["flow"][number],
+            "ethertype": ethertype,
+            "src_ip": src,
+            "dst_ip": dst,
+            "protocol": proto,  # IP 协议号
+            "src_port": sport,
+            "dst_port": dport,
+        }
+
+    def search(
+        self,
+        expression: Optional[str] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        flow: Optional[int] = None,
+        offset: int = 0,
+        limit: int = 100,
+    ) -> Dict[str, Any]:
+        """
+        布尔检索：expression 为类 BPF 过滤表达式 (语法同重放过滤)，flow 限定单个会话 (包摘要中的 flow)，
+        start_time / end_time 为抓包时间范围 (秒，含两端)；各条件之间为"与"关系
+        返回命中包数、命中会话数与 [offset, offset + limit) 的包摘要
+        """
+        started = time.perf_counter()
+        total, flows, summaries = self.stream(expression, start_time, end_time, flow, offset, limit)
+        page = list(summaries)
+
+        elapsed = time.perf_counter() - started
+        PACKET_SEARCH_SECONDS.observe(elapsed)
+        return {
+            "total": total,
+            "flows": flows,
+            "offset": offset,
+            "limit": limit,
+            "packets": page,
+            "took_ms": round(elapsed * 1000, 3),
+        }
+
+    def stream(
+        self,
+        expression: Optional[str] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        flow: Optional[int] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> Tuple[int, int, Iterator[Dict[str, Any]]]:
+        """
+        与 search 相同，但包摘要以迭代器惰性生成 (limit 为 None 时直到最后一个命中包)，
+        用于流式响应；返回 (命中包数, 命中会话数, 包摘要迭代器)
+        """
+        flow_ids, lo, hi, in_time = self._resolve(expression, start_time, end_time, flow)
+        total = self._count(flow_ids, lo, hi, in_time)
+
+        if in_time is not None or total * SCAN_DENSITY >= hi - lo:
+            numbers = self._scan_packets(flow_ids, lo, hi)
+        else:
+            numbers = self._merge_packets(flow_ids, lo, hi)
+        if in_time is not None:
+            numbers = filter(in_time, numbers)
+        stop = offset + limit if limit is not None else None
+        return total, len(flow_ids), map(self._summary, islice(numbers, offset, stop))
+
+    def runs(
+        self,
+        expression: Optional[str] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        flow: Optional[int] = None,
+    ) -> Iterator[Tuple[int, int]]:
+        """
+        与 search 相同的条件，惰性输出全部命中包的连续区间 [起, 止) (按序号递增)，供导出等整段拷贝使用
+        条件解析在调用时立即完成 (表达式错误当场抛出)，区间在遍历时才逐步生成
+        """
+        flow_ids, lo, hi, in_time = self._resolve(expression, start_time, end_time, flow)
+        if lo >= hi or not flow_ids:
+            return iter(())
+        if in_time is not None:
+            return self._coalesce(filter(in_time, self._scan_packets(flow_ids, lo, hi)))
+        unfiltered = not (expression and expression.strip()) and flow is None
+        if unfiltered or len(flow_ids) == self.flow_count:
+            return iter(((lo, hi),))
+        counts = self.directory["count"]
+        # 命中包数的上界 (会话总包数) 足够稀疏时按会话归并，否则扫描会话列
+        if sum(map(counts.__getitem__, flow_ids)) * SCAN_DENSITY < hi - lo:
+            return self._coalesce(self._merge_packets(flow_ids, lo, hi))
+        return self._scan_runs(flow_ids, lo, hi)
+
+    def _resolve(
+        self,
+        expression: Optional[str],
+        start_time: Optional[float],
+        end_time: Optional[float],
+        flow: Optional[int],
+    ) -> Tuple[List[int], int, int, Optional[Callable[[int], bool]]]:
+        """
+        条件 -> (命中会话编号, 包序号区间 [lo, hi), 逐包时间判定)
+        时间戳有序时时间范围直接二分为序号区间，逐包判定为 None
+        """
+        matched = self.universe
+        if expression and expression.strip():
+            if not self.packet_index.meta["flows_supported"]:
+                linktype = self.packet_index.meta["linktype"]
+                raise ValueError(f"Filter expressions are not supported for link type {linktype}")
+            matched = PacketFilter(expression).evaluate(self._primitive, self.universe)
+        if flow is not None:
+            matched &= (1 << flow) if 0 <= flow < self.flow_count else 0
+
+        # 时间范围 -> 包序号区间 (时间戳有序时二分查找，否则逐包判定)
+        n = self.packet_index.count
+        ts = self.packet_index.columns["ts_ns"]
+        start_ns = int(start_time * 1e9) if start_time is not None else None
+        end_ns = int(end_time * 1e9) if end_time is not None else None
+        lo, hi, ts_check = 0, n, False
+        if start_ns is not None or end_ns is not None:
+            if self.packet_index.meta["ts_sorted"]:
+                lo = bisect.bisect_left(ts, start_ns) if start_ns is not None else 0
+                hi = bisect.bisect_right(ts, end_ns) if end_ns is not None else n
+                hi = max(hi, lo)
+            else:
+                ts_check = True
+        in_time = None
+        if ts_check:
+            lo_ns = start_ns if start_ns is not None else -(1 << 63)
+            hi_ns = end_ns if end_ns is not None else (1 << 63) - 1
+
+            def in_time(number: int) -> bool:
+                return lo_ns <= ts[number] <= hi_ns
+
+        first, last = self.directory["first"], self.directory["last"]
+        flow_ids = _bit_positions(matched)
+        if lo != 0 or hi != n:
+            flow_ids = [f for f in flow_ids if first[f] < hi and last[f] >= lo]
+        return flow_ids, lo, hi, in_time
+
+    def _count(
+        self, flow_ids: List[int], lo: int, hi: int, in_time: Optional[Callable[[int], bool]]
+    ) -> int:
+        """
+        计数：完全落在区间内的会话直接累加包数；跨越区间边界的会话需解码，
+        解码量超过区间内的包数时改为扫描会话列
+        """
+        first, last, counts = (self.directory[k] for k in ("first", "last", "count"))
+        if in_time is not None:
+            return sum(1 for number in self._scan_packets(flow_ids, lo, hi) if in_time(number))
+        if lo == 0 and hi == self.packet_index.count:
+            return sum(map(counts.__getitem__, flow_ids))
+        total = 0
+        crossing: List[int] = []
+        for f in flow_ids:
+            if lo <= first[f] and last[f] < hi:
+                total += counts[f]
+            else:
+                crossing.append(f)
+        if sum(counts[f] for f in crossing) > hi - lo:
+            return sum(1 for _ in self._scan_packets(flow_ids, lo, hi))
+        for f in crossing:
+            packets = self._packets_of(f)
+            total += bisect.bisect_left(packets, hi) - bisect.bisect_left(packets, lo)
+        return total
+
+    # ---------- 打开 ----------
+
+    _cache: "OrderedDict[Tuple[str, str], PacketSearchIndex]" = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def open(
+        cls, pcap_file: str, file_hash: str, index_dir: Path = PACKET_INDEX_DIR
+    ) -> "PacketSearchIndex":
+        """
+        打开检索索引，不存在时生成 (包索引同样按需生成)
+        打开后的索引在进程内按 LRU 保留，重复检索不再解析元数据；淘汰时不主动关闭，
+        映射随最后一个引用释放，不影响仍在使用它的请求。
+        缓存键包含抓包路径：同一内容的多份上传共用索引文件，但导出/提取时各自从自己的文件读取包数据，
+        删除其中一份不影响其他文件
+        """
+        path = _search_path(index_dir, file_hash)
+        key = (str(path), str(pcap_file))
+        with cls._cache_lock:
+            index = cls._cache.get(key)
+            if index is not None:
+                cls._cache.move_to_end(key)
+                return index
+
+        packet_index = PacketIndex.open(pcap_file, file_hash, index_dir)
+        try:
+            with build_lock(str(path)):
+                exists = path.exists()
+                cache_lookup("packet_search", exists)
+                if not exists:
+                    cls.build(packet_index, path)
+            index = cls(path, packet_index)
+            if index.meta.get("byteorder") != sys.byteorder:
+                with build_lock(str(path)):
+                    cls.build(packet_index, path)
+                index = cls(path, packet_index)
+        except Exception:
+            packet_index.close()
+            raise
+
+        with cls._cache_lock:
+            cls._cache[key] = index
+            cls._cache.move_to_end(key)
+            while len(cls._cache) > PACKET_SEARCH_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return index
+
+
+    @classmethod
+    def delete_for_hash(cls, file_hash: str, index_dir: Path = PACKET_INDEX_DIR):
+        """删除某个文件内容的包索引与检索索引，并移出进程内缓存"""
+        path = str(_search_path(index_dir, file_hash))
+        with cls._cache_lock:
+            for key in [k for k in cls._cache if k[0] == path]:
+                del cls._cache[key]
+        Path(path).unlink(missing_ok=True)
+        PacketIndex.delete_for_hash(file_hash, index_dir)
+
+
+class PcapExporter:
+    """
+    按检索条件导出命中包为经典 PCAP，结果按 (文件哈希, 条件摘要) 缓存
+    命中区间惰性生成、逐段由内核从源文件拷贝到导出文件，导出量再大也不在内存中缓冲包数据
+    """
+
+    def __init__(
+        self,
+        pcap_file: str,
+        file_hash: str,
+        index_dir: Path = PACKET_INDEX_DIR,
+        cache_dir: Path = EXPORT_CACHE_DIR,
+        cache_budget: int = EXPORT_CACHE_BUDGET,
+    ):
+        self.pcap_file = pcap_file
+        self.file_hash = file_hash
+        self.index_dir = index_dir
+        self.cache = DerivedPcapCache(cache_dir, cache_budget, kind="export")
+
+    def export(
+        self,
+        expression: Optional[str] = None,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        flow: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """条件同 PacketSearchIndex.search；返回导出文件路径与包数等统计"""
+        index = PacketSearchIndex.open(self.pcap_file, self.file_hash, self.index_dir)
+        # 先解析条件：表达式错误直接抛出，不进入缓存生成
+        runs = index.runs(expression, start_time, end_time, flow)
+        params = json.dumps(
+            [(expression or "").strip(), start_time, end_time, flow], separators=(",", ":")
+        )
+        key = hashlib.sha256(params.encode("utf-8")).hexdigest()[:32]
+
+        def produce(out) -> Dict[str, Any]:
+            stats = index.packet_index.write_subset(runs, out)
+            if not stats["packets"]:
+                raise ValueError("No packets match the export filter")
+            return stats
+
+        return self.cache.get_or_build(f"{self.file_hash}-{key}", produce, zero_copy=True)
+
+
+def build_search_index(pcap_file: str, file_hash: str):
+    """上传后的后台任务：预先生成包索引与检索索引，失败只记录日志 (首次检索时会重试)"""
+    try:
+        PacketSearchIndex.open(pcap_file, file_hash)
+    except Exception as e:
+        logger.warning(f"Search index build failed for {pcap_file}: {e}")
+
+
+def delete_derived_files(file_hash: str):
+    """
+    删除某个文件内容派生出的全部磁盘文件：包索引、检索索引、导出/子集/地址改写缓存
+    地址改写的源也可能是子集提取结果 (按子集内容哈希命名)，随子集一并清理。
+    调用方负责确认已没有其他文件引用同一内容
+    """
+    PacketSearchIndex.delete_for_hash(file_hash)
+    DerivedPcapCache(EXPORT_CACHE_DIR, EXPORT_CACHE_BUDGET, kind="export").delete_for_hash(file_hash)
+    subsets = DerivedPcapCache(SUBSET_CACHE_DIR, SUBSET_CACHE_BUDGET, kind="subset").delete_for_hash(file_hash)
+    rewrite = DerivedPcapCache(REWRITE_CACHE_DIR, REWRITE_CACHE_BUDGET, kind="rewrite")
+    for source in [file_hash, *subsets]:
+        rewrite.delete_for_hash(source)
+    logger.info(f"Removed derived files for {file_hash[:12]}")
@@ -1,5 +1,6 @@
 import os
 import socket
+import hashlib
 from collections import Counter
 from typing import Dict, Any, List
 import dpkt
@@ -51,21 +52,34 @@ class PCAPParser:
             ret.append("C")
         return "".join(ret) if ret else "none"
 
+    def get_file_hash(self) -> str:
+        """计算文件内容 SHA-256 (分块读取，不会把大文件载入内存)"""
+        digest = hashlib.sha256()
+        with open(self.pcap_file, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
     def get_basic_info(self) -> Dict[str, Any]:
         """获取基本信息 (流式统计，极速版)"""
         count = 0
+        first_ts = last_ts = None
         try:
             if os.path.exists(self.pcap_file):
                 with open(self.pcap_file, "rb") as f:
                     reader = self._get_reader(f)
-                    # 仅遍历计数，避免任何反序列化开销
-                    for _ in reader:
+                    # 仅遍历计数与首尾时间戳，避免任何反序列化开销
+                    for ts, _ in reader:
+                        if first_ts is None:
+                            first_ts = ts
+                        last_ts = ts
                         count += 1
         except Exception as e:
             print(f"Warning: Error getting basic info: {e}")
 
         return {
             "total_packets": count,
+            "duration": float(last_ts - first_ts) if count else 0.0,
             "file_size": (
                 os.path.getsize(self.pcap_file) if os.path.exists(self.pcap_file) else 0
             ),
@@ -0,0 +1,407 @@
+import os
+import json
+import struct
+import hashlib
+import logging
+import ipaddress
+from collections import Counter
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+import dpkt
+
+from services.derived_pcap_cache import IO_BUFFER_SIZE, DerivedPcapCache, HashingWriter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 改写结果缓存目录与磁盘预算 (按最近使用时间淘汰)
+REWRITE_CACHE_DIR = Path(os.getenv("REPLAY_REWRITE_CACHE_DIR", "results/rewrite_cache"))
+REWRITE_CACHE_BUDGET = int(os.getenv("REPLAY_REWRITE_CACHE_BUDGET", str(20 * 1024 ** 3)))
+# 仅指定 target_ip 时，从前 N 个包中推断被替换的服务端地址
+PRIMARY_SCAN_PACKETS = int(os.getenv("REPLAY_REWRITE_SCAN_PACKETS", "200000"))
+
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": "<",  # 微秒，小端
+    b"\xa1\xb2\xc3\xd4": ">",  # 微秒，大端
+    b"\x4d\x3c\xb2\xa1": "<",  # 纳秒，小端
+    b"\xa1\xb2\x3c\x4d": ">",  # 纳秒，大端
+}
+
+DLT_EN10MB = 1
+DLT_RAW = (12, 14, 101)
+DLT_IPV4 = 228
+DLT_IPV6 = 229
+DLT_LINUX_SLL = 113
+DLT_LINUX_SLL2 = 276
+
+ETH_IPV4 = 0x0800
+ETH_ARP = 0x0806
+ETH_IPV6 = 0x86DD
+ETH_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPV6_EXT_HEADERS = (0, 43, 60)  # 逐跳选项 / 路由 / 目的选项
+IPV6_FRAGMENT = 44
+
+
+def _fold(s: int) -> int:
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+    return s
+
+
+def locate_l3(linktype: int, data: bytes) -> Tuple[int, int]:
+    """网络层偏移与以太类型；无法识别时以太类型为 0"""
+    if linktype == DLT_EN10MB:
+        off = 12
+        if len(data) < 14:
+            return 0, 0
+        ethertype = (data[12] << 8) | data[13]
+        while ethertype in ETH_VLAN and len(data) >= off + 8:
+            off += 4
+            ethertype = (data[off] << 8) | data[off + 1]
+        return off + 2, ethertype
+    if linktype == DLT_LINUX_SLL:
+        return 16, ((data[14] << 8) | data[15]) if len(data) >= 16 else 0
+    if linktype == DLT_LINUX_SLL2:
+        return 20, ((data[0] << 8) | data[1]) if len(data) >= 20 else 0
+    if linktype in DLT_RAW or linktype in (DLT_IPV4, DLT_IPV6):
+        if not data:
+            return 0, 0
+        version = data[0] >> 4
+        return 0, ETH_IPV4 if version == 4 else ETH_IPV6 if version == 6 else 0
+    raise ValueError(f"Unsupported link type: {linktype}")
+
+
+def _checksum_delta(old: bytes, new: bytes) -> int:
+    """地址替换对反码和的增量 (RFC 1624: sum(~m + m'))，同一地址对只需计算一次"""
+    s = 0
+    for i in range(0, len(old), 2):
+        s += (~((old[i] << 8) | old[i + 1]) & 0xFFFF) + ((new[i] << 8) | new[i + 1])
+    return _fold(s)
+
+
+def _apply_delta(buf: bytearray, offset: int, delta: int, udp: bool = False):
+    """按 RFC 1624 式 3 增量更新校验和: HC' = ~(~HC + ~m + m')"""
+    csum = (buf[offset] << 8) | buf[offset + 1]
+    if udp and csum == 0:
+        return  # IPv4 UDP 未启用校验和
+    csum = ~_fold((~csum & 0xFFFF) + delta) & 0xFFFF
+    if udp and csum == 0:
+        csum = 0xFFFF
+    buf[offset] = csum >> 8
+    buf[offset + 1] = csum & 0xFF
+
+
+class RewriteRules:
+    """
+    IP/MAC 改写规则
+    ip_map 为显式地址映射 (源、目的地址同时按映射替换，保持双向会话一致)；
+    仅给出 target_ip 时，把抓包中的主要服务端地址替换为 target_ip。
+    target_mac 给出时，发往/来自被替换地址的帧同步改写目的/源 MAC。
+    """
+
+    def __init__(
+        self,
+        ip_map: Optional[Dict[str, str]] = None,
+        target_ip: Optional[str] = None,
+        target_mac: Optional[str] = None,
+    ):
+        self.ip_map: Dict[str, str] = {}
+        for old, new in (ip_map or {}).items():
+            old_addr, new_addr = ipaddress.ip_address(old), ipaddress.ip_address(new)
+            if old_addr.version != new_addr.version:
+                raise ValueError(f"IP version mismatch in rewrite map: {old} -> {new}")
+            self.ip_map[str(old_addr)] = str(new_addr)
+        self.target_ip = str(ipaddress.ip_address(target_ip)) if target_ip else None
+        self.target_mac = self._normalize_mac(target_mac) if target_mac else None
+        if self.target_mac and self.is_empty():
+            raise ValueError("target_mac requires target_ip or ip_map")
+
+    @staticmethod
+    def _normalize_mac(mac: str) -> str:
+        parts = mac.replace("-", ":").lower().split(":")
+        if len(parts) != 6 or not all(len(p) == 2 for p in parts):
+            raise ValueError(f"Invalid MAC address: {mac}")
+        bytes.fromhex("".join(parts))
+        return ":".join(parts)
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "RewriteRules":
+        data = data or {}
+        return cls(data.get("ip_map"), data.get("target_ip"), data.get("target_mac"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ip_map": dict(sorted(self.ip_map.items())),
+            "target_ip": self.target_ip,
+            "target_mac": self.target_mac,
+        }
+
+    def is_empty(self) -> bool:
+        return not self.ip_map and not self.target_ip
+
+    @property
+    def key(self) -> str:
+        """规则摘要，与文件哈希共同组成缓存键"""
+        canonical = json.dumps(self.to_dict(), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+class PCAPRewriter:
+    """
+    PCAP 地址改写器
+    1. 流式逐包处理：只拷贝命中映射的包，按预先计算的增量修正 IPv4 头部与 TCP/UDP/ICMPv6 校验和
+       (不重算整包，原抓包中因网卡卸载导致的错误校验和也会原样保留)。
+    2. 经典 PCAP 保留原文件头与时间戳精度；PCAPNG 转换为纳秒精度的经典 PCAP 供 tcpreplay 使用。
+    3. 结果按 (文件哈希, 规则摘要) 缓存在磁盘，重复重放到同一目标时直接复用。
+    """
+
+    def __init__(
+        self,
+        pcap_file: str,
+        file_hash: str,
+        cache_dir: Path = REWRITE_CACHE_DIR,
+        cache_budget: int = REWRITE_CACHE_BUDGET,
+    ):
+        self.pcap_file = pcap_file
+        self.file_hash = file_hash
+        self.cache = DerivedPcapCache(cache_dir, cache_budget, kind="rewrite")
+
+    def cached(self, rules: RewriteRules) -> Optional[Dict[str, Any]]:
+        return self.cache.get(f"{self.file_hash}-{rules.key}")
+
+    def rewrite(self, rules: RewriteRules) -> Dict[str, Any]:
+        """返回改写后的文件路径、内容哈希与统计；相同文件与规则只改写一次"""
+
+        def produce(out: HashingWriter) -> Dict[str, Any]:
+            ip_map = self._resolve_ip_map(rules)
+            stats = self._rewrite_to(out, ip_map, rules.target_mac)
+            return {**stats, "ip_map": ip_map, "target_mac": rules.target_mac}
+
+        return self.cache.get_or_build(f"{self.file_hash}-{rules.key}", produce)
+
+    # ---------- 读取 ----------
+
+    def _open_records(self, f: BinaryIO) -> Tuple[bytes, int, Iterator[Tuple[bytes, bytes]]]:
+        """返回 (输出文件头, 链路类型, 记录迭代器)；记录为 (16 字节记录头, 包数据)"""
+        header = f.read(24)
+        endian = PCAP_MAGICS.get(header[:4])
+        if endian:
+            linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+            return header, linktype, self._iter_pcap(f, endian)
+
+        # PCAPNG：经 dpkt 解析后写成纳秒精度的经典 PCAP
+        f.seek(0)
+        reader = dpkt.pcapng.Reader(f)
+        linktype = reader.datalink()
+        out_header = struct.pack("<IHHiIII", 0xA1B23C4D, 2, 4, 0, 0, 262144, linktype)
+        return out_header, linktype, self._iter_pcapng(reader)
+
+    @staticmethod
+    def _iter_pcap(f: BinaryIO, endian: str) -> Iterator[Tuple[bytes, bytes]]:
+        # 按块读取后在内存中切分记录，避免每个包两次 read 调用
+        caplen_of = struct.Struct(endian + "I").unpack_from
+        block, pos = b"", 0
+        while True:
+            if len(block) - pos < 16 or len(block) - pos < 16 + caplen_of(block, pos + 8)[0]:
+                chunk = f.read(IO_BUFFER_SIZE)
+                if not chunk:
+                    return  # 文件结束 (末尾不完整的记录被丢弃)
+                block, pos = block[pos:] + chunk, 0
+                continue
+            end = pos + 16 + caplen_of(block, pos + 8)[0]
+            yield block[pos : pos + 16], block[pos + 16 : end]
+            pos = end
+
+    @staticmethod
+    def _iter_pcapng(reader) -> Iterator[Tuple[bytes, bytes]]:
+        record = struct.Struct("<IIII")
+        for ts, data in reader:
+            ns = int(round(ts * 1e9))
+            yield record.pack(ns // 1_000_000_000, ns % 1_000_000_000, len(data), len(data)), data
+
+    # ---------- 规则解析 ----------
+
+    def _resolve_ip_map(self, rules: RewriteRules) -> Dict[str, str]:
+        ip_map = dict(rules.ip_map)
+        if rules.target_ip and rules.target_ip not in ip_map.values():
+            server = self._primary_server(ipaddress.ip_address(rules.target_ip).version)
+            if server is None:
+                raise ValueError("No IP traffic to rewrite in this capture")
+            ip_map.setdefault(server, rules.target_ip)
+        return ip_map
+
+    def _primary_server(self, version: int) -> Optional[str]:
+        """
+        推断被替换的服务端地址：优先取收到 TCP SYN 最多的地址 (会话发起方的对端)，
+        没有 TCP 握手时取收包最多的地址；只扫描前 PRIMARY_SCAN_PACKETS 个包。
+        """
+        syn_dst, dst = Counter(), Counter()
+        with open(self.pcap_file, "rb", buffering=IO_BUFFER_SIZE) as f:
+            _, linktype, records = self._open_records(f)
+            for i, (_, data) in enumerate(records):
+                if i >= PRIMARY_SCAN_PACKETS:
+                    break
+                l3, ethertype = locate_l3(linktype, data)
+                if ethertype == ETH_IPV4 and version == 4 and len(data) >= l3 + 20:
+                    addr = data[l3 + 16 : l3 + 20]
+                    proto, l4 = data[l3 + 9], l3 + (data[l3] & 0x0F) * 4
+                elif ethertype == ETH_IPV6 and version == 6 and len(data) >= l3 + 40:
+                    addr = data[l3 + 24 : l3 + 40]
+                    proto, l4 = data[l3 + 6], l3 + 40
+                else:
+                    continue
+                dst[addr] += 1
+                if proto == 6 and len(data) > l4 + 13 and data[l4 + 13] & 0x12 == 0x02:
+                    syn_dst[addr] += 1
+        counter = syn_dst or dst
+        if not counter:
+            return None
+        return str(ipaddress.ip_address(counter.most_common(1)[0][0]))
+
+    # ---------- 改写 ----------
+
+    def _rewrite_to(
+        self, out: HashingWriter, ip_map: Dict[str, str], target_mac: Optional[str]
+    ) -> Dict[str, int]:
+        addr_map = {
+            ipaddress.ip_address(old).packed: ipaddress.ip_address(new).packed
+            for old, new in ip_map.items()
+        }
+        deltas = {old: _checksum_delta(old, new) for old, new in addr_map.items()}
+        mac = bytes.fromhex(target_mac.replace(":", "")) if target_mac else None
+
+        packets = rewritten = 0
+        with open(self.pcap_file, "rb", buffering=IO_BUFFER_SIZE) as f:
+            header, linktype, records = self._open_records(f)
+            ethernet = linktype == DLT_EN10MB
+            locate = locate_l3
+            out.write(header)
+            # 攒满约 1MB 再一次写入并更新哈希，减少逐包调用开销
+            pending, pending_size = [], 0
+            for hdr, data in records:
+                packets += 1
+                if ethernet and data[12:14] == b"\x08\x00":
+                    l3, ethertype = 14, ETH_IPV4  # 最常见的无 VLAN 以太网 IPv4，省去一次函数调用
+                else:
+                    l3, ethertype = locate(linktype, data)
+                buf = None
+                if ethertype == ETH_IPV4:
+                    buf = self._rewrite_ipv4(data, l3, addr_map, deltas, mac if ethernet else None)
+                elif ethertype == ETH_IPV6:
+                    buf = self._rewrite_ipv6(data, l3, addr_map, deltas, mac if ethernet else None)
+                elif ethertype == ETH_ARP:
+                    buf = self._rewrite_arp(data, l3, addr_map, mac if ethernet else None)
+                pending.append(hdr)
+                if buf is None:
+                    pending.append(data)
+                else:
+                    pending.append(buf)
+                    rewritten += 1
+                pending_size += 16 + len(data)
+                if pending_size >= IO_BUFFER_SIZE:
+                    out.write(b"".join(pending))
+                    pending, pending_size = [], 0
+            out.write(b"".join(pending))
+        return {"packets": packets, "rewritten": rewritten}
+
+    @staticmethod
+    def _rewrite_mac(buf: bytearray, mac: Optional[bytes], src: bool, dst: bool):
+        if mac:
+            if dst and not buf[0] & 1:  # 广播/组播目的 MAC 保持不变
+                buf[0:6] = mac
+            if src:
+                buf[6:12] = mac
+
+    @classmethod
+    def _rewrite_ipv4(cls, data, l3, addr_map, deltas, mac) -> Optional[bytearray]:
+        if len(data) < l3 + 20:
+            return None
+        src, dst = data[l3 + 12 : l3 + 16], data[l3 + 16 : l3 + 20]
+        new_src, new_dst = addr_map.get(src), addr_map.get(dst)
+        if new_src is None and new_dst is None:
+            return None
+
+        buf = bytearray(data)
+        delta = 0
+        if new_src is not None:
+            buf[l3 + 12 : l3 + 16] = new_src
+            delta += deltas[src]
+        if new_dst is not None:
+            buf[l3 + 16 : l3 + 20] = new_dst
+            delta += deltas[dst]
+        delta = _fold(delta)
+        _apply_delta(buf, l3 + 10, delta)
+
+        # 伪首部包含源/目的地址：同一增量修正传输层校验和 (仅首个分片带传输层头部)
+        if (buf[l3 + 6] & 0x1F) == 0 and buf[l3 + 7] == 0:
+            l4 = l3 + (buf[l3] & 0x0F) * 4
+            proto = buf[l3 + 9]
+            if proto == 6 and len(buf) >= l4 + 18:
+                _apply_delta(buf, l4 + 16, delta)
+            elif proto == 17 and len(buf) >= l4 + 8:
+                _apply_delta(buf, l4 + 6, delta, udp=True)
+        cls._rewrite_mac(buf, mac, new_src is not None, new_dst is not None)
+        return buf
+
+    @classmethod
+    def _rewrite_ipv6(cls, data, l3, addr_map, deltas, mac) -> Optional[bytearray]:
+        if len(data) < l3 + 40:
+            return None
+        src, dst = data[l3 + 8 : l3 + 24], data[l3 + 24 : l3 + 40]
+        new_src, new_dst = addr_map.get(src), addr_map.get(dst)
+        if new_src is None and new_dst is None:
+            return None
+
+        buf = bytearray(data)
+        delta = 0
+        if new_src is not None:
+            buf[l3 + 8 : l3 + 24] = new_src
+            delta += deltas[src]
+        if new_dst is not None:
+            buf[l3 + 24 : l3 + 40] = new_dst
+            delta += deltas[dst]
+        delta = _fold(delta)
+
+        # 跳过扩展头定位传输层 (IPv6 无头部校验和)
+        proto, l4 = buf[l3 + 6], l3 + 40
+        while len(buf) >= l4 + 8:
+            if proto in IPV6_EXT_HEADERS:
+                proto, l4 = buf[l4], l4 + (buf[l4 + 1] + 1) * 8
+            elif proto == IPV6_FRAGMENT:
+                if ((buf[l4 + 2] << 8) | buf[l4 + 3]) & 0xFFF8:
+                    proto = None  # 非首个分片
+                    break
+                proto, l4 = buf[l4], l4 + 8
+            else:
+                break
+        if proto == 6 and len(buf) >= l4 + 18:
+            _apply_delta(buf, l4 + 16, delta)
+        elif proto == 17 and len(buf) >= l4 + 8:
+            _apply_delta(buf, l4 + 6, delta, udp=True)
+        elif proto == 58 and len(buf) >= l4 + 4:
+            _apply_delta(buf, l4 + 2, delta)
+        cls._rewrite_mac(buf, mac, new_src is not None, new_dst is not None)
+        return buf
+
+    @classmethod
+    def _rewrite_arp(cls, data, l3, addr_map, mac) -> Optional[bytearray]:
+        # 仅处理以太网/IPv4 ARP：发送方地址 l3+14，目标地址 l3+24
+        if len(data) < l3 + 28 or data[l3 + 2 : l3 + 6] != b"\x08\x00\x06\x04":
+            return None
+        spa, tpa = data[l3 + 14 : l3 + 18], data[l3 + 24 : l3 + 28]
+        new_spa, new_tpa = addr_map.get(spa), addr_map.get(tpa)
+        if new_spa is None and new_tpa is None:
+            return None
+        buf = bytearray(data)
+        if new_spa is not None:
+            buf[l3 + 14 : l3 + 18] = new_spa
+            if mac:
+                buf[l3 + 8 : l3 + 14] = mac
+        if new_tpa is not None:
+            buf[l3 + 24 : l3 + 28] = new_tpa
+            if mac and any(buf[l3 + 18 : l3 + 24]):  # 请求中的目标硬件地址为全 0，保持不变
+                buf[l3 + 18 : l3 + 24] = mac
+        cls._rewrite_mac(buf, mac, new_spa is not None, new_tpa is not None)
+        return buf
@@ -0,0 +1,186 @@
+import os
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from serialization import dumps, loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 等待执行的任务上限，超出后拒绝新任务 (而不是无限堆积线程)
+REPLAY_QUEUE_MAX = int(os.getenv("REPLAY_QUEUE_MAX", "100"))
+# 每个沙箱同时执行的重放任务数
+REPLAY_MAX_CONCURRENT_PER_SANDBOX = int(os.getenv("REPLAY_MAX_CONCURRENT_PER_SANDBOX", "2"))
+# 默认沙箱容器
+SANDBOX_CONTAINER = os.getenv("REPLAY_SANDBOX_CONTAINER", "cyber-replay-sandbox")
+
+# Worker 心跳过期时间 (秒)；超过该时间未续期的 worker 视为已退出，其在途任务会被回收
+WORKER_HEARTBEAT_TTL = int(os.getenv("REPLAY_WORKER_HEARTBEAT_TTL", "30"))
+
+QUEUE_KEY = "replay:queue"  # LIST: 左进右出，FIFO
+WORKERS_KEY = "replay:workers"  # SET: 已注册的 worker
+
+
+def job_key(task_id: str) -> str:
+    return f"replay:job:{task_id}"
+
+
+def stop_key(task_id: str) -> str:
+    return f"replay:task:{task_id}:stop"
+
+
+def running_key(sandbox: str) -> str:
+    return f"replay:sandbox:{sandbox}:running"
+
+
+def worker_key(worker_id: str) -> str:
+    return f"replay:worker:{worker_id}"
+
+
+def worker_jobs_key(worker_id: str) -> str:
+    return f"replay:worker:{worker_id}:jobs"
+
+
+# 原子领取：沙箱仍有空闲并发槽时，从队列尾部 (最早入队) 取出一个任务，
+# 同时记入 worker 在途列表与沙箱运行集合，并在任务参数中记录所在沙箱；
+# 多个 worker 并发领取也不会超出并发上限
+_CLAIM_SCRIPT = """
+if redis.call('SCARD', KEYS[3]) >= tonumber(ARGV[1]) then
+    return false
+end
+local task_id = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+if not task_id then
+    return false
+end
+redis.call('SADD', KEYS[3], task_id)
+redis.call('HSET', ARGV[3] .. task_id, 'sandbox', ARGV[2])
+return task_id
+"""
+
+
+class QueueFullError(Exception):
+    """重放队列已满"""
+
+
+class ReplayScheduler:
+    """
+    重放任务调度器 (Redis 持久化，API 与 worker 进程共享)
+    1. 有界 FIFO 队列：API 只负责入队，队列满时直接拒绝；按入队顺序公平执行。
+    2. 每个沙箱的并发槽位由运行集合约束，领取操作为原子脚本。
+    3. worker 以心跳续期，在途任务记录在各自的列表中；worker 退出后由存活的 worker 回收。
+    """
+
+    def __init__(self, redis_client, max_queue: int = REPLAY_QUEUE_MAX):
+        self.redis = redis_client
+        self.max_queue = max_queue
+        self._claim = redis_client.register_script(_CLAIM_SCRIPT)
+
+    # ---------- API 侧 ----------
+
+    def enqueue(self, task_id: str, job: Dict[str, Any]) -> int:
+        """任务入队，返回排队位置 (从 1 开始)；队列已满时抛出 QueueFullError"""
+        self.redis.hset(job_key(task_id), mapping={k: dumps(v) for k, v in job.items()})
+        length = self.redis.lpush(QUEUE_KEY, task_id)
+        if length > self.max_queue:
+            # 先入队再校验，无需加锁；超出上限的任务立即撤回
+            self.redis.lrem(QUEUE_KEY, 1, task_id)
+            self.redis.delete(job_key(task_id))
+            raise QueueFullError(f"Replay queue is full ({self.max_queue})")
+        return length
+
+    def cancel(self, task_id: str) -> bool:
+        """从队列中撤回尚未开始的任务，返回是否撤回成功"""
+        removed = self.redis.lrem(QUEUE_KEY, 0, task_id)
+        if removed:
+            self.redis.delete(job_key(task_id))
+        return bool(removed)
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """排队位置 (1 表示下一个执行)，不在队列中返回 None"""
+        index = self.redis.lpos(QUEUE_KEY, task_id)
+        if index is None:
+            return None
+        return self.redis.llen(QUEUE_KEY) - index
+
+    def depth(self) -> int:
+        """排队中的任务数"""
+        return self.redis.llen(QUEUE_KEY)
+
+    def request_stop(self, task_id: str):
+        """为运行中的任务设置停止标记 (进程 PID 尚未上报时由执行方检查)"""
+        self.redis.set(stop_key(task_id), 1, ex=3600)
+
+    def stop_requested(self, task_id: str) -> bool:
+        return bool(self.redis.exists(stop_key(task_id)))
+
+    def stats(self, sandboxes: Optional[List[str]] = None) -> Dict[str, Any]:
+        sandboxes = sandboxes or [SANDBOX_CONTAINER]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.llen(QUEUE_KEY)
+        for name in sandboxes:
+            pipe.scard(running_key(name))
+        results = pipe.execute()
+        return {
+            "queued": results[0],
+            "max_queue": self.max_queue,
+            "running": dict(zip(sandboxes, results[1:])),
+            "max_concurrent_per_sandbox": REPLAY_MAX_CONCURRENT_PER_SANDBOX,
+        }
+
+    # ---------- worker 侧 ----------
+
+    def claim(
+        self, worker_id: str, sandbox: str, capacity: int
+    ) -> Optional[Dict[str, Any]]:
+        """为指定沙箱领取下一个任务，无空闲槽位或队列为空时返回 None"""
+        task_id = self._claim(
+            keys=[QUEUE_KEY, worker_jobs_key(worker_id), running_key(sandbox)],
+            args=[capacity, dumps(sandbox), job_key("")],
+        )
+        if not task_id:
+            return None
+        raw = self.redis.hgetall(job_key(task_id))
+        job = {k: loads(v) for k, v in raw.items()}
+        job["task_id"] = task_id
+        return job
+
+    def release(self, worker_id: str, sandbox: str, task_id: str):
+        """任务结束：释放并发槽位并清理在途记录"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.srem(running_key(sandbox), task_id)
+        pipe.lrem(worker_jobs_key(worker_id), 0, task_id)
+        pipe.delete(job_key(task_id), stop_key(task_id))
+        pipe.execute()
+
+    def heartbeat(self, worker_id: str):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(WORKERS_KEY, worker_id)
+        pipe.set(worker_key(worker_id), time.time(), ex=WORKER_HEARTBEAT_TTL)
+        pipe.execute()
+
+    def unregister(self, worker_id: str):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.srem(WORKERS_KEY, worker_id)
+        pipe.delete(worker_key(worker_id))
+        pipe.execute()
+
+    def collect_orphans(self) -> List[Dict[str, Any]]:
+        """
+        回收心跳已过期的 worker 遗留的在途任务，返回对应的任务参数 (含 task_id)。
+        逐个 RPOP 出队，多个 worker 同时回收时每个任务只会被处理一次。
+        """
+        orphans = []
+        for worker_id in self.redis.smembers(WORKERS_KEY):
+            if self.redis.exists(worker_key(worker_id)):
+                continue
+            while True:
+                task_id = self.redis.rpop(worker_jobs_key(worker_id))
+                if not task_id:
+                    break
+                raw = self.redis.hgetall(job_key(task_id))
+                job = {k: loads(v) for k, v in raw.items()}
+                job.update({"task_id": task_id, "worker_id": worker_id})
+                orphans.append(job)
+            self.redis.srem(WORKERS_KEY, worker_id)
+        return orphans
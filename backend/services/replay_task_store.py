@@ -0,0 +1,267 @@
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from serialization import dumps, loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 已结束任务的保留时间 (秒)，到期后摘要与日志自动过期
+REPLAY_TASK_RETENTION = int(os.getenv("REPLAY_TASK_RETENTION", str(7 * 24 * 3600)))
+# 未结束任务的过期时间 (秒，每次写入时续期)：worker 异常退出、任务停在中间状态时同样会过期
+REPLAY_TASK_STALE_TTL = int(os.getenv("REPLAY_TASK_STALE_TTL", str(REPLAY_TASK_RETENTION)))
+
+# 每个任务保留的终端日志行数
+MAX_LOG_LINES = 50
+
+# 每个任务保留的吞吐采样点数 (tcpreplay 每秒输出一次统计，约 1 小时)
+MAX_METRIC_SAMPLES = 3600
+
+FINISHED_STATUSES = {"completed", "failed", "stopped"}
+
+# 运行中任务状态的最短写入间隔 (秒)；状态变化时立即写入
+STATUS_FLUSH_INTERVAL = float(os.getenv("REPLAY_STATUS_FLUSH_INTERVAL", "0.25"))
+
+TASK_INDEX_KEY = "replay:tasks"  # ZSET: task_id -> start_time
+TASK_EXPIRY_KEY = "replay:tasks:expiry"  # ZSET: task_id -> 摘要与日志的过期时间
+LEGACY_KEY_PATTERN = "replay_task:*"  # 旧版整段 JSON 存储
+
+
+def task_key(task_id: str) -> str:
+    return f"replay:task:{task_id}"
+
+
+def logs_key(task_id: str) -> str:
+    return f"replay:task:{task_id}:logs"
+
+
+def metrics_key(task_id: str) -> str:
+    return f"replay:task:{task_id}:metrics"
+
+
+def fidelity_key(task_id: str) -> str:
+    return f"replay:task:{task_id}:fidelity"
+
+
+def _encode(fields: Dict[str, Any]) -> Dict[str, bytes]:
+    # 每个字段单独 JSON 编码，读取时还原数值/None 等类型
+    return {k: dumps(v) for k, v in fields.items() if k != "logs"}
+
+
+def _decode(raw: Dict[str, str]) -> Dict[str, Any]:
+    task = {}
+    for k, v in raw.items():
+        try:
+            task[k] = loads(v)
+        except (TypeError, ValueError):
+            task[k] = v
+    return task
+
+
+class ReplayTaskStore:
+    """
+    重放任务注册表
+    1. ZSET 按开始时间索引全部任务，列表分页为 ZREVRANGE + 管道批量 HGETALL，不再 KEYS 扫描。
+    2. 任务摘要存放在 Hash 中，字段可增量更新；终端日志与吞吐采样分别存放在定长 List 中，列表接口不读取。
+    3. 每次写入都设置过期时间 (结束后按保留策略，未结束时按 REPLAY_TASK_STALE_TTL 续期)，
+       过期时间同时记入 TASK_EXPIRY_KEY；分页前按其批量清理索引，total 与每页条数只含有效任务。
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def save(
+        self,
+        task_id: str,
+        fields: Dict[str, Any],
+        new_logs: Optional[Iterable[str]] = None,
+        pipe=None,
+        samples: Optional[Iterable[Dict[str, Any]]] = None,
+    ):
+        """增量写入任务字段并追加日志/吞吐采样；传入 pipe 时只排队命令，由调用方统一执行"""
+        if not self.redis:
+            return
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.redis.pipeline(transaction=False)
+
+        encoded = _encode(fields)
+        if encoded:
+            pipe.hset(task_key(task_id), mapping=encoded)
+        if "start_time" in fields:
+            pipe.zadd(TASK_INDEX_KEY, {task_id: fields["start_time"]}, nx=True)
+        new_logs = list(new_logs or [])
+        if new_logs:
+            pipe.rpush(logs_key(task_id), *new_logs)
+            pipe.ltrim(logs_key(task_id), -MAX_LOG_LINES, -1)
+        samples = [dumps(s) for s in samples or []]
+        if samples:
+            pipe.rpush(metrics_key(task_id), *samples)
+            pipe.ltrim(metrics_key(task_id), -MAX_METRIC_SAMPLES, -1)
+        if fields.get("status") in FINISHED_STATUSES:
+            ttl = REPLAY_TASK_RETENTION
+        else:
+            ttl = REPLAY_TASK_STALE_TTL
+        for key in (task_key(task_id), logs_key(task_id), metrics_key(task_id), fidelity_key(task_id)):
+            pipe.expire(key, ttl)
+        pipe.zadd(TASK_EXPIRY_KEY, {task_id: time.time() + ttl})
+
+        if own_pipe:
+            pipe.execute()
+
+    def get(self, task_id: str, with_logs: bool = True) -> Optional[Dict[str, Any]]:
+        if not self.redis:
+            return None
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(task_key(task_id))
+        if with_logs:
+            pipe.lrange(logs_key(task_id), 0, -1)
+        results = pipe.execute()
+        if not results[0]:
+            return None
+        task = _decode(results[0])
+        if with_logs:
+            task["logs"] = results[1]
+        return task
+
+    def get_metrics(self, task_id: str) -> List[Dict[str, Any]]:
+        """读取任务的吞吐时间序列 (按时间顺序)"""
+        if not self.redis:
+            return []
+        return [loads(s) for s in self.redis.lrange(metrics_key(task_id), 0, -1)]
+
+    def save_fidelity(self, task_id: str, report: Dict[str, Any]):
+        """保存时间保真度完整报告 (摘要中只保留关键指标)"""
+        if self.redis:
+            self.redis.set(fidelity_key(task_id), dumps(report))
+
+    def get_fidelity(self, task_id: str) -> Optional[Dict[str, Any]]:
+        if not self.redis:
+            return None
+        data = self.redis.get(fidelity_key(task_id))
+        return loads(data) if data else None
+
+    def list(self, offset: int = 0, limit: int = 50) -> Dict[str, Any]:
+        """按开始时间倒序分页列出任务摘要 (不含日志)"""
+        if not self.redis:
+            return {"tasks": [], "total": 0}
+
+        self._trim_index()
+        task_ids = self.redis.zrevrange(TASK_INDEX_KEY, offset, offset + limit - 1)
+        pipe = self.redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(task_key(task_id))
+        rows = pipe.execute() if task_ids else []
+
+        tasks: List[Dict[str, Any]] = []
+        expired = []
+        for task_id, raw in zip(task_ids, rows):
+            if raw:
+                tasks.append(_decode(raw))
+            else:
+                expired.append(task_id)
+
+        # 惰性清理：其余原因失效 (如摘要被手动删除) 的任务从索引中移除
+        if expired:
+            self.redis.zrem(TASK_INDEX_KEY, *expired)
+
+        return {"tasks": tasks, "total": self.redis.zcard(TASK_INDEX_KEY)}
+
+    def _trim_index(self):
+        """按过期时间清理索引：摘要已过期的任务不再计入 total，也不会占用分页位置"""
+        now = time.time()
+        expired = self.redis.zrangebyscore(TASK_EXPIRY_KEY, "-inf", now)
+        if not expired:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrem(TASK_INDEX_KEY, *expired)
+        pipe.zremrangebyscore(TASK_EXPIRY_KEY, "-inf", now)
+        pipe.execute()
+
+    def delete(self, task_id: str):
+        if not self.redis:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(
+            task_key(task_id), logs_key(task_id), metrics_key(task_id), fidelity_key(task_id)
+        )
+        pipe.zrem(TASK_INDEX_KEY, task_id)
+        pipe.zrem(TASK_EXPIRY_KEY, task_id)
+        pipe.execute()
+
+    def migrate_legacy(self) -> int:
+        """将旧版 replay_task:{id} JSON 字符串迁移到注册表 (SCAN 遍历，不阻塞 Redis)"""
+        if not self.redis:
+            return 0
+        migrated = 0
+        for key in self.redis.scan_iter(match=LEGACY_KEY_PATTERN, count=500):
+            try:
+                data = self.redis.get(key)
+            except Exception:
+                continue  # 非字符串类型的 key，不属于旧版数据
+            if not data:
+                continue
+            task = loads(data)
+            task_id = task.get("task_id") or key.split(":", 1)[1]
+            task.setdefault("start_time", time.time())
+            self.save(task_id, task, new_logs=task.get("logs") or [])
+            self.redis.delete(key)
+            migrated += 1
+        if migrated:
+            logger.info(f"Migrated {migrated} legacy replay tasks")
+        return migrated
+
+
+class ThrottledTaskWriter:
+    """
+    重放任务状态的节流写入器
+    沙箱输出再频繁，也只在状态变化或距上次写入超过 interval 时调用一次 write：
+    期间的字段变更合并为最新值，日志与吞吐采样累积后批量写入，Redis 写入频率与输出速率无关。
+    """
+
+    def __init__(
+        self,
+        write: Callable[[Dict[str, Any], List[str], List[Dict[str, Any]]], None],
+        interval: float = STATUS_FLUSH_INTERVAL,
+    ):
+        self.write = write
+        self.interval = interval
+        self._fields: Dict[str, Any] = {}
+        self._logs: List[str] = []
+        self._samples: List[Dict[str, Any]] = []
+        self._status: Optional[str] = None
+        self._last_flush = 0.0
+
+    def update(
+        self,
+        fields: Dict[str, Any],
+        new_logs: Optional[Iterable[str]] = None,
+        samples: Optional[Iterable[Dict[str, Any]]] = None,
+    ):
+        status = fields.get("status")
+        status_changed = status is not None and status != self._status
+        if status is not None:
+            self._status = status
+
+        self._fields.update(fields)
+        self._logs.extend(new_logs or [])
+        self._samples.extend(samples or [])
+        # 日志在写入前只保留最近 MAX_LOG_LINES 行，避免两次写入之间无限累积
+        del self._logs[:-MAX_LOG_LINES]
+
+        if status_changed or time.monotonic() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """写出累积的变更 (任务结束或异常退出时需显式调用，保证尾部日志不丢)"""
+        if not (self._fields or self._logs or self._samples):
+            return
+        fields, logs, samples = self._fields, self._logs, self._samples
+        self._fields, self._logs, self._samples = {}, [], []
+        self._last_flush = time.monotonic()
+        try:
+            self.write(fields, logs, samples)
+        except Exception as e:
+            logger.warning(f"Failed to write replay task status: {e}")
@@ -0,0 +1,111 @@
+import os
+import logging
+from typing import Any, Dict, Iterator
+
+import requests
+
+from metrics import SANDBOX_AGENT_SECONDS, cache_lookup, instrument_session
+from serialization import loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 沙箱内重放代理端口 (沙箱容器名在 sandbox-net 中可直接解析)
+SANDBOX_AGENT_PORT = int(os.getenv("SANDBOX_AGENT_PORT", "7070"))
+# 建连超时 (秒)；读取超时覆盖 tcpreplay 每秒一次的统计输出间隔
+AGENT_CONNECT_TIMEOUT = float(os.getenv("SANDBOX_AGENT_CONNECT_TIMEOUT", "3"))
+AGENT_READ_TIMEOUT = float(os.getenv("SANDBOX_AGENT_READ_TIMEOUT", "60"))
+
+# 进程内共享的 HTTP 连接池 (长连接复用，避免每次请求重新建连)
+_session = requests.Session()
+instrument_session(_session, SANDBOX_AGENT_SECONDS)
+
+
+class SandboxAgentError(Exception):
+    """沙箱代理不可达或返回错误"""
+
+
+class SandboxAgentClient:
+    """沙箱重放代理客户端：缓存检查/上传、启动重放并读取 NDJSON 进度流、按任务停止"""
+
+    def __init__(self, sandbox: str, port: int = SANDBOX_AGENT_PORT):
+        self.sandbox = sandbox
+        self.base_url = f"http://{sandbox}:{port}"
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (AGENT_CONNECT_TIMEOUT, AGENT_READ_TIMEOUT))
+        try:
+            return _session.request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.RequestException as e:
+            raise SandboxAgentError(f"Sandbox agent '{self.sandbox}' is unreachable: {e}")
+
+    @staticmethod
+    def _error(resp: requests.Response) -> str:
+        try:
+            return resp.json().get("error", resp.text)
+        except ValueError:
+            return resp.text
+
+    def health(self) -> Dict[str, Any]:
+        resp = self._request("GET", "/health")
+        if resp.status_code != 200:
+            raise SandboxAgentError(self._error(resp))
+        return resp.json()
+
+    def has_pcap(self, file_hash: str) -> bool:
+        """检查缓存 (命中时代理会刷新该文件的最近使用时间)"""
+        resp = self._request("GET", f"/cache/{file_hash}")
+        if resp.status_code not in (200, 404):
+            raise SandboxAgentError(self._error(resp))
+        cache_lookup("sandbox_pcap", resp.status_code == 200)
+        return resp.status_code == 200
+
+    def upload_pcap(self, file_hash: str, path: str) -> Dict[str, Any]:
+        """以文件对象作为请求体流式上传 (带 Content-Length，不整体读入内存)"""
+        with open(path, "rb") as f:
+            resp = self._request(
+                "PUT",
+                f"/cache/{file_hash}",
+                data=f,
+                headers={"Content-Length": str(os.path.getsize(path))},
+            )
+        if resp.status_code != 201:
+            raise SandboxAgentError(f"PCAP upload failed: {self._error(resp)}")
+        result = resp.json()
+        if result.get("evicted"):
+            logger.info(f"Sandbox {self.sandbox} evicted {result['evicted']}")
+        return result
+
+    def start_replay(
+        self,
+        task_id: str,
+        file_hash: str,
+        speed: float,
+        measure_fidelity: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        启动重放并逐条产出进度事件，直到收到 finished 事件或连接结束；
+        measure_fidelity 时代理在重放期间抓包，并在 finished 之前产出 fidelity 事件。
+        """
+        resp = self._request(
+            "POST",
+            "/replays",
+            json={
+                "task_id": task_id,
+                "file_hash": file_hash,
+                "speed": speed,
+                "measure_fidelity": measure_fidelity,
+            },
+            stream=True,
+        )
+        with resp:
+            if resp.status_code != 200:
+                raise SandboxAgentError(f"Replay start failed: {self._error(resp)}")
+            for line in resp.iter_lines():
+                if line:
+                    yield loads(line)
+
+    def cancel(self, task_id: str) -> bool:
+        """停止指定任务的发包进程，任务不在运行时返回 False"""
+        resp = self._request("DELETE", f"/replays/{task_id}")
+        return resp.status_code == 200
@@ -0,0 +1,239 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Dict, List
+
+import docker
+
+from clients import get_docker, get_redis
+from services.replay_scheduler import (
+    REPLAY_MAX_CONCURRENT_PER_SANDBOX,
+    SANDBOX_CONTAINER,
+    running_key,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 沙箱容器通过标签发现 (compose 中 sandbox 服务带有该标签，可 --scale 多个副本)
+SANDBOX_LABEL_KEY = "cyber-replay.role"
+SANDBOX_LABEL_VALUE = "sandbox"
+# 由沙箱池通过 Docker API 创建的容器额外带有该标签，缩容时只会移除这些容器
+MANAGED_LABEL_KEY = "cyber-replay.managed"
+
+# 容器列表缓存时间 (秒)，避免每次调度都请求 Docker API
+SANDBOX_DISCOVERY_INTERVAL = float(os.getenv("SANDBOX_DISCOVERY_INTERVAL", "5"))
+# 扩容上限
+SANDBOX_POOL_MAX = int(os.getenv("SANDBOX_POOL_MAX", "8"))
+
+DRAINING_KEY = "replay:sandbox:draining"  # SET: 不再接收新任务的沙箱
+
+
+class SandboxPool:
+    """
+    沙箱容器池
+    1. 按标签发现运行中的沙箱，兼容未打标签的旧版单沙箱容器。
+    2. 调度时按运行任务数从少到多给出候选沙箱，跳过满载、排空中与健康检查失败的沙箱。
+    3. 支持通过 Docker API 扩缩容：以现有沙箱为模板创建副本，缩容只移除空闲的托管副本。
+    """
+
+    def __init__(
+        self,
+        docker_client=None,
+        redis_client=None,
+        capacity: int = REPLAY_MAX_CONCURRENT_PER_SANDBOX,
+    ):
+        self._docker = docker_client
+        self._redis = redis_client
+        self.capacity = capacity
+        self._containers: List[Any] = []
+        self._discovered_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def docker(self):
+        # 未注入时使用共享客户端 (Docker 重连后自动切换到新客户端)
+        return self._docker if self._docker is not None else get_docker()
+
+    @property
+    def redis(self):
+        return self._redis if self._redis is not None else get_redis()
+
+    def discover(self, refresh: bool = False) -> List[Any]:
+        """获取运行中的沙箱容器列表 (短时缓存)"""
+        if not self.docker:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            if not refresh and now - self._discovered_at < SANDBOX_DISCOVERY_INTERVAL:
+                return self._containers
+            try:
+                containers = self.docker.containers.list(
+                    filters={
+                        "label": f"{SANDBOX_LABEL_KEY}={SANDBOX_LABEL_VALUE}",
+                        "status": "running",
+                    }
+                )
+                if not containers:
+                    # 旧版部署：固定名称、未打标签的单个沙箱
+                    try:
+                        legacy = self.docker.containers.get(SANDBOX_CONTAINER)
+                        if legacy.status == "running":
+                            containers = [legacy]
+                    except docker.errors.NotFound:
+                        pass
+            except Exception as e:
+                logger.warning(f"Sandbox discovery failed: {e}")
+                return self._containers
+            self._containers = sorted(containers, key=lambda c: c.name)
+            self._discovered_at = now
+            return self._containers
+
+    @staticmethod
+    def _health(container) -> str:
+        """Docker 健康检查状态；未配置健康检查时视为 healthy"""
+        health = (container.attrs.get("State") or {}).get("Health") or {}
+        return health.get("Status", "healthy")
+
+    def members(self, refresh: bool = False) -> List[Dict[str, Any]]:
+        """沙箱池成员及负载"""
+        containers = self.discover(refresh)
+        if not containers:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for c in containers:
+            pipe.scard(running_key(c.name))
+        pipe.smembers(DRAINING_KEY)
+        results = pipe.execute()
+        draining = results[-1]
+
+        members = []
+        for c, running in zip(containers, results[:-1]):
+            health = self._health(c)
+            members.append(
+                {
+                    "name": c.name,
+                    "id": c.short_id,
+                    "health": health,
+                    "draining": c.name in draining,
+                    # 健康检查失败的沙箱自动排空：不接收新任务，运行中的任务照常结束
+                    "schedulable": c.name not in draining and health != "unhealthy",
+                    "running": running,
+                    "capacity": self.capacity,
+                    "managed": c.labels.get(MANAGED_LABEL_KEY) == "true",
+                }
+            )
+        return members
+
+    def names(self) -> List[str]:
+        return [c.name for c in self.discover()]
+
+    def candidates(self) -> List[str]:
+        """可接收新任务的沙箱，按运行任务数从少到多排列 (最少负载优先)"""
+        members = [
+            m for m in self.members() if m["schedulable"] and m["running"] < self.capacity
+        ]
+        members.sort(key=lambda m: (m["running"], m["name"]))
+        return [m["name"] for m in members]
+
+    def drain(self, name: str):
+        self.redis.sadd(DRAINING_KEY, name)
+
+    def undrain(self, name: str):
+        self.redis.srem(DRAINING_KEY, name)
+
+    def scale(self, replicas: int) -> Dict[str, Any]:
+        """
+        调整沙箱数量：不足时以现有沙箱为模板创建副本；
+        超出时先排空多余的托管副本，空闲后才移除 (compose 创建的沙箱不会被移除)。
+        """
+        if not self.docker:
+            raise RuntimeError("Docker is unavailable")
+        replicas = max(1, min(replicas, SANDBOX_POOL_MAX))
+        containers = self.discover(refresh=True)
+        if not containers:
+            raise RuntimeError("No sandbox available as scaling template")
+
+        created, removed, draining = [], [], []
+        if replicas > len(containers):
+            template = containers[0]
+            for _ in range(replicas - len(containers)):
+                created.append(self._create_replica(template))
+        elif replicas < len(containers):
+            members = {m["name"]: m for m in self.members()}
+            managed = [c for c in containers if members[c.name]["managed"]]
+            # 优先移除已排空、负载低的副本
+            managed.sort(
+                key=lambda c: (not members[c.name]["draining"], members[c.name]["running"])
+            )
+            for c in managed[: len(containers) - replicas]:
+                self.drain(c.name)
+                if members[c.name]["running"] == 0:
+                    c.remove(force=True)
+                    self.undrain(c.name)
+                    removed.append(c.name)
+                else:
+                    draining.append(c.name)
+
+        self.discover(refresh=True)
+        return {
+            "replicas": len(self._containers),
+            "created": created,
+            "removed": removed,
+            "draining": draining,
+        }
+
+    def reap_drained(self) -> List[str]:
+        """移除已排空且空闲的托管副本 (缩容时仍有任务运行的副本在此完成移除)"""
+        removed = []
+        for m in self.members(refresh=True):
+            if m["managed"] and m["draining"] and m["running"] == 0:
+                try:
+                    self.docker.containers.get(m["name"]).remove(force=True)
+                    self.undrain(m["name"])
+                    removed.append(m["name"])
+                    logger.info(f"Removed drained sandbox replica {m['name']}")
+                except Exception as e:
+                    logger.warning(f"Failed to remove sandbox {m['name']}: {e}")
+        if removed:
+            self.discover(refresh=True)
+        return removed
+
+    def _create_replica(self, template) -> str:
+        """以模板容器的镜像、环境变量、权限、网络与卷挂载创建新沙箱"""
+        host_config = template.attrs.get("HostConfig") or {}
+        networks = list(
+            ((template.attrs.get("NetworkSettings") or {}).get("Networks") or {}).keys()
+        )
+        volumes = {
+            m["Name"]: {"bind": m["Destination"], "mode": "rw"}
+            for m in template.attrs.get("Mounts", [])
+            if m.get("Type") == "volume" and m.get("Name")
+        }
+        labels = {
+            SANDBOX_LABEL_KEY: SANDBOX_LABEL_VALUE,
+            MANAGED_LABEL_KEY: "true",
+        }
+        name = f"cyber-replay-sandbox-{uuid.uuid4().hex[:8]}"
+        container = self.docker.containers.run(
+            template.image.id,
+            name=name,
+            detach=True,
+            labels=labels,
+            # 缓存预算等配置与模板一致，不回落到镜像默认值
+            environment=(template.attrs.get("Config") or {}).get("Env") or [],
+            cap_add=host_config.get("CapAdd") or ["NET_ADMIN", "NET_RAW"],
+            network=networks[0] if networks else None,
+            volumes=volumes,
+            restart_policy={"Name": "unless-stopped"},
+        )
+        for network in networks[1:]:
+            self.docker.networks.get(network).connect(container)
+        logger.info(f"Created sandbox replica {name}")
+        return name
+
+
+# 进程级单例，API 与 worker 共享发现缓存
+sandbox_pool = SandboxPool()
@@ -0,0 +1,144 @@
+import os
+import heapq
+import bisect
+import marshal
+import tempfile
+from itertools import islice
+from operator import itemgetter
+from typing import Any, BinaryIO, Callable, Dict, Hashable, Iterator, List, Tuple
+
+IO_BUFFER_SIZE = 1024 * 1024
+
+_first = itemgetter(0)
+
+
+def _read_run(f: BinaryIO) -> Iterator[Tuple[Hashable, Any]]:
+    while True:
+        try:
+            yield marshal.load(f)
+        except EOFError:
+            return
+
+
+class SpillTable:
+    """
+    可溢出到磁盘的聚合表
+    热路径直接读写 data (普通 dict)；spill() 把当前内容按键排序写成一个有序 run 文件并清空 data
+    (原地清空，调用方持有的 data 引用保持有效)。items() 对全部 run 与内存剩余部分做多路归并，
+    相同键用 merge(旧值, 新值) 合并，因此溢出与否结果一致。
+    键在同一张表内必须可相互比较；值必须能被 marshal 序列化 (数字、字符串、list/tuple/set、None)。
+    run 文件写在调用方提供的临时目录中，由调用方在用完后整体删除。
+    """
+
+    def __init__(self, name: str, merge: Callable[[Any, Any], Any], spill_dir: str):
+        self.name = name
+        self.merge = merge
+        self.spill_dir = spill_dir
+        self.data: Dict[Hashable, Any] = {}
+        self.runs: List[str] = []
+
+    def spill(self) -> int:
+        """写出当前内容，返回写出的条目数"""
+        if not self.data:
+            return 0
+        fd, path = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".run", dir=self.spill_dir)
+        with os.fdopen(fd, "wb", buffering=IO_BUFFER_SIZE) as f:
+            dump = marshal.dump
+            for item in sorted(self.data.items(), key=_first):
+                dump(item, f)
+        self.runs.append(path)
+        count = len(self.data)
+        self.data.clear()
+        return count
+
+    def items(self, ordered: bool = False) -> Iterator[Tuple[Hashable, Any]]:
+        """
+        遍历合并后的全部条目 (只能遍历一次，遍历期间不要再写入)
+        已溢出时总是按键有序；未溢出时 ordered=True 才排序，否则按插入顺序
+        """
+        if not self.runs:
+            if ordered:
+                yield from sorted(self.data.items(), key=_first)
+            else:
+                yield from self.data.items()
+            return
+
+        files = [open(path, "rb", buffering=IO_BUFFER_SIZE) for path in self.runs]
+        try:
+            streams = [_read_run(f) for f in files]
+            streams.append(iter(sorted(self.data.items(), key=_first)))
+            merge = self.merge
+            current_key, current = None, None
+            has_current = False
+            for key, value in heapq.merge(*streams, key=_first):
+                if has_current and key == current_key:
+                    current = merge(current, value)
+                    continue
+                if has_current:
+                    yield current_key, current
+                current_key, current, has_current = key, value, True
+            if has_current:
+                yield current_key, current
+        finally:
+            for f in files:
+                f.close()
+
+
+class SpillLog:
+    """
+    可溢出到磁盘的追加日志 (如告警列表，按发现顺序保存，不做合并)
+    热路径直接向 data (普通 list) 追加；spill() 把当前内容追加写入同一个 run 文件并原地清空 data。
+    遍历时先读磁盘部分再读内存部分，顺序与追加顺序一致；len() 为全部条目数。
+    每次 spill 记录写入的起始序号与文件偏移，since(start) 只需从所在批次开始读取。
+    """
+
+    def __init__(self, name: str, spill_dir: str):
+        self.name = name
+        self.spill_dir = spill_dir
+        self.data: List[Any] = []
+        self.path = None
+        self.spilled = 0
+        # 每次 spill 写入的 (起始序号, 文件偏移)
+        self.batches: List[Tuple[int, int]] = []
+
+    def spill(self) -> int:
+        if not self.data:
+            return 0
+        if self.path is None:
+            fd, self.path = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".log", dir=self.spill_dir)
+            os.close(fd)
+        with open(self.path, "ab", buffering=IO_BUFFER_SIZE) as f:
+            self.batches.append((self.spilled, f.tell()))
+            dump = marshal.dump
+            for item in self.data:
+                dump(item, f)
+        count = len(self.data)
+        self.spilled += count
+        self.data.clear()
+        return count
+
+    def __len__(self) -> int:
+        return self.spilled + len(self.data)
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.since(0)
+
+    def since(self, start: int) -> Iterator[Any]:
+        """从第 start 条 (按追加顺序) 开始遍历"""
+        if start < self.spilled:
+            batch = self.batches[bisect.bisect_right(self.batches, (start, float("inf"))) - 1]
+            with open(self.path, "rb", buffering=IO_BUFFER_SIZE) as f:
+                f.seek(batch[1])
+                yield from islice(_read_run(f), start - batch[0], None)
+            start = self.spilled
+        yield from self.data[start - self.spilled :]
+
+
+def add_counts(a: int, b: int) -> int:
+    return a + b
+
+
+def add_pairs(a: List[int], b: List[int]) -> List[int]:
+    a[0] += b[0]
+    a[1] += b[1]
+    return a
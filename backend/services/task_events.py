@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Optional
+
+from clients import get_async_redis
+from serialization import dumps, dumps_str, loads
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 频道命名: 每个任务一个频道，列表页可按前缀模式订阅全部任务
+ANALYSIS_CHANNEL_PREFIX = "analysis_events:"
+REPLAY_CHANNEL_PREFIX = "replay_events:"
+LIVE_CHANNEL_PREFIX = "live_events:"
+
+# 进入这些状态后任务不会再有更新，单任务订阅可以直接结束
+TERMINAL_STATUSES = {"completed", "failed", "stopped", "deleted"}
+
+# SSE 心跳间隔 (秒)，防止代理层因空闲断开长连接
+KEEPALIVE_INTERVAL = 15
+
+
+def analysis_channel(task_id: str) -> str:
+    return f"{ANALYSIS_CHANNEL_PREFIX}{task_id}"
+
+
+def replay_channel(task_id: str) -> str:
+    return f"{REPLAY_CHANNEL_PREFIX}{task_id}"
+
+
+def live_channel(watch_id: str) -> str:
+    return f"{LIVE_CHANNEL_PREFIX}{watch_id}"
+
+
+def publish_task_event(redis_client, channel: str, data: dict):
+    """向 Redis 频道推送一条任务更新 (推送失败不影响任务本身)"""
+    if not redis_client:
+        return
+    try:
+        redis_client.publish(channel, dumps(data))
+    except Exception as e:
+        logger.warning(f"Failed to publish task event on {channel}: {e}")
+
+
+def _format_sse(data: Any) -> str:
+    payload = data if isinstance(data, str) else dumps_str(data)
+    return f"data: {payload}\n\n"
+
+
+async def stream_task_events(
+    channel: str,
+    snapshot: Optional[Callable[[], Optional[dict]]] = None,
+    pattern: bool = False,
+) -> AsyncIterator[str]:
+    """
+    订阅 Redis 频道并转换为 SSE 文本流。
+    先订阅再读取快照，保证快照与后续增量之间不会漏掉更新。
+    单任务订阅在收到终态后自动结束；模式订阅 (pattern=True) 持续推送直到客户端断开。
+    """
+    # 共享连接池：订阅期间占用一条连接，结束后归还
+    pubsub = get_async_redis().pubsub()
+    try:
+        if pattern:
+            await pubsub.psubscribe(channel)
+        else:
+            await pubsub.subscribe(channel)
+
+        if snapshot:
+            initial = await asyncio.to_thread(snapshot)
+            if initial is not None:
+                yield _format_sse(initial)
+                if not pattern and initial.get("status") in TERMINAL_STATUSES:
+                    return
+
+        while True:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=KEEPALIVE_INTERVAL
+            )
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            data = message.get("data")
+            yield _format_sse(data)
+
+            if not pattern:
+                try:
+                    if loads(data).get("status") in TERMINAL_STATUSES:
+                        return
+                except (TypeError, ValueError):
+                    pass
+    finally:
+        try:
+            await pubsub.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close event subscription: {e}")
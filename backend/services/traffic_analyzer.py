@@ -1,10 +1,75 @@
 import os
 import re
+import heapq
+import shutil
 import socket
-from collections import defaultdict, Counter
-from typing import Dict, Any, List, Tuple
+import struct
+import time
+import logging
+import tempfile
+from collections import Counter
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Callable, Iterable, Iterator, Optional, Union
 import dpkt
 
+from metrics import ANALYSIS_PACKETS, ANALYSIS_SPILLS, ANALYSIS_STAGE_SECONDS
+from services.spill_table import SpillLog, SpillTable, add_counts, add_pairs
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 已处理报文计数按批上报，长时间分析期间指标也能持续增长；内存预算也按批检查
+PACKET_METRIC_BATCH = 8192
+
+# 聚合状态 (会话/链路/主机/时间线表与告警) 的内存预算 (字节)，0 表示不限制
+ANALYSIS_MEMORY_BUDGET = int(os.getenv("ANALYSIS_MEMORY_BUDGET", str(512 * 1024 ** 2)))
+ANALYSIS_SPILL_DIR = Path(os.getenv("ANALYSIS_SPILL_DIR", "results/analysis_spill"))
+
+# 各表单条记录的估算占用 (字节，含键中的地址字符串；按 CPython 3.11 实测取整)
+FLOW_ENTRY_BYTES = 500
+LINK_ENTRY_BYTES = 270
+HOST_ENTRY_BYTES = 140
+TIMELINE_ENTRY_BYTES = 230
+ALERT_ENTRY_BYTES = 440
+
+# 分析结果中内嵌的告警条数 (全部告警经 on_alerts 交给调用方持久化，分页查询)
+ANALYSIS_RESULT_ALERTS = int(os.getenv("ANALYSIS_RESULT_ALERTS", "1000"))
+
+# 接收全部会话/告警记录迭代器的回调
+RecordSink = Callable[[Iterator[Dict[str, Any]]], None]
+
+
+class AnalysisState:
+    """
+    逐包聚合状态：全量分析对整个文件使用一次，实时分析 (live_capture) 对同一个状态按批追加
+    会话、链路、主机、时间线表与告警超出内存预算时溢出到 spill_dir，由调用方在用完后删除该目录
+    """
+
+    def __init__(self, spill_dir: str):
+        self.total_packets = 0
+        self.total_bytes = 0
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        self.protocol_stats: Counter = Counter()
+        # 5元组 -> [包数, 字节数, 首包时间, 末包时间, 威胁集合 (无威胁时为 None)]
+        self.flow_table = SpillTable("flows", TrafficAnalyzer._merge_flow, spill_dir)
+        # (源, 目的) -> 包数
+        self.link_table = SpillTable("links", add_counts, spill_dir)
+        # 源地址 -> 发包数
+        self.host_table = SpillTable("hosts", add_counts, spill_dir)
+        # 秒级时间戳 -> [包数, 字节数]
+        self.timeline_table = SpillTable("timeline", add_pairs, spill_dir)
+        # 威胁告警 (按发现顺序追加)
+        self.alerts = SpillLog("alerts", spill_dir)
+        self.tables: List[Union[SpillTable, SpillLog]] = [
+            self.flow_table, self.link_table, self.host_table, self.timeline_table, self.alerts
+        ]
+        # 已上报到指标的包数与各阶段累计耗时
+        self.reported_packets = 0
+        self.decode_seconds = 0.0
+        self.dpi_seconds = 0.0
+
 
 class TrafficAnalyzer:
     """
@@ -16,6 +81,9 @@ class TrafficAnalyzer:
     4. 健壮性: 兼容 PCAP 和 PCAPNG，完善的异常捕获。
     """
 
+    # 结果结构版本号：输出格式变化时递增，使旧的分析快照失效
+    RESULT_VERSION = 2
+
     # --- 轻量级威胁检测规则引擎 (预编译正则以提升性能) ---
     THREAT_SIGNATURES = {
         "SQL_Injection": re.compile(
@@ -26,8 +94,20 @@ class TrafficAnalyzer:
         "Command_Injection": re.compile(rb"(?i)(;\s*ls|\|\s*cat|`.*`)"),
     }
 
-    def __init__(self, pcap_file: str):
+    def __init__(
+        self,
+        pcap_file: str,
+        profiler: Optional[Any] = None,
+        memory_budget: int = ANALYSIS_MEMORY_BUDGET,
+    ):
+        """
+        profiler: 可选的剖析会话 (AnalysisProfiler)，提供时分析器额外写入 profiler.counters
+        并在逐包循环结束时调用 profiler.checkpoint；未提供时热路径上只多一次 None 判断
+        memory_budget: 聚合状态的内存预算 (字节)，超出时溢出到磁盘
+        """
         self.pcap_file = pcap_file
+        self.profiler = profiler
+        self.memory_budget = memory_budget
 
     @staticmethod
     def _inet_to_str(inet: bytes) -> str:
@@ -50,157 +130,317 @@ class TrafficAnalyzer:
             f.seek(0)
             return dpkt.pcapng.Reader(f)
 
-    def full_analysis(self) -> Dict[str, Any]:
-        """全量流式分析入口 (O(n) 时间复杂度，极低内存消耗)"""
-
-        # --- 1. 状态容器初始化 ---
-        total_packets = 0
-        total_bytes = 0
-        start_time = None
-        end_time = None
-
-        protocol_stats = Counter()
-        src_ips = Counter()
-        connection_counts = defaultdict(int)
-
-        # 记录 5元组 统计
-        flow_stats = defaultdict(lambda: {"packets": 0, "bytes": 0, "threats": set()})
-        # 时间线
-        timeline_stats = defaultdict(lambda: {"packets": 0, "bytes": 0})
-        # 威胁告警列表
-        alerts: List[Dict[str, Any]] = []
+    @staticmethod
+    def _flow_row(flow_key: Tuple, info: List[Any]) -> Dict[str, Any]:
+        """将内部流统计 [包数, 字节数, 首包时间, 末包时间, 威胁集合] 转换为对外输出的会话记录"""
+        src, dst, proto, sport, dport = flow_key
+        packets, size, first_seen, last_seen, threats = info
+        return {
+            "src_ip": src,
+            "src_port": sport,
+            "dst_ip": dst,
+            "dst_port": dport,
+            "protocol": proto,
+            "packets": packets,
+            "bytes": size,
+            "start_time": first_seen,
+            "end_time": last_seen,
+            "duration": last_seen - first_seen,
+            "threats": list(threats or ()),  # 包含该流命中的威胁标签
+        }
 
-        # --- 2. 基于 dpkt 的高性能流式解析 ---
+    @staticmethod
+    def _merge_flow(older: List[Any], newer: List[Any]) -> List[Any]:
+        """合并同一会话在不同 run 中的统计 (older 来自更早写出的 run)"""
+        older[0] += newer[0]
+        older[1] += newer[1]
+        older[3] = newer[3]
+        if newer[4]:
+            older[4] = (older[4] or set()) | newer[4]
+        return older
+
+    def _spill(self, tables: List[Union[SpillTable, SpillLog]], counters: Optional[Counter]):
+        """聚合状态接近内存预算：把各张大表写成磁盘上的有序 run"""
+        written = {}
+        for table in tables:
+            count = table.spill()
+            if count:
+                written[table.name] = count
+                ANALYSIS_SPILLS.labels(table.name).inc()
+                if counters is not None:
+                    counters[f"spilled.{table.name}"] += count
+        logger.info(f"Analysis state over budget, spilled to disk: {written}")
+
+    def full_analysis(
+        self, on_flows: Optional[RecordSink] = None, on_alerts: Optional[RecordSink] = None
+    ) -> Dict[str, Any]:
+        """
+        全量流式分析入口 (O(n) 时间复杂度，聚合状态受内存预算约束)
+        on_flows: 可选回调，接收全部会话记录的迭代器 (返回结果中只保留 Top 50)
+        on_alerts: 可选回调，接收全部告警的迭代器 (返回结果中只保留前 ANALYSIS_RESULT_ALERTS 条)
+        """
         if not os.path.exists(self.pcap_file):
             raise FileNotFoundError(f"File not found: {self.pcap_file}")
 
+        ANALYSIS_SPILL_DIR.mkdir(parents=True, exist_ok=True)
+        spill_dir = tempfile.mkdtemp(prefix="analysis-", dir=ANALYSIS_SPILL_DIR)
+        try:
+            return self._analyze(spill_dir, on_flows, on_alerts)
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    def _analyze(
+        self, spill_dir: str, on_flows: Optional[RecordSink], on_alerts: Optional[RecordSink]
+    ) -> Dict[str, Any]:
+        """
+        会话、链路、主机与时间线表的估算占用超过内存预算时写出为 spill_dir 中的有序 run，
+        结束时多路归并，结果与全部在内存中聚合一致；告警同样计入预算，溢出时按发现顺序追加到磁盘日志
+        """
+        state = AnalysisState(spill_dir)
+
         # 使用二进制方式读取，dpkt 需要
         with open(self.pcap_file, "rb") as f:
             try:
-                pcap_reader = self._get_reader(f)
-
-                for timestamp, buf in pcap_reader:
-                    total_packets += 1
-                    pkt_len = len(buf)
-                    total_bytes += pkt_len
-
-                    # 时间线聚合
-                    if start_time is None:
-                        start_time = timestamp
-                    end_time = timestamp
-                    ts_second = int(timestamp)
-                    timeline_stats[ts_second]["packets"] += 1
-                    timeline_stats[ts_second]["bytes"] += pkt_len
-
-                    # 链路层解析 (默认按以太网解析，如果包损坏则跳过)
-                    try:
-                        eth = dpkt.ethernet.Ethernet(buf)
-                    except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
-                        continue
-
-                    # 仅处理 IP 数据包 (IPv4/IPv6)
-                    if not isinstance(eth.data, (dpkt.ip.IP, dpkt.ip6.IP6)):
-                        protocol_stats["Non-IP"] += 1
-                        continue
-
-                    ip = eth.data
-                    src_ip = self._inet_to_str(ip.src)
-                    dst_ip = self._inet_to_str(ip.dst)
-                    src_ips[src_ip] += 1
-                    connection_counts[(src_ip, dst_ip)] += 1
-
-                    # 传输层解析
-                    proto_name = "Other"
-                    src_port, dst_port = "*", "*"
-                    payload = b""
-
-                    if isinstance(ip.data, dpkt.tcp.TCP):
-                        proto_name = "TCP"
-                        src_port = ip.data.sport
-                        dst_port = ip.data.dport
-                        payload = ip.data.data
-                    elif isinstance(ip.data, dpkt.udp.UDP):
-                        proto_name = "UDP"
-                        src_port = ip.data.sport
-                        dst_port = ip.data.dport
-                        payload = ip.data.data
-                    elif isinstance(ip.data, dpkt.icmp.ICMP):
-                        proto_name = "ICMP"
-
-                    protocol_stats[proto_name] += 1
-
-                    # 记录 Flow (五元组或三元组)
-                    if proto_name in ["TCP", "UDP"]:
-                        flow_key = (src_ip, dst_ip, proto_name, src_port, dst_port)
-                        flow_stats[flow_key]["packets"] += 1
-                        flow_stats[flow_key]["bytes"] += pkt_len
-
-                    # --- 3. 应用层解析与规则匹配 (深度流量检查 DPI) ---
-                    if payload:
-                        # 简单的特征匹配
-                        for threat_name, pattern in self.THREAT_SIGNATURES.items():
-                            if pattern.search(payload):
-                                alert_info = {
-                                    "time": timestamp,
-                                    "src_ip": src_ip,
-                                    "dst_ip": dst_ip,
-                                    "port": dst_port,
-                                    "threat_type": threat_name,
-                                    "protocol": proto_name,
-                                }
-                                alerts.append(alert_info)
-                                # 在流级别标记此流包含威胁
-                                if proto_name in ["TCP", "UDP"]:
-                                    flow_stats[flow_key]["threats"].add(threat_name)
-
-            except Exception as e:
-                # OOM 或格式损坏时优雅降级，保留已解析的数据
-                print(f"[Warning] PCAP parser stopped early due to: {e}")
+                self.consume(state, self._get_reader(f))
+            except (dpkt.UnpackError, ValueError, struct.error) as e:
+                # 只有格式损坏时优雅降级，保留已解析的数据；内存不足、溢出写盘失败 (OSError) 等
+                # 让任务失败，而不是返回截断的结果
+                logger.warning(f"PCAP parser stopped early due to: {e}")
+
+        ANALYSIS_STAGE_SECONDS.labels("decode").observe(state.decode_seconds)
+        ANALYSIS_STAGE_SECONDS.labels("dpi").observe(state.dpi_seconds)
+        if self.profiler is not None:
+            self.profiler.counters.update(
+                {
+                    "packets": state.total_packets,
+                    "bytes": state.total_bytes,
+                    "alerts": len(state.alerts),
+                    # 溢出后为内存中剩余的条目数
+                    "resident.flows": len(state.flow_table.data),
+                    "resident.hosts": len(state.host_table.data),
+                    "resident.links": len(state.link_table.data),
+                    "resident.timeline_buckets": len(state.timeline_table.data),
+                    "stage_seconds.decode": state.decode_seconds,
+                    "stage_seconds.dpi": state.dpi_seconds,
+                }
+            )
+            # 逐包状态此时最大，留存内存快照
+            self.profiler.checkpoint("decoded")
+        return self.summarize(state, on_flows, on_alerts)
+
+    def consume(self, state: "AnalysisState", records: Iterable[Tuple[float, bytes]]):
+        """
+        把 (时间戳, 原始帧) 逐包聚合进 state
+        同一个 state 可以多次调用 (实时分析按批追加)；中途抛出异常时已处理部分仍计入 state
+        """
+        # --- 1. 状态载入局部变量 (热路径直接操作 dict，溢出时原地清空，引用保持有效) ---
+        total_packets = state.total_packets
+        total_bytes = state.total_bytes
+        start_time = state.start_time
+        end_time = state.end_time
+        reported_packets = state.reported_packets
+
+        protocol_stats = state.protocol_stats
+        tables = state.tables
+        flow_stats = state.flow_table.data
+        connection_counts = state.link_table.data
+        src_ips = state.host_table.data
+        timeline_stats = state.timeline_table.data
+        alerts = state.alerts.data
+        memory_budget = self.memory_budget
+
+        # --- 2. 基于 dpkt 的高性能流式解析 ---
+
+        # 阶段耗时先累计在局部变量中，结束后一次性写回 (逐包只对带载荷的报文多两次计时)
+        clock = time.perf_counter
+        loop_started = clock()
+        dpi_seconds = 0.0
+        counters = self.profiler.counters if self.profiler is not None else None
+
+        try:
+            for timestamp, buf in records:
+                total_packets += 1
+                if total_packets % PACKET_METRIC_BATCH == 0:
+                    ANALYSIS_PACKETS.inc(total_packets - reported_packets)
+                    reported_packets = total_packets
+                    if memory_budget and (
+                        len(flow_stats) * FLOW_ENTRY_BYTES
+                        + len(connection_counts) * LINK_ENTRY_BYTES
+                        + len(src_ips) * HOST_ENTRY_BYTES
+                        + len(timeline_stats) * TIMELINE_ENTRY_BYTES
+                        + len(alerts) * ALERT_ENTRY_BYTES
+                    ) > memory_budget:
+                        self._spill(tables, counters)
+                pkt_len = len(buf)
+                total_bytes += pkt_len
+
+                # 时间线聚合
+                if start_time is None:
+                    start_time = timestamp
+                end_time = timestamp
+                ts_second = int(timestamp)
+                bucket = timeline_stats.get(ts_second)
+                if bucket is None:
+                    timeline_stats[ts_second] = [1, pkt_len]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += pkt_len
+
+                # 链路层解析 (默认按以太网解析，如果包损坏则跳过)
+                try:
+                    eth = dpkt.ethernet.Ethernet(buf)
+                except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+                    if counters is not None:
+                        counters["decode_errors"] += 1
+                    continue
+
+                # 仅处理 IP 数据包 (IPv4/IPv6)
+                if not isinstance(eth.data, (dpkt.ip.IP, dpkt.ip6.IP6)):
+                    protocol_stats["Non-IP"] += 1
+                    continue
+
+                ip = eth.data
+                src_ip = self._inet_to_str(ip.src)
+                dst_ip = self._inet_to_str(ip.dst)
+                src_ips[src_ip] = src_ips.get(src_ip, 0) + 1
+                link = (src_ip, dst_ip)
+                connection_counts[link] = connection_counts.get(link, 0) + 1
+
+                # 传输层解析
+                proto_name = "Other"
+                src_port, dst_port = "*", "*"
+                payload = b""
+
+                if isinstance(ip.data, dpkt.tcp.TCP):
+                    proto_name = "TCP"
+                    src_port = ip.data.sport
+                    dst_port = ip.data.dport
+                    payload = ip.data.data
+                elif isinstance(ip.data, dpkt.udp.UDP):
+                    proto_name = "UDP"
+                    src_port = ip.data.sport
+                    dst_port = ip.data.dport
+                    payload = ip.data.data
+                elif isinstance(ip.data, dpkt.icmp.ICMP):
+                    proto_name = "ICMP"
+
+                protocol_stats[proto_name] += 1
+
+                # 记录 Flow (五元组或三元组)
+                if proto_name in ["TCP", "UDP"]:
+                    flow_key = (src_ip, dst_ip, proto_name, src_port, dst_port)
+                    flow = flow_stats.get(flow_key)
+                    if flow is None:
+                        flow = flow_stats[flow_key] = [0, 0, timestamp, timestamp, None]
+                    flow[0] += 1
+                    flow[1] += pkt_len
+                    flow[3] = timestamp
+
+                # --- 3. 应用层解析与规则匹配 (深度流量检查 DPI) ---
+                if payload:
+                    dpi_started = clock()
+                    if counters is not None:
+                        counters["payload_packets"] += 1
+                        counters["payload_bytes"] += len(payload)
+                    # 简单的特征匹配
+                    for threat_name, pattern in self.THREAT_SIGNATURES.items():
+                        if counters is None:
+                            matched = pattern.search(payload)
+                        else:
+                            # 剖析时按规则计时，定位回溯严重的正则
+                            rule_started = clock()
+                            matched = pattern.search(payload)
+                            counters[f"rule_seconds.{threat_name}"] += clock() - rule_started
+                        if matched:
+                            alert_info = {
+                                "time": timestamp,
+                                "src_ip": src_ip,
+                                "dst_ip": dst_ip,
+                                "port": dst_port,
+                                "threat_type": threat_name,
+                                "protocol": proto_name,
+                            }
+                            alerts.append(alert_info)
+                            # 在流级别标记此流包含威胁
+                            if proto_name in ["TCP", "UDP"]:
+                                if flow[4] is None:
+                                    flow[4] = set()
+                                flow[4].add(threat_name)
+                    dpi_seconds += clock() - dpi_started
+        finally:
+            ANALYSIS_PACKETS.inc(total_packets - reported_packets)
+            state.total_packets = total_packets
+            state.total_bytes = total_bytes
+            state.start_time = start_time
+            state.end_time = end_time
+            state.reported_packets = total_packets
+            state.dpi_seconds += dpi_seconds
+            state.decode_seconds += clock() - loop_started - dpi_seconds
+
+    def summarize(
+        self,
+        state: "AnalysisState",
+        on_flows: Optional[RecordSink] = None,
+        on_alerts: Optional[RecordSink] = None,
+    ) -> Dict[str, Any]:
+        """
+        由聚合状态生成分析结果 (不修改 state，实时分析可在追加过程中反复调用)
+        on_flows: 可选回调，接收全部会话记录的迭代器 (返回结果中只保留 Top 50)
+        on_alerts: 可选回调，接收全部告警的迭代器 (返回结果中只保留前 ANALYSIS_RESULT_ALERTS 条)
+        """
+        clock = time.perf_counter
+        counters = self.profiler.counters if self.profiler is not None else None
+        total_packets, total_bytes = state.total_packets, state.total_bytes
+        start_time, end_time = state.start_time, state.end_time
+        protocol_stats, alerts = state.protocol_stats, state.alerts
+        flow_table, link_table = state.flow_table, state.link_table
+        host_table, timeline_table = state.host_table, state.timeline_table
+
+        aggregate_started = clock()
+        persist_seconds = 0.0
 
         # --- 4. 数据格式化与组装 ---
+        # 各表按 items() 流式遍历 (溢出时为多路归并)；Top N 用有界堆，与整体排序后截取的结果一致
         duration = (end_time - start_time) if (start_time and end_time) else 0
 
-        statistics = {
-            "total_packets": total_packets,
-            "total_bytes": total_bytes,
-            "duration": duration,
-            "packets_per_second": total_packets / duration if duration > 0 else 0,
-            "top_talkers": [
-                {"ip": ip, "packets": c} for ip, c in src_ips.most_common(10)
-            ],
-            "total_threats": len(alerts),  # 新增维度：总威胁数
-        }
-
         protocols = {
             "protocol_distribution": [
                 {"name": k, "value": v} for k, v in protocol_stats.items()
             ]
         }
 
-        # 流量会话 (按包数量 Top 50)
-        sorted_flows = sorted(
-            flow_stats.items(), key=lambda x: x[1]["packets"], reverse=True
-        )[:50]
-        top_flows = []
-        for (src, dst, proto, sport, dport), info in sorted_flows:
-            top_flows.append(
-                {
-                    "src_ip": src,
-                    "src_port": sport,
-                    "dst_ip": dst,
-                    "dst_port": dport,
-                    "protocol": proto,
-                    "packets": info["packets"],
-                    "bytes": info["bytes"],
-                    "threats": list(info["threats"]),  # 包含该流命中的威胁标签
-                }
-            )
+        # 流量会话 (按包数量 Top 50)：与全量会话持久化共用一次遍历
+        top_heap: List[Tuple[int, int, Tuple, List[Any]]] = []
+
+        def iter_flows() -> Iterator[Tuple[Tuple, List[Any]]]:
+            for seq, (key, info) in enumerate(flow_table.items()):
+                # 包数相同时先出现的会话优先 (同 sorted 的稳定排序)
+                entry = (info[0], -seq, key, info)
+                if len(top_heap) < 50:
+                    heapq.heappush(top_heap, entry)
+                elif entry > top_heap[0]:
+                    heapq.heapreplace(top_heap, entry)
+                yield key, info
+
+        # 全量会话与告警交给调用方持久化 (用于分页查询)
+        persist_started = clock()
+        if on_flows is not None:
+            on_flows(self._flow_row(key, info) for key, info in iter_flows())
+        else:
+            for _ in iter_flows():
+                pass
+        if on_alerts is not None:
+            on_alerts(iter(alerts))
+        if on_flows is not None or on_alerts is not None:
+            persist_seconds = clock() - persist_started
+            ANALYSIS_STAGE_SECONDS.labels("persist").observe(persist_seconds)
+        top_flows = [
+            self._flow_row(key, info) for _, _, key, info in sorted(top_heap, reverse=True)
+        ]
 
         # 攻击路径图 (Top 100 链路)
         limit_links = 100
-        sorted_links = sorted(
-            connection_counts.items(), key=lambda x: x[1], reverse=True
-        )[:limit_links]
+        sorted_links = heapq.nlargest(limit_links, link_table.items(), key=lambda x: x[1])
         valid_nodes = set()
         echarts_links = []
 
@@ -216,9 +456,29 @@ class TrafficAnalyzer:
                 }
             )
 
+        # 一次遍历主机表，同时得到 Top 10 发包主机与攻击路径节点的发包数
+        node_sent: Dict[str, int] = {}
+
+        def iter_hosts() -> Iterator[Tuple[str, int]]:
+            for ip, count in host_table.items():
+                if ip in valid_nodes:
+                    node_sent[ip] = count
+                yield ip, count
+
+        top_talkers = heapq.nlargest(10, iter_hosts(), key=lambda x: x[1])
+
+        statistics = {
+            "total_packets": total_packets,
+            "total_bytes": total_bytes,
+            "duration": duration,
+            "packets_per_second": total_packets / duration if duration > 0 else 0,
+            "top_talkers": [{"ip": ip, "packets": c} for ip, c in top_talkers],
+            "total_threats": len(alerts),  # 新增维度：总威胁数
+        }
+
         echarts_nodes = []
         for node in valid_nodes:
-            sent_count = src_ips[node]
+            sent_count = node_sent.get(node, 0)
             # 根据发包量简单分类
             if sent_count > 1000:
                 cat = 2
@@ -249,9 +509,14 @@ class TrafficAnalyzer:
 
         # 时间线聚合
         timeline_list = [
-            {"time": ts, "packets": info["packets"], "bytes": info["bytes"]}
-            for ts, info in sorted(timeline_stats.items())
+            {"time": ts, "packets": info[0], "bytes": info[1]}
+            for ts, info in timeline_table.items(ordered=True)
         ]
+        aggregate_seconds = clock() - aggregate_started - persist_seconds
+        ANALYSIS_STAGE_SECONDS.labels("aggregate").observe(aggregate_seconds)
+        if counters is not None:
+            counters["stage_seconds.aggregate"] += aggregate_seconds
+            counters["stage_seconds.persist"] += persist_seconds
 
         return {
             "statistics": statistics,
@@ -259,7 +524,8 @@ class TrafficAnalyzer:
             "flows": {"top_flows": top_flows},
             "attack_path": attack_path_data,
             "timeline": {"timeline": timeline_list},
-            "threat_alerts": alerts,  # [新增] 将规则引擎捕获的恶意流量独立返回
+            # [新增] 将规则引擎捕获的恶意流量独立返回 (全部告警经 on_alerts 持久化后分页查询)
+            "threat_alerts": list(islice(alerts, ANALYSIS_RESULT_ALERTS)),
         }
 
     # 兼容原有的拆分接口
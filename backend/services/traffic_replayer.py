@@ -1,309 +1,492 @@
-import docker
 import time
-import json
-import threading
 import os
-import tarfile
 import uuid
 import logging
-import redis
-from typing import Optional
+from typing import List, Optional, Tuple
+
+from clients import get_redis
+from metrics import (
+    REPLAY_PREPARE_SECONDS,
+    REPLAY_RESULTS,
+    REPLAY_START_SECONDS,
+    observe_replay_rate,
+)
+from services.task_events import replay_channel, publish_task_event
+from services.replay_task_store import (
+    FINISHED_STATUSES,
+    ReplayTaskStore,
+    ThrottledTaskWriter,
+)
+from services.replay_scheduler import ReplayScheduler, SANDBOX_CONTAINER
+from services.sandbox_agent import SandboxAgentClient, SandboxAgentError
+from services.pcap_parser import PCAPParser
+from services.pcap_rewriter import PCAPRewriter, RewriteRules
+from services.packet_filter import PacketSelection
+from services.packet_index import SubsetExtractor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-REDIS_PORT = 6379
-
 
 class TrafficReplayer:
-    """下一代流量重放器 (Docker Stream 流式通信防死锁版)"""
+    """流量重放器 (任务经调度队列下发到沙箱常驻代理执行)"""
 
-    def __init__(self, pcap_file: str = None):
+    def __init__(
+        self,
+        pcap_file: str = None,
+        redis_client=None,
+        file_hash: Optional[str] = None,
+        total_packets: int = 0,
+        duration: float = 0.0,
+    ):
+        """
+        redis_client 由调用方注入共享客户端；未传入时使用进程级共享连接池。
+        file_hash 为文件内容哈希 (入库时已计算)，用作沙箱缓存键；未提供时按需计算。
+        total_packets / duration 为入库时统计的包数与抓包时长，用于进度与期望速率计算。
+        """
         self.pcap_file = pcap_file
-        try:
-            self.docker_client = docker.from_env()
-        except Exception as e:
-            logger.warning(f"Docker client init failed: {e}")
-            self.docker_client = None
+        self.file_hash = file_hash
+        self.total_packets = total_packets or 0
+        self.duration = duration or 0.0
+        self.redis = redis_client if redis_client is not None else get_redis()
+        self.tasks = ReplayTaskStore(self.redis)
+        self.scheduler = ReplayScheduler(self.redis)
+
+    @classmethod
+    def from_job(cls, job: dict, redis_client=None) -> "TrafficReplayer":
+        """由调度队列中的任务参数重建重放器 (worker 进程使用)"""
+        return cls(
+            job.get("pcap_file"),
+            redis_client,
+            file_hash=job.get("file_hash"),
+            total_packets=job.get("total_packets", 0),
+            duration=job.get("duration", 0.0),
+        )
 
-        try:
-            self.redis = redis.Redis(
-                host=REDIS_HOST, port=REDIS_PORT, decode_responses=True
-            )
-        except Exception as e:
-            logger.error(f"Redis connection failed: {e}")
-            self.redis = None
-
-    def _save_task(self, task_id: str, data: dict):
-        if self.redis:
-            self.redis.set(f"replay_task:{task_id}", json.dumps(data))
-
-    def _get_task(self, task_id: str) -> dict:
-        if self.redis:
-            data = self.redis.get(f"replay_task:{task_id}")
-            return json.loads(data) if data else None
-        return None
-
-    def _copy_to_container_safe(self, container, src_path: str, dst_path: str):
-        """修复 OOM 隐患：使用临时文件打包，避免大文件直接塞入内存"""
-        tar_path = f"{src_path}.tar"
-        try:
-            # 1. 将文件打包到本地磁盘临时 tar 文件中 (极其省内存)
-            with tarfile.open(tar_path, mode="w") as tar:
-                tar.add(src_path, arcname=os.path.basename(dst_path))
-
-            # 2. 以二进制流读取发给 Docker
-            with open(tar_path, "rb") as f:
-                logger.info(f"Uploading {src_path} -> {container.name}:{dst_path}")
-                container.put_archive(path=os.path.dirname(dst_path), data=f)
-        except Exception as e:
-            logger.error(f"Failed to copy file to container: {e}")
-            raise
-        finally:
-            if os.path.exists(tar_path):
-                os.remove(tar_path)
+    def _publish_task(
+        self, task_id: str, data: dict, new_logs: List[str] = None, pipe=None
+    ):
+        """推送任务更新：不带完整日志，仅附带本次新增的日志行"""
+        event = {k: v for k, v in data.items() if k != "logs"}
+        if new_logs:
+            event["new_logs"] = new_logs
+        publish_task_event(pipe or self.redis, replay_channel(task_id), event)
+
+    def _update_task(
+        self, task_id: str, data: dict, new_logs: List[str] = None, samples: List[dict] = None
+    ):
+        """HSET 摘要、追加日志/采样与事件推送在同一个管道中一次往返完成"""
+        if not self.redis:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        self.tasks.save(task_id, data, new_logs, pipe=pipe, samples=samples)
+        self._publish_task(task_id, data, new_logs, pipe=pipe)
+        pipe.execute()
+
+    def _task_writer(self, task_id: str) -> ThrottledTaskWriter:
+        """运行期状态更新走节流写入器，避免逐行输出逐次写 Redis"""
+        return ThrottledTaskWriter(
+            lambda fields, logs, samples: self._update_task(task_id, fields, logs, samples)
+        )
+
+    def _get_task(self, task_id: str, with_logs: bool = True) -> dict:
+        return self.tasks.get(task_id, with_logs=with_logs)
 
-    def _generate_sandbox_script(
-        self, pcap_path: str, target_ip: str, speed: float
-    ) -> str:
+    def _ensure_file_hash(self) -> str:
+        if not self.file_hash:
+            # 历史文件入库时未记录哈希，按需计算 (流式读取)
+            self.file_hash = PCAPParser(self.pcap_file).get_file_hash()
+        return self.file_hash
+
+    def _ensure_sandbox_pcap(self, agent: SandboxAgentClient, path: str, file_hash: str):
+        """确保 PCAP 已在沙箱缓存中 (按内容哈希复用，未命中时流式上传)"""
+        if agent.has_pcap(file_hash):
+            logger.info(f"Sandbox cache hit: {agent.sandbox}/{file_hash}")
+            return
+        logger.info(f"Uploading {path} -> {agent.sandbox}/{file_hash}")
+        agent.upload_pcap(file_hash, path)
+
+    def _prepare_pcap(
+        self,
+        rules: RewriteRules,
+        selection: PacketSelection,
+        task: dict,
+        writer: ThrottledTaskWriter,
+        speed: float = 1.0,
+    ) -> Tuple[str, str]:
         """
-        沙箱内部执行脚本。
-        核心改变：直接将进度通过 JSON 格式 print 到 stdout。宿主机通过 docker stream 实时捕获。
+        返回实际下发的 PCAP 路径与内容哈希：
+        先按选择条件借助包索引提取子集 (只拷贝选中记录)，再对结果应用地址改写；两步结果均有缓存。
         """
-        return f"""
-import sys
-import time
-import json
-import os
-import subprocess
-
-pcap_path = "{pcap_path}"
-target_ip = "{target_ip}"
-speed = {speed}
-
-def emit_status(sent, total, status, msg=""):
-    # 将状态直接打印到标准输出，外层可以实时截获
-    out = json.dumps({{
-        "sent": sent, "total": total, "status": status, 
-        "msg": msg, "ts": time.time()
-    }})
-    print(f"[[STATUS_SYNC]]|{{out}}", flush=True)
-
-try:
-    emit_status(0, 100, "preparing", "Starting environment setup...")
-    
-    # 获取包数
-    file_size = os.path.getsize(pcap_path)
-    total_packets = max(100, int(file_size / 800))  # 粗略估算，后续可由 tcpreplay 输出修正
-    
-    emit_status(0, total_packets, "running", "Applying IP/MAC rewrite rules...")
-    
-    # 查找网卡 (排除 lo 本地环回)
-    iface = 'eth0'
-    for name in os.listdir('/sys/class/net'):
-        if name != 'lo':
-            iface = name
-            break
-
-    # 组装 tcpreplay 命令
-    cmd = ["tcpreplay", "-i", iface]
-    if speed >= 999: # 约等于极限速度
-        cmd.append("--topspeed")
-    else:
-        cmd.extend(["-x", str(speed)])
-    
-    cmd.append(pcap_path)
-
-    emit_status(0, total_packets, "running", f"Starting packet injection on {{iface}}...")
-    
-    # 启动发包 (带实时输出)
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    
-    sent_pkts = 0
-    for line in iter(process.stdout.readline, ""):
-        line = line.strip()
-        if line:
-            # 你可以将 tcpreplay 的实时日志通过 MSG 字段传出去
-            emit_status(sent_pkts, total_packets, "running", line)
-            
-    process.stdout.close()
-    process.wait()
-
-    if process.returncode != 0:
-        raise Exception(f"tcpreplay exit code {{process.returncode}}")
-
-    emit_status(total_packets, total_packets, "completed", "Replay finished successfully.")
-
-except Exception as e:
-    emit_status(0, 0, "failed", f"ERROR: {{str(e)}}")
-    sys.exit(1)
-"""
+        path, file_hash = self.pcap_file, self._ensure_file_hash()
+
+        if not selection.is_empty():
+            writer.update(
+                task,
+                [f"[{time.strftime('%H:%M:%S')}] Selecting packets: {selection.describe()}"],
+            )
+            subset = SubsetExtractor(path, file_hash).extract(selection)
+            # 进度与期望速率按子集计算
+            self.total_packets, self.duration = subset["packets"], subset["duration"]
+            task.update(
+                {
+                    "total_packets": subset["packets"],
+                    "expected_pps": self._expected_pps(speed),
+                }
+            )
+            source = "cache hit" if subset["cached"] else f"{subset['seconds']}s"
+            writer.update(
+                task,
+                [
+                    f"[{time.strftime('%H:%M:%S')}] Selected {subset['packets']}/"
+                    f"{subset['total_packets']} packets ({source})"
+                ],
+            )
+            path, file_hash = subset["path"], subset["sha256"]
+
+        if rules.is_empty():
+            return path, file_hash
+
+        stamp = time.strftime("%H:%M:%S")
+        writer.update(task, [f"[{stamp}] Applying IP/MAC rewrite rules..."])
+        result = PCAPRewriter(path, file_hash).rewrite(rules)
+
+        mapping = ", ".join(f"{old} -> {new}" for old, new in result["ip_map"].items())
+        source = "cache hit" if result["cached"] else f"{result['seconds']}s"
+        task["rewrite"] = {
+            "ip_map": result["ip_map"],
+            "target_mac": result["target_mac"],
+            "rewritten_packets": result["rewritten"],
+            "cached": result["cached"],
+        }
+        writer.update(
+            task,
+            [
+                f"[{time.strftime('%H:%M:%S')}] Rewrote {result['rewritten']}/{result['packets']} "
+                f"packets ({mapping}; {source})"
+            ],
+        )
+        return result["path"], result["sha256"]
+
+    def _expected_pps(self, speed: float) -> Optional[float]:
+        """按原始抓包节奏与倍速计算的期望发包速率；极限速度或时长未知时无期望值"""
+        if speed >= 999 or self.duration <= 0 or not self.total_packets:
+            return None
+        return self.total_packets * speed / self.duration
+
+    def _ensure_packet_count(self):
+        """历史文件入库时未统计包数/时长，按需补算 (流式遍历)"""
+        if not self.total_packets:
+            info = PCAPParser(self.pcap_file).get_basic_info()
+            self.total_packets = info.get("total_packets", 0)
+            self.duration = info.get("duration", 0.0)
+
+    @staticmethod
+    def _apply_metrics(task: dict, metrics: dict) -> dict:
+        """将沙箱上报的累计统计写入任务摘要，返回一个时间序列采样点"""
+        total = task.get("total_packets") or 0
+        sent = metrics.get("sent", 0)
+        pps = metrics.get("pps", 0.0)
+        expected_pps = task.get("expected_pps")
+
+        eta = None
+        if pps > 0 and total > sent:
+            eta = round((total - sent) / pps, 1)
+        keep_up = round(pps / expected_pps, 3) if expected_pps and pps else None
+
+        task.update(
+            {
+                "sent_bytes": metrics.get("bytes", 0),
+                "elapsed": metrics.get("elapsed", 0.0),
+                "pps": pps,
+                "mbps": metrics.get("mbps", 0.0),
+                "failed_packets": metrics.get("failed", 0),
+                "eta_seconds": eta,
+                "keep_up_ratio": keep_up,
+            }
+        )
+        return {
+            "ts": time.time(),
+            "sent": sent,
+            "bytes": metrics.get("bytes", 0),
+            "elapsed": metrics.get("elapsed", 0.0),
+            "pps": pps,
+            "mbps": metrics.get("mbps", 0.0),
+            "failed": metrics.get("failed", 0),
+            "keep_up_ratio": keep_up,
+        }
 
     def start_replay(
         self,
         target_ip: Optional[str] = None,
         speed_multiplier: float = 1.0,
         use_sandbox: bool = True,
+        target_mac: Optional[str] = None,
+        ip_map: Optional[dict] = None,
+        selection: Optional[dict] = None,
+        measure_fidelity: bool = False,
     ):
         if not self.pcap_file or not os.path.exists(self.pcap_file):
             raise FileNotFoundError("PCAP file is missing")
 
+        # 先校验改写规则与子集条件 (格式错误时抛出 ValueError，不创建任务)
+        rules = RewriteRules(ip_map, target_ip, target_mac)
+        subset = PacketSelection.from_dict(selection)
+
+        self._ensure_packet_count()
+
         task_id = str(uuid.uuid4())
         initial_state = {
             "task_id": task_id,
-            "status": "initializing",
+            "status": "queued",
             "progress": 0,
             "sent_packets": 0,
-            "total_packets": 0,
-            "logs": [],  # 新增：用于存储前端展示的终端日志
+            "total_packets": self.total_packets,
+            "speed_multiplier": speed_multiplier,
+            "expected_pps": self._expected_pps(speed_multiplier),
+            "measure_fidelity": measure_fidelity,
             "start_time": time.time(),
         }
-        self._save_task(task_id, initial_state)
-
-        thread = threading.Thread(
-            target=self._run_sandbox_stream_replay,
-            args=(task_id, target_ip, speed_multiplier),
-        )
-        thread.daemon = True
-        thread.start()
-        return task_id
+        if not subset.is_empty():
+            initial_state["selection"] = subset.describe()
+        self._update_task(task_id, initial_state)
 
-    def _run_sandbox_stream_replay(self, task_id: str, target_ip: str, speed: float):
-        task = self._get_task(task_id) or {}
+        # 由 worker 按队列顺序与沙箱并发上限执行；队列已满时撤销任务记录并向上抛出
         try:
-            container = self.docker_client.containers.get("cyber-replay-sandbox")
-
-            sandbox_pcap = f"/tmp/{task_id}.pcap"
-            sandbox_script = f"/tmp/replay_{task_id}.py"
+            self.scheduler.enqueue(
+                task_id,
+                {
+                    "pcap_file": self.pcap_file,
+                    "file_hash": self.file_hash,
+                    "total_packets": self.total_packets,
+                    "duration": self.duration,
+                    "target_ip": target_ip,
+                    "rewrite": rules.to_dict(),
+                    "selection": subset.to_dict(),
+                    "speed_multiplier": speed_multiplier,
+                    "measure_fidelity": measure_fidelity,
+                },
+            )
+        except Exception:
+            self.tasks.delete(task_id)
+            raise
+        return task_id
 
-            # 1. 复制文件
-            self._copy_to_container_safe(container, self.pcap_file, sandbox_pcap)
+    def run_job(self, job: dict, sandbox: str = SANDBOX_CONTAINER):
+        """执行一个已领取的调度任务 (阻塞直到重放结束)"""
+        # 兼容升级前入队、只带 target_ip 的任务
+        rules = RewriteRules.from_dict(job.get("rewrite") or {"target_ip": job.get("target_ip")})
+        selection = PacketSelection.from_dict(job.get("selection"))
+        self._run_sandbox_stream_replay(
+            job["task_id"],
+            rules,
+            job.get("speed_multiplier", 1.0),
+            sandbox,
+            selection,
+            job.get("measure_fidelity", False),
+        )
 
-            # 2. 生成并复制脚本
-            script_content = self._generate_sandbox_script(
-                sandbox_pcap, target_ip or "None", speed
-            )
-            local_script = f"/tmp/script_{task_id}.py"
-            with open(local_script, "w") as f:
-                f.write(script_content)
-            self._copy_to_container_safe(container, local_script, sandbox_script)
-            os.remove(local_script)
+    def _run_sandbox_stream_replay(
+        self,
+        task_id: str,
+        rules: RewriteRules,
+        speed: float,
+        sandbox: str = SANDBOX_CONTAINER,
+        selection: Optional[PacketSelection] = None,
+        measure_fidelity: bool = False,
+    ):
+        task = self._get_task(task_id, with_logs=False) or {}
+        writer = self._task_writer(task_id)
+        agent = SandboxAgentClient(sandbox)
+        try:
+            task.update({"status": "initializing", "sandbox": sandbox})
+            writer.update(task)
+
+            # 1. 提取子集、改写地址 (结果均缓存复用)，并确保 PCAP 在沙箱缓存中
+            with REPLAY_PREPARE_SECONDS.time():
+                pcap_path, pcap_hash = self._prepare_pcap(
+                    rules, selection or PacketSelection(), task, writer, speed
+                )
+                self._ensure_sandbox_pcap(agent, pcap_path, pcap_hash)
+
+            # 排队或上传期间收到停止请求：不再启动
+            if self.scheduler.stop_requested(task_id):
+                task.update({"status": "stopped", "end_time": time.time()})
+                writer.update(task)
+                return
 
             task.update({"status": "starting", "progress": 5})
-            self._save_task(task_id, task)
+            writer.update(task)
+
+            # 2. 由沙箱常驻代理直接启动 tcpreplay，逐条读取 NDJSON 进度事件
+            for event in agent.start_replay(task_id, pcap_hash, speed, measure_fidelity):
+                self._apply_event(task_id, task, event, agent, writer)
+
+            if task.get("status") not in FINISHED_STATUSES:
+                task.update(
+                    {
+                        "status": "failed",
+                        "error": "Replay stream ended unexpectedly",
+                        "end_time": time.time(),
+                    }
+                )
+                writer.update(task)
+
+        except SandboxAgentError as e:
+            logger.error(f"Replay task {task_id} failed: {e}")
+            task.update({"status": "failed", "error": str(e), "end_time": time.time()})
+            writer.update(task)
+        except Exception as e:
+            logger.error(f"Replay task failed: {e}")
+            task.update({"status": "failed", "error": str(e), "end_time": time.time()})
+            writer.update(task)
+        finally:
+            writer.flush()
+            REPLAY_RESULTS.labels(task.get("status", "failed")).inc()
 
-            # 3. 执行脚本并流式捕获输出 (关键改进：不会死锁)
-            # 注意: exec_run 返回一个生成器，我们可以一行行读取容器输出
-            exec_obj = container.exec_run(
-                f"python3 {sandbox_script}", stream=True, detach=False
+    def _apply_event(
+        self,
+        task_id: str,
+        task: dict,
+        event: dict,
+        agent: SandboxAgentClient,
+        writer: ThrottledTaskWriter,
+    ):
+        """将代理上报的事件合并进任务摘要，经节流写入器落库与推送"""
+        kind = event.get("type")
+        stamp = time.strftime("%H:%M:%S", time.localtime(event.get("ts", time.time())))
+        new_logs: List[str] = []
+        samples = None
+
+        if kind == "started":
+            task.update({"status": "running", "pid": event.get("pid")})
+            if task.get("start_time"):
+                REPLAY_START_SECONDS.observe(max(0.0, time.time() - task["start_time"]))
+            new_logs.append(
+                f"[{stamp}] Packet injection started on {event.get('iface')} (pid {event.get('pid')})"
             )
+            # 进程启动前已请求停止：立即结束
+            if self.scheduler.stop_requested(task_id):
+                agent.cancel(task_id)
+        elif kind == "progress":
+            samples = [self._apply_metrics(task, event.get("metrics") or {})]
+        elif kind == "log":
+            new_logs.append(f"[{stamp}] {event.get('msg', '')}")
+        elif kind == "fidelity":
+            report = event.get("report") or {}
+            self.tasks.save_fidelity(task_id, report)
+            task["fidelity"] = self._fidelity_summary(report)
+            new_logs.append(f"[{stamp}] {self._describe_fidelity(report)}")
+        elif kind == "finished":
+            status = event.get("status", "failed")
+            if event.get("metrics"):
+                samples = [self._apply_metrics(task, event["metrics"])]
+                observe_replay_rate(event["metrics"], task.get("expected_pps"))
+            task.update({"status": status, "end_time": time.time()})
+            if status == "failed":
+                task["error"] = f"tcpreplay exit code {event.get('returncode')}"
+            new_logs.append(f"[{stamp}] Replay {status}.")
+
+        if samples:
+            task["sent_packets"] = samples[0]["sent"]
+        total = task.get("total_packets") or 0
+        if task.get("status") == "completed":
+            task["progress"] = 100
+        elif total > 0:
+            task["progress"] = min(100, int(task.get("sent_packets", 0) / total * 100))
+        writer.update(task, new_logs, samples)
+
+    @staticmethod
+    def _fidelity_summary(report: dict) -> dict:
+        """任务摘要中保留的保真度指标 (完整报告单独存放)"""
+        jitter = report.get("jitter_us") or {}
+        return {
+            "loss_rate": report.get("loss_rate"),
+            "lost_packets": report.get("lost_packets"),
+            "reordered_packets": report.get("reordered_packets"),
+            "jitter_p50_us": jitter.get("p50"),
+            "jitter_p99_us": jitter.get("p99"),
+            "timing_bias_us": report.get("timing_bias_us"),
+            "capture_dropped": report.get("capture_dropped"),
+        }
 
-            for output_bytes in exec_obj.output:
-                output_str = output_bytes.decode("utf-8", errors="ignore").strip()
-                if not output_str:
-                    continue
-
-                # 解析从沙箱脚本打印出的状态
-                if "[[STATUS_SYNC]]|" in output_str:
-                    try:
-                        json_str = output_str.split("[[STATUS_SYNC]]|")[1]
-                        sync_data = json.loads(json_str)
-
-                        sent = sync_data.get("sent", 0)
-                        total = sync_data.get("total", 100)
-                        status = sync_data.get("status", "running")
-                        msg = sync_data.get("msg", "")
-
-                        # 保存日志到列表，供前端拉取
-                        if msg:
-                            # 限制日志长度防止爆内存
-                            task.setdefault("logs", []).append(
-                                f"[{time.strftime('%H:%M:%S')}] {msg}"
-                            )
-                            task["logs"] = task["logs"][-50:]
-
-                        task.update(
-                            {
-                                "status": status,
-                                "sent_packets": sent,
-                                "total_packets": total,
-                                "progress": (
-                                    int((sent / total) * 100) if total > 0 else 0
-                                ),
-                                "end_time": (
-                                    time.time()
-                                    if status in ["completed", "failed"]
-                                    else None
-                                ),
-                            }
-                        )
-                        self._save_task(task_id, task)
-                    except Exception as e:
-                        logger.warning(f"Failed to parse sync data: {e}")
-
-        except docker.errors.NotFound:
-            task.update(
-                {
-                    "status": "failed",
-                    "error": "Sandbox container 'cyber-replay-sandbox' is not running.",
-                }
-            )
-            self._save_task(task_id, task)
-        except Exception as e:
-            logger.error(f"Replay task failed: {e}")
-            task.update({"status": "failed", "error": str(e)})
-            self._save_task(task_id, task)
+    @staticmethod
+    def _describe_fidelity(report: dict) -> str:
+        text = (
+            f"Fidelity: lost {report.get('lost_packets', 0)}/{report.get('source_packets', 0)} "
+            f"({report.get('loss_rate', 0) * 100:.3f}%), reordered {report.get('reordered_packets', 0)}"
+        )
+        jitter = report.get("jitter_us")
+        if jitter:
+            text += f", gap jitter p50 {jitter['p50']}us p99 {jitter['p99']}us"
+        if report.get("capture_dropped"):
+            text += f" (capture dropped {report['capture_dropped']})"
+        return text
 
     def get_status(self, task_id: str):
-        return self._get_task(task_id)
+        task = self._get_task(task_id)
+        if task and task.get("status") == "queued":
+            task["queue_position"] = self.scheduler.queue_position(task_id)
+        return task
 
-    def list_tasks(self) -> list:
-        """列出 Redis 中所有的重放任务"""
-        if not self.redis:
-            return []
-        keys = self.redis.keys("replay_task:*")
-        tasks = []
-        for k in keys:
-            data = self.redis.get(k)
-            if data:
-                tasks.append(json.loads(data))
-        # 按开始时间倒序排列
-        tasks.sort(key=lambda x: x.get("start_time", 0), reverse=True)
-        return tasks
+    def get_metrics(self, task_id: str) -> List[dict]:
+        """任务吞吐时间序列"""
+        return self.tasks.get_metrics(task_id)
+
+    def get_fidelity(self, task_id: str) -> Optional[dict]:
+        """时间保真度完整报告 (未开启测量或尚未完成时为 None)"""
+        return self.tasks.get_fidelity(task_id)
+
+    def list_tasks(self, offset: int = 0, limit: int = 50) -> dict:
+        """按开始时间倒序分页列出重放任务摘要 (不含日志)"""
+        return self.tasks.list(offset, limit)
+
+    @staticmethod
+    def _cancel_on_sandbox(sandbox: str, task_id: str) -> bool:
+        """只结束指定任务的发包进程，不影响同一沙箱中的其他重放"""
+        try:
+            return SandboxAgentClient(sandbox).cancel(task_id)
+        except SandboxAgentError as e:
+            logger.warning(f"Failed to stop replay {task_id} on {sandbox}: {e}")
+            return False
 
     def stop_replay(self, task_id: str) -> dict:
-        """停止重放任务"""
-        task = self._get_task(task_id)
-        if task:
-            task["status"] = "stopping"
-            self._save_task(task_id, task)
-            # 实际向容器发出停止信号 (直接 kill 掉 tcpreplay 进程)
-            try:
-                if self.docker_client:
-                    container = self.docker_client.containers.get(
-                        "cyber-replay-sandbox"
-                    )
-                    container.exec_run("pkill tcpreplay")
-            except Exception as e:
-                logger.warning(f"Failed to kill tcpreplay in container: {e}")
-            return {"message": "任务正在停止..."}
-        return {"error": "未找到该任务"}
+        """停止重放任务：排队中的直接撤回，运行中的由沙箱代理结束对应进程"""
+        task = self._get_task(task_id, with_logs=False)
+        if not task:
+            return {"error": "未找到该任务"}
+
+        status = task.get("status")
+        if status in FINISHED_STATUSES:
+            return {"message": "任务已结束"}
+
+        if status == "queued" and self.scheduler.cancel(task_id):
+            task.update({"status": "stopped", "end_time": time.time()})
+            self._update_task(task_id, task)
+            return {"message": "任务已取消"}
+
+        # 已被 worker 领取：设置停止标记 (发包进程尚未启动时由执行方检查)，已启动则立即结束
+        self.scheduler.request_stop(task_id)
+        task["status"] = "stopping"
+        self._update_task(task_id, task)
+        if task.get("sandbox"):
+            self._cancel_on_sandbox(task["sandbox"], task_id)
+        return {"message": "任务正在停止..."}
 
     def delete_task(self, task_id: str) -> dict:
         """删除重放任务及记录"""
-        task = self._get_task(task_id)
+        task = self._get_task(task_id, with_logs=False)
         if not task:
             return {"error": "未找到该任务"}
 
         # 若在运行，先尝试停止
-        if task.get("status") in ["initializing", "starting", "running", "stopping"]:
+        if task.get("status") not in FINISHED_STATUSES:
             try:
                 self.stop_replay(task_id)
             except Exception:
                 pass
 
         # 从 Redis 清除数据
-        if self.redis:
-            self.redis.delete(f"replay_task:{task_id}")
+        self.tasks.delete(task_id)
+        self._publish_task(task_id, {"task_id": task_id, "status": "deleted"})
         return {"message": "任务已删除", "task_id": task_id}
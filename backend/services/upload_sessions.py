@@ -0,0 +1,313 @@
+"""
+可续传的分块上传
+大文件先创建上传会话 (服务端按总大小预分配文件)，再按偏移 PATCH 各个分块，分块可以并发、乱序、重复上传，
+每块先写入临时文件，按请求头中的校验和核对无误后才拷贝到预分配文件的对应区间并记为已接收；全部分块到齐后 complete 计算整体摘要并转入常规的入库流程。
+连接中断后查询会话即可得到缺失的分块，只补传缺失部分。
+会话元数据存放在 Redis (多个 API 进程共享)，数据文件位于 UPLOAD_SESSION_DIR，过期会话在创建新会话时清理。
+"""
+import os
+import time
+import uuid
+import zlib
+import errno
+import fcntl
+import hashlib
+import tempfile
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from serialization import dumps, loads
+from services.derived_pcap_cache import ZeroCopyWriter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 未完成会话的数据文件目录 (与 uploads 位于同一文件系统，完成时直接改名)
+UPLOAD_SESSION_DIR = Path(os.getenv("UPLOAD_SESSION_DIR", "uploads/.sessions"))
+# 会话过期时间 (秒)：每收到一个分块刷新；完成后的会话保留同样时长，重复 complete 返回同一结果
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", "86400"))
+# 分块大小：客户端可在创建会话时指定，限制在 [MIN, MAX] 之间
+UPLOAD_CHUNK_DEFAULT = int(os.getenv("UPLOAD_CHUNK_DEFAULT", str(8 * 1024 * 1024)))
+UPLOAD_CHUNK_MIN = 256 * 1024
+UPLOAD_CHUNK_MAX = int(os.getenv("UPLOAD_CHUNK_MAX", str(64 * 1024 * 1024)))
+# 整体摘要计算时的读取块大小
+HASH_READ_SIZE = 8 * 1024 * 1024
+# complete 期间的互斥锁过期时间 (秒)，进程异常退出后锁自动释放
+FINALIZE_LOCK_TTL = 3600
+
+ALLOWED_SUFFIXES = (".pcap", ".pcapng", ".cap")
+
+
+def session_key(upload_id: str) -> str:
+    return f"upload_session:{upload_id}"
+
+
+def chunks_key(upload_id: str) -> str:
+    # Hash: 分块序号 -> 校验和
+    return f"upload_session:{upload_id}:chunks"
+
+
+def finalize_lock_key(upload_id: str) -> str:
+    return f"upload_session:{upload_id}:finalizing"
+
+
+class ChecksumMismatch(ValueError):
+    """分块或整体内容与客户端给出的校验和不一致"""
+
+
+class IncompleteUpload(Exception):
+    """complete 时仍有分块缺失"""
+
+    def __init__(self, missing: List[int]):
+        super().__init__(f"{len(missing)} chunks missing")
+        self.missing = missing
+
+
+class UploadBusy(Exception):
+    """同一会话的 complete 正在进行 (此时不再接受分块)"""
+
+
+class ChunkWriter:
+    """
+    单个分块的接收：数据先顺序写入会话目录下的临时文件并计算校验和，
+    核对无误后 (commit) 才整段拷贝到预分配文件的对应区间；校验失败的重传不会覆盖已接收的内容。
+    不同分块写入文件的不同区间，多个请求并发提交互不干扰
+    """
+
+    def __init__(self, spool_dir: Path, upload_id: str, offset: int, length: int, algorithm: str):
+        self.offset = offset
+        self.length = length
+        self.algorithm = algorithm
+        self.received = 0
+        self._sha256 = hashlib.sha256() if algorithm == "sha256" else None
+        self._crc32 = 0
+        self._fd, self._spool = tempfile.mkstemp(prefix=f"{upload_id}.", suffix=".chunk", dir=spool_dir)
+
+    def write(self, data) -> None:
+        if self.received + len(data) > self.length:
+            raise ValueError(f"Chunk at offset {self.offset} exceeds {self.length} bytes")
+        if self._sha256 is not None:
+            self._sha256.update(data)
+        else:
+            self._crc32 = zlib.crc32(data, self._crc32)
+        view = memoryview(data)
+        while view:
+            written = os.write(self._fd, view)
+            self.received += written
+            view = view[written:]
+
+    def copy_to(self, fd: int):
+        """把已核对的分块拷贝到目标文件的 offset 处 (内核态拷贝)"""
+        os.lseek(fd, self.offset, os.SEEK_SET)
+        ZeroCopyWriter(fd).copy_range(self._fd, 0, self.length)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            os.remove(self._spool)
+            self._fd = None
+
+    @property
+    def checksum(self) -> str:
+        if self._sha256 is not None:
+            return self._sha256.hexdigest()
+        return f"{self._crc32 & 0xFFFFFFFF:08x}"
+
+    def verify(self, expected: str):
+        if self.received != self.length:
+            raise ValueError(f"Chunk at offset {self.offset} has {self.received} of {self.length} bytes")
+        if expected.strip().lower() != self.checksum:
+            raise ChecksumMismatch(f"Checksum mismatch for chunk at offset {self.offset}")
+
+
+class UploadSessionStore:
+    def __init__(self, redis_client, session_dir: Path = UPLOAD_SESSION_DIR):
+        self.redis = redis_client
+        self.session_dir = Path(session_dir)
+
+    def data_path(self, upload_id: str) -> Path:
+        return self.session_dir / f"{upload_id}.part"
+
+    # ---------- 会话 ----------
+
+    def create(
+        self,
+        filename: str,
+        size: int,
+        chunk_size: Optional[int] = None,
+        sha256: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        if not filename.endswith(ALLOWED_SUFFIXES):
+            raise ValueError("只支持PCAP格式文件")
+        if size <= 0:
+            raise ValueError("size must be positive")
+        chunk_size = min(max(chunk_size or UPLOAD_CHUNK_DEFAULT, UPLOAD_CHUNK_MIN), UPLOAD_CHUNK_MAX)
+
+        self.session_dir.mkdir(parents=True, exist_ok=True)
+        self.sweep()
+        upload_id = str(uuid.uuid4())
+        self._preallocate(self.data_path(upload_id), size)
+
+        session = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": size,
+            "chunk_size": chunk_size,
+            "chunks": (size + chunk_size - 1) // chunk_size,
+            "sha256": sha256.lower() if sha256 else None,
+            "status": "uploading",
+            "created_at": time.time(),
+        }
+        self.redis.set(session_key(upload_id), dumps(session), ex=UPLOAD_SESSION_TTL)
+        return session
+
+    @staticmethod
+    def _preallocate(path: Path, size: int):
+        """预分配整个文件：提前暴露磁盘空间不足，并发写入的分块不产生碎片"""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except AttributeError:
+                os.ftruncate(fd, size)
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    raise
+                # 文件系统不支持预分配时退化为稀疏文件
+                os.ftruncate(fd, size)
+        except Exception:
+            os.close(fd)
+            os.remove(path)
+            raise
+        os.close(fd)
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        data = self.redis.get(session_key(upload_id))
+        return loads(data) if data else None
+
+    def status(self, upload_id: str) -> Optional[Dict[str, Any]]:
+        """会话信息与缺失分块的偏移 (客户端断线后据此补传)"""
+        session = self.get(upload_id)
+        if session is None:
+            return None
+        status = {k: v for k, v in session.items() if k != "sha256"}
+        if session["status"] == "uploading":
+            missing = self.missing(session)
+            status["received"] = session["chunks"] - len(missing)
+            status["missing"] = [index * session["chunk_size"] for index in missing]
+        return status
+
+    def missing(self, session: Dict[str, Any]) -> List[int]:
+        received = {int(i) for i in self.redis.hkeys(chunks_key(session["upload_id"]))}
+        return [i for i in range(session["chunks"]) if i not in received]
+
+    # ---------- 分块 ----------
+
+    @staticmethod
+    def chunk_length(session: Dict[str, Any], offset: int) -> int:
+        """校验分块偏移并返回该分块应有的长度 (末块可以较短)"""
+        chunk_size, size = session["chunk_size"], session["size"]
+        if offset % chunk_size or not 0 <= offset < size:
+            raise ValueError(f"offset must be a multiple of {chunk_size} below {size}")
+        return min(chunk_size, size - offset)
+
+    def open_chunk(self, session: Dict[str, Any], offset: int, algorithm: str) -> ChunkWriter:
+        length = self.chunk_length(session, offset)
+        if not self.data_path(session["upload_id"]).exists():
+            raise FileNotFoundError(session["upload_id"])
+        return ChunkWriter(self.session_dir, session["upload_id"], offset, length, algorithm)
+
+    def commit_chunk(self, session: Dict[str, Any], writer: ChunkWriter) -> int:
+        """
+        把已核对的分块写入预分配文件并记为已接收，返回已接收的分块数
+        写入期间持有数据文件的共享锁，finalize 持排他锁：finalize 开始后 (已加 Redis 锁) 到达的分块被拒绝，
+        已在写入的分块先写完，finalize 再统计缺失分块并计算摘要
+        """
+        upload_id = session["upload_id"]
+        fd = os.open(self.data_path(upload_id), os.O_WRONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if self.redis.exists(finalize_lock_key(upload_id)):
+                raise UploadBusy(upload_id)
+            writer.copy_to(fd)
+            return self._mark_received(session, writer)
+        finally:
+            os.close(fd)
+
+    def _mark_received(self, session: Dict[str, Any], writer: ChunkWriter) -> int:
+        """记录已写入的分块并刷新会话过期时间，返回已接收的分块数"""
+        upload_id = session["upload_id"]
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(chunks_key(upload_id), str(writer.offset // session["chunk_size"]), writer.checksum)
+        pipe.expire(chunks_key(upload_id), UPLOAD_SESSION_TTL)
+        pipe.expire(session_key(upload_id), UPLOAD_SESSION_TTL)
+        pipe.hlen(chunks_key(upload_id))
+        return pipe.execute()[-1]
+
+    # ---------- 完成 ----------
+
+    def finalize(self, upload_id: str, dest: Path) -> Tuple[int, str]:
+        """
+        全部分块到齐后计算整体 SHA-256 (与常规上传的 file_hash 一致)，把数据文件改名到 dest
+        返回 (字节数, 摘要)；整体摘要与创建会话时给出的不一致时丢弃会话
+        """
+        if not self.redis.set(finalize_lock_key(upload_id), 1, nx=True, ex=FINALIZE_LOCK_TTL):
+            raise UploadBusy(upload_id)
+        try:
+            session = self.get(upload_id)
+            if session is None:
+                raise FileNotFoundError(upload_id)
+            path = self.data_path(upload_id)
+            with open(path, "rb") as f:
+                # 等待正在写入的分块提交完毕，之后到达的分块会看到 Redis 锁而被拒绝
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                missing = self.missing(session)
+                if missing:
+                    raise IncompleteUpload([index * session["chunk_size"] for index in missing])
+                digest = hashlib.sha256()
+                while True:
+                    block = f.read(HASH_READ_SIZE)
+                    if not block:
+                        break
+                    digest.update(block)
+            file_hash = digest.hexdigest()
+            if session["sha256"] and session["sha256"] != file_hash:
+                self.abort(upload_id)
+                raise ChecksumMismatch("File checksum mismatch, upload discarded")
+            os.replace(path, dest)
+            return session["size"], file_hash
+        except BaseException:
+            self.redis.delete(finalize_lock_key(upload_id))
+            raise
+
+    def complete(self, upload_id: str, result: Dict[str, Any]):
+        """入库成功后保存结果，重复 complete (如客户端没收到响应) 直接返回同一结果"""
+        session = self.get(upload_id) or {"upload_id": upload_id}
+        session.update({"status": "completed", "result": result})
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(session_key(upload_id), dumps(session), ex=UPLOAD_SESSION_TTL)
+        pipe.delete(chunks_key(upload_id), finalize_lock_key(upload_id))
+        pipe.execute()
+
+    def abort(self, upload_id: str) -> bool:
+        deleted = self.redis.delete(
+            session_key(upload_id), chunks_key(upload_id), finalize_lock_key(upload_id)
+        )
+        try:
+            os.remove(self.data_path(upload_id))
+        except FileNotFoundError:
+            pass
+        return bool(deleted)
+
+    def sweep(self):
+        """清理会话已过期 (或已被丢弃) 且长时间没有写入的数据文件，以及进程异常退出残留的分块临时文件"""
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        for path in [*self.session_dir.glob("*.part"), *self.session_dir.glob("*.chunk")]:
+            try:
+                upload_id = path.name.split(".", 1)[0]
+                if path.stat().st_mtime < cutoff and not self.redis.exists(session_key(upload_id)):
+                    path.unlink()
+                    logger.info(f"Removed expired upload session data {path.name}")
+            except FileNotFoundError:
+                continue
@@ -0,0 +1,147 @@
+"""
+重放 worker 进程
+从 Redis 调度队列领取重放任务并在沙箱中执行，与 API 进程分离：API 重启不影响运行中的重放。
+启动方式: python worker.py
+"""
+import os
+import time
+import uuid
+import signal
+import socket
+import logging
+import threading
+from typing import Dict
+
+from clients import init_clients, get_redis
+from metrics import REPLAY_QUEUE_DEPTH, WORKER_METRICS_PORT, serve, track
+from services.replay_scheduler import (
+    SANDBOX_CONTAINER,
+    WORKER_HEARTBEAT_TTL,
+    ReplayScheduler,
+)
+from services.replay_task_store import FINISHED_STATUSES, ReplayTaskStore
+from services.sandbox_pool import SandboxPool, sandbox_pool
+from services.traffic_replayer import TrafficReplayer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 队列为空或沙箱满载时的轮询间隔 (秒)
+POLL_INTERVAL = float(os.getenv("REPLAY_WORKER_POLL_INTERVAL", "0.5"))
+
+
+class ReplayWorker:
+    """
+    重放任务执行器
+    1. 按队列顺序领取任务，放置到负载最低的可用沙箱；每个沙箱同时执行的任务数不超过池容量。
+    2. 定期续期心跳；发现心跳过期的 worker 时回收其在途任务 (结束残留进程并标记失败)，
+       并移除缩容时已排空、现已空闲的沙箱副本。
+    3. 收到退出信号后停止领取新任务，等待在途重放结束后退出。
+    """
+
+    def __init__(self, pool: SandboxPool = sandbox_pool, worker_id: str = None):
+        self.pool = pool
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.stop_event = threading.Event()
+        self._threads: Dict[str, threading.Thread] = {}
+
+    def run(self):
+        scheduler = ReplayScheduler(get_redis())
+        logger.info(
+            f"Replay worker {self.worker_id} started (capacity {self.pool.capacity} per sandbox)"
+        )
+        last_beat = last_reap = 0.0
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                try:
+                    if now - last_beat >= WORKER_HEARTBEAT_TTL / 3:
+                        scheduler.heartbeat(self.worker_id)
+                        last_beat = now
+                    if now - last_reap >= WORKER_HEARTBEAT_TTL:
+                        self._recover_orphans(scheduler)
+                        self.pool.reap_drained()
+                        last_reap = now
+
+                    self._threads = {
+                        task_id: t for task_id, t in self._threads.items() if t.is_alive()
+                    }
+                    job = self._claim_next(scheduler)
+                except Exception as e:
+                    logger.warning(f"Replay worker loop error: {e}")
+                    job = None
+
+                if job is None:
+                    self.stop_event.wait(POLL_INTERVAL)
+                    continue
+
+                thread = threading.Thread(
+                    target=self._execute, args=(scheduler, job), daemon=True
+                )
+                self._threads[job["task_id"]] = thread
+                thread.start()
+        finally:
+            for thread in list(self._threads.values()):
+                thread.join()
+            scheduler.unregister(self.worker_id)
+            logger.info(f"Replay worker {self.worker_id} stopped")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _claim_next(self, scheduler: ReplayScheduler):
+        """按负载从低到高尝试各沙箱；并发领取冲突时原子脚本会拒绝，继续尝试下一个"""
+        for sandbox in self.pool.candidates():
+            job = scheduler.claim(self.worker_id, sandbox, self.pool.capacity)
+            if job:
+                return job
+        return None
+
+    def _execute(self, scheduler: ReplayScheduler, job: dict):
+        task_id = job["task_id"]
+        try:
+            replayer = TrafficReplayer.from_job(job, get_redis())
+            replayer.run_job(job, job["sandbox"])
+        except Exception as e:
+            logger.error(f"Replay job {task_id} crashed: {e}")
+        finally:
+            scheduler.release(self.worker_id, job["sandbox"], task_id)
+
+    def _recover_orphans(self, scheduler: ReplayScheduler):
+        """回收已退出 worker 的在途任务：结束沙箱内残留进程并标记失败，释放并发槽位"""
+        store = ReplayTaskStore(get_redis())
+        for job in scheduler.collect_orphans():
+            task_id = job["task_id"]
+            task = store.get(task_id, with_logs=False) or {}
+            sandbox = task.get("sandbox") or job.get("sandbox") or SANDBOX_CONTAINER
+            if task and task.get("status") not in FINISHED_STATUSES:
+                # 代理在调用方断开后也会自行结束发包，这里显式停止以防万一
+                TrafficReplayer._cancel_on_sandbox(sandbox, task_id)
+                replayer = TrafficReplayer(redis_client=get_redis())
+                task.update(
+                    {
+                        "status": "failed",
+                        "error": "Replay worker exited unexpectedly",
+                        "end_time": time.time(),
+                    }
+                )
+                replayer._update_task(task_id, task)
+            scheduler.release(job["worker_id"], sandbox, task_id)
+            logger.warning(f"Recovered orphaned replay task {task_id}")
+
+
+def main():
+    init_clients()
+    # 独立 worker 进程单独暴露指标 (内嵌在 API 进程时由 /metrics 统一输出)
+    track(REPLAY_QUEUE_DEPTH, lambda: ReplayScheduler(get_redis()).depth())
+    if WORKER_METRICS_PORT:
+        serve(WORKER_METRICS_PORT)
+        logger.info(f"Worker metrics exposed on :{WORKER_METRICS_PORT}/metrics")
+    worker = ReplayWorker()
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,34 @@ api.interceptors.request.use(
   }
 )
 
+// 分块上传的并发连接数与单块失败重试次数
+const CHUNK_CONCURRENCY = 4
+const CHUNK_RETRIES = 3
+
+// CRC32 查表 (页面不是安全上下文、没有 crypto.subtle 时用于分块校验)
+const CRC32_TABLE = Array.from({ length: 256 }, (_, n) => {
+  let c = n
+  for (let k = 0; k < 8; k++) c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1
+  return c >>> 0
+})
+
+const crc32 = (bytes) => {
+  let crc = 0xffffffff
+  for (let i = 0; i < bytes.length; i++) crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xff] ^ (crc >>> 8)
+  return (crc ^ 0xffffffff) >>> 0
+}
+
+// 分块校验请求头：优先 SHA-256
+const chunkChecksum = async (buffer) => {
+  if (window.crypto?.subtle) {
+    const digest = new Uint8Array(await window.crypto.subtle.digest('SHA-256', buffer))
+    return { 'X-Chunk-SHA256': Array.from(digest, b => b.toString(16).padStart(2, '0')).join('') }
+  }
+  return { 'X-Chunk-CRC32': crc32(new Uint8Array(buffer)).toString(16).padStart(8, '0') }
+}
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms))
+
 // 响应拦截器：已经在这里统一剥离了 response.data，后面的接口直接 return 即可
 api.interceptors.response.use(
   response => {
@@ -29,17 +57,69 @@ api.interceptors.response.use(
 
 export default {
   // --- PCAP管理 ---
-  uploadPcap(file) {
+  uploadPcap(file, onProgress = () => {}) {
     const formData = new FormData()
     formData.append('file', file)
     return api.post('/pcap/upload', formData, {
       headers: { 'Content-Type': 'multipart/form-data' },
-      timeout: 0 // 上传大文件特殊处理，不超时
+      timeout: 0, // 上传大文件特殊处理，不超时
+      onUploadProgress: (e) => e.total && onProgress(Math.round(e.loaded * 100 / e.total))
     })
   },
+
+  /**
+   * 大文件分块上传：多个连接并发上传各分块，每块带校验和；
+   * 中断后重新选择同一文件时查询会话，只补传缺失的分块
+   */
+  async uploadPcapChunked(file, onProgress = () => {}) {
+    const resumeKey = `pcap-upload:${file.name}:${file.size}:${file.lastModified}`
+    let session = null
+    const savedId = localStorage.getItem(resumeKey)
+    if (savedId) {
+      session = await api.get(`/pcap/uploads/${savedId}`).catch(() => null)
+      if (session?.status === 'completed') {
+        localStorage.removeItem(resumeKey)
+        return session.result
+      }
+    }
+    if (!session) {
+      session = await api.post('/pcap/uploads', { filename: file.name, size: file.size })
+      localStorage.setItem(resumeKey, session.upload_id)
+    }
+
+    const { upload_id: uploadId, chunk_size: chunkSize, chunks } = session
+    const pending = [...session.missing]
+    let done = chunks - pending.length
+    onProgress(Math.round(done * 100 / chunks))
+
+    const worker = async () => {
+      while (pending.length) {
+        const offset = pending.shift()
+        const buffer = await file.slice(offset, offset + chunkSize).arrayBuffer()
+        const headers = { 'Content-Type': 'application/octet-stream', ...(await chunkChecksum(buffer)) }
+        for (let attempt = 1; ; attempt++) {
+          try {
+            await api.patch(`/pcap/uploads/${uploadId}`, buffer, { params: { offset }, headers, timeout: 0 })
+            break
+          } catch (error) {
+            if (attempt >= CHUNK_RETRIES) throw error
+            await sleep(1000 * attempt)
+          }
+        }
+        done += 1
+        onProgress(Math.round(done * 100 / chunks))
+      }
+    }
+    await Promise.all(Array.from({ length: CHUNK_CONCURRENCY }, worker))
+
+    const result = await api.post(`/pcap/uploads/${uploadId}/complete`, null, { timeout: 0 })
+    localStorage.removeItem(resumeKey)
+    return result
+  },
   
-  listPcaps() {
-    return api.get('/pcap/list')
+  // 分页列出文件 (params: page, page_size)
+  listPcaps(params = {}) {
+    return api.get('/pcap/list', { params })
   },
   
   getPcapInfo(fileId) {
@@ -49,6 +129,16 @@ export default {
   deletePcap(fileId) {
     return api.delete(`/pcap/${fileId}`)
   },
+
+  // 导出命中包的下载地址 (params: q, start, end, flow, 五元组 等)，由浏览器直接下载，不经 axios 缓冲
+  exportPcapUrl(fileId, params = {}) {
+    const query = new URLSearchParams()
+    for (const [key, value] of Object.entries(params)) {
+      if (value !== null && value !== undefined && value !== '') query.append(key, value)
+    }
+    const qs = query.toString()
+    return `/api/pcap/${fileId}/export${qs ? `?${qs}` : ''}`
+  },
   
   // --- 流量分析 (合并清理版) ---
   
@@ -68,6 +158,13 @@ export default {
   getAnalysisStatus(taskId) {
     return api.get(`/analysis/status/${taskId}`)
   },
+
+  /**
+   * 3. 订阅分析任务进度 (SSE 推送，替代轮询)
+   */
+  subscribeAnalysisEvents(taskId) {
+    return new EventSource(`/api/analysis/events/${taskId}`)
+  },
   
   // 3. 获取时间线 (单独获取数据的接口保留，以备不时之需)
   getTimeline(fileId) {
@@ -81,14 +178,28 @@ export default {
   getStatistics(fileId) {
     return api.get(`/analysis/${fileId}/statistics`)
   },
+
+  // 会话/告警明细分页查询 (params: 过滤条件、sort、order、limit、cursor)
+  queryFlows(fileId, params = {}) {
+    return api.get(`/analysis/${fileId}/flows`, { params })
+  },
+
+  queryAlerts(fileId, params = {}) {
+    return api.get(`/analysis/${fileId}/alerts`, { params })
+  },
   
   // --- 流量重放 ---
-  startReplay(fileId, targetIp = null, speedMultiplier = 1.0, useSandbox = true) {
+  // filter: 重放子集条件 { expression, flow, flow_id, alert_id, start_time, end_time, packet_ranges }
+  // measureFidelity: 重放期间抓包并生成时间保真度报告
+  startReplay(fileId, targetIp = null, speedMultiplier = 1.0, useSandbox = true, targetMac = null, filter = null, measureFidelity = false) {
     return api.post('/replay/start', {
       file_id: fileId,
       target_ip: targetIp,
+      target_mac: targetMac,
       speed_multiplier: speedMultiplier,
-      use_sandbox: useSandbox
+      use_sandbox: useSandbox,
+      filter,
+      measure_fidelity: measureFidelity
     })
   },
   
@@ -100,8 +211,19 @@ export default {
     return api.post('/replay/stop', { task_id: taskId })
   },
   
-  listReplayTasks() {
-    return api.get('/replay/tasks')
+  // 时间保真度完整报告 (丢包、乱序、包间隔分布与抖动分位数)
+  getReplayFidelity(taskId) {
+    return api.get(`/replay/${taskId}/fidelity`)
+  },
+
+  // 分页列出重放任务摘要 (params: offset, limit)
+  listReplayTasks(params = {}) {
+    return api.get('/replay/tasks', { params })
+  },
+
+  // 订阅重放任务状态与日志 (SSE)，不传 taskId 时订阅全部任务
+  subscribeReplayEvents(taskId = null) {
+    return new EventSource(taskId ? `/api/replay/events/${taskId}` : '/api/replay/events')
   },
   
   deleteReplayTask(taskId) {
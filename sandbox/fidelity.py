@@ -0,0 +1,431 @@
+"""
+重放时间保真度测量 (仅依赖标准库，在沙箱内运行)
+把重放期间在沙箱网卡上抓到的报文与下发的源 PCAP 逐包对齐，统计:
+  丢包      源报文未出现在抓包中
+  乱序      到达时序号小于此前已到达的最大序号 (RFC 4737)
+  包间隔    源中相邻两包 (均已对齐) 的原始间隔 / 倍速 与 实际间隔 的差值分布 (抖动分位数)
+
+对齐键为报文"不变部分"的哈希: 从三层开始，清零 TTL/Hop Limit、IPv4 头校验和与 TCP/UDP 校验和，
+并按 IP 总长度截掉以太网填充，因此不受二层改写、校验和卸载和转发跳数的影响。
+对齐以流式滑动窗口进行，内存与抓包大小无关；超出窗口 (REORDER_WINDOW 个包) 仍未出现的源报文计为丢失。
+"""
+import math
+import time
+import struct
+import hashlib
+from collections import deque
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+REORDER_WINDOW = 100000
+PROGRESS_EVERY = 200000
+DUPLICATE_CANDIDATES = 16
+
+# 报告中包间隔直方图的分桶边界 (微秒)
+GAP_BUCKETS_US = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+# 直接以 IP 头开始的链路类型 (12/14 为部分平台上 DLT_RAW 的取值；NULL 为 4 字节协议族头)
+RAW_LINKTYPES = (LINKTYPE_NULL, LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6, 12, 14)
+
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_EPB = 0x00000006
+
+# (时间戳单位换算为纳秒的倍数, 字节序)
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": (1000, "<"),
+    b"\xa1\xb2\xc3\xd4": (1000, ">"),
+    b"\x4d\x3c\xb2\xa1": (1, "<"),
+    b"\xa1\xb2\x3c\x4d": (1, ">"),
+}
+
+
+# ---------- 读取 ----------
+
+
+def iter_packets(path: str) -> Iterator[Tuple[int, int, bytes]]:
+    """逐包产出 (时间戳纳秒, 链路类型, 报文数据)，支持经典 pcap (微秒/纳秒) 与 pcapng"""
+    with open(path, "rb", buffering=1024 * 1024) as f:
+        magic = f.read(4)
+        if magic in PCAP_MAGICS:
+            yield from _iter_pcap(f, magic)
+        elif magic == struct.pack("<I", PCAPNG_SHB):
+            f.seek(0)
+            yield from _iter_pcapng(f)
+        else:
+            raise ValueError(f"Unsupported capture format: {path}")
+
+
+def _iter_pcap(f, magic: bytes):
+    scale, endian = PCAP_MAGICS[magic]
+    header = f.read(20)
+    linktype = struct.unpack(endian + "I", header[16:20])[0] & 0x0FFFFFFF
+    record = struct.Struct(endian + "IIII")
+    while True:
+        head = f.read(16)
+        if len(head) < 16:
+            return
+        sec, frac, caplen, _ = record.unpack(head)
+        data = f.read(caplen)
+        if len(data) < caplen:
+            return  # 抓包被截断 (例如进程被强制结束)
+        yield sec * 1_000_000_000 + frac * scale, linktype, data
+
+
+def _tsresol_to_ns(value: int) -> Callable[[int], int]:
+    if value & 0x80:
+        shift = value & 0x7F
+        return lambda units: (units * 1_000_000_000) >> shift
+    digits = value
+    if digits <= 9:
+        factor = 10 ** (9 - digits)
+        return lambda units: units * factor
+    divisor = 10 ** (digits - 9)
+    return lambda units: units // divisor
+
+
+def _iter_pcapng(f):
+    endian = "<"
+    interfaces = []  # [(链路类型, 时间戳换算函数)]
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        block_type = struct.unpack("<I", head[:4])[0]
+        if block_type == PCAPNG_SHB:
+            bom = f.read(4)
+            endian = "<" if bom == b"\x4d\x3c\x2b\x1a" else ">"
+            length = struct.unpack(endian + "I", head[4:8])[0]
+            f.seek(length - 12, 1)
+            interfaces = []  # 新的 section 重新编号接口
+            continue
+        if endian == ">":
+            block_type = struct.unpack(">I", head[:4])[0]
+        length = struct.unpack(endian + "I", head[4:8])[0]
+        if length < 12:
+            raise ValueError("Corrupt pcapng block")
+        body = f.read(length - 8)
+        if len(body) < length - 8:
+            return
+        body = body[:-4]  # 去掉尾部重复的块长度
+
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack(endian + "H", body[:2])[0]
+            to_ns = _tsresol_to_ns(6)
+            pos = 8
+            while pos + 4 <= len(body):
+                code, size = struct.unpack(endian + "HH", body[pos:pos + 4])
+                if code == 0:
+                    break
+                if code == 9 and size >= 1:  # if_tsresol
+                    to_ns = _tsresol_to_ns(body[pos + 4])
+                pos += 4 + (size + 3) // 4 * 4
+            interfaces.append((linktype, to_ns))
+        elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+            if block_type == PCAPNG_EPB:
+                iface, high, low, caplen = struct.unpack(endian + "IIII", body[:16])
+            else:
+                iface, _, high, low, caplen = struct.unpack(endian + "HHIII", body[:16])
+            if iface >= len(interfaces):
+                raise ValueError("pcapng packet references an unknown interface")
+            linktype, to_ns = interfaces[iface]
+            yield to_ns((high << 32) | low), linktype, body[20:20 + caplen]
+
+
+# ---------- 对齐键 ----------
+
+
+def _l3_offset(linktype: int, data: bytes) -> Tuple[Optional[int], int]:
+    """返回 (三层起始偏移, 以太类型)；无法识别时偏移为 None"""
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None, 0
+        offset, ethertype = 14, struct.unpack_from("!H", data, 12)[0]
+        while ethertype in (0x8100, 0x88A8) and len(data) >= offset + 4:
+            ethertype = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+        return offset, ethertype
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None, 0
+        return 16, struct.unpack_from("!H", data, 14)[0]
+    offset = 4 if linktype == LINKTYPE_NULL else 0
+    if linktype in RAW_LINKTYPES and len(data) > offset:
+        return offset, 0x86DD if data[offset] >> 4 == 6 else 0x0800
+    return None, 0
+
+
+def packet_key(linktype: int, data: bytes) -> bytes:
+    """报文不变部分的 8 字节摘要"""
+    offset, ethertype = _l3_offset(linktype, data)
+    if offset is None:
+        return hashlib.blake2b(data, digest_size=8).digest()
+
+    if ethertype == 0x0800 and len(data) >= offset + 20:
+        ihl = (data[offset] & 0x0F) * 4
+        total = struct.unpack_from("!H", data, offset + 2)[0]
+        buf = bytearray(data[offset:offset + max(total, ihl)])
+        buf[8] = 0  # TTL
+        buf[10:12] = b"\x00\x00"  # 头校验和
+        proto = buf[9]
+        fragment_offset = struct.unpack_from("!H", buf, 6)[0] & 0x1FFF
+        if fragment_offset == 0:
+            _zero_l4_checksum(buf, ihl, proto)
+    elif ethertype == 0x86DD and len(data) >= offset + 40:
+        payload = struct.unpack_from("!H", data, offset + 4)[0]
+        buf = bytearray(data[offset:offset + 40 + payload])
+        buf[7] = 0  # Hop Limit
+        _zero_l4_checksum(buf, 40, buf[6])
+    else:
+        buf = data[offset:]
+    return hashlib.blake2b(bytes(buf), digest_size=8).digest()
+
+
+def _zero_l4_checksum(buf: bytearray, l4: int, proto: int):
+    if proto == 6 and len(buf) >= l4 + 18:
+        buf[l4 + 16:l4 + 18] = b"\x00\x00"
+    elif proto == 17 and len(buf) >= l4 + 8:
+        buf[l4 + 6:l4 + 8] = b"\x00\x00"
+
+
+# ---------- 统计 ----------
+
+
+class LogHistogram:
+    """
+    对数分桶直方图 (每十倍 100 个桶，相对误差约 2.3%)
+    以固定内存流式统计任意多个非负值的分位数，另记录精确的计数、均值与最大值。
+    """
+
+    PER_DECADE = 100
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero += 1
+            return
+        bucket = math.floor(math.log10(value) * self.PER_DECADE)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = self.zero
+        if seen >= rank:
+            return 0.0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # 取桶的几何中点，并以精确最大值为上限
+                return min(10 ** ((bucket + 0.5) / self.PER_DECADE), self.max)
+        return self.max
+
+    def summary(self, scale: float = 1.0) -> Dict[str, float]:
+        """分位数摘要；scale 用于单位换算 (例如纳秒 -> 微秒传 1e-3)"""
+        return {
+            "mean": round(self.total / self.count * scale, 3) if self.count else 0.0,
+            "p50": round(self.percentile(50) * scale, 3),
+            "p90": round(self.percentile(90) * scale, 3),
+            "p99": round(self.percentile(99) * scale, 3),
+            "p999": round(self.percentile(99.9) * scale, 3),
+            "max": round(self.max * scale, 3),
+        }
+
+    def coarse(self, edges_ns) -> list:
+        """按给定边界 (纳秒) 汇总为粗粒度分布: [<e0, e0-e1, ..., >=en]"""
+        counts = [0] * (len(edges_ns) + 1)
+        counts[0] += self.zero
+        for bucket, n in self.buckets.items():
+            value = 10 ** ((bucket + 0.5) / self.PER_DECADE)
+            i = 0
+            while i < len(edges_ns) and value >= edges_ns[i]:
+                i += 1
+            counts[i] += n
+        return counts
+
+
+def _take(entries: deque, distance: Callable[[Tuple[int, int]], float]) -> Tuple[int, int]:
+    """
+    从同键的待对齐源报文 (序号, 源时间戳) 中取出一个: 内容完全相同的报文 (如重传、心跳) 中某个丢失时，
+    按顺序取会使之后的同键报文全部错位，因此在前 DUPLICATE_CANDIDATES 个中取 distance 最小的。
+    """
+    if len(entries) == 1:
+        return entries.popleft()
+    best, best_delta = 0, None
+    for i in range(min(len(entries), DUPLICATE_CANDIDATES)):
+        delta = distance(entries[i])
+        if best_delta is None or delta < best_delta:
+            best, best_delta = i, delta
+    entry = entries[best]
+    del entries[best]
+    return entry
+
+
+def measure(
+    source_path: str,
+    capture_path: str,
+    speed: float,
+    window: int = REORDER_WINDOW,
+    progress: Optional[Callable[[int], None]] = None,
+) -> Dict[str, Any]:
+    """
+    对齐源 PCAP 与重放抓包并生成保真度报告。
+    speed 为重放倍速；>= 999 (极限速度) 时没有期望间隔，只报告丢包、乱序与实际间隔分布。
+    progress(已处理抓包数) 每 PROGRESS_EVERY 个包回调一次，供调用方保持连接活跃。
+    """
+    started = time.perf_counter()
+    timed = speed < 999
+
+    source = (
+        (idx, ts, packet_key(linktype, data))
+        for idx, (ts, linktype, data) in enumerate(iter_packets(source_path))
+    )
+    source_next = next(source, None)
+    source_count = 0
+
+    pending: Dict[bytes, deque] = {}  # 键 -> 窗口内尚未对齐的 (序号, 源时间戳)
+    order: deque = deque()  # 窗口内读入的 (序号, 键)，用于淘汰
+    recent: Dict[int, Tuple[int, int]] = {}  # 窗口内已对齐的 序号 -> (源时间戳, 抓包时间戳)
+
+    captured = matched = unmatched = lost = 0
+    reordered = max_reorder = 0
+    highest = -1
+    first_cap = last_cap = None
+    first_src = last_src = None
+
+    expected_gaps = LogHistogram()
+    actual_gaps = LogHistogram()
+    jitter = LogHistogram()
+    error_total = 0
+    # 最近一次对齐的序号与 (抓包时间 - 源时间/倍速)，用于在相同报文中挑选对应的那一个
+    last_idx, anchor = -1, 0.0
+
+    def add_pair(earlier, later):
+        nonlocal error_total
+        (src_a, cap_a), (src_b, cap_b) = earlier, later
+        actual = cap_b - cap_a
+        actual_gaps.add(abs(actual))
+        if timed:
+            expected = (src_b - src_a) / speed
+            expected_gaps.add(expected)
+            error = actual - expected
+            error_total += error
+            jitter.add(abs(error))
+
+    for cap_ts, linktype, data in iter_packets(capture_path):
+        captured += 1
+        if progress and captured % PROGRESS_EVERY == 0:
+            progress(captured)
+        key = packet_key(linktype, data)
+
+        # 在窗口范围内向前读取源报文，直到找到该键
+        while key not in pending and source_next is not None and source_next[0] <= highest + window:
+            idx, ts, k = source_next
+            pending.setdefault(k, deque()).append((idx, ts))
+            order.append((idx, k))
+            source_count += 1
+            source_next = next(source, None)
+
+        entries = pending.get(key)
+        if not entries:
+            unmatched += 1  # 非重放流量 (如 ARP 应答) 或重复报文
+            continue
+        if timed:
+            # 期望发送时刻最接近的
+            idx, src_ts = _take(entries, lambda e: abs(cap_ts - anchor - e[1] / speed))
+            anchor = cap_ts - src_ts / speed
+        else:
+            # 极限速度下没有期望时刻，取序号紧随上一个对齐报文的
+            idx, src_ts = _take(entries, lambda e: abs(e[0] - last_idx - 1))
+        last_idx = idx
+        if not entries:
+            del pending[key]
+        matched += 1
+
+        if idx < highest:
+            reordered += 1
+            max_reorder = max(max_reorder, highest - idx)
+        else:
+            highest = idx
+        first_cap = cap_ts if first_cap is None else min(first_cap, cap_ts)
+        last_cap = cap_ts if last_cap is None else max(last_cap, cap_ts)
+        first_src = src_ts if first_src is None else min(first_src, src_ts)
+        last_src = src_ts if last_src is None else max(last_src, src_ts)
+
+        point = (src_ts, cap_ts)
+        recent[idx] = point
+        if idx - 1 in recent:
+            add_pair(recent[idx - 1], point)
+        if idx + 1 in recent:
+            add_pair(point, recent[idx + 1])
+
+        # 淘汰落后于窗口的源报文: 仍未对齐的计为丢失
+        while order and order[0][0] < highest - window:
+            old_idx, old_key = order.popleft()
+            recent.pop(old_idx, None)
+            queue = pending.get(old_key)
+            if queue and queue[0][0] == old_idx:
+                queue.popleft()
+                lost += 1
+                if not queue:
+                    del pending[old_key]
+
+    lost += sum(len(q) for q in pending.values())
+    while source_next is not None:
+        lost += 1
+        source_count += 1
+        source_next = next(source, None)
+
+    edges_ns = [e * 1000 for e in GAP_BUCKETS_US]
+    report: Dict[str, Any] = {
+        "speed": speed,
+        "source_packets": source_count,
+        "captured_packets": captured,
+        "matched_packets": matched,
+        "lost_packets": lost,
+        "loss_rate": round(lost / source_count, 6) if source_count else 0.0,
+        "unmatched_packets": unmatched,
+        "reordered_packets": reordered,
+        "reorder_rate": round(reordered / matched, 6) if matched else 0.0,
+        "max_reorder_distance": max_reorder,
+        "reorder_window": window,
+        "actual_duration": round((last_cap - first_cap) / 1e9, 6) if matched else 0.0,
+        "expected_duration": None,
+        "gap_pairs": actual_gaps.count,
+        "actual_gap_us": actual_gaps.summary(1e-3),
+        "expected_gap_us": None,
+        "jitter_us": None,
+        "timing_bias_us": None,
+        "gap_histogram": {
+            "edges_us": list(GAP_BUCKETS_US),
+            "actual": actual_gaps.coarse(edges_ns),
+            "expected": None,
+        },
+    }
+    if timed and matched:
+        report["expected_duration"] = round((last_src - first_src) / speed / 1e9, 6)
+    if timed and jitter.count:
+        report["expected_gap_us"] = expected_gaps.summary(1e-3)
+        report["jitter_us"] = jitter.summary(1e-3)
+        # 正值表示整体偏慢 (实际间隔大于期望间隔)
+        report["timing_bias_us"] = round(error_total / jitter.count / 1e3, 3)
+        report["gap_histogram"]["expected"] = expected_gaps.coarse(edges_ns)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
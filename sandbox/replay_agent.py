@@ -0,0 +1,470 @@
+"""
+沙箱重放代理 (常驻进程)
+后端通过 HTTP 下发重放任务，代理直接启动 tcpreplay 并以 NDJSON 流式返回进度，
+无需为每个任务生成脚本、上传归档和 docker exec。
+
+接口:
+  GET    /health                 健康检查
+  GET    /cache/<sha256>         PCAP 是否已缓存 (命中时刷新最近使用时间，并在租期内保护其不被淘汰)
+  PUT    /cache/<sha256>         上传 PCAP (校验哈希后原子落盘，按磁盘预算淘汰)
+
+缓存目录可由多个沙箱副本共享：淘汰与占用登记通过目录下的文件锁互斥，
+查询/上传与运行中的重放在 .pins 下登记占用 (带租期)，任何副本都不会淘汰仍被占用的 PCAP。
+  POST   /replays                启动重放，响应体为 NDJSON 事件流，直到重放结束
+                                 (measure_fidelity 为真时同时在网卡上抓包，结束后上报时间保真度报告)
+  GET    /replays                运行中的任务
+  DELETE /replays/<task_id>      停止指定任务
+"""
+import os
+import re
+import json
+import time
+import uuid
+import fcntl
+import signal
+import hashlib
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fidelity
+
+AGENT_PORT = int(os.getenv("REPLAY_AGENT_PORT", "7070"))
+CACHE_DIR = os.getenv("SANDBOX_PCAP_CACHE_DIR", "/var/cache/cyber-replay/pcaps")
+CACHE_BUDGET = int(os.getenv("SANDBOX_PCAP_CACHE_BUDGET", str(10 * 1024 ** 3)))
+CHUNK_SIZE = 1024 * 1024
+# 占用登记的租期 (秒)：覆盖调度方查询/上传到发起重放之间的间隔；运行中的重放定期续期
+PIN_LEASE_SECONDS = float(os.getenv("SANDBOX_PCAP_PIN_SECONDS", "300"))
+PIN_DIR = os.path.join(CACHE_DIR, ".pins")
+LOCK_PATH = os.path.join(CACHE_DIR, ".lock")
+# 保真度测量的临时抓包目录、内核抓包缓冲 (KiB)、等待抓包就绪与重放结束后的排空时间 (秒)
+CAPTURE_DIR = os.getenv("SANDBOX_CAPTURE_DIR", "/tmp/cyber-replay-captures")
+CAPTURE_BUFFER_KB = int(os.getenv("SANDBOX_CAPTURE_BUFFER_KB", "65536"))
+CAPTURE_START_TIMEOUT = 5.0
+CAPTURE_DRAIN_SECONDS = 0.5
+
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+ACTUAL_RE = re.compile(r"Actual:\s*(\d+)\s*packets\s*\((\d+)\s*bytes\)\s*sent in\s*([\d.]+)\s*seconds")
+RATED_RE = re.compile(r"Rated:\s*([\d.]+)\s*Bps,\s*([\d.]+)\s*Mbps,\s*([\d.]+)\s*pps")
+FAILED_RE = re.compile(r"Failed packets:\s*(\d+)")
+DROPPED_RE = re.compile(r"(\d+)\s*packets? dropped by kernel")
+
+_jobs = {}  # task_id -> subprocess.Popen (启动中为 None)
+_job_pins = {}  # task_id -> 占用登记文件
+_jobs_lock = threading.Lock()
+
+
+def _cache_path(file_hash):
+    return os.path.join(CACHE_DIR, f"{file_hash}.pcap")
+
+
+def _detect_iface():
+    # 查找网卡 (排除 lo 本地环回)
+    for name in sorted(os.listdir("/sys/class/net")):
+        if name != "lo":
+            return name
+    return "eth0"
+
+
+@contextmanager
+def _cache_locked(exclusive):
+    """
+    缓存目录锁 (flock，对共享同一目录的所有副本与线程生效)：
+    淘汰持排他锁；登记占用并确认文件存在持共享锁，两者不会交错
+    """
+    with open(LOCK_PATH, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _pin(file_hash, holder):
+    """登记 (或续期) 对 PCAP 的占用；须在 _cache_locked 内调用"""
+    os.makedirs(PIN_DIR, exist_ok=True)
+    path = os.path.join(PIN_DIR, f"{file_hash}.{holder}")
+    with open(path, "a"):
+        pass
+    os.utime(path)
+    return path
+
+
+def _unpin(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _pinned():
+    """租期内仍被占用的 PCAP 哈希；顺带清理过期登记 (调度方未发起重放、副本异常退出等)"""
+    pinned = set()
+    if not os.path.isdir(PIN_DIR):
+        return pinned
+    now = time.time()
+    for name in os.listdir(PIN_DIR):
+        path = os.path.join(PIN_DIR, name)
+        try:
+            if now - os.stat(path).st_mtime > PIN_LEASE_SECONDS:
+                os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue
+        pinned.add(name.split(".", 1)[0])
+    return pinned
+
+
+def _renew_pins():
+    """运行中的重放可能超过租期，定期为其续期"""
+    while True:
+        time.sleep(PIN_LEASE_SECONDS / 3)
+        with _jobs_lock:
+            paths = list(_job_pins.values())
+        for path in paths:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+
+def _evict(keep):
+    """缓存超出磁盘预算时按最近使用时间淘汰 (跳过任一副本仍占用的文件与刚上传的文件)；须持排他锁调用"""
+    in_use = {_cache_path(h) for h in _pinned()}
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.startswith(".") or name.endswith(".partial") or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(e[1] for e in entries)
+    evicted = []
+    for mtime, size, path in sorted(entries):
+        if total <= CACHE_BUDGET:
+            break
+        if path == keep or path in in_use:
+            continue
+        os.remove(path)
+        total -= size
+        evicted.append(os.path.basename(path))
+    return evicted
+
+
+class Capture:
+    """重放期间在发包网卡上抓取出方向报文 (排除代理自身的 HTTP 连接)，供保真度对齐"""
+
+    def __init__(self, task_id, iface):
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        self.path = os.path.join(CAPTURE_DIR, f"{task_id}.pcap")
+        self._stderr = []
+        self._ready = threading.Event()
+        self._process = subprocess.Popen(
+            [
+                "tcpdump", "-i", iface, "-Q", "out", "-n",
+                "-B", str(CAPTURE_BUFFER_KB),
+                "--time-stamp-precision=nano",
+                "-w", self.path,
+                "not", "tcp", "port", str(AGENT_PORT),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self._reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._reader.start()
+        # tcpdump 输出 "listening on ..." 后才开始抓包，之前发出的报文会被计为丢失
+        if not self._ready.wait(CAPTURE_START_TIMEOUT) or self._process.poll() is not None:
+            self.close()
+            raise RuntimeError(" ".join(self._stderr).strip() or "tcpdump did not start")
+
+    def _read_stderr(self):
+        for line in iter(self._process.stderr.readline, ""):
+            self._stderr.append(line.strip())
+            if "listening on" in line:
+                self._ready.set()
+
+    def stop(self):
+        """等待在途报文排空后结束抓包，返回内核丢弃的报文数"""
+        time.sleep(CAPTURE_DRAIN_SECONDS)
+        if self._process.poll() is None:
+            self._process.send_signal(signal.SIGINT)  # SIGINT 使 tcpdump 刷新文件并输出统计
+        try:
+            self._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._reader.join(timeout=1)
+        for line in self._stderr:
+            m = DROPPED_RE.search(line)
+            if m:
+                return int(m.group(1))
+        return 0
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass  # 访问日志由后端记录
+
+    # ---------- 响应工具 ----------
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_event(self, event):
+        # 分块传输，每个 chunk 是一行 JSON
+        data = (json.dumps(event) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    # ---------- 路由 ----------
+
+    def do_GET(self):
+        if self.path == "/health":
+            with _jobs_lock:
+                running = len(_jobs)
+            return self._send_json(200, {"status": "ok", "running": running})
+        if self.path == "/replays":
+            with _jobs_lock:
+                tasks = {task_id: p.pid for task_id, p in _jobs.items() if p is not None}
+            return self._send_json(200, {"replays": tasks})
+        if self.path.startswith("/cache/"):
+            file_hash = self.path[len("/cache/"):]
+            if not HASH_RE.match(file_hash):
+                return self._send_json(400, {"error": "invalid hash"})
+            path = _cache_path(file_hash)
+            with _cache_locked(exclusive=False):
+                try:
+                    os.utime(path)  # 刷新 mtime，供 LRU 淘汰
+                    size = os.path.getsize(path)
+                except FileNotFoundError:
+                    return self._send_json(404, {"error": "not cached"})
+                # 命中后调度方随即发起重放：租期内任何副本都不会淘汰该文件
+                _pin(file_hash, "lookup")
+            return self._send_json(200, {"size": size})
+        self._send_json(404, {"error": "not found"})
+
+    def do_PUT(self):
+        if not self.path.startswith("/cache/"):
+            return self._send_json(404, {"error": "not found"})
+        file_hash = self.path[len("/cache/"):]
+        if not HASH_RE.match(file_hash):
+            return self._send_json(400, {"error": "invalid hash"})
+
+        length = int(self.headers.get("Content-Length", "0"))
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # 目录由多个副本共享，临时文件名必须全局唯一
+        fd, partial = tempfile.mkstemp(prefix=f"{file_hash}.", suffix=".partial", dir=CACHE_DIR)
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError("upload interrupted")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if digest.hexdigest() != file_hash:
+                os.remove(partial)
+                return self._send_json(400, {"error": "hash mismatch"})
+            with _cache_locked(exclusive=False):
+                os.replace(partial, _cache_path(file_hash))
+                _pin(file_hash, "lookup")
+        except Exception as e:
+            if os.path.exists(partial):
+                os.remove(partial)
+            return self._send_json(500, {"error": str(e)})
+
+        with _cache_locked(exclusive=True):
+            evicted = _evict(keep=_cache_path(file_hash))
+        self._send_json(201, {"size": length, "evicted": evicted})
+
+    def do_DELETE(self):
+        if not self.path.startswith("/replays/"):
+            return self._send_json(404, {"error": "not found"})
+        task_id = self.path[len("/replays/"):]
+        with _jobs_lock:
+            if task_id not in _jobs:
+                return self._send_json(404, {"error": "no such replay"})
+            process = _jobs[task_id]
+        if process is None:
+            return self._send_json(409, {"error": "replay starting"})
+        process.send_signal(signal.SIGTERM)
+        self._send_json(200, {"task_id": task_id, "stopping": True})
+
+    def do_POST(self):
+        if self.path != "/replays":
+            return self._send_json(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length", "0"))
+        job = json.loads(self.rfile.read(length) or b"{}")
+        task_id = job.get("task_id")
+        file_hash = job.get("file_hash", "")
+        speed = float(job.get("speed", 1.0))
+        measure_fidelity = bool(job.get("measure_fidelity"))
+        if not task_id or not HASH_RE.match(file_hash):
+            return self._send_json(400, {"error": "task_id and file_hash are required"})
+        pcap_path = _cache_path(file_hash)
+
+        # 检查与占位在同一次持锁内完成，同一任务的并发请求只有一个能启动
+        with _jobs_lock:
+            if task_id in _jobs:
+                return self._send_json(409, {"error": "replay already running"})
+            _jobs[task_id] = None
+        try:
+            with _cache_locked(exclusive=False):
+                if not os.path.exists(pcap_path):
+                    return self._send_json(409, {"error": "pcap not cached"})
+                pin = _pin(file_hash, uuid.uuid4().hex)
+            with _jobs_lock:
+                _job_pins[task_id] = pin
+            self._run_replay(task_id, pcap_path, speed, measure_fidelity)
+        finally:
+            with _jobs_lock:
+                _jobs.pop(task_id, None)
+                pin = _job_pins.pop(task_id, None)
+            if pin:
+                _unpin(pin)
+
+    def _run_replay(self, task_id, pcap_path, speed, measure_fidelity):
+        # 组装 tcpreplay 命令 (stdbuf 关闭管道缓冲，保证每秒的统计行实时输出)
+        iface = _detect_iface()
+        cmd = ["stdbuf", "-oL", "tcpreplay", "-i", iface, "--stats=1"]
+        if speed >= 999:  # 约等于极限速度
+            cmd.append("--topspeed")
+        else:
+            cmd.extend(["-x", str(speed)])
+        cmd.append(pcap_path)
+
+        # 先启动抓包，保证第一个报文也能被记录
+        capture, capture_error = None, None
+        if measure_fidelity:
+            try:
+                capture = Capture(task_id, iface)
+            except Exception as e:
+                capture_error = str(e)
+
+        try:
+            process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+        except Exception as e:
+            if capture:
+                capture.close()
+            return self._send_json(500, {"error": str(e)})
+        with _jobs_lock:
+            _jobs[task_id] = process
+        os.utime(pcap_path)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        metrics = {"sent": 0, "bytes": 0, "elapsed": 0.0, "bps": 0.0, "mbps": 0.0, "pps": 0.0, "failed": 0}
+        try:
+            self._write_event({"type": "started", "pid": process.pid, "iface": iface, "ts": time.time()})
+            if capture_error:
+                self._write_event(
+                    {"type": "log", "msg": f"Fidelity capture unavailable: {capture_error}", "ts": time.time()}
+                )
+            for line in iter(process.stdout.readline, ""):
+                line = line.strip()
+                if not line:
+                    continue
+                m = ACTUAL_RE.search(line)
+                if m:
+                    metrics.update(sent=int(m.group(1)), bytes=int(m.group(2)), elapsed=float(m.group(3)))
+                    continue  # 与紧随其后的 Rated 行合并为一次上报
+                m = RATED_RE.search(line)
+                if m:
+                    metrics.update(bps=float(m.group(1)), mbps=float(m.group(2)), pps=float(m.group(3)))
+                    self._write_event({"type": "progress", "metrics": dict(metrics), "ts": time.time()})
+                    continue
+                m = FAILED_RE.search(line)
+                if m:
+                    metrics["failed"] = int(m.group(1))
+                self._write_event({"type": "log", "msg": line, "ts": time.time()})
+
+            process.wait()
+            if process.returncode < 0:
+                status = "stopped"  # 被信号终止：来自停止请求
+            elif process.returncode == 0:
+                status = "completed"
+            else:
+                status = "failed"
+            if capture:
+                self._report_fidelity(capture, status, pcap_path, speed)
+            self._write_event(
+                {
+                    "type": "finished",
+                    "status": status,
+                    "returncode": process.returncode,
+                    "metrics": dict(metrics),
+                    "ts": time.time(),
+                }
+            )
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 调用方已断开：没有人再跟踪该任务，直接结束发包
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        finally:
+            process.stdout.close()
+            process.wait()
+            if capture:
+                capture.close()
+
+    def _report_fidelity(self, capture, status, pcap_path, speed):
+        """结束抓包并与源 PCAP 对齐；只有完整重放的结果有意义，测量失败不影响重放状态"""
+        dropped = capture.stop()
+        if status != "completed":
+            self._write_event({"type": "log", "msg": f"Fidelity report skipped (replay {status})", "ts": time.time()})
+            return
+        self._write_event({"type": "log", "msg": "Measuring timing fidelity...", "ts": time.time()})
+        try:
+            report = fidelity.measure(
+                pcap_path,
+                capture.path,
+                speed,
+                # 对齐大文件期间没有其他输出，定期发送心跳避免调用方读取超时
+                progress=lambda n: self._write_event({"type": "heartbeat", "aligned": n, "ts": time.time()}),
+            )
+        except Exception as e:
+            self._write_event({"type": "log", "msg": f"Fidelity measurement failed: {e}", "ts": time.time()})
+            return
+        report["capture_dropped"] = dropped
+        self._write_event({"type": "fidelity", "report": report, "ts": time.time()})
+
+
+def main():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    threading.Thread(target=_renew_pins, name="pin-renewer", daemon=True).start()
+    server = ThreadingHTTPServer(("0.0.0.0", AGENT_PORT), AgentHandler)
+    server.daemon_threads = True
+    print(f"Replay agent listening on :{AGENT_PORT}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()